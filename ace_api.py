@@ -25,6 +25,7 @@ except ImportError:
     sys.exit(1)
 
 import argparse
+import concurrent.futures
 import copy
 import datetime
 import inspect
@@ -39,6 +40,8 @@ import shutil
 import socket
 import tarfile
 import tempfile
+import threading
+import time
 import traceback
 import urllib3
 import uuid
@@ -115,6 +118,291 @@ LOCAL_TIMEZONE = pytz.timezone(tzlocal.get_localzone().zone)
 # the datetime string format we use for this api
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
 
+# connection pooling
+# every remote host gets its own requests.Session so that repeated API calls to the same node reuse the
+# keep-alive connections instead of paying for a new TCP and TLS handshake each time
+
+# the number of connection pools (hosts) and connections per pool kept by each session
+default_pool_connections = 10
+default_pool_maxsize = 10
+# set to False to go back to a new connection for every API call
+default_use_sessions = True
+# the number of threads used to execute the *_async calls
+default_async_workers = 4
+
+_sessions = {} # key = remote_host, value = requests.Session
+_sessions_pid = None # the pid of the process that created the sessions
+_sessions_lock = threading.Lock()
+
+_executor = None # concurrent.futures.ThreadPoolExecutor used by the *_async calls
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+_statistics = {} # key = remote_host, value = dict of counters (see get_api_statistics)
+_statistics_lock = threading.Lock()
+
+def set_session_pool_size(pool_connections=None, pool_maxsize=None):
+    """Sets the size of the connection pools used by the sessions created for each remote host.
+    Sessions that already exist are closed so that the new sizes take effect.
+
+    :param int pool_connections: (optional) The number of connection pools to cache.
+    :param int pool_maxsize: (optional) The maximum number of connections to keep open to a single remote host.
+    """
+    global default_pool_connections
+    global default_pool_maxsize
+
+    if pool_connections is not None:
+        default_pool_connections = pool_connections
+    if pool_maxsize is not None:
+        default_pool_maxsize = pool_maxsize
+
+    close_sessions()
+
+def set_use_sessions(use_sessions):
+    """Enables or disables the use of persistent sessions for API calls.
+
+    :param bool use_sessions: If False then every API call opens a new connection.
+    """
+    global default_use_sessions
+    default_use_sessions = use_sessions
+
+def set_async_workers(async_workers):
+    """Sets the number of threads used to execute the *_async API calls.
+
+    :param int async_workers: The maximum number of API calls executing at the same time.
+    """
+    global default_async_workers
+    global _executor
+    default_async_workers = async_workers
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def close_sessions():
+    """Closes all the connections kept open to the remote hosts."""
+    global _sessions
+    with _sessions_lock:
+        sessions = _sessions
+        _sessions = {}
+
+    for remote_host, session in sessions.items():
+        try:
+            session.close()
+        except Exception as e:
+            log.warning("unable to close session for {}: {}".format(remote_host, e))
+
+def get_api_statistics():
+    """Returns the counters collected for the API calls made by this process.
+
+    :return: A dictionary keyed by remote host. Each value is a dictionary with the following keys:
+        requests (the number of API calls), errors (the number of API calls that failed), connections (the number of
+        new connections opened, each of which is a TCP and TLS handshake), total_time and max_time (the total and
+        longest number of seconds spent waiting on a response.)
+    :rtype: dict
+    """
+    with _statistics_lock:
+        return { remote_host: dict(counters) for remote_host, counters in _statistics.items() }
+
+def reset_api_statistics():
+    """Clears the counters returned by get_api_statistics."""
+    with _statistics_lock:
+        _statistics.clear()
+
+def _get_statistics(remote_host):
+    # NOTE must be called while holding _statistics_lock
+    if remote_host not in _statistics:
+        _statistics[remote_host] = {
+            'requests': 0,
+            'errors': 0,
+            'connections': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+        }
+
+    return _statistics[remote_host]
+
+def _record_connection(remote_host):
+    with _statistics_lock:
+        _get_statistics(remote_host)['connections'] += 1
+
+def _record_api_call(remote_host, elapsed, error=False):
+    with _statistics_lock:
+        counters = _get_statistics(remote_host)
+        counters['requests'] += 1
+        counters['total_time'] += elapsed
+        counters['max_time'] = max(counters['max_time'], elapsed)
+        if error:
+            counters['errors'] += 1
+
+class _InstrumentedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter that counts the new connections it opens to the remote host."""
+    def __init__(self, remote_host, *args, **kwargs):
+        # NOTE this needs to be set before the call to the parent constructor which calls init_poolmanager
+        self.remote_host = remote_host
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        remote_host = self.remote_host
+        pool_classes_by_scheme = {}
+        for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+            class _InstrumentedConnectionPool(pool_class):
+                def _new_conn(self):
+                    _record_connection(remote_host)
+                    return super()._new_conn()
+
+            pool_classes_by_scheme[scheme] = _InstrumentedConnectionPool
+
+        self.poolmanager.pool_classes_by_scheme = pool_classes_by_scheme
+
+def _get_session(remote_host):
+    """Returns the requests.Session used to talk to the given remote host."""
+    global _sessions
+    global _sessions_pid
+
+    with _sessions_lock:
+        # sessions (and their sockets) are not shared with child processes
+        if _sessions_pid != os.getpid():
+            _sessions = {}
+            _sessions_pid = os.getpid()
+
+        if remote_host not in _sessions:
+            _sessions[remote_host] = _create_session(remote_host)
+
+        return _sessions[remote_host]
+
+def _create_session(remote_host):
+    """Returns a new requests.Session that counts the connections it opens to the given remote host."""
+    session = requests.Session()
+    adapter = _InstrumentedHTTPAdapter(remote_host,
+                                       pool_connections=default_pool_connections,
+                                       pool_maxsize=default_pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def _get_executor():
+    """Returns the thread pool used to execute the *_async API calls."""
+    global _executor
+    global _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=default_async_workers)
+            _executor_pid = os.getpid()
+
+        return _executor
+
+class _MultipartStream(object):
+    """A multipart/form-data request body that reads the files it contains as the request is sent.
+    Files given as paths are not opened until they are reached and are closed as soon as they have been read,
+    so only one file is open at a time and nothing is loaded into memory up front."""
+
+    def __init__(self, fields=[], files=[]):
+        """
+        :param list fields: A list of (name, value) tuples of form fields.
+        :param list files: A list of (field_name, file_name, path_or_fp) tuples of files.
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+        # each part is either bytes or a tuple of (path_or_fp, size)
+        self.parts = []
+        for name, value in fields:
+            if isinstance(value, str):
+                value = value.encode('utf8')
+
+            self.parts.append(self._render_headers(name) + value + b'\r\n')
+
+        for field_name, file_name, source in files:
+            self.parts.append(self._render_headers(field_name, file_name))
+            if isinstance(source, str):
+                self.parts.append((source, os.path.getsize(source)))
+            elif isinstance(source, io.TextIOBase):
+                self.parts.append(source.read().encode('utf8'))
+            else:
+                try:
+                    position = source.tell()
+                    size = source.seek(0, os.SEEK_END) - position
+                    source.seek(position)
+                    self.parts.append((source, size))
+                except (AttributeError, OSError):
+                    # not seekable so we have to read it now
+                    self.parts.append(source.read())
+
+            self.parts.append(b'\r\n')
+
+        self.parts.append('--{}--\r\n'.format(self.boundary).encode())
+
+        # requests uses this as the Content-Length of the body
+        self.len = sum([len(part) if isinstance(part, bytes) else part[1] for part in self.parts])
+
+        self._index = 0 # the index of the part currently being read
+        self._offset = 0 # how much of the current part has been read
+        self._fp = None # the file currently being read
+        self._opened = False # set to True if we opened self._fp
+
+    def _render_headers(self, name, file_name=None):
+        field = urllib3.fields.RequestField(name=name, data=b'', filename=file_name)
+        field.make_multipart(content_type=None)
+        return '--{}\r\n'.format(self.boundary).encode() + field.render_headers().encode('utf8')
+
+    def _next_part(self):
+        if self._fp is not None and self._opened:
+            self._fp.close()
+
+        self._fp = None
+        self._opened = False
+        self._index += 1
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+
+        result = []
+        while size > 0 and self._index < len(self.parts):
+            part = self.parts[self._index]
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + size]
+                self._offset += len(chunk)
+                if self._offset >= len(part):
+                    self._next_part()
+            else:
+                source, part_size = part
+                if self._offset >= part_size:
+                    self._next_part()
+                    continue
+
+                if self._fp is None:
+                    if isinstance(source, str):
+                        self._fp = open(source, 'rb')
+                        self._opened = True
+                    else:
+                        self._fp = source
+
+                chunk = self._fp.read(min(size, part_size - self._offset))
+                if not chunk:
+                    raise IOError("file {} is shorter than expected ({} of {} bytes)".format(
+                                  source, self._offset, part_size))
+
+                self._offset += len(chunk)
+
+            result.append(chunk)
+            size -= len(chunk)
+
+        return b''.join(result)
+
+    def close(self):
+        if self._fp is not None and self._opened:
+            self._fp.close()
+
+        self._fp = None
+        self._opened = False
+
 def _execute_api_call(command, 
                       method=METHOD_GET, 
                       remote_host=None, 
@@ -124,7 +412,9 @@ def _execute_api_call(command,
                       files=None, 
                       params=None,
                       proxies=None,
-                      timeout=None):
+                      timeout=None,
+                      headers=None,
+                      use_session=None):
 
     if remote_host is None:
         remote_host = default_remote_host
@@ -132,12 +422,21 @@ def _execute_api_call(command,
     if ssl_verification is None:
         ssl_verification = default_ssl_verification
 
+    if use_session is None:
+        use_session = default_use_sessions
+
+    if use_session:
+        session = _get_session(remote_host)
+    else:
+        # the call gets a session (and connection) of it's own that is closed when the call completes
+        session = _create_session(remote_host)
+
     if method == METHOD_GET:
-        func = requests.get
+        func = session.get
     elif method == METHOD_PUT:
-        func = requests.put
+        func = session.put
     else:
-        func = requests.post
+        func = session.post
 
     kwargs = { 'stream': stream }
     if params is not None:
@@ -152,10 +451,20 @@ def _execute_api_call(command,
         kwargs['proxies'] = proxies
     if timeout is not None:
         kwargs['timeout'] = timeout
+    if headers is not None:
+        kwargs['headers'] = headers
 
-    r = func('https://{}/api/{}'.format(remote_host, command), **kwargs)
-    r.raise_for_status()
-    return r
+    start = time.time()
+    error = True
+    try:
+        r = func('https://{}/api/{}'.format(remote_host, command), **kwargs)
+        r.raise_for_status()
+        error = False
+        return r
+    finally:
+        _record_api_call(remote_host, time.time() - start, error=error)
+        if not use_session:
+            session.close()
 
 def get_supported_api_version(*args, **kwargs):
     """Get the API version for the ACE ecosystem you're working with.
@@ -249,6 +558,7 @@ def submit(
     :param list observables: (optional) A list of observables to add to the request.
     :param list tags: (optional) An optional list of tags to add the the analysis.
     :param list files: (optional) A list of (file_name, file_descriptor) tuples to be included in this ACE request.
+    The file descriptor can also be the path to the file, in which case the file is only opened while it is being sent.
     :return: A result dictionary. If submission was successful, the UUID of the analysis will be contained. Like this:
         {'result': {'uuid': '960b0a0f-3ea2-465f-852f-ebccac6ae282'}}
     :rtype: dict
@@ -294,7 +604,7 @@ def submit(
     #if isinstance(details, str):
         #details = json.loads(details)
 
-    # make sure each file is a tuple of (str, fp)
+    # make sure each file is a tuple of (str, fp or path)
     _error_message = "file parameter {} invalid: each element of the file parameter must be a tuple of " \
                      "(file_name, file_descriptor)"
 
@@ -304,11 +614,11 @@ def submit(
         assert len(f) == 2, _error_message.format(index)
         assert f[1], _error_message.format(index)
         assert isinstance(f[0], str), _error_message.format(index)
-        files_params.append(('file', (f[0], f[1])))
+        files_params.append(('file', f[0], f[1]))
 
     # OK everything seems legit
-    return _execute_api_call('analysis/submit', data={
-        'analysis': json.dumps({
+    body = _MultipartStream(fields=[
+        ('analysis', json.dumps({
             'analysis_mode': analysis_mode,
             'tool': tool,
             'tool_instance': tool_instance,
@@ -318,8 +628,21 @@ def submit(
             'details': details,
             'observables': observables,
             'tags': tags, 
-        }),
-    }, files=files_params, method=METHOD_POST, *args, **kwargs).json()
+        })),
+    ], files=files_params)
+
+    try:
+        return _execute_api_call('analysis/submit', data=body, headers={'Content-Type': body.content_type},
+                                 method=METHOD_POST, *args, **kwargs).json()
+    finally:
+        body.close()
+
+def submit_async(*args, **kwargs):
+    """Same as submit() except the call is made on a background thread.
+
+    :return: A concurrent.futures.Future for the result of submit().
+    """
+    return _get_executor().submit(submit, *args, **kwargs)
 
 def _cli_submit(args):
     
@@ -563,6 +886,13 @@ def download(uuid, target_dir, *args, **kwargs):
         except:
             sys.stderr.write("unable to delete temporary file {}: {}\n".format(tar_path, e))
 
+def download_async(*args, **kwargs):
+    """Same as download() except the call is made on a background thread.
+
+    :return: A concurrent.futures.Future that completes when the download has been extracted.
+    """
+    return _get_executor().submit(download, *args, **kwargs)
+
 def _cli_download(args):
     target_dir = args.output_dir
     if not target_dir:
@@ -596,23 +926,41 @@ def upload(uuid, source_dir, overwrite=False, sync=True, *args, **kwargs):
         tar.add(source_dir, '.')
         tar.close()
 
-        with open(tar_path, 'rb') as fp:
-            return _execute_api_call('engine/upload/{}'.format(uuid), data={
-                'upload_modifiers': json.dumps({
-                    'overwrite': overwrite,
-                    'sync': sync,
-                })},
-                method=METHOD_POST,
-                files=[('archive', (os.path.basename(tar_path), fp))]).json()
+        body = _MultipartStream(fields=[
+            ('upload_modifiers', json.dumps({
+                'overwrite': overwrite,
+                'sync': sync,
+            }))], files=[('archive', os.path.basename(tar_path), tar_path)])
+
+        try:
+            return _execute_api_call('engine/upload/{}'.format(uuid), data=body,
+                                     headers={'Content-Type': body.content_type},
+                                     method=METHOD_POST, *args, **kwargs).json()
+        finally:
+            body.close()
     finally:
         try:
             os.remove(tar_path)
         except Exception as e:
             log.warning("unable to remove {}: {}".foramt(tar_path, e))
 
+def upload_async(*args, **kwargs):
+    """Same as upload() except the call is made on a background thread.
+
+    :return: A concurrent.futures.Future for the result of upload().
+    """
+    return _get_executor().submit(upload, *args, **kwargs)
+
 def clear(uuid, lock_uuid, *args, **kwargs):
     return _execute_api_call('engine/clear/{}/{}'.format(uuid, lock_uuid), *args, **kwargs).status_code == 200
 
+def clear_async(*args, **kwargs):
+    """Same as clear() except the call is made on a background thread.
+
+    :return: A concurrent.futures.Future for the result of clear().
+    """
+    return _get_executor().submit(clear, *args, **kwargs)
+
 def cloudphish_submit(url, reprocess=False, ignore_filters=False, context={}, *args, **kwargs):
     """Submit a URL for Cloudphish to analyze.
 
@@ -636,6 +984,13 @@ def cloudphish_submit(url, reprocess=False, ignore_filters=False, context={}, *a
 
     return _execute_api_call('cloudphish/submit', data=data, method=METHOD_POST, *args, **kwargs).json()
 
+def cloudphish_submit_async(*args, **kwargs):
+    """Same as cloudphish_submit() except the call is made on a background thread.
+
+    :return: A concurrent.futures.Future for the result of cloudphish_submit().
+    """
+    return _get_executor().submit(cloudphish_submit, *args, **kwargs)
+
 def _cli_cloudphish_submit(args):
     if args.context:
         if args.context.startswith('@'):
@@ -976,7 +1331,8 @@ class Analysis(object):
                 logging.error("'{}' does not exist.".format(file_name_or_path))
                 return self
 
-            data_or_fp = open(file_name_or_path, 'rb')
+            # the file is opened when the analysis is submitted
+            data_or_fp = file_name_or_path
 
         self.submit_kwargs['files'].append((file_name, data_or_fp))
         self.add_observable('file', file_name, *args, **kwargs)
@@ -1180,6 +1536,11 @@ class Analysis(object):
                     if not os.path.isdir(destination_dir):
                         os.makedirs(destination_dir)
                 try:
+                    # files can be given as paths
+                    if isinstance(fp, str):
+                        shutil.copyfile(fp, destination_path)
+                        continue
+
                     # the call to submit caused the fp to get read. Restting with seek
                     fp.seek(0)
                     with open(destination_path, 'wb') as _f:
@@ -1204,6 +1565,10 @@ class Analysis(object):
         finally:
             # we make sure we close our file descriptors
             for file_name, fp in open_files:
+                # files given as paths are opened (and closed) as they are sent
+                if isinstance(fp, str):
+                    continue
+
                 try:
                     fp.close()
                 except Exception as e:
@@ -1280,10 +1645,9 @@ def submit_failed_alerts(remote_host=None, ssl_verification=None, fail_dir='.saq
 
             logging.info("submitting {}".format(alert))
 
-            # we need to open file handles for the Analysis class
-            # because they are saved as a tuple of (source_path, relative_storage_path) on fail
-
-            alert.submit_kwargs['files'] = [(f[1], open(f[0], 'rb')) for f in alert.submit_kwargs['files']]
+            # they are saved as a tuple of (source_path, relative_storage_path) on fail
+            # the files are passed as paths so that they are only opened one at a time as they are sent
+            alert.submit_kwargs['files'] = [(f[1], f[0]) for f in alert.submit_kwargs['files']]
             alert.submit(save_on_fail=False)
 
             if delete_on_success:
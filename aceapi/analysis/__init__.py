@@ -15,6 +15,7 @@ from .. import db, json_result, json_request
 import saq
 from saq import LOCAL_TIMEZONE
 from saq.analysis import RootAnalysis, _JSONEncoder
+from saq.analysis.timeline import load_timeline, summarize_timeline
 from saq.database import get_db_connection, ALERT
 from saq.error import report_exception
 from saq.constants import *
@@ -262,7 +263,8 @@ def get_status(uuid):
         'workload': None,
         'delayed_analysis': [],
         'locks': None,
-        'alert': None
+        'alert': None,
+        'timeline': None
     }
 
     with get_db_connection() as db:
@@ -369,6 +371,13 @@ WHERE
                 'lock_owner': row[3]
             }
 
+    # how much time has been spent analyzing it? (see saq.analysis.timeline)
+    try:
+        result['timeline'] = summarize_timeline(load_timeline(storage_dir))
+    except Exception as e:
+        logging.error("unable to load timeline for {}: {}".format(uuid, e))
+        report_exception()
+
     return json_result({'result': result})
 
 @analysis_bp.route('/details/<uuid>/<name>', methods=['GET'])
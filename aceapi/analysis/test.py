@@ -129,6 +129,9 @@ class APIAnalysisTestCase(APIBasicTestCase):
         self.assertEquals(result['workload']['node_id'], saq.SAQ_NODE_ID)
         self.assertEquals(result['workload']['analysis_mode'], 'analysis')
         self.assertTrue(isinstance(parse_event_time(result['workload']['insert_date']), datetime.datetime))
+        # nothing has analyzed it yet
+        self.assertEquals(result['timeline']['invocations'], 0)
+        self.assertEquals(result['timeline']['modules'], [])
 
     def test_api_analysis_submit_invalid(self):
         result = self.client.post(url_for('analysis.submit'), data={}, content_type='multipart/form-data')
@@ -13,6 +13,7 @@ import tempfile
 import threading
 
 import saq
+import saq.analysis.cold
 from .. import json_result, json_request
 from saq.analysis import RootAnalysis
 from saq.database import use_db
@@ -47,7 +48,8 @@ def download(uuid):
 
     try:
         tar = tarfile.open(fileobj=os.fdopen(fp, 'wb'), mode='w|')
-        tar.add(target_dir, '.')
+        # alerts in cold storage are sent as loose files
+        saq.analysis.cold.add_to_tar(target_dir, tar)
         tar.close()
 
         os.lseek(fp, 0, os.SEEK_SET)
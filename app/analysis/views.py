@@ -10,7 +10,6 @@ import math
 import os
 import os.path
 import pymysql
-import pysip
 import random
 import re
 import shutil
@@ -32,20 +31,17 @@ from email.utils import COMMASPACE, formatdate
 from operator import attrgetter
 from subprocess import Popen, PIPE, DEVNULL
 from urllib.parse import urlparse
-from sandboxapi.falcon import FalconAPI
 
 import businesstime
-import pandas as pd
 import requests
-from pymongo import MongoClient
 
 import saq
 import saq.analysis
+import saq.analysis.cold
+import saq.analysis.timeline
 import saq.intel
 import saq.remediation
 import saq.remediation.email
-import virustotal
-import splunklib
 
 from saq import SAQ_HOME
 from saq.constants import *
@@ -77,7 +73,7 @@ import ace_api
 from app import db
 from app.analysis import *
 from flask import jsonify, render_template, redirect, request, url_for, flash, session, \
-                  make_response, g, send_from_directory, send_file
+                  make_response, g, send_from_directory, send_file, after_this_request
 from flask_login import login_user, logout_user, login_required, current_user
 
 from sqlalchemy import and_, or_, func, distinct
@@ -292,6 +288,23 @@ def redirect_to():
     flash("invalid target {}".format(target))
     return redirect(url_for('analysis.index'))
 
+def _get_file_observable_path(alert, file_observable):
+    """Returns the full path to the file of the given file observable.
+       If the alert has been moved into cold storage (see saq.analysis.cold) then a temporary copy of the file is
+       extracted which is deleted after the request."""
+    full_path = os.path.join(SAQ_HOME, alert.storage_dir, file_observable.value)
+    if os.path.exists(full_path) or not saq.analysis.cold.is_cold(alert.storage_dir):
+        return full_path
+
+    temp_dir = tempfile.mkdtemp(dir=saq.TEMP_DIR)
+
+    @after_this_request
+    def _remove_temp_dir(response):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return response
+
+    return saq.analysis.cold.extract_file(alert.storage_dir, file_observable.value, temp_dir) or full_path
+
 @analysis.route('/email_file', methods=["POST"])
 @login_required
 def email_file():
@@ -323,7 +336,7 @@ def email_file():
         return redirect("/analysis?direct=" + alert.uuid)
 
     # get the full path to the file to expose
-    full_path = os.path.join(SAQ_HOME, alert.storage_dir, file_observable.value)
+    full_path = _get_file_observable_path(alert, file_observable)
     if not os.path.exists(full_path):
         logging.error("file path {0} does not exist for alert {1} user {2}".format(full_path, alert, current_user))
         flash("internal error")
@@ -429,7 +442,7 @@ def download_file():
         return redirect(url_for('analysis.index'))
 
     # get the full path to the file to expose
-    full_path = os.path.join(SAQ_HOME, alert.storage_dir, file_observable.value)
+    full_path = _get_file_observable_path(alert, file_observable)
     if not os.path.exists(full_path):
         logging.error("file path {0} does not exist for alert {1} user {2}".format(full_path, alert, current_user))
         flash("internal error")
@@ -445,6 +458,7 @@ def download_file():
         secret = saq.CONFIG.get("vxstream", "secret")
         proxies = saq.PROXIES if saq.CONFIG.getboolean('vxstream', 'use_proxy') else {}
         logging.debug("Uploading file to falcon sandbox")
+        from sandboxapi.falcon import FalconAPI
         falcon = FalconAPI(apikey, url=baseuri, proxies=proxies, env=environmentid)
         job_id = None
         with open(full_path, 'rb') as fp:
@@ -461,6 +475,7 @@ def download_file():
 
     if request.method == "POST" and mode == "virustotal":
         apikey = saq.CONFIG.get("virus_total","api_key")
+        import virustotal
         vt = virustotal.VirusTotal(apikey)
         res = vt.send_file(full_path)
         if res:
@@ -2301,6 +2316,7 @@ def manage():
 
 # begin helper functions for metrics
 def businessHourCycleTimes(df):
+    import pandas as pd # only needed for metrics
     # return pd.Series(timedelta) of alert cycle times in business hours
     business_hours = (datetime.time(6), datetime.time(18))
     _bt = businesstime.BusinessTime(business_hours=business_hours)
@@ -2316,6 +2332,7 @@ def businessHourCycleTimes(df):
 
 
 def alert_stats_for_month(df, business_hours=False):
+    import pandas as pd # only needed for metrics
     # df = dataframe of all alerts during one month
     # output: dataframe of alert cycle_time & quantity stats by disposition
 
@@ -2354,6 +2371,7 @@ def alert_stats_for_month(df, business_hours=False):
 
 
 def statistic_by_dispo(df, stat, business_hours=False):
+    import pandas as pd # only needed for metrics
     # Input: 
     #    df - dataframe of alerts with these columns: 
     #        ['month', 'insert_date', 'disposition', 'disposition_time', 'owner_id', 'owner_time']
@@ -2483,6 +2501,7 @@ def SliceAlertsByTimeCategory(df):
 
 
 def Hours_of_Operation(df):
+    import pandas as pd # only needed for metrics
     # df = dataframe of alerts -> SliceAlertsByTimeCategory
     # output = df of alert-cycle-time averages and quantities,
     #          for each month (across all dispositions), and respective to the hours
@@ -2547,6 +2566,7 @@ def Hours_of_Operation(df):
 
 
 def monthly_alert_SLAs(alerts):
+    import pandas as pd # only needed for metrics
     # input - dataframe of alerts
     
     months = alerts.index.get_level_values('month').unique()
@@ -2578,6 +2598,7 @@ def monthly_alert_SLAs(alerts):
 
 
 def add_email_alert_counts_per_event(events):
+    import pandas as pd # only needed for metrics
 
     # given event id and company name ~ get alert count per company
     alrt_cnt_company = """SELECT 
@@ -2659,6 +2680,7 @@ def add_email_alert_counts_per_event(events):
 
 
 def generate_intel_tables(sip=True, crits=False):
+    import pandas as pd # only needed for metrics
     if sip and crits:
         logging.error("Can only use one intel source at a time.")
         return False, False
@@ -2666,11 +2688,13 @@ def generate_intel_tables(sip=True, crits=False):
         mongo_uri = saq.CONFIG.get("crits", "mongodb_uri")
         mongo_host = mongo_uri[mongo_uri.rfind('://')+3:mongo_uri.rfind(':')]
         mongo_port = int(mongo_uri[mongo_uri.rfind(':')+1:])
+        from pymongo import MongoClient
         client = MongoClient(mongo_host, mongo_port)
         crits = client.crits
     elif sip:
         sip_host = saq.CONFIG.get("sip", "remote_address")
         api_key = saq.CONFIG.get("sip", "api_key")
+        import pysip
         sip = pysip.Client(sip_host, api_key, verify=False) 
     else:
         logging.warn("No intel source specified.")
@@ -2772,8 +2796,10 @@ def get_created_OR_modified_indicators_during(daterange_start, daterange_end, cr
     :param bool modified: If True, return table of modified indicators
     :return: Pandas DataFrame table
     """
+    import pandas as pd # only needed for metrics
     sip_host = saq.CONFIG.get("sip", "remote_address")
     api_key = saq.CONFIG.get("sip", "api_key")
+    import pysip
     sc = pysip.Client(sip_host, api_key, verify=False) 
    
     if created is modified: # they should never be the same
@@ -2801,6 +2827,7 @@ def get_created_OR_modified_indicators_during(daterange_start, daterange_end, cr
 @analysis.route('/metrics', methods=['GET', 'POST'])
 @login_required
 def metrics():
+    import pandas as pd # only needed for metrics
 
     if not saq.CONFIG['gui'].getboolean('display_metrics'):
         # redirect to index
@@ -3715,6 +3742,14 @@ GROUP BY a.disposition""", (self.obj.type, self.obj.md5_hex))
 
     domain_summary_str = _create_histogram_string(domains)
 
+    # how much time did each analysis module spend on this alert?
+    timeline_summary = None
+    try:
+        timeline_summary = saq.analysis.timeline.summarize_timeline(
+                           saq.analysis.timeline.load_timeline(alert.storage_dir))
+    except Exception as e:
+        logging.error("unable to load timeline for {}: {}".format(alert, e))
+
     return render_template('analysis/index.html',
                            alert=alert,
                            alert_tags=alert_tags,
@@ -3736,6 +3771,7 @@ GROUP BY a.disposition""", (self.obj.type, self.obj.md5_hex))
                            domains=domains,
                            domain_list=domain_list,
                            domain_summary_str=domain_summary_str,
+                           timeline_summary=timeline_summary,
                            email_remediations=email_remediations,
                            remediation_history=remediation_history)
 
@@ -0,0 +1,207 @@
+# vim: sw=4:ts=4:et
+
+import hashlib
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import urllib.parse
+import uuid
+
+import saq
+from saq.database import get_db_connection
+from saq.test import *
+
+from flask import Flask
+
+LOCAL_PORT = 43125
+web_server = None
+
+# the list of resources requested in each request made to our fake VT API
+vt_requests = []
+
+class _FakeVirusTotalHandler(http.server.BaseHTTPRequestHandler):
+    """Answers VT API file report requests with a report for each of the requested resources."""
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        resources = query['resource'][0].split(',')
+        vt_requests.append(resources)
+
+        reports = [ { 'resource': resource, 'response_code': 1, 'positives': 0, 'total': 1, 'scans': {} }
+                    for resource in resources ]
+
+        # VT returns a list when more than one resource is requested
+        content = json.dumps(reports if len(reports) > 1 else reports[0]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("[fake vt] {}".format(format % args))
+
+def random_hash(hash_function):
+    """Returns a hash that has not been seen by the cache (or memcached) yet."""
+    return hash_function(str(uuid.uuid4()).encode()).hexdigest()
+
+class TestCase(ACEBasicTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        global web_server
+
+        class _customTCPServer(socketserver.TCPServer):
+            allow_reuse_address = True
+
+        web_server = _customTCPServer(('localhost', LOCAL_PORT), _FakeVirusTotalHandler)
+        web_server_thread = threading.Thread(target=web_server.serve_forever)
+        web_server_thread.daemon = True
+        web_server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        web_server.shutdown()
+        web_server.server_close()
+
+    def setUp(self):
+        ACEBasicTestCase.setUp(self)
+
+        import app.vt_hash_cache.views
+        from app.vt_hash_cache import vt_hash_cache_bp
+
+        # the rate limiter is created on first use from the configuration
+        app.vt_hash_cache.views._rate_limiter = None
+        del vt_requests[:]
+
+        saq.CONFIG['virus_total']['query_url'] = 'http://localhost:{}/vtapi/v2/file/report'.format(LOCAL_PORT)
+        saq.CONFIG['virus_total']['api_key'] = 'test'
+        saq.CONFIG['virus_total']['max_requests_per_minute'] = '0'
+        saq.CONFIG['virus_total']['max_resources_per_request'] = '2'
+
+        self.old_proxies = saq.PROXIES
+        saq.PROXIES = {}
+
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+            c.execute("DELETE FROM result_cache")
+            db.commit()
+
+        self.vt_hash_cache_app = Flask(__name__)
+        self.vt_hash_cache_app.register_blueprint(vt_hash_cache_bp)
+        self.vt_hash_cache_client = self.vt_hash_cache_app.test_client()
+
+    def tearDown(self):
+        ACEBasicTestCase.tearDown(self)
+        saq.PROXIES = self.old_proxies
+
+    def cache_result(self, md5_hash=None, sha1_hash=None, sha2_hash=None):
+        """Stores a result in the result_cache table and returns it (as a JSON string.)"""
+        vt_result = json.dumps({ 'response_code': 1, 'positives': 1, 'total': 1, 'cached': True })
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+            c.execute("""INSERT INTO result_cache ( result, md5, sha1, sha2 ) VALUES ( %s, %s, %s, %s )""",
+                      (vt_result, md5_hash, sha1_hash, sha2_hash))
+            db.commit()
+
+        return vt_result
+
+    def get_result_cache_count(self):
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+            c.execute("SELECT COUNT(*) FROM result_cache")
+            return c.fetchone()[0]
+
+    def batch_query(self, hashes):
+        return self.vt_hash_cache_client.post('/vthc/batch', data=json.dumps({ 'hashes': hashes }),
+                                              content_type='application/json')
+
+    def test_rate_limiter(self):
+        from app.vt_hash_cache.views import RateLimiter
+
+        rate_limiter = RateLimiter(2)
+        self.assertTrue(rate_limiter.acquire())
+        self.assertTrue(rate_limiter.acquire())
+        self.assertFalse(rate_limiter.acquire())
+
+        # requests older than 60 seconds no longer count against the limit
+        rate_limiter.request_times[0] -= 61
+        self.assertTrue(rate_limiter.acquire())
+        self.assertFalse(rate_limiter.acquire())
+
+        # a limit of 0 means no limit
+        rate_limiter = RateLimiter(0)
+        for _ in range(10):
+            self.assertTrue(rate_limiter.acquire())
+
+    def test_batch_query(self):
+        cached_md5 = random_hash(hashlib.md5)
+        cached_sha2 = random_hash(hashlib.sha256)
+        cached_md5_result = self.cache_result(md5_hash=cached_md5)
+        cached_sha2_result = self.cache_result(sha2_hash=cached_sha2)
+
+        uncached_md5 = random_hash(hashlib.md5)
+        uncached_sha1 = random_hash(hashlib.sha1)
+        uncached_sha2 = random_hash(hashlib.sha256)
+
+        # hashes are compared in lower case
+        result = self.batch_query([ cached_md5.upper(), cached_sha2, uncached_md5, uncached_sha1.upper(),
+                                    uncached_sha2 ])
+        self.assertEquals(result.status_code, 200)
+        result = json.loads(result.data.decode())
+        self.assertEquals(set(result.keys()), set([ cached_md5, cached_sha2, uncached_md5, uncached_sha1,
+                                                    uncached_sha2 ]))
+
+        # the cached hashes are not sent to VT
+        self.assertEquals(result[cached_md5], json.loads(cached_md5_result))
+        self.assertEquals(result[cached_sha2], json.loads(cached_sha2_result))
+
+        # the uncached hashes are sent to VT two at a time
+        self.assertEquals(len(vt_requests), 2)
+        self.assertEquals(sorted([ _ for resources in vt_requests for _ in resources ]),
+                          sorted([ uncached_md5, uncached_sha1, uncached_sha2 ]))
+        for _hash in [ uncached_md5, uncached_sha1, uncached_sha2 ]:
+            self.assertEquals(result[_hash]['resource'], _hash)
+
+        # and the results are cached
+        self.assertEquals(self.get_result_cache_count(), 5)
+
+        # so the same batch does not go to VT again
+        del vt_requests[:]
+        result = self.batch_query([ cached_md5, cached_sha2, uncached_md5, uncached_sha1, uncached_sha2 ])
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(len(json.loads(result.data.decode())), 5)
+        self.assertEquals(len(vt_requests), 0)
+        self.assertEquals(self.get_result_cache_count(), 5)
+
+    def test_batch_query_invalid_hash(self):
+        result = self.batch_query([ random_hash(hashlib.md5), 'invalid' ])
+        self.assertEquals(result.status_code, 500)
+        self.assertEquals(len(vt_requests), 0)
+
+    def test_batch_query_rate_limit(self):
+        saq.CONFIG['virus_total']['max_requests_per_minute'] = '1'
+
+        cached_md5 = random_hash(hashlib.md5)
+        self.cache_result(md5_hash=cached_md5)
+        uncached_hashes = [ random_hash(hashlib.md5) for _ in range(4) ]
+
+        # only the first VT request is allowed
+        result = self.batch_query([ cached_md5 ] + uncached_hashes)
+        self.assertEquals(result.status_code, 200)
+        result = json.loads(result.data.decode())
+        self.assertEquals(len(vt_requests), 1)
+        self.assertEquals(set(result.keys()), set([ cached_md5 ] + vt_requests[0]))
+        self.assertEquals(log_count('vt api request limit reached'), 1)
+
+        # the single hash query is rejected once the limit is reached
+        result = self.vt_hash_cache_client.get('/vthc/query', query_string={ 'h': random_hash(hashlib.md5) })
+        self.assertEquals(result.status_code, 500)
+        self.assertEquals(result.data.decode(), 'vt api request limit reached')
+        self.assertEquals(len(vt_requests), 1)
+
+        # cached results are still available
+        result = self.vt_hash_cache_client.get('/vthc/query', query_string={ 'h': cached_md5 })
+        self.assertEquals(result.status_code, 200)
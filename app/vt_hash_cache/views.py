@@ -3,6 +3,8 @@
 import json
 import logging
 import os.path
+import threading
+import time
 
 import memcache
 import requests
@@ -23,6 +25,100 @@ HASH_TYPE_SHA2 = 'SHA2'
 VT_KEY_MD5_HASH = 'md5'
 VT_KEY_SHA1_HASH = 'sha1'
 VT_KEY_SHA2_HASH = 'sha256'
+VT_KEY_RESOURCE = 'resource'
+
+# maps the hash type to the column in the result_cache table
+HASH_TYPE_COLUMNS = {
+    HASH_TYPE_MD5: 'md5',
+    HASH_TYPE_SHA1: 'sha1',
+    HASH_TYPE_SHA2: 'sha2',
+}
+
+class RateLimiter(object):
+    """Limits the number of requests made to the VT API in any 60 second window.
+       A limit of 0 means there is no limit. Note that this is tracked per process."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.request_times = []
+
+    def acquire(self):
+        """Returns True if a request can be made now, False if the limit has been reached."""
+        if not self.limit:
+            return True
+
+        with self.lock:
+            now = time.time()
+            self.request_times = [_ for _ in self.request_times if now - _ < 60]
+            if len(self.request_times) >= self.limit:
+                return False
+
+            self.request_times.append(now)
+            return True
+
+_rate_limiter = None
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(saq.CONFIG['virus_total'].getint('max_requests_per_minute', fallback=0))
+
+    return _rate_limiter
+
+def get_hash_type(_hash):
+    """Returns the type of the given hash (determined by the length) or None if it is not a valid hash."""
+    if len(_hash) == 32:
+        return HASH_TYPE_MD5
+    elif len(_hash) == 40:
+        return HASH_TYPE_SHA1
+    elif len(_hash) == 64:
+        return HASH_TYPE_SHA2
+
+    return None
+
+def get_memcache_client():
+    client_address = saq.CONFIG['memcached']['client_address']
+
+    # see if we are using a unix socket with a relative path
+    if client_address.startswith('unix:'):
+        address = client_address[len('unix:'):]
+        if not os.path.isabs(address):
+            client_address = 'unix:{}/{}'.format(saq.SAQ_HOME, address)
+
+    return memcache.Client([client_address], debug=0)
+
+def get_result_hashes(_hash, _hash_type, vt_json):
+    """Returns the tuple (md5, sha1, sha2) for the given hash and VT result."""
+    md5_hash = None
+    sha1_hash = None
+    sha2_hash = None
+
+    if _hash_type == HASH_TYPE_MD5:
+        md5_hash = _hash
+    elif VT_KEY_MD5_HASH in vt_json:
+        md5_hash = vt_json[VT_KEY_MD5_HASH].lower()
+
+    if _hash_type == HASH_TYPE_SHA1:
+        sha1_hash = _hash
+    elif VT_KEY_SHA1_HASH in vt_json:
+        sha1_hash = vt_json[VT_KEY_SHA1_HASH].lower()
+
+    if _hash_type == HASH_TYPE_SHA2:
+        sha2_hash = _hash
+    elif VT_KEY_SHA2_HASH in vt_json:
+        sha2_hash = vt_json[VT_KEY_SHA2_HASH].lower()
+
+    return md5_hash, sha1_hash, sha2_hash
+
+def get_memcache_mapping(result_id, vt_result, md5_hash, sha1_hash, sha2_hash):
+    """Returns the dict of memcache keys and values used to cache the given result."""
+    result = { str(result_id): vt_result }
+    for _hash in [ md5_hash, sha1_hash, sha2_hash ]:
+        if _hash:
+            result[_hash] = str(result_id)
+
+    return result
 
 @vt_hash_cache_bp.route('/vthc/query', methods=['GET'])
 def query():
@@ -38,33 +134,19 @@ def query():
     else:
         _hash = request.values['h'].lower()
 
-    _hash_type = None
     result_id = None
     vt_result = None
     md5_hash = None
     sha1_hash = None
     sha2_hash = None
-    
+
     # determine the type by the lenght of the hash
-    if len(_hash) == 32:
-        _hash_type = HASH_TYPE_MD5
-    elif len(_hash) == 40:
-        _hash_type = HASH_TYPE_SHA1
-    elif len(_hash) == 64:
-        _hash_type = HASH_TYPE_SHA2
-    else:
+    _hash_type = get_hash_type(_hash)
+    if _hash_type is None:
          return "invalid hash", 500
 
     # do we already have a cached query result for this?
-    client_address = saq.CONFIG['memcached']['client_address']
-
-    # see if we are using a unix socket with a relative path
-    if client_address.startswith('unix:'):
-        address = client_address[len('unix:'):]
-        if not os.path.isabs(address):
-            client_address = 'unix:{}/{}'.format(saq.SAQ_HOME, address)
-
-    client = memcache.Client([client_address], debug=0)
+    client = get_memcache_client()
     result_id = client.get(_hash)
 
     if result_id:
@@ -78,21 +160,19 @@ def query():
         with get_db_connection('vt_hash_cache') as db:
             c = db.cursor()
 
-            if _hash_type == HASH_TYPE_MD5:
-                column = 'md5'
-            elif _hash_type == HASH_TYPE_SHA1:
-                column = 'sha1'
-            elif _hash_type == HASH_TYPE_SHA2:
-                column = 'sha2'
+            column = HASH_TYPE_COLUMNS[_hash_type]
 
             # there could potentionally be multiple rows
             # get the latest result
-            c.execute("""SELECT result_id, insert_date, result, 
+            c.execute("""SELECT result_id, insert_date, result,
                                 md5, sha1, sha2 FROM result_cache WHERE {} = %s
                                 ORDER BY insert_date DESC LIMIT 1""".format(column), (_hash,))
             row = c.fetchone()
             if not row:
                 # if we don't have it in the database then we perform a query here
+                if not get_rate_limiter().acquire():
+                    return "vt api request limit reached", 500
+
                 try:
                     logging.info("vt api request for {}".format(_hash))
                     r = requests.get(saq.CONFIG['virus_total']['query_url'], params={
@@ -125,26 +205,9 @@ def query():
                         logging.warning("vt result has more than one entry for {}".format(_hash))
                     vt_json = vt_json[0]
 
-                md5_hash = None
-                sha1_hash = None
-                sha2_hash = None
-
-                if _hash_type == HASH_TYPE_MD5:
-                    md5_hash = _hash
-                elif VT_KEY_MD5_HASH in vt_json:
-                    md5_hash = vt_json[VT_KEY_MD5_HASH].lower()
+                md5_hash, sha1_hash, sha2_hash = get_result_hashes(_hash, _hash_type, vt_json)
 
-                if _hash_type == HASH_TYPE_SHA1:
-                    sha1_hash = _hash
-                elif VT_KEY_SHA1_HASH in vt_json:
-                    sha1_hash = vt_json[VT_KEY_SHA1_HASH].lower()
-
-                if _hash_type == HASH_TYPE_SHA2:
-                    sha2_hash = _hash
-                elif VT_KEY_SHA2_HASH in vt_json:
-                    sha2_hash = vt_json[VT_KEY_SHA2_HASH].lower()
-
-                c.execute("""INSERT INTO result_cache ( result, md5, sha1, sha2 ) 
+                c.execute("""INSERT INTO result_cache ( result, md5, sha1, sha2 )
                              VALUES ( %s, %s, %s, %s )""", ( vt_result, md5_hash, sha1_hash, sha2_hash))
                 result_id = c.lastrowid
                 if not result_id:
@@ -154,7 +217,7 @@ def query():
 
             else:
                 logging.info("vt db hit for {}".format(_hash))
-                
+
                 # database results are available
                 result_id, insert_date, vt_result, md5_hash, sha1_hash, sha2_hash = row
 
@@ -165,15 +228,167 @@ def query():
         return "VT Result unavailable", 500
 
     # now cache the result
-    if md5_hash:
-        client.set(md5_hash, str(result_id))
-    if sha1_hash:
-        client.set(sha1_hash, str(result_id))
-    if sha2_hash:
-        client.set(sha2_hash, str(result_id))
-
-    client.set(str(result_id), vt_result)
-        
+    client.set_multi(get_memcache_mapping(result_id, vt_result, md5_hash, sha1_hash, sha2_hash))
+
     response = make_response(vt_result)
     response.mime_type = 'application/json'
     return response, 200
+
+def query_virus_total(hashes):
+    """Queries the VT API for the given list of (lower case) hashes.
+       Returns a dict where the key is the hash and the value is the VT result (as a JSON string.)
+       Hashes that could not be queried are not included in the result."""
+    result = {}
+    max_resources = saq.CONFIG['virus_total'].getint('max_resources_per_request', fallback=4)
+
+    for index in range(0, len(hashes), max_resources):
+        resources = hashes[index:index + max_resources]
+
+        if not get_rate_limiter().acquire():
+            logging.warning("vt api request limit reached: skipping {} hashes".format(len(hashes) - index))
+            break
+
+        try:
+            logging.info("vt api request for {}".format(','.join(resources)))
+            r = requests.get(saq.CONFIG['virus_total']['query_url'], params={
+                'resource': ','.join(resources),
+                'apikey': saq.CONFIG['virus_total']['api_key']}, proxies=saq.PROXIES, timeout=5)
+        except Exception as e:
+            logging.error("unable to query VT: {}".format(e))
+            continue
+
+        if r.status_code != 200:
+            logging.error("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+            continue
+
+        try:
+            vt_json = json.loads(r.content.decode())
+        except Exception as e:
+            logging.error("unable to load json for {}: {}".format(','.join(resources), e))
+            continue
+
+        # VT returns a list when more than one resource is requested
+        if not isinstance(vt_json, list):
+            vt_json = [ vt_json ]
+
+        for position, entry in enumerate(vt_json):
+            if not isinstance(entry, dict):
+                continue
+
+            # the results are in the order requested but use the resource field if it's there
+            _hash = entry.get(VT_KEY_RESOURCE, None)
+            _hash = _hash.lower() if isinstance(_hash, str) else None
+            if _hash not in resources:
+                if position >= len(resources):
+                    continue
+
+                _hash = resources[position]
+
+            result[_hash] = json.dumps(entry)
+
+    return result
+
+@vt_hash_cache_bp.route('/vthc/batch', methods=['POST'])
+def batch_query():
+    """Looks up multiple hashes in a single request.
+       The hashes are passed as a JSON list in the hashes field of a JSON body or as multiple h form values.
+       Returns a JSON dict where the key is the hash and the value is the VT result.
+       Hashes that could not be resolved are not included in the result."""
+
+    #
+    # NOTE
+    # hashes are stored and compared in LOWER CASE
+    #
+
+    json_body = request.get_json(silent=True)
+    if json_body is not None and 'hashes' in json_body:
+        hashes = json_body['hashes']
+    else:
+        hashes = request.values.getlist('h')
+
+    hash_types = {} # key = hash, value = hash type
+    for _hash in hashes:
+        if not isinstance(_hash, str):
+            return "invalid hash", 500
+
+        _hash = _hash.lower()
+        _hash_type = get_hash_type(_hash)
+        if _hash_type is None:
+            return "invalid hash {}".format(_hash), 500
+
+        hash_types[_hash] = _hash_type
+
+    results = {} # key = hash, value = VT result as JSON string
+    memcache_mapping = {}
+
+    # see what is already cached
+    client = get_memcache_client()
+    result_ids = client.get_multi(list(hash_types.keys()))
+    if result_ids:
+        cached_results = client.get_multi(list(set([str(_) for _ in result_ids.values()])))
+        for _hash, result_id in result_ids.items():
+            if str(result_id) in cached_results:
+                results[_hash] = cached_results[str(result_id)]
+
+    if results:
+        logging.info("vt cache hit for {} of {} hashes".format(len(results), len(hash_types)))
+
+    missing = [ _ for _ in hash_types.keys() if _ not in results ]
+    if missing:
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+
+            # look them all up in a single query
+            clauses = []
+            params = []
+            for _hash_type, column in HASH_TYPE_COLUMNS.items():
+                column_hashes = [ _ for _ in missing if hash_types[_] == _hash_type ]
+                if column_hashes:
+                    clauses.append('{} IN ( {} )'.format(column, ','.join(['%s' for _ in column_hashes])))
+                    params.extend(column_hashes)
+
+            # there could potentionally be multiple rows for a hash so we use the latest result
+            c.execute("""SELECT result_id, insert_date, result,
+                                md5, sha1, sha2 FROM result_cache WHERE {}
+                                ORDER BY insert_date DESC""".format(' OR '.join(clauses)), tuple(params))
+
+            for result_id, insert_date, vt_result, md5_hash, sha1_hash, sha2_hash in c:
+                matched = False
+                for _hash in [ md5_hash, sha1_hash, sha2_hash ]:
+                    if _hash in hash_types and _hash not in results:
+                        results[_hash] = vt_result
+                        matched = True
+
+                if matched:
+                    memcache_mapping.update(get_memcache_mapping(result_id, vt_result,
+                                                                 md5_hash, sha1_hash, sha2_hash))
+
+            missing = [ _ for _ in missing if _ not in results ]
+            if missing:
+                # only the hashes we don't know about go to VT
+                for _hash, vt_result in query_virus_total(missing).items():
+                    md5_hash, sha1_hash, sha2_hash = get_result_hashes(_hash, hash_types[_hash],
+                                                                       json.loads(vt_result))
+
+                    c.execute("""INSERT INTO result_cache ( result, md5, sha1, sha2 )
+                                 VALUES ( %s, %s, %s, %s )""", ( vt_result, md5_hash, sha1_hash, sha2_hash))
+                    result_id = c.lastrowid
+                    if not result_id:
+                        logging.error("unable to get result_id after INSERT")
+                        continue
+
+                    results[_hash] = vt_result
+                    memcache_mapping.update(get_memcache_mapping(result_id, vt_result,
+                                                                 md5_hash, sha1_hash, sha2_hash))
+
+                db.commit()
+
+    # now cache the results
+    if memcache_mapping:
+        client.set_multi(memcache_mapping)
+
+    # the results are already JSON strings
+    response = make_response('{{{}}}'.format(','.join(['{}:{}'.format(json.dumps(_hash), vt_result)
+                                                       for _hash, vt_result in results.items()])))
+    response.mime_type = 'application/json'
+    return response, 200
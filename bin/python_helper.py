@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+#
+# a long-lived helper process that runs python scripts (olevba_wrapper.py, rtfobj.py, pdf-parser.py, etc...)
+# so that we do not pay for interpreter startup every time (see lib/saq/helper_pool.py)
+# NOTE this needs to run under both python2.7 and python3
+#
+# usage: python_helper.py unix_socket_path
+#
+# the helper connects to the given unix socket and sends its pid on the first line
+# then it runs one script per request (one JSON object per line)
+# client --> helper : {"script": path, "args": [ ... ], "cwd": path or null}
+# helper --> client : {"returncode": int, "stdout": base64, "stderr": base64}
+#
+# the modules a script imports and the logging configuration it sets up are removed after each script
+# so that nothing one script does carries over to the next one
+#
+
+import base64
+import io
+import json
+import logging
+import os
+import runpy
+import socket
+import sys
+import traceback
+
+class CapturedOutput(object):
+    """Captures what a script writes to sys.stdout or sys.stderr as bytes."""
+    encoding = 'utf-8'
+
+    def __init__(self):
+        # python3 scripts that write bytes use sys.stdout.buffer
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+
+        self.buffer.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+def save_logging():
+    """Returns the current logging configuration (see restore_logging.)"""
+    root = logging.getLogger()
+    return root.level, list(root.handlers), set(logging.Logger.manager.loggerDict.keys())
+
+def remove_handlers(logger, keep=()):
+    for handler in list(getattr(logger, 'handlers', [])):
+        if handler in keep:
+            continue
+
+        logger.removeHandler(handler)
+        try:
+            handler.close()
+        except Exception:
+            pass
+
+def restore_logging(saved):
+    """Removes the handlers and loggers added since save_logging was called."""
+    level, handlers, names = saved
+    root = logging.getLogger()
+    remove_handlers(root, keep=handlers)
+    root.setLevel(level)
+    logging.disable(logging.NOTSET)
+
+    for name in list(logging.Logger.manager.loggerDict.keys()):
+        if name not in names:
+            remove_handlers(logging.Logger.manager.loggerDict.pop(name))
+
+def run_job(job):
+    """Runs the script described by the given job. Returns a tuple of (returncode, stdout, stderr)."""
+    stdout = CapturedOutput()
+    stderr = CapturedOutput()
+    returncode = 0
+
+    saved_cwd = os.getcwd()
+    saved_path = list(sys.path)
+    saved_argv = list(sys.argv)
+    saved_modules = dict(sys.modules)
+    saved_logging = save_logging()
+
+    sys.stdout = stdout
+    sys.stderr = stderr
+    sys.argv = [ job['script'] ] + list(job['args'])
+    # scripts can import modules that sit next to them
+    sys.path.insert(0, os.path.dirname(os.path.abspath(job['script'])))
+
+    try:
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+
+        runpy.run_path(job['script'], run_name='__main__')
+
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            stderr.write('{}\n'.format(e.code))
+            returncode = 1
+
+    except BaseException:
+        stderr.write(traceback.format_exc())
+        returncode = 1
+
+    finally:
+        restore_logging(saved_logging)
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+
+        # the next script imports its modules fresh
+        for name in list(sys.modules.keys()):
+            if name not in saved_modules:
+                del sys.modules[name]
+
+        sys.modules.update(saved_modules)
+        os.chdir(saved_cwd)
+
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+def main():
+    # the protocol uses a unix socket so that nothing the scripts (or the processes they start) write can corrupt it
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sys.argv[1])
+    protocol_in = sock.makefile('rb')
+    protocol_out = sock.makefile('wb')
+
+    protocol_out.write('{}\n'.format(os.getpid()).encode('utf-8'))
+    protocol_out.flush()
+
+    while True:
+        line = protocol_in.readline()
+        if not line:
+            break
+
+        returncode, stdout, stderr = run_job(json.loads(line.decode('utf-8')))
+        response = json.dumps({
+            'returncode': returncode,
+            'stdout': base64.b64encode(stdout).decode('ascii'),
+            'stderr': base64.b64encode(stderr).decode('ascii'),
+        })
+
+        protocol_out.write(response.encode('utf-8') + b'\n')
+        protocol_out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,6 @@ from getpass import getpass
 import ace_api
 from saq.configuration import load_configuration
 from saq.constants import *
-from saq.messaging import initialize_message_system
-from saq.network_semaphore import initialize_fallback_semaphores
-from saq.sla import SLA
 from saq.util import create_directory
 
 import pytz
@@ -133,6 +130,7 @@ def initialize(saq_home=None,
                relative_dir=None):
 
     from saq.database import initialize_database, initialize_node, initialize_automation_user
+    from saq.sla import SLA
 
     global API_PREFIX
     global AUTOMATION_USER_ID
@@ -159,6 +157,7 @@ def initialize(saq_home=None,
     global LOG_DIRECTORY
     global LOG_LEVEL
     global MANAGED_NETWORKS
+    global MESSAGE_SYSTEM
     global MODULE_STATS_DIR
     global OTHER_PROXIES 
     global OTHER_SLA_SETTINGS
@@ -189,6 +188,8 @@ def initialize(saq_home=None,
     TOR_PROXY = None
     # list of iptools.IpRange objects defined in [network_configuration]
     MANAGED_NETWORKS = None
+    # the message system is loaded the first time a message is sent (see saq.messaging.send_message)
+    MESSAGE_SYSTEM = None
     # set this to True to force all anlaysis to result in an alert being generated
     FORCED_ALERTS = False
     # the private key password for encrypting/decrypting archive files
@@ -437,11 +438,15 @@ def initialize(saq_home=None,
     CA_CHAIN_PATH = os.path.join(SAQ_HOME, CONFIG['SSL']['ca_chain_path'])
     ace_api.set_default_ssl_ca_path(CA_CHAIN_PATH)
 
+    # connections made to other nodes are pooled per node
+    ace_api.set_session_pool_size(pool_connections=CONFIG['api'].getint('client_pool_connections', fallback=10),
+                                  pool_maxsize=CONFIG['api'].getint('client_pool_maxsize', fallback=10))
+
     # initialize the database connection
     initialize_database()
 
-    # initialize fallback semaphores
-    initialize_fallback_semaphores()
+    # NOTE the fallback semaphores and the message system are initialized when they are first used
+    # so that short lived commands don't have to load them
 
     # XXX get rid of this
     try:
@@ -526,7 +531,4 @@ def initialize(saq_home=None,
     # make sure we've got the automation user set up
     initialize_automation_user()
 
-    # initialize other systems
-    initialize_message_system()
-
     logging.debug("SAQ initialized")
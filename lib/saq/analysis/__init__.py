@@ -16,6 +16,7 @@ import os.path
 import re
 import shutil
 import sys
+import threading
 import time
 import uuid
 
@@ -23,6 +24,8 @@ import dateutil.parser
 import requests
 
 import saq
+import saq.analysis.cold
+import saq.analysis.pack
 from saq.constants import *
 from saq.error import report_exception
 from saq.util import *
@@ -598,11 +601,26 @@ class Analysis(TaggableObject, DetectableObject):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
         
         # save the details
+        # NOTE the details file may be a hard link to the details of another RootAnalysis (see RootAnalysis.merge)
+        # so we write to a temporary file and then replace the link
         logging.debug("SAVE: saving external details for {} to {}".format(self, self.external_details_path))
-        with open(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path), 'w') as fp:
-            json.dump(self._details, fp, cls=_JSONEncoder)
+        details_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path)
+        if saq.analysis.pack.is_enabled():
+            saq.analysis.pack.get_details_pack(self.storage_dir).write(self.external_details_path,
+                                                                       json.dumps(self._details, cls=_JSONEncoder))
             _track_writes()
 
+            # loose files take precedence over the pack
+            if os.path.lexists(details_path):
+                os.remove(details_path)
+        else:
+            temp_path = '{}.tmp'.format(details_path)
+            with open(temp_path, 'w') as fp:
+                json.dump(self._details, fp, cls=_JSONEncoder)
+                _track_writes()
+
+            os.replace(temp_path, details_path)
+
         #if overwrite_warning:
             #full_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir, '.ace', self.external_details_path)
             #logging.warning("new file size is {} bytes".format(os.path.getsize(full_path)))
@@ -625,6 +643,8 @@ class Analysis(TaggableObject, DetectableObject):
             if os.path.exists(full_path):
                 logging.debug("removing external details file {}".format(full_path))
                 os.remove(full_path)
+            elif saq.analysis.pack.get_details_pack(self.root.storage_dir).delete(self.external_details_path):
+                logging.debug("removed external details {} from pack".format(self.external_details_path))
             else:
                 logging.warning("external details path {} does not exist".format(full_path))
 
@@ -698,8 +718,35 @@ class Analysis(TaggableObject, DetectableObject):
         details_file_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path)
 
         if not os.path.exists(details_file_path):
-            logging.warning("missing file {0}".format(details_file_path))
-            return None
+            # are the details packed?
+            try:
+                data = saq.analysis.pack.get_details_pack(self.storage_dir).read(self.external_details_path)
+            except Exception as e:
+                logging.error("unable to read {} from details pack of {}: {}".format(
+                              self.external_details_path, self.storage_dir, e))
+                report_exception()
+                return None
+
+            if data is None:
+                # has the alert been moved into cold storage?
+                try:
+                    data = saq.analysis.cold.get_cold_storage(self.storage_dir).read(
+                           os.path.join('.ace', self.external_details_path))
+                except Exception as e:
+                    logging.error("unable to read {} from cold storage of {}: {}".format(
+                                  self.external_details_path, self.storage_dir, e))
+                    report_exception()
+                    return None
+
+            if data is None:
+                logging.warning("missing file {0}".format(details_file_path))
+                return None
+
+            self._details = json.loads(data)
+            _track_reads()
+            self.external_details_loaded = True
+            logging.debug("LOAD: loaded external details {}".format(self.external_details_path))
+            return self._details
 
         if os.path.getsize(details_file_path) > 1024 * 1024:
             logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, os.path.getsize(details_file_path)))
@@ -1204,6 +1251,120 @@ class Relationship(object):
         if Relationship.KEY_RELATIONSHIP_TARGET in value:
             self.target = value[Relationship.KEY_RELATIONSHIP_TARGET]
 
+# the maximum number of observables to look up in a single query in fetch_observable_tags
+TAG_FETCH_BATCH_SIZE = 500
+
+# short-lived process-wide cache of the tags mapped to observables in observable_tag_mapping
+# key = (tag_mapping_type, tag_mapping_md5_hex), value = tuple(time, list of tag names)
+# kept in least recently used order (see [observable_tags] cache_size)
+_TAG_CACHE = collections.OrderedDict()
+_TAG_CACHE_LOCK = threading.Lock()
+
+def _get_tag_cache_lifetime():
+    """Returns the number of seconds tag lookups are cached for (0 if the cache is disabled.)"""
+    return create_timedelta(saq.CONFIG['observable_tags'].get('cache_lifetime',
+                                                              fallback='00:00:00')).total_seconds()
+
+def _get_tag_cache_size():
+    """Returns the maximum number of tag lookups that are cached."""
+    return saq.CONFIG['observable_tags'].getint('cache_size', fallback=10000)
+
+def clear_tag_cache():
+    """Clears the cache of observable tag lookups."""
+    with _TAG_CACHE_LOCK:
+        _TAG_CACHE.clear()
+
+def fetch_observable_tags(observables):
+    """Fetches the user created tags for the given observables from the database and adds them to the observables.
+       All of the observables are looked up with a single query (per TAG_FETCH_BATCH_SIZE observables.)
+       Observables that have already been fetched are skipped."""
+
+    lifetime = _get_tag_cache_lifetime()
+    now = time.time()
+
+    targets = {} # key = (tag_mapping_type, tag_mapping_md5_hex), value = [ Observable ]
+    for observable in observables:
+        # don't want to do this more than once
+        if observable._tags_fetched:
+            continue
+
+        # bail if we don't have what we need
+        if observable.tag_mapping_type is None or observable.tag_mapping_md5_hex is None:
+            continue
+
+        key = (observable.tag_mapping_type, observable.tag_mapping_md5_hex.lower())
+        if key not in targets:
+            targets[key] = []
+
+        targets[key].append(observable)
+
+    if not targets:
+        return
+
+    results = {} # key = (tag_mapping_type, tag_mapping_md5_hex), value = [ tag names ]
+    if lifetime > 0:
+        with _TAG_CACHE_LOCK:
+            for key in targets.keys():
+                try:
+                    cache_time, tag_names = _TAG_CACHE[key]
+                except KeyError:
+                    continue
+
+                if now - cache_time < lifetime:
+                    results[key] = tag_names
+                    _TAG_CACHE.move_to_end(key)
+                else:
+                    del _TAG_CACHE[key]
+
+    missing = [key for key in targets.keys() if key not in results]
+
+    from saq.database import get_db_connection
+    try:
+        if missing:
+            fetched = {} # same as results
+            with get_db_connection() as db:
+                c = db.cursor()
+                for index in range(0, len(missing), TAG_FETCH_BATCH_SIZE):
+                    batch = missing[index:index + TAG_FETCH_BATCH_SIZE]
+                    parameters = []
+                    for o_type, md5_hex in batch:
+                        parameters.append(o_type)
+                        parameters.append(md5_hex)
+                        fetched[(o_type, md5_hex)] = []
+
+                    c.execute("""SELECT `observables`.`type`, HEX(`observables`.`md5`), `tags`.`name`
+                                 FROM observables
+                                 JOIN observable_tag_mapping ON observables.id = observable_tag_mapping.observable_id
+                                 JOIN tags ON observable_tag_mapping.tag_id = tags.id
+                                 WHERE ( `observables`.`type`, `observables`.`md5` ) IN ( {} )""".format(
+                              ','.join(['( %s, UNHEX(%s) )' for _ in batch])), tuple(parameters))
+
+                    for o_type, md5_hex, tag_name in c:
+                        fetched[(o_type, md5_hex.lower())].append(tag_name)
+
+            results.update(fetched)
+            if lifetime > 0:
+                cache_size = _get_tag_cache_size()
+                with _TAG_CACHE_LOCK:
+                    for key in missing:
+                        _TAG_CACHE[key] = (now, results[key])
+                        _TAG_CACHE.move_to_end(key)
+
+                    # drop the least recently used lookups
+                    while len(_TAG_CACHE) > cache_size:
+                        _TAG_CACHE.popitem(last=False)
+
+    except Exception as e:
+        # some times you won't be able to fetch the tags for an observable
+        logging.debug(f"unable to fetch tags for {len(missing)} observables: {e}")
+
+    for key, tag_names in results.items():
+        for observable in targets[key]:
+            for tag_name in tag_names:
+                observable.add_tag(tag_name)
+
+            observable._tags_fetched = True
+
 class Observable(TaggableObject, DetectableObject):
     """Represents a piece of information discovered in an analysis that can itself be analyzed."""
 
@@ -1661,34 +1822,7 @@ class Observable(TaggableObject, DetectableObject):
 
     def fetch_tags(self):
         """Fetches user created tags for this observable from the database and adds them to the observables."""
-
-        # don't want to do this more than once
-        if self._tags_fetched:
-            return
-
-        # bail if we don't have what we need
-        if self.tag_mapping_type is None or self.tag_mapping_md5_hex is None:
-            return
-
-        from saq.database import get_db_connection
-        try:
-            with get_db_connection() as db:
-                c = db.cursor()
-                c.execute("""SELECT `tags`.`name`
-                             FROM observables
-                             JOIN observable_tag_mapping ON observables.id = observable_tag_mapping.observable_id
-                             JOIN tags ON observable_tag_mapping.tag_id = tags.id
-                             WHERE `observables`.`type` = %s AND `observables`.`md5` = UNHEX(%s)""", 
-                         (self.tag_mapping_type, self.tag_mapping_md5_hex))
-
-                for row in c:
-                    self.add_tag(row[0])
-
-            self._tags_fetched = True
-
-        except Exception as e:
-            # some times you won't be able to fetch the tags for an observable
-            logging.debug(f"unable to fetch tags for {self}: {e}")
+        fetch_observable_tags([self])
 
     @property
     def analysis(self):
@@ -1979,6 +2113,15 @@ class Observable(TaggableObject, DetectableObject):
            By default does == comparison, can be overridden."""
         return self.value == other_value
 
+    def _normalize_value(self, value):
+        """Returns the value as it is compared by _compare_value. Override this along with _compare_value."""
+        return value
+
+    @property
+    def spec_key(self):
+        """Returns a hashable key that is the same for observables that are equal."""
+        return (self.type, self.time, self._normalize_value(self.value))
+
     def __eq__(self, other):
         if not isinstance(other, Observable):
             return False
@@ -2914,6 +3057,14 @@ class RootAnalysis(Analysis):
         # save our own details
         Analysis.save(self)
 
+        # replaced details accumulate in the pack
+        if saq.analysis.pack.is_enabled():
+            try:
+                saq.analysis.pack.get_details_pack(self.storage_dir).compact_if_needed()
+            except Exception as e:
+                logging.error("unable to compact details pack for {}: {}".format(self, e))
+                report_exception()
+
         # now the rest should encode as JSON with the custom JSON encoder
         try:
             # we use a temporary file to deal with very large JSON files taking a long time to encode
@@ -2939,8 +3090,13 @@ class RootAnalysis(Analysis):
             logging.warning("alert {} already loaded".format(self))
 
         try:
-            with open(self.json_path, 'r') as fp:
-                self.json = json.load(fp)
+            if not os.path.exists(self.json_path) and saq.analysis.cold.is_cold(self.storage_dir):
+                # the alert has been moved into cold storage
+                self.json = json.loads(saq.analysis.cold.get_cold_storage(self.storage_dir).read(
+                                       os.path.basename(self.json_path)).decode('utf8'))
+            else:
+                with open(self.json_path, 'r') as fp:
+                    self.json = json.load(fp)
 
             _track_reads()
 
@@ -2984,14 +3140,17 @@ class RootAnalysis(Analysis):
 
         logging.debug("merging {} into {} target {}".format(other, self, target_analysis))
 
+        # index the observables we already have so we can look them up by spec
+        observable_index = {} # key = Observable.spec_key, value = Observable
+        for observable in self.all_observables:
+            observable_index.setdefault(observable.spec_key, observable)
+
         # maps the observables from the other alert to new ones in this one
-        transfer_map = {} # key = uuid of other observable, value = uuid of the new observable
+        transfer_map = {} # key = uuid of other observable, value = the observable in this one
         # go through and copy all the observations over first
         for other_observable in other.all_observables:
             # does this observation already exist?
-            existing_observable = self.get_observable_by_spec(other_observable.type, 
-                                                              other_observable.value, 
-                                                              other_observable.time)
+            existing_observable = observable_index.get(other_observable.spec_key, None)
 
             if existing_observable:
                 target_observable = existing_observable
@@ -3003,11 +3162,14 @@ class RootAnalysis(Analysis):
                 logging.debug("making copy of {}".format(other_observable))
                 target_observable = copy.copy(other_observable)
                 target_observable.clear_analysis() # make sure these are cleared out (we'll add them back in later...)
-                # note that we use the record_observable here instead of add_observable
+                # we already know it doesn't exist so we record it directly rather than using record_observable
                 # we're just moving them over into this RootAnalysis right now
-                target_observable = self.record_observable(target_observable)
+                target_observable.root = self
+                self.observable_store[target_observable.id] = target_observable
+                observable_index[target_observable.spec_key] = target_observable
+                self.set_modified()
 
-                # if the observable is a file then the actual file needs to be copied over
+                # if the observable is a file then the actual file needs to be brought over
                 # TODO this should go into the functionality of the observable class
                 if target_observable.type == F_FILE:
                     src_path = os.path.join(other.storage_dir, other_observable.value)
@@ -3017,47 +3179,45 @@ class RootAnalysis(Analysis):
                         dest_dir = os.path.join(self.storage_dir, os.path.dirname(other_observable.value))
                         dest_path = os.path.join(dest_dir, os.path.basename(other_observable.value))
                         try:
-                            logging.debug("copying merged file observable {} to {}".format(src_path, dest_path))
                             if not os.path.isdir(dest_dir):
                                 os.makedirs(dest_dir)
-                            shutil.copy(src_path, dest_path)
+
+                            self._link_or_copy(src_path, dest_path)
                         except Exception as e:
                             logging.error("unable to copy {} to {}: {}".format(src_path, dest_path, e))
                             report_exception()
 
             # keep track of how they are moving over
-            transfer_map[other_observable.id] = target_observable.id
+            transfer_map[other_observable.id] = target_observable
 
         for other_observable in other.all_observables:
             # find the corresponding observable in this alert
-            target_observable = self.get_observable_by_spec(other_observable.type,
-                                                            other_observable.value,
-                                                            other_observable.time)
-            if target_observable is None:
-                logging.error("could not find target observable {} in {}".format(other_observable, self))
-                continue
+            target_observable = transfer_map[other_observable.id]
 
             # remap relationships
             for r in target_observable.relationships:
                 if r.target.id in transfer_map:
                     logging.debug("re-targeting {}".format(r))
-                    r.target = self.get_observable_by_spec(other.observable_store[r.target.id].type,
-                                                           other.observable_store[r.target.id].value,
-                                                           other.observable_store[r.target.id].time)
+                    r.target = transfer_map[r.target.id]
 
             for other_analysis in other_observable.all_analysis:
                 # do we already have this analysis for this observable in the target?
                 existing_analysis = target_observable.get_analysis(type(other_analysis))
                 if existing_analysis is None:
                     logging.debug("merging analysis {} into {}".format(other_analysis, target_observable))
-                    details = other_analysis.details
                     new_analysis = copy.copy(other_analysis)
                     new_analysis.clear_observables()
-                    new_analysis.external_details_path = None
-                    new_analysis.external_details_loaded = False
                     new_analysis.external_details = None
-                    new_analysis.details = details
-                    new_analysis.set_modified()
+
+                    # if the details have not been loaded then we share the existing details file
+                    # the link is replaced with a new file if the details are saved (see Analysis.save)
+                    if not self._link_details(other, other_analysis, new_analysis):
+                        details = other_analysis.details
+                        new_analysis.external_details_path = None
+                        new_analysis.external_details_loaded = False
+                        new_analysis.details = details
+                        new_analysis.set_modified()
+
                     #new_analysis = type(other_analysis)()
                     #new_analysis.details = other_analysis.details
                     target_observable.add_analysis(new_analysis)
@@ -3065,7 +3225,7 @@ class RootAnalysis(Analysis):
                     # and then copy all the observables in
                     for o in other_analysis.observables:
                         # find the corresponding observable in this root
-                        current_observable = self.get_observable_by_spec(o.type, o.value, o.time)
+                        current_observable = transfer_map.get(o.id, None)
                         if current_observable is None:
                             logging.error("could not find current observable {} in {} for {}".format(
                                           o, self, other_analysis))
@@ -3076,9 +3236,7 @@ class RootAnalysis(Analysis):
 
         # finally, all the observables in the RootAnalysis object get added to the target_analysis
         for other_observable in other.observables:
-            existing_observable = self.get_observable_by_spec(other_observable.type, 
-                                                              other_observable.value, 
-                                                              other_observable.time)
+            existing_observable = transfer_map.get(other_observable.id, None)
             if existing_observable is None:
                 logging.error("cannot find observable type {} value {} time {}".format(other_observable.type,
                                                                                        other_observable.value,
@@ -3086,6 +3244,49 @@ class RootAnalysis(Analysis):
             else:
                 target_analysis.add_observable(existing_observable)
 
+    def _link_or_copy(self, src_path, dest_path):
+        """Hard links src_path to dest_path, falling back to copying the file if it cannot be linked."""
+        try:
+            os.link(src_path, dest_path)
+            logging.debug("linked merged file {} to {}".format(src_path, dest_path))
+            return
+        except FileExistsError:
+            if os.path.samefile(src_path, dest_path):
+                return
+        except OSError as e:
+            # different file system
+            logging.debug("unable to link {} to {}: {}".format(src_path, dest_path, e))
+
+        logging.debug("copying merged file {} to {}".format(src_path, dest_path))
+        shutil.copy(src_path, dest_path)
+
+    def _link_details(self, other, other_analysis, new_analysis):
+        """Links the external details file of the Analysis other_analysis in the RootAnalysis other into the
+           storage directory of this RootAnalysis for the Analysis new_analysis.
+           Returns True if the details were linked, False if they need to be copied."""
+        # are the details in memory?
+        if other_analysis._details is not None or other_analysis.external_details_path is None:
+            return False
+
+        src_path = os.path.join(saq.SAQ_RELATIVE_DIR, other.storage_dir, '.ace', other_analysis.external_details_path)
+        dest_dir = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')
+        dest_path = os.path.join(dest_dir, other_analysis.external_details_path)
+
+        try:
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+
+            os.link(src_path, dest_path)
+        except OSError as e:
+            logging.debug("unable to link details {} to {}: {}".format(src_path, dest_path, e))
+            return False
+
+        new_analysis.external_details_path = other_analysis.external_details_path
+        new_analysis.external_details_loaded = False
+        new_analysis._details = None
+        new_analysis._is_modified = False
+        return True
+
     def _materialize(self):
         """Utility function to replace specific dict() in json with runtime object references."""
         # in other words, load the JSON
@@ -3227,18 +3428,43 @@ class RootAnalysis(Analysis):
         p = Popen(['find', abs_path(self.storage_dir), '-type', 'd', '-empty', '-delete'])
         p.wait()
 
-    def archive(self):
-        """Removes the details of analysis and external files.  Keeps observables and tags."""
-        from subprocess import Popen
+    def _get_stored_file_hashes(self, observables):
+        """Returns the sha256 values of the F_FILE observables that may refer to content in the file store."""
+        result = []
+        for o in observables:
+            if o.type != F_FILE:
+                continue
+
+            # content in the file store is hard linked
+            try:
+                if os.stat(o.path).st_nlink < 2:
+                    continue
+            except OSError:
+                continue
+
+            result.append(o.sha256_hash)
+
+        return result
+
+    def archive(self, rate_limiter=None):
+        """Removes the details of analysis and external files.  Keeps observables and tags.
+           The optional saq.util.TokenBucket limits how fast files are deleted."""
+        import saq.file_store
 
         logging.info("archiving {}".format(self))
 
+        # keep track of what content we might be releasing from the file store
+        released_hashes = self._get_stored_file_hashes([o for o in self.all_observables if o not in self.observables])
+
         # NOTE that we do not clear the details that came with Alert
         # clear external details storage for all analysis (except self)
         for _analysis in self.all_analysis:
             if _analysis is self:
                 continue
 
+            if rate_limiter and _analysis.external_details_path is not None:
+                rate_limiter.acquire()
+
             _analysis.reset()
 
         retained_files = set()
@@ -3255,41 +3481,25 @@ class RootAnalysis(Analysis):
                 target_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, o.value)
                 if os.path.exists(target_path):
                     logging.debug("deleting observable file {}".format(target_path))
+                    if rate_limiter:
+                        rate_limiter.acquire()
 
                     try:
                         os.remove(target_path)
                     except Exception as e:
                         logging.error("unable to remove {}: {}".format(target_path, str(e)))
 
-        for dir_path, dir_names, file_names in os.walk(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)):
-            # ignore anything in the root of the storage directory
-            if dir_path == os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir):
-                logging.debug("skipping core directory {}".format(dir_path))
+        # delete everything in the subdirectories of the storage directory (and any empty directories left behind)
+        # ignoring anything in the root of the storage directory and the .ace subdirectory
+        base_dir = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)
+        for dir_name in os.listdir(base_dir):
+            dir_path = os.path.join(base_dir, dir_name)
+            if dir_name == '.ace' or not os.path.isdir(dir_path) or os.path.islink(dir_path):
                 continue
 
-            # and ignore anything in the .ace subdirectory
-            if dir_path == os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'):
-                logging.debug("skipping core directory {}".format(dir_path))
-                continue
+            remove_directory(dir_path, keep=retained_files, rate_limiter=rate_limiter)
 
-            for file_name in file_names:
-                file_path = os.path.join(dir_path, file_name)
-                # and ignore any F_FILE we wanted to keep
-                if file_path in retained_files:
-                    logging.debug("skipping retained file {}".format(file_path))
-                    continue
-
-                try:
-                    logging.debug("deleting {}".format(file_path))
-                    os.remove(file_path)
-                except Exception as e:
-                    logging.error("unable to remove {}: {}".format(file_path, e))
-                    report_exception()
-
-        # remove any empty directories left behind
-        logging.debug("removing empty directories inside {}".format(self.storage_dir))
-        p = Popen(['find', os.path.join(saq.SAQ_HOME, self.storage_dir), '-type', 'd', '-empty', '-delete'])
-        p.wait()
+        saq.file_store.release(released_hashes)
 
     def move(self, dest_dir):
         """Moves the contents of self.storage_dir into dest_dir."""
@@ -3315,6 +3525,10 @@ class RootAnalysis(Analysis):
 
     def delete(self):
         """Deletes everything contained in the storage_dir and marks this RootAnalysis as deleted."""
+        import saq.file_store
+
+        released_hashes = self._get_stored_file_hashes(self.all_observables)
+
         try:
             if os.path.exists(self.storage_dir):
                 shutil.rmtree(self.storage_dir)
@@ -3323,6 +3537,8 @@ class RootAnalysis(Analysis):
             logging.error("unable to delete {}: {}".format(self, e))
             raise e
 
+        saq.file_store.release(released_hashes)
+
     def __str__(self):
         return "RootAnalysis({})".format(self.uuid)
 
@@ -3348,6 +3564,11 @@ class RootAnalysis(Analysis):
         """Returns the list of all Observables discovered for this Alert."""
         return self.observable_store.values()
 
+    def prefetch_tags(self):
+        """Fetches the user created tags for all of the observables in this analysis with a single query.
+           See fetch_observable_tags."""
+        fetch_observable_tags(self.all_observables)
+
     def get_observables_by_type(self, o_type):
         """Returns the list of Observables that match the given type."""
         return [o for o in self.all_observables if o.type == o_type]
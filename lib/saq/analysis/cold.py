@@ -0,0 +1,298 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# cold storage of archived alerts
+#
+# Once an alert has been archived (see RootAnalysis.archive) the files that remain in its storage directory are rarely
+# read again but still use disk space and inodes. compress_storage_dir() moves them into a single compressed
+# container (.cold.zip) in the root of the storage directory.
+#
+# A zip file is used because each member is compressed on its own and the central directory at the end of the file is
+# an index of the members, so any one file can be read without decompressing the rest.
+#
+# Readers look for a loose file first and then fall back to the container. Anything written to the storage directory
+# after it was compressed (for example when an analyst adds a tag to the alert) is written as a loose file and takes
+# precedence over what is in the container.
+#
+
+import collections
+import logging
+import os, os.path
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+import saq
+import saq.analysis.pack
+
+COLD_FILE_NAME = '.cold.zip'
+
+# the maximum number of ColdStorage objects cached by get_cold_storage()
+COLD_CACHE_SIZE = 32
+
+COMPRESSION_TYPES = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+def get_days_old():
+    """Returns how many days old an archived alert must be before it is compressed, or 0 if this is disabled."""
+    return saq.CONFIG['cold_storage'].getint('days_old', fallback=0)
+
+def get_compression():
+    """Returns the zipfile compression type to use for new containers."""
+    compression = saq.CONFIG['cold_storage'].get('compression', fallback='deflated')
+    try:
+        return COMPRESSION_TYPES[compression]
+    except KeyError:
+        raise ValueError("invalid [cold_storage] compression {}".format(compression))
+
+def get_cold_path(storage_dir):
+    """Returns the path to the cold storage container of the given storage directory."""
+    return os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, COLD_FILE_NAME)
+
+def is_cold(storage_dir):
+    """Returns True if the given storage directory has been compressed."""
+    return os.path.exists(get_cold_path(storage_dir))
+
+class ColdStorage(object):
+    """Read-only access to the cold storage container of a storage directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip_file = None
+        # the (inode, mtime) of the container we opened (it is replaced when more files are compressed)
+        self.stat_key = None
+        self.lock = threading.RLock()
+
+    def _open(self):
+        """Returns the open zipfile.ZipFile, reopening it if the container has changed.
+           Raises FileNotFoundError if the container does not exist."""
+        st = os.stat(self.path)
+        stat_key = (st.st_ino, st.st_mtime_ns)
+        if self.zip_file is None or stat_key != self.stat_key:
+            self.close()
+            self.zip_file = zipfile.ZipFile(self.path, 'r')
+            self.stat_key = stat_key
+
+        return self.zip_file
+
+    def close(self):
+        with self.lock:
+            if self.zip_file is not None:
+                try:
+                    self.zip_file.close()
+                except Exception as e:
+                    logging.debug("unable to close {}: {}".format(self.path, e))
+
+                self.zip_file = None
+                self.stat_key = None
+
+    def _get_info(self, name):
+        try:
+            return self._open().getinfo(name)
+        except (FileNotFoundError, KeyError):
+            return None
+
+    def __contains__(self, name):
+        with self.lock:
+            return self._get_info(name) is not None
+
+    def names(self):
+        """Returns the list of (relative) file names stored in the container."""
+        with self.lock:
+            try:
+                return self._open().namelist()
+            except FileNotFoundError:
+                return []
+
+    def open(self, name):
+        """Returns a binary file object for the given name, or None if it does not exist."""
+        with self.lock:
+            info = self._get_info(name)
+            if info is None:
+                return None
+
+            return self.zip_file.open(info)
+
+    def read(self, name):
+        """Returns the contents of the given name as bytes, or None if it does not exist."""
+        fp = self.open(name)
+        if fp is None:
+            return None
+
+        with fp:
+            return fp.read()
+
+    def extract(self, name, dest_path):
+        """Writes the contents of the given name to dest_path. Returns True if the name existed."""
+        fp = self.open(name)
+        if fp is None:
+            return False
+
+        with fp, open(dest_path, 'wb') as fp_out:
+            shutil.copyfileobj(fp, fp_out)
+
+        return True
+
+_cold_cache = collections.OrderedDict() # key = path, value = ColdStorage
+_cold_cache_lock = threading.Lock()
+
+def get_cold_storage(storage_dir):
+    """Returns the (cached) ColdStorage for the given storage directory."""
+    path = get_cold_path(storage_dir)
+    with _cold_cache_lock:
+        try:
+            _cold_cache.move_to_end(path)
+            return _cold_cache[path]
+        except KeyError:
+            pass
+
+        cold_storage = _cold_cache[path] = ColdStorage(path)
+        while len(_cold_cache) > COLD_CACHE_SIZE:
+            _, evicted = _cold_cache.popitem(last=False)
+            evicted.close()
+
+        return cold_storage
+
+def compress_storage_dir(storage_dir, compression=None, rate_limiter=None):
+    """Moves the files of the given storage directory into its cold storage container.
+       Files that are already in the container are kept unless they have been replaced by a loose file.
+       The optional saq.util.TokenBucket limits how fast the loose files are deleted.
+       Returns the number of loose files that were moved into the container."""
+
+    if compression is None:
+        compression = get_compression()
+
+    base_dir = os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir)
+    cold_path = get_cold_path(storage_dir)
+    temp_path = '{}.tmp'.format(cold_path)
+    pack = saq.analysis.pack.get_details_pack(storage_dir)
+
+    loose_files = [] # of the paths of the files moved into the container
+    written = set() # of the names written into the container
+    with zipfile.ZipFile(temp_path, 'w', compression=compression, allowZip64=True) as zip_file:
+        for dir_path, dir_names, file_names in os.walk(base_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if file_path in [ cold_path, temp_path, pack.path ]:
+                    continue
+
+                if not os.path.exists(file_path):
+                    logging.warning("skipping broken link {} in {}".format(file_path, storage_dir))
+                    continue
+
+                name = os.path.relpath(file_path, base_dir)
+                zip_file.write(file_path, name)
+                written.add(name)
+                loose_files.append(file_path)
+
+        # packed analysis details (see saq.analysis.pack) are stored as the files they would have been
+        for detail_name in pack.names():
+            name = os.path.join('.ace', detail_name)
+            if name not in written:
+                zip_file.writestr(name, pack.read(detail_name))
+                written.add(name)
+
+        # and anything compressed before that has not been replaced since
+        if os.path.exists(cold_path):
+            with zipfile.ZipFile(cold_path, 'r') as old_zip_file:
+                for info in old_zip_file.infolist():
+                    if info.filename in written:
+                        continue
+
+                    with old_zip_file.open(info) as fp_in, \
+                         zip_file.open(info.filename, 'w', force_zip64=True) as fp_out:
+                        shutil.copyfileobj(fp_in, fp_out)
+
+                    written.add(info.filename)
+
+    # make sure we can read back everything before we delete anything
+    with zipfile.ZipFile(temp_path, 'r') as zip_file:
+        bad_file = zip_file.testzip()
+
+    if bad_file is not None:
+        os.remove(temp_path)
+        raise RuntimeError("cold storage container for {} failed verification at {}".format(storage_dir, bad_file))
+
+    os.replace(temp_path, cold_path)
+
+    for file_path in loose_files:
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            logging.error("unable to remove {}: {}".format(file_path, e))
+
+    if os.path.exists(pack.path):
+        os.remove(pack.path)
+
+    # remove the directories left empty (but not the storage directory itself)
+    for dir_path, dir_names, file_names in os.walk(base_dir, topdown=False):
+        if dir_path != base_dir and not os.listdir(dir_path):
+            try:
+                os.rmdir(dir_path)
+            except OSError as e:
+                logging.debug("unable to remove directory {}: {}".format(dir_path, e))
+
+    logging.debug("moved {} files from {} into cold storage".format(len(loose_files), storage_dir))
+    return len(loose_files)
+
+def decompress_storage_dir(storage_dir):
+    """Moves the files in the cold storage container of the given storage directory back into loose files.
+       Returns the number of files that were created."""
+    cold_path = get_cold_path(storage_dir)
+    if not os.path.exists(cold_path):
+        return 0
+
+    base_dir = os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir)
+    count = 0
+    with zipfile.ZipFile(cold_path, 'r') as zip_file:
+        for info in zip_file.infolist():
+            # loose files take precedence over the container
+            if os.path.exists(os.path.join(base_dir, info.filename)):
+                continue
+
+            zip_file.extract(info, base_dir)
+            count += 1
+
+    os.remove(cold_path)
+    return count
+
+def add_to_tar(storage_dir, tar, arcname='.'):
+    """Adds the given storage directory to the given tarfile.TarFile as loose files, including whatever is in its
+       cold storage container."""
+    base_dir = os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir)
+    tar.add(base_dir, arcname, filter=lambda tarinfo: None if os.path.basename(tarinfo.name) == COLD_FILE_NAME
+                                                      else tarinfo)
+
+    cold_path = os.path.join(base_dir, COLD_FILE_NAME)
+    if not os.path.exists(cold_path):
+        return
+
+    with zipfile.ZipFile(cold_path, 'r') as zip_file:
+        for info in zip_file.infolist():
+            if info.is_dir() or os.path.exists(os.path.join(base_dir, info.filename)):
+                continue
+
+            tarinfo = tarfile.TarInfo(os.path.join(arcname, info.filename))
+            tarinfo.size = info.file_size
+            tarinfo.mtime = time.mktime(info.date_time + (0, 0, -1))
+            tarinfo.mode = 0o644
+            with zip_file.open(info) as fp:
+                tar.addfile(tarinfo, fileobj=fp)
+
+def extract_file(storage_dir, name, dest_dir):
+    """Extracts the given (relative) file name from the cold storage container of the given storage directory into
+       dest_dir, keeping the base name of the file. Returns the path to the extracted file or None if it does not
+       exist."""
+    dest_path = os.path.join(dest_dir, os.path.basename(name))
+    if not get_cold_storage(storage_dir).extract(name, dest_path):
+        return None
+
+    return dest_path
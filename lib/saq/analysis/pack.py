@@ -0,0 +1,302 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# packed storage of analysis details
+#
+# By default the details of each Analysis object are stored in their own JSON file in the .ace subdirectory of the
+# storage directory of the RootAnalysis. Large alerts end up with thousands of small files.
+#
+# When [global] packed_details is enabled the details are instead appended to a single file (.ace/details.pack)
+# as records keyed by the same external_details_path the Analysis would have used for the file name.
+#
+# Each record is a header line followed by the data.
+#
+#   <name> <length>\n<length bytes of JSON>\n
+#
+# A record with a length of -1 (and no data) marks the name as deleted. The last record for a name wins. The index of
+# name -> offset is built by reading only the header lines and is cached per process. Records are never modified in
+# place, so readers only need to pick up what was appended since they last looked. compact() rewrites the pack
+# without the replaced and deleted records.
+#
+# Loose detail files take precedence over the pack so both storage formats can be used in the same directory.
+#
+
+import collections
+import fcntl
+import logging
+import os, os.path
+import threading
+
+import saq
+
+PACK_FILE_NAME = 'details.pack'
+TOMBSTONE = -1
+
+# the maximum number of DetailsPack objects cached by get_details_pack()
+PACK_CACHE_SIZE = 128
+
+# compact_if_needed() compacts a pack once at least this many bytes (and at least half of the pack) are used by
+# replaced or deleted records
+COMPACT_MIN_DEAD_BYTES = 1024 * 1024
+
+def is_enabled():
+    """Returns True if new analysis details should be saved into the pack."""
+    return saq.CONFIG['global'].getboolean('packed_details', fallback=False)
+
+def get_pack_path(storage_dir):
+    """Returns the path to the details pack of the given storage directory."""
+    return os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, '.ace', PACK_FILE_NAME)
+
+class DetailsPack(object):
+    """An append-only file of named JSON records."""
+
+    def __init__(self, path):
+        self.path = path
+        # key = name, value = (offset of the data, length of the data)
+        self.index = {}
+        # how far into the file we have read the headers
+        self.scanned_offset = 0
+        # the inode of the file we indexed (compact() replaces the file)
+        self.inode = None
+        # the number of bytes used by records that have been replaced or deleted
+        self.dead_bytes = 0
+        self.lock = threading.RLock()
+
+    def _scan(self, fp=None):
+        """Updates the index with any records appended since the last scan.
+           The headers are read from the given open file (or the pack file if fp is None.) Readers pass the file
+           they are about to read from so that the offsets in the index are for that file even if compact()
+           replaces the pack in the meantime."""
+        if fp is None:
+            try:
+                with open(self.path, 'rb') as fp:
+                    return self._scan(fp)
+            except FileNotFoundError:
+                self.index = {}
+                self.scanned_offset = 0
+                self.inode = None
+                self.dead_bytes = 0
+                return
+
+        st = os.fstat(fp.fileno())
+        if st.st_ino != self.inode or st.st_size < self.scanned_offset:
+            self.index = {}
+            self.scanned_offset = 0
+            self.inode = st.st_ino
+            self.dead_bytes = 0
+
+        if st.st_size == self.scanned_offset:
+            return
+
+        fp.seek(self.scanned_offset)
+        while True:
+            record_offset = fp.tell()
+            header = fp.readline()
+            # partial header from a write in progress?
+            if not header.endswith(b'\n'):
+                break
+
+            try:
+                name, length = header[:-1].decode('utf8').rsplit(' ', 1)
+                length = int(length)
+            except ValueError:
+                logging.error("corrupt record header at offset {} in {}".format(record_offset, self.path))
+                break
+
+            data_offset = fp.tell()
+            if length != TOMBSTONE:
+                # partial data from a write in progress?
+                if data_offset + length + 1 > st.st_size:
+                    break
+
+                fp.seek(length + 1, os.SEEK_CUR)
+
+            if name in self.index:
+                self.dead_bytes += self.index[name][1]
+
+            if length == TOMBSTONE:
+                self.index.pop(name, None)
+                self.dead_bytes += fp.tell() - record_offset
+            else:
+                self.index[name] = (data_offset, length)
+
+            self.scanned_offset = fp.tell()
+
+    def __contains__(self, name):
+        with self.lock:
+            self._scan()
+            return name in self.index
+
+    def names(self):
+        """Returns the list of names stored in the pack."""
+        with self.lock:
+            self._scan()
+            return list(self.index.keys())
+
+    def read(self, name):
+        """Returns the data stored for the given name as a str, or None if it does not exist."""
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        # the data is read from the same file the offset came from (see _scan)
+        with fp:
+            with self.lock:
+                self._scan(fp)
+                if name not in self.index:
+                    return None
+
+                offset, length = self.index[name]
+
+            fp.seek(offset)
+            return fp.read(length).decode('utf8')
+
+    def _append(self, name, data):
+        if '\n' in name:
+            raise ValueError("invalid record name {}".format(name))
+
+        if data is None:
+            record = '{} {}\n'.format(name, TOMBSTONE).encode('utf8')
+        else:
+            data = data.encode('utf8')
+            record = b''.join(['{} {}\n'.format(name, len(data)).encode('utf8'), data, b'\n'])
+
+        with self.lock:
+            while True:
+                with open(self.path, 'ab') as fp:
+                    fcntl.flock(fp, fcntl.LOCK_EX)
+                    try:
+                        # was the file replaced by compact() while we waited for the lock?
+                        if os.fstat(fp.fileno()).st_ino != os.stat(self.path).st_ino:
+                            continue
+
+                        fp.write(record)
+                        fp.flush()
+                        return
+                    finally:
+                        fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def write(self, name, data):
+        """Stores the given str data under the given name, replacing any existing data."""
+        self._append(name, data)
+
+    def delete(self, name):
+        """Deletes the given name from the pack. Returns True if it existed."""
+        if name not in self:
+            return False
+
+        self._append(name, None)
+        return True
+
+    @property
+    def size(self):
+        """Returns the size of the pack file in bytes, or 0 if it does not exist."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def compact(self):
+        """Rewrites the pack without any replaced or deleted records. Returns the number of bytes saved."""
+        with self.lock:
+            if not os.path.exists(self.path):
+                return 0
+
+            with open(self.path, 'rb+') as lock_fp:
+                # hold the lock so nothing is appended to the file we are replacing
+                fcntl.flock(lock_fp, fcntl.LOCK_EX)
+                try:
+                    # already replaced by another compact()?
+                    if os.fstat(lock_fp.fileno()).st_ino != os.stat(self.path).st_ino:
+                        return 0
+
+                    self._scan(lock_fp)
+                    original_size = os.fstat(lock_fp.fileno()).st_size
+                    temp_path = '{}.tmp'.format(self.path)
+                    with open(temp_path, 'wb') as fp_out:
+                        for name, (offset, length) in self.index.items():
+                            lock_fp.seek(offset)
+                            fp_out.write('{} {}\n'.format(name, length).encode('utf8'))
+                            fp_out.write(lock_fp.read(length))
+                            fp_out.write(b'\n')
+
+                    os.replace(temp_path, self.path)
+                finally:
+                    fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+            self._scan()
+            return original_size - self.size
+
+    def compact_if_needed(self):
+        """Compacts the pack if enough of it is used by replaced or deleted records.
+           Returns the number of bytes saved."""
+        with self.lock:
+            self._scan()
+            if self.dead_bytes < COMPACT_MIN_DEAD_BYTES or self.dead_bytes * 2 < self.scanned_offset:
+                return 0
+
+        logging.debug("compacting {} ({} dead bytes)".format(self.path, self.dead_bytes))
+        return self.compact()
+
+_pack_cache = collections.OrderedDict() # key = path, value = DetailsPack
+_pack_cache_lock = threading.Lock()
+
+def get_details_pack(storage_dir):
+    """Returns the (cached) DetailsPack for the given storage directory."""
+    path = get_pack_path(storage_dir)
+    with _pack_cache_lock:
+        try:
+            _pack_cache.move_to_end(path)
+            return _pack_cache[path]
+        except KeyError:
+            pass
+
+        pack = _pack_cache[path] = DetailsPack(path)
+        while len(_pack_cache) > PACK_CACHE_SIZE:
+            _pack_cache.popitem(last=False)
+
+        return pack
+
+def pack_storage_dir(storage_dir):
+    """Moves the loose analysis detail files of the given storage directory into the pack.
+       Returns the number of files that were moved."""
+    details_dir = os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, '.ace')
+    if not os.path.isdir(details_dir):
+        return 0
+
+    pack = get_details_pack(storage_dir)
+    count = 0
+    for file_name in sorted(os.listdir(details_dir)):
+        if not file_name.endswith('.json'):
+            continue
+
+        file_path = os.path.join(details_dir, file_name)
+        with open(file_path, 'r') as fp:
+            pack.write(file_name, fp.read())
+
+        os.remove(file_path)
+        count += 1
+
+    pack.compact()
+    return count
+
+def unpack_storage_dir(storage_dir):
+    """Moves the analysis details stored in the pack of the given storage directory back into loose files.
+       Returns the number of files that were created."""
+    pack = get_details_pack(storage_dir)
+    if not os.path.exists(pack.path):
+        return 0
+
+    details_dir = os.path.dirname(pack.path)
+    count = 0
+    for name in pack.names():
+        file_path = os.path.join(details_dir, name)
+        # loose files take precedence over the pack
+        if not os.path.exists(file_path):
+            with open(file_path, 'w') as fp:
+                fp.write(pack.read(name))
+
+            count += 1
+
+    os.remove(pack.path)
+    return count
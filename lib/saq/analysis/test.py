@@ -4,6 +4,7 @@ import datetime
 import json
 import logging
 import os, os.path
+import shutil
 import time
 import unittest
 
@@ -120,3 +121,355 @@ class RootAnalysisTestCase(ACEBasicTestCase):
 
         o1 = root.add_observable(F_TEST, 'test_1')
         self.assertEquals(o1.md5_hex, '4e70ffa82fbe886e3c4ac00ac374c29b')
+
+    def _create_merge_source(self, observable_count=1):
+        """Creates and saves a RootAnalysis with a file observable with analysis and returns it reloaded."""
+        import uuid
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+
+        with open(os.path.join(root.storage_dir, 'test.txt'), 'w') as fp:
+            fp.write('test')
+
+        file_observable = root.add_observable(F_FILE, 'test.txt')
+        analysis = BasicTestAnalysis()
+        analysis.initialize_details()
+        file_observable.add_analysis(analysis)
+        for index in range(observable_count):
+            analysis.add_observable(F_TEST, 'test_{}'.format(index))
+
+        analysis.add_observable(F_USER, 'Admin')
+        root.save()
+
+        # load it fresh so the details are not in memory
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        return root
+
+    def test_merge(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        existing_user = root.add_observable(F_USER, 'admin')
+        root.save()
+
+        other = self._create_merge_source()
+        root.merge(root, other)
+
+        # existing observables are matched by spec (users are not case sensitive)
+        self.assertEquals(len(root.get_observables_by_type(F_USER)), 1)
+        self.assertTrue(root.find_observable(F_USER) is existing_user)
+
+        # files are hard linked instead of copied
+        file_observable = root.find_observable(F_FILE)
+        self.assertIsNotNone(file_observable)
+        self.assertTrue(os.path.samefile(os.path.join(root.storage_dir, 'test.txt'),
+                                         os.path.join(other.storage_dir, 'test.txt')))
+
+        # details are shared with the other root until they are modified
+        analysis = file_observable.get_analysis(BasicTestAnalysis)
+        self.assertIsNotNone(analysis)
+        other_analysis = other.find_observable(F_FILE).get_analysis(BasicTestAnalysis)
+        details_path = os.path.join(root.storage_dir, '.ace', analysis.external_details_path)
+        other_details_path = os.path.join(other.storage_dir, '.ace', other_analysis.external_details_path)
+        self.assertTrue(os.path.samefile(details_path, other_details_path))
+        self.assertEquals(analysis.details, { 'test_result': True })
+        self.assertEquals(len(analysis.get_observables_by_type(F_TEST)), 1)
+        self.assertTrue(analysis.get_observables_by_type(F_USER)[0] is existing_user)
+
+        analysis.details['test_result'] = False
+        analysis.set_modified()
+        root.save()
+
+        self.assertFalse(os.path.samefile(details_path, other_details_path))
+        with open(other_details_path, 'r') as fp:
+            self.assertEquals(json.load(fp), { 'test_result': True })
+
+        # and everything comes back after a reload
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.find_observable(F_FILE).get_analysis(BasicTestAnalysis)
+        self.assertEquals(analysis.details, { 'test_result': False })
+
+    def test_merge_benchmark(self):
+        observable_count = 2000
+        other = self._create_merge_source(observable_count=observable_count)
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        for index in range(observable_count):
+            root.add_observable(F_TEST, 'existing_{}'.format(index))
+
+        start = time.time()
+        root.merge(root, other)
+        elapsed = time.time() - start
+        logging.info("BENCHMARK: merged {} observables into {} observables in {:.3f} seconds".format(
+                     len(other.all_observables), observable_count, elapsed))
+
+        self.assertEquals(len(root.get_observables_by_type(F_TEST)), observable_count * 2)
+
+    def _create_details_root(self, analysis_count):
+        """Creates and saves a RootAnalysis with analysis_count Analysis objects that have details."""
+        import uuid
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        for index in range(analysis_count):
+            analysis = BasicTestAnalysis()
+            analysis.initialize_details()
+            analysis.details['index'] = index
+            root.add_observable(F_TEST, 'test_{}'.format(index)).add_analysis(analysis)
+
+        root.save()
+        return root
+
+    def _load_all_details(self, storage_dir):
+        root = RootAnalysis(storage_dir=storage_dir)
+        root.load()
+        return [ a.details for o in root.all_observables for a in o.all_analysis ]
+
+    def test_packed_details(self):
+        import saq.analysis.pack
+
+        saq.CONFIG['global']['packed_details'] = 'yes'
+        root = self._create_details_root(10)
+        details_dir = os.path.join(root.storage_dir, '.ace')
+        self.assertEquals(os.listdir(details_dir), [ saq.analysis.pack.PACK_FILE_NAME ])
+
+        details = self._load_all_details(root.storage_dir)
+        self.assertEquals(sorted([d['index'] for d in details]), list(range(10)))
+
+        # modified details replace what is in the pack
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable_by_spec(F_TEST, 'test_0').get_analysis(BasicTestAnalysis)
+        analysis.details['test_result'] = False
+        analysis.set_modified()
+        root.save()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable_by_spec(F_TEST, 'test_0').get_analysis(BasicTestAnalysis)
+        self.assertFalse(analysis.details['test_result'])
+
+        # and reset removes them
+        pack = saq.analysis.pack.get_details_pack(root.storage_dir)
+        self.assertTrue(analysis.external_details_path in pack)
+        external_details_path = analysis.external_details_path
+        analysis.reset()
+        self.assertFalse(external_details_path in pack)
+        self.assertEquals(len(pack.names()), 9)
+        self.assertTrue(pack.compact() > 0)
+        self.assertEquals(len(pack.names()), 9)
+
+        # packed details can still be loaded after packing is disabled
+        saq.CONFIG['global']['packed_details'] = 'no'
+        self.assertEquals(len(self._load_all_details(root.storage_dir)), 9)
+
+        # and can be moved in and out of the pack
+        self.assertEquals(saq.analysis.pack.unpack_storage_dir(root.storage_dir), 9)
+        self.assertEquals(len(os.listdir(details_dir)), 9)
+        self.assertEquals(len(self._load_all_details(root.storage_dir)), 9)
+        self.assertEquals(saq.analysis.pack.pack_storage_dir(root.storage_dir), 9)
+        self.assertEquals(os.listdir(details_dir), [ saq.analysis.pack.PACK_FILE_NAME ])
+        self.assertEquals(len(self._load_all_details(root.storage_dir)), 9)
+
+    def test_packed_details_compact_race(self):
+        from saq.analysis.pack import DetailsPack
+
+        path = os.path.join(saq.TEMP_DIR, 'compact_race.pack')
+        if os.path.exists(path):
+            os.remove(path)
+
+        # another process compacts the pack right after the reader has looked up the offset
+        other_pack = DetailsPack(path)
+        class _RacingPack(DetailsPack):
+            def _scan(self, fp=None):
+                super()._scan(fp)
+                if fp is not None and other_pack.dead_bytes > 0:
+                    other_pack.compact()
+
+        for index in range(10):
+            other_pack.write('test_{}'.format(index), '{{"index": {}}}'.format(index))
+
+        other_pack.write('test_0', '{"index": "replaced"}')
+        other_pack._scan()
+
+        pack = _RacingPack(path)
+        self.assertEquals(json.loads(pack.read('test_5')), { 'index': 5 })
+        # the pack was replaced and the reader picks up the new offsets the next time
+        self.assertEquals(other_pack.dead_bytes, 0)
+        self.assertEquals(json.loads(pack.read('test_6')), { 'index': 6 })
+        self.assertEquals(json.loads(pack.read('test_0')), { 'index': 'replaced' })
+
+    def test_cold_storage(self):
+        import tarfile
+        import saq.analysis.cold
+
+        root = self._create_details_root(10)
+        with open(os.path.join(root.storage_dir, 'test.txt'), 'w') as fp:
+            fp.write('test')
+
+        root.add_observable(F_FILE, 'test.txt')
+        root.save()
+
+        file_count = sum([len(file_names) for _, _, file_names in os.walk(root.storage_dir)])
+        self.assertEquals(saq.analysis.cold.compress_storage_dir(root.storage_dir), file_count)
+        self.assertTrue(saq.analysis.cold.is_cold(root.storage_dir))
+        self.assertEquals(os.listdir(root.storage_dir), [ saq.analysis.cold.COLD_FILE_NAME ])
+
+        # everything can still be loaded out of cold storage
+        details = self._load_all_details(root.storage_dir)
+        self.assertEquals(sorted([d['index'] for d in details if d]), list(range(10)))
+        path = saq.analysis.cold.extract_file(root.storage_dir, 'test.txt', saq.TEMP_DIR)
+        with open(path, 'r') as fp:
+            self.assertEquals(fp.read(), 'test')
+
+        # and sent as loose files
+        tar_path = os.path.join(saq.TEMP_DIR, 'cold.tar')
+        with tarfile.open(tar_path, 'w') as tar:
+            saq.analysis.cold.add_to_tar(root.storage_dir, tar)
+
+        with tarfile.open(tar_path, 'r') as tar:
+            names = tar.getnames()
+
+        self.assertTrue('./data.json' in names)
+        self.assertTrue('./test.txt' in names)
+        self.assertFalse(os.path.join('.', saq.analysis.cold.COLD_FILE_NAME) in names)
+
+        # changes are saved as loose files that take precedence over the container
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        root.add_tag('cold')
+        root.save()
+        self.assertTrue(os.path.exists(root.json_path))
+
+        # which are moved into the container the next time
+        self.assertTrue(saq.analysis.cold.compress_storage_dir(root.storage_dir) > 0)
+        self.assertEquals(os.listdir(root.storage_dir), [ saq.analysis.cold.COLD_FILE_NAME ])
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.has_tag('cold'))
+
+        # and can be moved back out
+        self.assertEquals(saq.analysis.cold.decompress_storage_dir(root.storage_dir), file_count)
+        self.assertFalse(saq.analysis.cold.is_cold(root.storage_dir))
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, 'test.txt')))
+        details = self._load_all_details(root.storage_dir)
+        self.assertEquals(sorted([d['index'] for d in details if d]), list(range(10)))
+
+    def test_timeline(self):
+        import saq.analysis.cold
+        from saq.analysis.timeline import TimelineEntry, append_timeline, load_timeline, summarize_timeline, \
+                                          record_module_costs, get_module_costs, get_module_costs_dir
+
+        root = self._create_details_root(1)
+        self.assertEquals(load_timeline(root.storage_dir), [])
+        append_timeline(root.storage_dir, [
+            TimelineEntry('analysis_module_a', 'obs_1', 1000.0, 2.0, 'analysis', False, 0.5),
+            TimelineEntry('analysis_module_b', 'obs_1', 1002.0, 1.0, 'no_analysis', True, 0.0), ])
+        append_timeline(root.storage_dir, [
+            TimelineEntry('analysis_module_a', 'obs_2', 1010.0, 4.0, 'error', False, 0.0), ])
+
+        timeline = load_timeline(root.storage_dir)
+        self.assertEquals(len(timeline), 3)
+        self.assertEquals(timeline[2], TimelineEntry('analysis_module_a', 'obs_2', 1010.0, 4.0, 'error', False, 0.0))
+
+        summary = summarize_timeline(timeline, limit=1)
+        self.assertEquals(summary['invocations'], 3)
+        self.assertEquals(summary['total_seconds'], 7.0)
+        self.assertEquals(summary['semaphore_wait_seconds'], 0.5)
+        self.assertEquals(summary['first_start'], 1000.0)
+        self.assertEquals(summary['last_end'], 1014.0)
+        self.assertEquals(summary['modules'], [ { 'module': 'analysis_module_a', 'invocations': 2, 'total_seconds': 6.0,
+                                                  'max_seconds': 4.0, 'semaphore_wait_seconds': 0.5, 'errors': 1,
+                                                  'delayed': 0 } ])
+        self.assertEquals(summary['slowest'][0]['observable_id'], 'obs_2')
+
+        # entries appended after the storage directory moved into cold storage are added to the existing timeline
+        saq.analysis.cold.compress_storage_dir(root.storage_dir)
+        self.assertEquals(len(load_timeline(root.storage_dir)), 3)
+        append_timeline(root.storage_dir, [
+            TimelineEntry('analysis_module_b', 'obs_2', 1020.0, 1.0, 'analysis', False, 0.0), ])
+        saq.analysis.cold.compress_storage_dir(root.storage_dir)
+        self.assertEquals(len(load_timeline(root.storage_dir)), 4)
+
+        # module costs are aggregated across all the analysis of the node
+        if os.path.exists(get_module_costs_dir()):
+            shutil.rmtree(get_module_costs_dir())
+
+        record_module_costs(root.uuid, 'analysis', timeline)
+        record_module_costs(root.uuid, 'correlation', timeline[:1])
+        modules = get_module_costs()
+        self.assertEquals([ m['module'] for m in modules ], [ 'analysis_module_a', 'analysis_module_b' ])
+        self.assertEquals(modules[0]['alerts'], 2)
+        self.assertEquals(modules[0]['invocations'], 3)
+        self.assertEquals(modules[0]['total_seconds'], 8.0)
+        self.assertEquals(modules[1]['delayed'], 1)
+        self.assertEquals([ m['module'] for m in get_module_costs(limit=1) ], [ 'analysis_module_a' ])
+        self.assertEquals(get_module_costs(analysis_mode='correlation')[0]['invocations'], 1)
+
+    def test_packed_details_benchmark(self):
+        import tarfile
+
+        analysis_count = 2000
+        for packed in [ 'no', 'yes' ]:
+            saq.CONFIG['global']['packed_details'] = packed
+
+            start = time.time()
+            root = self._create_details_root(analysis_count)
+            save_time = time.time() - start
+
+            start = time.time()
+            self.assertEquals(len(self._load_all_details(root.storage_dir)), analysis_count)
+            load_time = time.time() - start
+
+            start = time.time()
+            with tarfile.open(os.path.join(saq.TEMP_DIR, 'benchmark.tar'), 'w') as tar:
+                tar.add(root.storage_dir, arcname='.')
+            tar_time = time.time() - start
+
+            logging.info("BENCHMARK: packed_details = {} saved {} details in {:.3f} seconds "
+                         "loaded in {:.3f} seconds tar in {:.3f} seconds ({} files)".format(
+                         packed, analysis_count, save_time, load_time, tar_time,
+                         len(os.listdir(os.path.join(root.storage_dir, '.ace')))))
+
+    def test_prefetch_tags(self):
+        from saq.database import add_observable_tag_mapping
+        import saq.analysis
+
+        for index in range(10):
+            self.assertTrue(add_observable_tag_mapping(F_TEST, 'test_{}'.format(index), None, 'tag_{}'.format(index)))
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        for index in range(20):
+            root.add_observable(F_TEST, 'test_{}'.format(index))
+        root.save()
+
+        # tags are not fetched when an analysis is loaded
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertFalse(any([o._tags_fetched for o in root.all_observables]))
+
+        saq.CONFIG['observable_tags']['cache_lifetime'] = '00:00:10'
+        saq.analysis.clear_tag_cache()
+        root.prefetch_tags()
+        self.assertTrue(all([o._tags_fetched for o in root.all_observables]))
+        for index in range(20):
+            observable = root.get_observable_by_spec(F_TEST, 'test_{}'.format(index))
+            self.assertEquals(observable.has_tag('tag_{}'.format(index)), index < 10)
+
+        # the results (including the observables without tags) are cached
+        self.assertEquals(len(saq.analysis._TAG_CACHE), 20)
+
+        # until the tag mappings change
+        self.assertTrue(add_observable_tag_mapping(F_TEST, 'test_10', None, 'tag_10'))
+        self.assertEquals(len(saq.analysis._TAG_CACHE), 0)
+
+        # only the most recently used lookups are kept
+        saq.CONFIG['observable_tags']['cache_size'] = '5'
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        root.prefetch_tags()
+        self.assertTrue(root.get_observable_by_spec(F_TEST, 'test_10').has_tag('tag_10'))
+        self.assertEquals(len(saq.analysis._TAG_CACHE), 5)
+        saq.analysis.clear_tag_cache()
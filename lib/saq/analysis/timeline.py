@@ -0,0 +1,231 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# per-alert analysis timeline
+#
+# Every call the engine makes to an analysis module is recorded in the timeline of the RootAnalysis
+# (.ace/timeline.jsonl in the storage directory.) Each line is a JSON list of the fields of a TimelineEntry.
+#
+#   [ module, observable_id, start, duration, result, delayed, semaphore_wait ]
+#
+# start is a unix timestamp, duration and semaphore_wait are in seconds. The engine appends the entries of each pass
+# of analysis when the pass finishes, so the timeline of something that was analyzed several times (delayed analysis,
+# correlation, dispositioned, etc...) covers all of them. Like any other file, a loose timeline takes precedence over
+# the one in the cold storage container (see saq.analysis.cold) so the entries already in the container are copied
+# out before anything new is appended to a storage directory that has been moved into cold storage.
+#
+# The engine also appends a per-module summary of each pass to a node-wide file (DATA_DIR/stats/timeline/DATE.jsonl)
+# which get_module_costs() reads to report which modules cost the most across all the alerts of the node.
+#
+
+import collections
+import datetime
+import json
+import logging
+import os, os.path
+import time
+
+import saq
+import saq.analysis.cold
+
+TIMELINE_FILE_NAME = 'timeline.jsonl'
+
+# the result of a call to an analysis module
+TIMELINE_RESULT_ANALYSIS = 'analysis' # generated analysis
+TIMELINE_RESULT_NO_ANALYSIS = 'no_analysis' # did not generate analysis
+TIMELINE_RESULT_WAIT = 'wait' # waiting for the analysis of another module
+TIMELINE_RESULT_ERROR = 'error' # an exception was raised
+
+TimelineEntry = collections.namedtuple('TimelineEntry', [
+    'module',           # the config section of the analysis module
+    'observable_id',    # the id of the observable that was analyzed
+    'start',            # when the call started (unix timestamp)
+    'duration',         # how long the call took (in seconds)
+    'result',           # one of the TIMELINE_RESULT_ values
+    'delayed',          # True if the module delayed the analysis
+    'semaphore_wait',   # how long the module waited for its semaphore (in seconds)
+])
+
+def is_enabled():
+    """Returns True if the engine records the timeline of each alert."""
+    return saq.CONFIG['timeline'].getboolean('enabled', fallback=False)
+
+def get_summary_size():
+    """Returns the number of modules listed in timeline summaries."""
+    return saq.CONFIG['timeline'].getint('summary_size', fallback=10)
+
+def get_timeline_path(storage_dir):
+    return os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, '.ace', TIMELINE_FILE_NAME)
+
+def _read_cold_timeline(storage_dir):
+    """Returns the contents of the timeline in the cold storage container of the given storage directory,
+       or None if there is not one."""
+    if not saq.analysis.cold.is_cold(storage_dir):
+        return None
+
+    data = saq.analysis.cold.get_cold_storage(storage_dir).read(os.path.join('.ace', TIMELINE_FILE_NAME))
+    if data is None:
+        return None
+
+    return data.decode('utf8')
+
+def _parse_timeline(data):
+    entries = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            entries.append(TimelineEntry(*json.loads(line)))
+        except Exception as e:
+            logging.warning("invalid timeline entry {}: {}".format(line, e))
+
+    return entries
+
+def append_timeline(storage_dir, entries):
+    """Appends the given list of TimelineEntry to the timeline of the given storage directory."""
+    if not entries:
+        return
+
+    timeline_path = get_timeline_path(storage_dir)
+    os.makedirs(os.path.dirname(timeline_path), exist_ok=True)
+    lines = []
+    if not os.path.exists(timeline_path):
+        data = _read_cold_timeline(storage_dir)
+        if data:
+            lines.append(data.rstrip('\n'))
+
+    for entry in entries:
+        lines.append(json.dumps([ entry.module, entry.observable_id, round(entry.start, 3), round(entry.duration, 3),
+                                  entry.result, entry.delayed, round(entry.semaphore_wait, 3) ]))
+
+    with open(timeline_path, 'a') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+def load_timeline(storage_dir):
+    """Returns the list of TimelineEntry recorded for the given storage directory, in the order they were recorded."""
+    timeline_path = get_timeline_path(storage_dir)
+    if os.path.exists(timeline_path):
+        with open(timeline_path, 'r') as fp:
+            return _parse_timeline(fp.read())
+
+    data = _read_cold_timeline(storage_dir)
+    if data is None:
+        return []
+
+    return _parse_timeline(data)
+
+def _new_module_stats():
+    return { 'invocations': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'semaphore_wait_seconds': 0.0,
+             'errors': 0, 'delayed': 0 }
+
+def _add_module_stats(stats, invocations, total_seconds, max_seconds, semaphore_wait_seconds, errors, delayed):
+    stats['invocations'] += invocations
+    stats['total_seconds'] += total_seconds
+    stats['max_seconds'] = max(stats['max_seconds'], max_seconds)
+    stats['semaphore_wait_seconds'] += semaphore_wait_seconds
+    stats['errors'] += errors
+    stats['delayed'] += delayed
+
+def _get_module_stats(entries):
+    """Returns a dict of module -> stats for the given list of TimelineEntry."""
+    modules = {}
+    for entry in entries:
+        _add_module_stats(modules.setdefault(entry.module, _new_module_stats()),
+                          1, entry.duration, entry.duration, entry.semaphore_wait,
+                          1 if entry.result == TIMELINE_RESULT_ERROR else 0,
+                          1 if entry.delayed else 0)
+
+    return modules
+
+def _sort_module_stats(modules, limit):
+    result = [ dict(stats, module=module) for module, stats in modules.items() ]
+    result.sort(key=lambda stats: stats['total_seconds'], reverse=True)
+    return result[:limit]
+
+def summarize_timeline(entries, limit=None):
+    """Returns a summary of the given list of TimelineEntry as a dict with the following keys.
+       invocations - the number of calls to analysis modules
+       total_seconds - the time spent in analysis modules
+       semaphore_wait_seconds - the time spent waiting for semaphores
+       first_start, last_end - the time of the first and last calls (unix timestamps, None if there are none)
+       modules - the stats of the limit modules that took the most time
+       slowest - the limit slowest calls (as dicts of the TimelineEntry fields)"""
+    if limit is None:
+        limit = get_summary_size()
+
+    slowest = sorted(entries, key=lambda entry: entry.duration, reverse=True)[:limit]
+    return {
+        'invocations': len(entries),
+        'total_seconds': sum([ entry.duration for entry in entries ]),
+        'semaphore_wait_seconds': sum([ entry.semaphore_wait for entry in entries ]),
+        'first_start': min([ entry.start for entry in entries ]) if entries else None,
+        'last_end': max([ entry.start + entry.duration for entry in entries ]) if entries else None,
+        'modules': _sort_module_stats(_get_module_stats(entries), limit),
+        'slowest': [ entry._asdict() for entry in slowest ],
+    }
+
+#
+# node-wide module costs
+#
+
+def get_module_costs_dir():
+    return os.path.join(saq.DATA_DIR, 'stats', 'timeline')
+
+def record_module_costs(uuid, analysis_mode, entries):
+    """Records the cost of each module in the given list of TimelineEntry in the node-wide module cost log."""
+    if not entries:
+        return
+
+    target_dir = get_module_costs_dir()
+    os.makedirs(target_dir, exist_ok=True)
+    modules = { module: [ stats['invocations'], round(stats['total_seconds'], 3), round(stats['max_seconds'], 3),
+                          round(stats['semaphore_wait_seconds'], 3), stats['errors'], stats['delayed'] ]
+                for module, stats in _get_module_stats(entries).items() }
+
+    line = json.dumps({ 'uuid': uuid, 'analysis_mode': analysis_mode, 'time': round(time.time(), 3),
+                        'modules': modules }) + '\n'
+
+    # the file is shared by all the processes of the node
+    # each record is appended with a single write (see O_APPEND)
+    fd = os.open(os.path.join(target_dir, '{}.jsonl'.format(datetime.date.today().strftime('%Y%m%d'))),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf8'))
+    finally:
+        os.close(fd)
+
+def get_module_costs(days=1, limit=None, analysis_mode=None):
+    """Returns the stats (see summarize_timeline) of the limit modules that took the most time on this node
+       over the last number of days, optionally limited to the given analysis mode.
+       Each dict also includes the number of alerts (analysis passes) the module was called for."""
+    if limit is None:
+        limit = get_summary_size()
+
+    modules = {}
+    today = datetime.date.today()
+    for day in range(days):
+        path = os.path.join(get_module_costs_dir(), '{}.jsonl'.format(
+                            (today - datetime.timedelta(days=day)).strftime('%Y%m%d')))
+        if not os.path.exists(path):
+            continue
+
+        with open(path, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except Exception as e:
+                    logging.debug("invalid module cost record in {}: {}".format(path, e))
+                    continue
+
+                if analysis_mode is not None and record['analysis_mode'] != analysis_mode:
+                    continue
+
+                for module, values in record['modules'].items():
+                    if module not in modules:
+                        modules[module] = _new_module_stats()
+                        modules[module]['alerts'] = 0
+
+                    _add_module_stats(modules[module], *values)
+                    modules[module]['alerts'] += 1
+
+    return _sort_module_stats(modules, limit)
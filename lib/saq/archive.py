@@ -0,0 +1,247 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# in-process listing and extraction of zip and tar archives
+#
+# Members are streamed straight out of the archive into their destination instead of forking unzip, 7z or tar.
+# Extraction enforces limits on the number of members, the total number of bytes written, the ratio of bytes
+# written to the size of the archive and the time spent, so a zip bomb stops at the limit instead of filling the disk.
+# Member paths are normalized so that nothing is written outside of the target directory, and links and device files
+# are skipped.
+#
+# An archive can also be opened from the file object of a member of another archive, so the contents of nested
+# archives can be listed (or extracted) without writing the nested archive to disk first.
+#
+# Formats that cannot be read in-process (rar, ace, 7z, etc...) are still handled by the external tools.
+#
+
+import collections
+import fnmatch
+import logging
+import os, os.path
+import tarfile
+import time
+import zipfile
+
+import saq
+
+# the block size used when extracting members
+BLOCK_SIZE = 64 * 1024
+
+# the ratio limit is only checked once at least this many bytes have been extracted
+# (small files of repeated bytes legitimately compress very well)
+RATIO_CHECK_MIN_SIZE = 1024 * 1024
+
+# the password tried for encrypted zip members (commonly used for sharing malware samples)
+DEFAULT_PASSWORD = b'infected'
+
+class ArchiveLimitError(RuntimeError):
+    """Raised when extracting an archive would exceed one of the configured limits."""
+    pass
+
+# name is the path of the member inside the archive
+# size is the uncompressed size reported by the archive
+# compressed_size is the size of the member in the archive (or None if the format does not say)
+ArchiveMember = collections.namedtuple('ArchiveMember', [ 'name', 'size', 'compressed_size' ])
+
+class ArchiveLimits(object):
+    """The limits enforced when extracting an archive. A value of 0 is unlimited."""
+
+    def __init__(self, max_member_count=0, max_total_size=0, max_ratio=0, timeout=0):
+        self.max_member_count = max_member_count
+        self.max_total_size = max_total_size
+        self.max_ratio = max_ratio
+        # the maximum number of seconds spent extracting
+        self.timeout = timeout
+
+def get_default_limits():
+    """Returns the ArchiveLimits defined in the [archive] configuration section."""
+    return ArchiveLimits(max_member_count=saq.CONFIG['archive'].getint('max_member_count', fallback=0),
+                         max_total_size=saq.CONFIG['archive'].getint('max_total_size', fallback=0),
+                         max_ratio=saq.CONFIG['archive'].getint('max_ratio', fallback=0),
+                         timeout=saq.CONFIG['archive'].getint('timeout', fallback=0))
+
+def get_safe_path(target_dir, name):
+    """Returns the path the given member name should be extracted to inside of target_dir,
+       or None if the name does not contain anything usable."""
+    parts = [ part for part in name.replace('\\', '/').split('/') if part not in [ '', '.', '..' ] ]
+    if not parts:
+        return None
+
+    return os.path.join(target_dir, *parts)
+
+class Archive(object):
+    """Base class of the supported archive formats. Use open_archive() to get one."""
+
+    def __init__(self, archive_size=None, owned_fileobj=None):
+        # the size of the archive file in bytes (used for the ratio limit)
+        self.archive_size = archive_size
+        # the file object we opened for this archive (closed with the archive)
+        self.owned_fileobj = owned_fileobj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.owned_fileobj is not None:
+            self.owned_fileobj.close()
+
+    @property
+    def members(self):
+        """Returns the list of ArchiveMember for each regular file in the archive."""
+        raise NotImplementedError()
+
+    def open_member(self, member):
+        """Returns a binary file object for the given ArchiveMember."""
+        raise NotImplementedError()
+
+    def extract(self, target_dir, names=None, exclude=None, limits=None):
+        """Extracts the members of this archive into target_dir.
+           If names is given then only members with those names are extracted.
+           Members matching any of the fnmatch patterns in exclude are skipped.
+           limits is an ArchiveLimits (defaults to get_default_limits().)
+           Returns the list of paths (relative to target_dir) that were extracted.
+           Raises ArchiveLimitError if a limit is exceeded. Anything extracted up to that point is left in place."""
+
+        if limits is None:
+            limits = get_default_limits()
+
+        if names is not None:
+            names = set(names)
+
+        extracted = []
+        total_size = 0
+        deadline = time.monotonic() + limits.timeout if limits.timeout else None
+        for member in self.members:
+            if names is not None and member.name not in names:
+                continue
+
+            if exclude and any([fnmatch.fnmatch(member.name, pattern) for pattern in exclude]):
+                continue
+
+            dest_path = get_safe_path(target_dir, member.name)
+            if dest_path is None:
+                logging.debug("skipping archive member with invalid name {}".format(member.name))
+                continue
+
+            if limits.max_member_count and len(extracted) >= limits.max_member_count:
+                raise ArchiveLimitError("archive contains more than {} members".format(limits.max_member_count))
+
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            with self.open_member(member) as fp_in, open(dest_path, 'wb') as fp_out:
+                while True:
+                    data = fp_in.read(BLOCK_SIZE)
+                    if not data:
+                        break
+
+                    # these are checked as we go since the sizes the archive reports can be lies
+                    total_size += len(data)
+                    if limits.max_total_size and total_size > limits.max_total_size:
+                        raise ArchiveLimitError("extracted more than {} bytes".format(limits.max_total_size))
+
+                    if limits.max_ratio and self.archive_size and total_size > RATIO_CHECK_MIN_SIZE \
+                    and total_size / self.archive_size > limits.max_ratio:
+                        raise ArchiveLimitError("extracted more than {} times the size of the archive".format(
+                                                limits.max_ratio))
+
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise ArchiveLimitError("extraction took longer than {} seconds".format(limits.timeout))
+
+                    fp_out.write(data)
+
+            extracted.append(os.path.relpath(dest_path, start=target_dir))
+
+        return extracted
+
+class ZipArchive(Archive):
+    def __init__(self, fileobj, password=DEFAULT_PASSWORD, **kwargs):
+        super().__init__(**kwargs)
+        self.zip_file = zipfile.ZipFile(fileobj, 'r')
+        self.password = password
+        self._members = None
+
+    def close(self):
+        self.zip_file.close()
+        super().close()
+
+    @property
+    def members(self):
+        if self._members is None:
+            self._members = [ ArchiveMember(info.filename, info.file_size, info.compress_size)
+                              for info in self.zip_file.infolist() if not info.is_dir() ]
+
+        return self._members
+
+    def open_member(self, member):
+        return self.zip_file.open(member.name, pwd=self.password)
+
+class TarArchive(Archive):
+    def __init__(self, fileobj, **kwargs):
+        super().__init__(**kwargs)
+        self.tar_file = tarfile.open(fileobj=fileobj, mode='r:*')
+        self._members = None
+        self._tarinfo = {} # key = name, value = tarfile.TarInfo
+
+    def close(self):
+        self.tar_file.close()
+        super().close()
+
+    @property
+    def members(self):
+        if self._members is None:
+            self._members = []
+            for tarinfo in self.tar_file.getmembers():
+                # skip directories, links and devices
+                if not tarinfo.isfile():
+                    continue
+
+                self._tarinfo[tarinfo.name] = tarinfo
+                self._members.append(ArchiveMember(tarinfo.name, tarinfo.size, None))
+
+        return self._members
+
+    def open_member(self, member):
+        # make sure the members have been read
+        self.members
+        return self.tar_file.extractfile(self._tarinfo[member.name])
+
+def is_supported(path):
+    """Returns True if the archive at the given path can be read in-process."""
+    try:
+        return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+    except Exception as e:
+        logging.debug("unable to check archive {}: {}".format(path, e))
+        return False
+
+def open_archive(path=None, fileobj=None):
+    """Opens the archive at the given path (or in the given seekable binary file object.)
+       Returns an Archive, or None if the archive is not in a format that can be read in-process."""
+    assert path or fileobj
+
+    owned_fileobj = None
+    if fileobj is None:
+        fileobj = owned_fileobj = open(path, 'rb')
+
+    try:
+        archive_size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(0)
+
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            return ZipArchive(fileobj, archive_size=archive_size, owned_fileobj=owned_fileobj)
+
+        fileobj.seek(0)
+        try:
+            return TarArchive(fileobj, archive_size=archive_size, owned_fileobj=owned_fileobj)
+        except tarfile.TarError:
+            pass
+
+    except Exception as e:
+        logging.debug("unable to open archive {}: {}".format(path or fileobj, e))
+
+    if owned_fileobj is not None:
+        owned_fileobj.close()
+
+    return None
@@ -17,6 +17,8 @@ import uuid
 import ace_api
 
 import saq
+import saq.metrics
+from saq.constants import METRIC_COLLECTOR_SUBMISSIONS
 from saq.database import use_db, \
                          execute_with_retry, \
                          get_db_connection, \
@@ -40,6 +42,15 @@ NO_WORK_SUBMITTED = 4
 TEST_MODE_STARTUP = 'startup'
 TEST_MODE_SINGLE_SUBMISSION = 'single_submission'
 
+# the result label of the submissions metric
+SUBMISSION_RESULT_SUBMITTED = 'submitted'
+SUBMISSION_RESULT_SKIPPED = 'skipped' # coverage rules
+SUBMISSION_RESULT_RETRY = 'retry' # full delivery and the node was not available
+SUBMISSION_RESULT_FAILED = 'failed'
+
+COLLECTOR_SUBMISSIONS = saq.metrics.counter(METRIC_COLLECTOR_SUBMISSIONS,
+                                            "submissions sent to remote node groups", [ 'group', 'result' ])
+
 class Submission(object):
     """A single analysis submission.
        Keep in mind that this object gets serialized into a database blob via the pickle module.
@@ -117,13 +128,14 @@ class RemoteNode(object):
         """Attempts to submit the given Submission to this node."""
         assert isinstance(submission, Submission)
         # we need to convert the list of files to what is expected by the ace_api.submit function
+        # the files are passed as paths so that ace_api only opens them one at a time as they are sent
         _files = []
         for f in submission.files:
             if isinstance(f, tuple):
                 src_path, dest_name = f
-                _files.append((dest_name, open(os.path.join(self.incoming_dir, submission.uuid, os.path.basename(src_path)), 'rb')))
+                _files.append((dest_name, os.path.join(self.incoming_dir, submission.uuid, os.path.basename(src_path))))
             else:
-                _files.append((os.path.basename(f), open(os.path.join(self.incoming_dir, submission.uuid, os.path.basename(f)), 'rb')))
+                _files.append((os.path.basename(f), os.path.join(self.incoming_dir, submission.uuid, os.path.basename(f))))
 
         #files = [ (os.path.basename(f), open(os.path.join(self.incoming_dir, submission.uuid, os.path.basename(f)), 'rb')) for f in submission.files]
         result = ace_api.submit(
@@ -146,13 +158,6 @@ class RemoteNode(object):
         except Exception as e:
             logging.warning("submission irregularity for {}: {}".format(submission, e))
 
-        # clean up our file descriptors
-        for name, fp in _files:
-            try:
-                fp.close()
-            except Exception as e:
-                logging.error("unable to close file descriptor for {}: {}".format(name, e))
-
         return result
 
 class RemoteNodeGroup(object):
@@ -411,6 +416,7 @@ LIMIT %s""".format(','.join(['%s' for _ in available_modes]))
                 # we'll be skipping this one
                 logging.debug("skipping work id {} for group {} due to coverage constraints".format(
                               work_id, self.name))
+                COLLECTOR_SUBMISSIONS.labels(self.name, SUBMISSION_RESULT_SKIPPED).inc()
             else:
                 # otherwise we try to submit it
                 self.coverage_counter -= 100
@@ -428,6 +434,7 @@ LIMIT %s""".format(','.join(['%s' for _ in available_modes]))
                     submission_result = target.submit(submission)
                     logging.info("{} got submission result {} for {}".format(self, submission_result, submission))
                     submission_success = True
+                    COLLECTOR_SUBMISSIONS.labels(self.name, SUBMISSION_RESULT_SUBMITTED).inc()
                 except Exception as e:
                     log_function = logging.warning
                     if not self.full_delivery:
@@ -447,10 +454,12 @@ LIMIT %s""".format(','.join(['%s' for _ in available_modes]))
                     if self.full_delivery and (isinstance(e, urllib3.exceptions.MaxRetryError) \
                                           or isinstance(e, urllib3.exceptions.NewConnectionError) \
                                           or isinstance(e, requests.exceptions.ConnectionError)):
+                        COLLECTOR_SUBMISSIONS.labels(self.name, SUBMISSION_RESULT_RETRY).inc()
                         continue
 
                     # otherwise we consider it a failure
                     submission_failed = True
+                    COLLECTOR_SUBMISSIONS.labels(self.name, SUBMISSION_RESULT_FAILED).inc()
                     execute_with_retry(db, c, """UPDATE work_distribution SET status = 'ERROR' 
                                                  WHERE group_id = %s AND work_id = %s""",
                                       (self.group_id, work_id), commit=True)
@@ -21,13 +21,30 @@
 # Each of these "types" is managed by a HuntManager which loads the Hunt-based rules and manages the execution
 # of these rules, apply any concurrency constraints required.
 #
+# The HuntManager keeps the hunts in a heap ordered by the time they are next scheduled to execute
+# and executes them on a bounded pool of worker threads. The following optional settings can be added to
+# the hunt_type_ section (or to the service_hunter section to apply to all hunt types)
+#
+# max_workers = COUNT
+# schedule_jitter = DD:HH:MM:SS
+#
+# max_workers is the size of the worker pool
+# schedule_jitter is the maximum random delay added to the first execution of each hunt
+# (so that hundreds of hunts loaded at the same time do not all start at the same time)
+#
 
+import collections
+import concurrent.futures
 import configparser
 import datetime
+import functools
+import heapq
 import importlib
+import itertools
 import logging
 import operator
 import os, os.path
+import random
 import signal
 import threading
 import sqlite3
@@ -35,12 +52,18 @@ import sqlite3
 import pytz
 
 import saq
+import saq.metrics
 from saq.collectors import Collector, Submission
 from saq.constants import *
 from saq.error import report_exception
 from saq.network_semaphore import NetworkSemaphoreClient
 from saq.util import local_time, create_timedelta, abs_path, create_directory
 
+HUNT_EXECUTION_TIME = saq.metrics.histogram(METRIC_HUNT_EXECUTION_TIME, "time spent executing a hunt", [ 'hunt_type' ])
+HUNT_SEMAPHORE_WAIT_TIME = saq.metrics.histogram(METRIC_HUNT_SEMAPHORE_WAIT_TIME,
+                                                 "time spent waiting on the concurrency limit of a hunt type",
+                                                 [ 'hunt_type' ])
+
 def get_hunt_db_path(hunt_type):
     return os.path.join(saq.DATA_DIR, saq.CONFIG['collection']['persistence_dir'], 'hunt', f'{hunt_type}.db')
 
@@ -48,6 +71,46 @@ def open_hunt_db(hunt_type):
     """Utility function to open sqlite3 database with correct parameters."""
     return sqlite3.connect(get_hunt_db_path(hunt_type), detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
 
+class HuntStateWriter(object):
+    """Collects updates to the hunt persistence database and writes them in a single transaction.
+       This keeps the worker threads of a HuntManager from contending over the sqlite database."""
+
+    def __init__(self, hunt_type):
+        self.hunt_type = hunt_type
+        self.lock = threading.Lock()
+        # key = (hunt_name, column), value = the value to write
+        self.pending = {}
+
+    def update(self, hunt_name, column, value):
+        """Queues the update of the given column for the given hunt. Only the latest value is written."""
+        with self.lock:
+            self.pending[(hunt_name, column)] = value
+
+    def flush(self):
+        """Writes all of the pending updates. Returns the number of updates written."""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        if not pending:
+            return 0
+
+        try:
+            with open_hunt_db(self.hunt_type) as db:
+                c = db.cursor()
+                for (hunt_name, column), value in pending.items():
+                    c.execute(f"UPDATE hunt SET {column} = ? WHERE hunt_name = ?", (value, hunt_name))
+                db.commit()
+        except Exception:
+            # put the updates back so they are written next time (unless something newer came in)
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending.setdefault(key, value)
+            raise
+
+        logging.debug(f"wrote {len(pending)} hunt state updates for {self.hunt_type}")
+        return len(pending)
+
 class Hunt(object):
     """Abstract class that represents a single hunt."""
 
@@ -68,13 +131,13 @@ class Hunt(object):
         # a threading.RLock that is held while executing
         self.execution_lock = threading.RLock()
 
-        # a way for the controlling thread to wait for the hunt execution thread to start
-        self.startup_barrier = threading.Barrier(2)
-
         # if this is True then we're executing the Hunt outside of normal operations
         # in that case we don't want to record any of the execution time stamps
         self.manual_hunt = False
 
+        # the HuntStateWriter of the HuntManager that manages this hunt (set by HuntManager.add_hunt)
+        self.state_writer = None
+
     @property
     def last_executed_time(self):
         # if we don't already have this value then load it from the sqlite db
@@ -97,18 +160,30 @@ class Hunt(object):
 
     @last_executed_time.setter
     def last_executed_time(self, value):
+        self.set_last_executed_time(value)
+
+    def set_last_executed_time(self, value, defer=False):
+        """Sets the last_executed_time. If defer is True then the write to the database may be batched."""
         if value.tzinfo is None:
             value = pytz.utc.localize(value)
 
+        # NOTE -- datetime with tzinfo not supported by default timestamp converter in 3.6
+        self.write_state('last_executed_time', value.replace(tzinfo=None), defer=defer)
+        self._last_executed_time = value
+
+    def write_state(self, column, value, defer=False):
+        """Writes the value of the given column of the hunt table for this hunt.
+           If defer is True and this hunt is managed by a HuntManager then the write is queued
+           and written in a batch with the updates of the other hunts."""
+        if defer and self.state_writer is not None:
+            self.state_writer.update(self.name, column, value)
+            return
+
         with open_hunt_db(self.type) as db:
             c = db.cursor()
-            c.execute("UPDATE hunt SET last_executed_time = ? WHERE hunt_name = ?",
-                     (value.replace(tzinfo=None), self.name))
-                     # NOTE -- datetime with tzinfo not supported by default timestamp converter in 3.6
+            c.execute(f"UPDATE hunt SET {column} = ? WHERE hunt_name = ?", (value, self.name))
             db.commit()
 
-        self._last_executed_time = value
-
     def __str__(self):
         return f"Hunt({self.name}[{self.type}])"
 
@@ -123,26 +198,21 @@ class Hunt(object):
         self.execution_lock.acquire()
 
         # remember the last time we executed
-        self.last_executed_time = local_time()
-
-        # notify the manager that this is now executing
-        # this releases the manager thread to continue processing hunts
-        logging.debug(f"clearing barrier for {self}")
-        self.startup_barrier.wait()
+        self.set_last_executed_time(local_time(), defer=True)
 
         submission_list = None
 
         try:
             logging.info(f"executing {self}")
             start_time = local_time()
-            return self.execute(*args, **kwargs)
+            result = self.execute(*args, **kwargs)
             self.record_execution_time(local_time() - start_time)
+            return result
         except Exception as e:
             logging.error(f"{self} failed: {e}")
             report_exception()
             self.record_hunt_exception(e)
         finally:
-            self.startup_barrier.reset()
             self.execution_lock.release()
 
     def execute(self, *args, **kwargs):
@@ -224,13 +294,16 @@ CONCURRENCY_TYPE_LOCAL_SEMAPHORE = 'local_semaphore'
 
 class HuntManager(object):
     """Manages the hunting for a single hunt type."""
-    def __init__(self, collector, hunt_type, rule_dirs, hunt_cls, concurrency_limit, persistence_dir):
+    def __init__(self, collector, hunt_type, rule_dirs, hunt_cls, concurrency_limit, persistence_dir,
+                 max_workers=None, schedule_jitter=None):
         assert isinstance(collector, Collector)
         assert isinstance(hunt_type, str)
         assert isinstance(rule_dirs, list)
         assert issubclass(hunt_cls, Hunt)
         assert concurrency_limit is None or isinstance(concurrency_limit, int) or isinstance(concurrency_limit, str)
         assert isinstance(persistence_dir, str)
+        assert max_workers is None or isinstance(max_workers, int)
+        assert schedule_jitter is None or isinstance(schedule_jitter, datetime.timedelta)
 
         # reference to the collector (used to send the Submission objects)
         self.collector = collector
@@ -269,9 +342,43 @@ CREATE TABLE hunt (
 CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                 db.commit()
 
+        # updates to the sqlite3 database are batched and written by the manager thread
+        self.state_writer = HuntStateWriter(self.hunt_type)
+
         # the list of Hunt objects that are being managed
         self._hunts = []
 
+        # heap of [ scheduled_time, sequence, hunt ] in execution order
+        self._schedule = []
+        # the sequence of the current heap entry for each hunt (entries with any other sequence are stale)
+        self._scheduled = {} # key = hunt name, value = sequence
+        self._schedule_sequence = itertools.count()
+
+        # hunts that have completed execution and need to be scheduled again
+        # these are added by the worker threads and scheduled by the manager thread
+        self._completed_hunts = collections.deque()
+
+        # the maximum amount of (random) time added to the first execution of a hunt
+        if schedule_jitter is None:
+            schedule_jitter = create_timedelta(saq.CONFIG['service_hunter'].get('schedule_jitter',
+                                                                                fallback='00:00:00'))
+        self.schedule_jitter = schedule_jitter
+
+        # the pool of threads that execute the hunts
+        if max_workers is None:
+            max_workers = saq.CONFIG['service_hunter'].getint('max_workers', fallback=10)
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                              thread_name_prefix=f"Hunt Execution {self.hunt_type}")
+
+        # the future of the last execution of each hunt submitted to the executor
+        # a hunt is not submitted again until it has completed (or been cancelled)
+        self._futures = {} # key = hunt name, value = concurrent.futures.Future
+
+        # execution statistics for each hunt (see record_hunt_statistics)
+        self.hunt_statistics_lock = threading.Lock()
+        self.hunt_statistics = {} # key = hunt name, value = dict
+
         # the type of concurrency contraint this type of hunt uses (can be None)
         # use the set_concurrency_limit() function to change it
         self.concurrency_type = None
@@ -323,11 +430,15 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
 
         logging.info(f"{self} reloading hunts")
 
-        # first cancel any currently executing hunts
+        # first cancel any currently executing (or pending) hunts
+        self.cancel_pending_hunts()
         self.cancel_hunts()
         
         # then release all the hunts and load the new ones
         self._hunts = []
+        self._schedule = []
+        self._scheduled = {}
+        self._futures = {}
         self.load_hunts_from_config()
 
     def start(self):
@@ -346,6 +457,9 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         self.manager_control_event.set()
         self.wait_control_event.set()
 
+        # hunts that are waiting for a worker thread are never started
+        self.cancel_pending_hunts()
+
         for hunt in self.hunts:
             try:
                 hunt.cancel()
@@ -355,9 +469,28 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
 
     def wait(self, *args, **kwargs):
         self.manager_control_event.wait(*args, **kwargs)
+        self.cancel_pending_hunts()
         for hunt in self._hunts:
             hunt.wait(*args, **kwargs)
 
+        self.executor.shutdown(wait=False)
+        self.flush_hunt_state()
+
+    def cancel_pending_hunts(self):
+        """Cancels the hunts that have been submitted to the executor but have not started executing yet.
+           Returns the number of hunts cancelled."""
+        count = 0
+        for future in list(self._futures.values()):
+            if future.cancel():
+                count += 1
+
+        return count
+
+    def hunt_pending(self, hunt):
+        """Returns True if the given hunt has been submitted to the executor and has not completed yet."""
+        future = self._futures.get(hunt.name)
+        return future is not None and not future.done()
+
     def loop(self):
         logging.debug(f"started {self}")
         while not self.manager_control_event.is_set():
@@ -368,30 +501,83 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                 report_exception()
                 self.manager_control_event.wait(timeout=1)
 
+            self.flush_hunt_state()
+
             if self.reload_hunts_flag:
                 self.reload_hunts()
 
         logging.debug(f"stopped {self}")
 
+    def flush_hunt_state(self):
+        """Writes any pending hunt state updates to the database."""
+        try:
+            self.state_writer.flush()
+        except Exception as e:
+            logging.error(f"unable to write hunt state for {self}: {e}")
+            report_exception()
+
+    def schedule_hunt(self, hunt, jitter=False):
+        """Schedules the next execution of the given hunt. 
+           If jitter is True then a random delay of up to schedule_jitter is added."""
+        # hunts can be ready before their next execution time (see QueryHunt.ready)
+        scheduled_time = local_time() if hunt.ready else hunt.next_execution_time
+        if jitter and self.schedule_jitter:
+            scheduled_time += datetime.timedelta(seconds=random.uniform(0, self.schedule_jitter.total_seconds()))
+
+        sequence = next(self._schedule_sequence)
+        self._scheduled[hunt.name] = sequence
+        heapq.heappush(self._schedule, [ scheduled_time, sequence, hunt ])
+
     def execute(self):
-        # the next one to run should be the first in our list
-        for hunt in self.hunts:
-            if hunt.ready:
-                self.execute_hunt(hunt)
-                continue
-            else:
-                # this one isn't ready so wait for this hunt to be ready
-                wait_time = (hunt.next_execution_time - local_time()).total_seconds()
-                logging.info(f"next hunt is {hunt} @ {hunt.next_execution_time} ({wait_time} seconds)")
-                self.wait_control_event.wait(wait_time)
-                self.wait_control_event.clear()
-
-                # if a hunt ends while we're waiting, wait_control_event will break out before wait_time seconds
-                # at this point, it's possible there's another hunt ready to execute before this one we're waiting on
-                # so no matter what, we break out so that we re-enter with a re-ordered list of hunts
+        # schedule any hunts that have completed since the last time we were here
+        while self._completed_hunts:
+            hunt = self._completed_hunts.popleft()
+            if hunt in self._hunts and hunt.name not in self._scheduled:
+                self.schedule_hunt(hunt)
+
+        # execute everything that is ready
+        while self._schedule:
+            if self.manager_control_event.is_set():
                 return
 
-    def execute_hunt(self, hunt):
+            scheduled_time, sequence, hunt = self._schedule[0]
+
+            # skip over hunts that have been removed or rescheduled
+            if self._scheduled.get(hunt.name) != sequence or hunt not in self._hunts:
+                heapq.heappop(self._schedule)
+                continue
+
+            if scheduled_time > local_time():
+                break
+
+            heapq.heappop(self._schedule)
+            del self._scheduled[hunt.name]
+
+            # if the hunt is still running (or waiting for a worker thread) then it gets scheduled again when it completes
+            if self.hunt_pending(hunt) or hunt.running:
+                self._completed_hunts.append(hunt)
+                continue
+
+            if not hunt.ready:
+                self.schedule_hunt(hunt)
+                continue
+
+            self.execute_hunt(hunt, scheduled_time)
+
+        # the next one to run is at the top of the heap
+        if self._schedule:
+            scheduled_time, sequence, hunt = self._schedule[0]
+            wait_time = max((scheduled_time - local_time()).total_seconds(), 0)
+            logging.info(f"next hunt is {hunt} @ {scheduled_time} ({wait_time} seconds)")
+        else:
+            wait_time = None
+
+        # if a hunt ends while we're waiting, wait_control_event will break out before wait_time seconds
+        # at this point the hunt needs to be scheduled again so no matter what we return and re-enter
+        self.wait_control_event.wait(wait_time)
+        self.wait_control_event.clear()
+
+    def execute_hunt(self, hunt, scheduled_time=None):
         # are we ready to run another one of these types of hunts?
         # NOTE this will BLOCK until a semaphore is ready OR this manager is shutting down
         start_time = local_time()
@@ -406,18 +592,29 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         if hunt.semaphore is not None:
             self.record_semaphore_acquire_time(local_time() - start_time)
 
-        # start the execution of the hunt on a new thread
-        hunt_execution_thread = threading.Thread(target=self.execute_threaded_hunt, 
-                                                 args=(hunt,),
-                                                 name=f"Hunt Execution {hunt}")
-        hunt_execution_thread.start()
+        # start the execution of the hunt on the worker pool
+        # the hunt may wait in the queue of the executor if all the worker threads are busy
+        # the future is used to avoid submitting it again until then (see hunt_pending)
+        future = self.executor.submit(self.execute_threaded_hunt, hunt, scheduled_time)
+        future.add_done_callback(functools.partial(self._hunt_future_done, hunt))
+        self._futures[hunt.name] = future
+
+    def _hunt_future_done(self, hunt, future):
+        # hunts cancelled before they started still hold the concurrency lock acquired in execute_hunt
+        if future.cancelled():
+            logging.info(f"cancelled pending execution of {hunt}")
+            self.release_concurrency_lock(hunt.semaphore)
+        elif future.exception() is not None:
+            logging.error(f"execution of {hunt} failed: {future.exception()}")
 
-        # wait for the signal that the hunt has started
-        # this will block for a short time to ensure we don't wrap back around before the 
-        # execution lock is acquired
-        hunt.startup_barrier.wait()
+        # at this point this hunt has finished (and its submissions have been queued)
+        # so it is eligible to execute again
+        self._completed_hunts.append(hunt)
+        self.wait_control_event.set()
 
-    def execute_threaded_hunt(self, hunt):
+    def execute_threaded_hunt(self, hunt, scheduled_time=None):
+        submissions = None
+        start_time = local_time()
         try:
             submissions = hunt.execute_with_lock()
         except Exception as e:
@@ -425,8 +622,13 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
             report_exception()
         finally:
             self.release_concurrency_lock(hunt.semaphore)
-            # at this point this hunt has finished and is eligible to execute again
-            self.wait_control_event.set()
+            try:
+                self.record_hunt_statistics(hunt, 
+                                            schedule_lag=start_time - scheduled_time if scheduled_time else None,
+                                            runtime=local_time() - start_time,
+                                            result_count=len(submissions) if submissions else 0)
+            except Exception as e:
+                logging.error(f"unable to record statistics for {hunt}: {e}")
 
         if submissions is not None:
             for submission in submissions:
@@ -540,7 +742,9 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                      (hunt.name,))
             db.commit()
 
+        hunt.state_writer = self.state_writer
         self._hunts.append(hunt)
+        self.schedule_hunt(hunt, jitter=True)
         self.wait_control_event.set()
         return hunt
 
@@ -554,6 +758,7 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
             db.commit()
 
         self._hunts.remove(hunt)
+        self._scheduled.pop(hunt.name, None)
         self.wait_control_event.set()
         return hunt
 
@@ -571,7 +776,44 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         #raise KeyError(f"unknown hunt {hunt.name}")
 
     def record_semaphore_acquire_time(self, time_delta):
-        pass
+        HUNT_SEMAPHORE_WAIT_TIME.labels(self.hunt_type).observe(time_delta.total_seconds())
+
+    def record_hunt_statistics(self, hunt, schedule_lag, runtime, result_count):
+        """Records the statistics of a single execution of the given hunt.
+           schedule_lag is how late the hunt started (or None if it was not scheduled),
+           runtime is how long the hunt took to execute and result_count is the number of submissions."""
+        schedule_lag = max(schedule_lag.total_seconds(), 0) if schedule_lag is not None else 0
+        runtime = runtime.total_seconds()
+        HUNT_EXECUTION_TIME.labels(self.hunt_type).observe(runtime)
+
+        with self.hunt_statistics_lock:
+            stats = self.hunt_statistics.setdefault(hunt.name, {
+                'executions': 0,
+                'last_schedule_lag': 0,
+                'max_schedule_lag': 0,
+                'last_runtime': 0,
+                'total_runtime': 0,
+                'last_result_count': 0,
+                'total_result_count': 0, })
+
+            stats['executions'] += 1
+            stats['last_schedule_lag'] = schedule_lag
+            stats['max_schedule_lag'] = max(stats['max_schedule_lag'], schedule_lag)
+            stats['last_runtime'] = runtime
+            stats['total_runtime'] += runtime
+            stats['last_result_count'] = result_count
+            stats['total_result_count'] += result_count
+
+        logging.debug(f"{hunt} started {schedule_lag:.3f} seconds late, ran for {runtime:.3f} seconds "
+                      f"and returned {result_count} results")
+
+    def get_hunt_statistics(self):
+        """Returns a copy of the execution statistics for the hunts of this manager.
+           The result is a dict where the key is the name of the hunt and the value is a dict of
+           executions, last_schedule_lag, max_schedule_lag, last_runtime, total_runtime,
+           last_result_count and total_result_count (times are in seconds)."""
+        with self.hunt_statistics_lock:
+            return { name: stats.copy() for name, stats in self.hunt_statistics.items() }
 
 class HunterCollector(Collector):
     """Manages and executes the hunts configured for the system."""
@@ -623,6 +865,12 @@ class HunterCollector(Collector):
                               class_name, module_name, section))
                 continue
 
+            # these settings default to what is set for the service
+            max_workers = section.getint('max_workers', fallback=self.service_config.getint('max_workers', 
+                                                                                              fallback=10))
+            schedule_jitter = section.get('schedule_jitter', fallback=self.service_config.get('schedule_jitter',
+                                                                                                fallback='00:00:00'))
+
             logging.debug(f"loading hunt manager for {hunt_type} class {class_definition}")
             self.hunt_managers[hunt_type] = \
                 HuntManager(collector=self,
@@ -630,7 +878,9 @@ class HunterCollector(Collector):
                             rule_dirs=[_.strip() for _ in section['rule_dirs'].split(',')],
                             hunt_cls=class_definition,
                             concurrency_limit=section.get('concurrency_limit', fallback=None),
-                            persistence_dir=self.persistence_dir)
+                            persistence_dir=self.persistence_dir,
+                            max_workers=max_workers,
+                            schedule_jitter=create_timedelta(schedule_jitter))
 
     def extended_collection(self):
         # load each type of hunt from the configuration settings
@@ -3,6 +3,7 @@
 # ACE QRadar Hunting System
 #
 
+import threading
 
 import saq
 from saq.constants import *
@@ -15,16 +16,16 @@ from saq.util import *
 class QRadarHunt(QueryHunt):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # reference to the client used to make the request
-        self.qradar_client = None
+        # references to the clients used to make the requests
+        # there is more than one when the time range is split up (see QueryHunt.max_parallel_slices)
+        self.qradar_clients = []
+        self.qradar_clients_lock = threading.Lock()
 
         # supports hash-style comments
         self.strip_comments = True
 
     def execute_query(self, start_time, end_time, unit_test_query_results=None):
         submissions = [] # of Submission objects
-        self.qradar_client = QRadarAPIClient(saq.CONFIG['qradar']['url'], 
-                                             saq.CONFIG['qradar']['token'])
 
         start_time_str = start_time.strftime('%Y-%m-%d %H:%M %z')
         end_time_str = end_time.strftime('%Y-%m-%d %H:%M %z')
@@ -47,18 +48,27 @@ class QRadarHunt(QueryHunt):
                               event_time=None,
                               files=[])
 
-        # TODO implement the continue check callback
         if unit_test_query_results is not None:
             query_results = unit_test_query_results
         else:
+            qradar_client = QRadarAPIClient(saq.CONFIG['qradar']['url'], 
+                                            saq.CONFIG['qradar']['token'])
+
+            with self.qradar_clients_lock:
+                self.qradar_clients.append(qradar_client)
+
             try:
-                query_results = self.qradar_client.execute_aql_query(target_query, continue_check_callback=None)
+                # TODO implement the continue check callback
+                query_results = qradar_client.execute_aql_query(target_query, continue_check_callback=None)
             except QueryError as e:
                 logging.error(f"query error: {e} for {self}")
                 return None
             except QueryCanceledError:
                 logging.warning(f"query was canceled for {self}")
                 return None
+            finally:
+                with self.qradar_clients_lock:
+                    self.qradar_clients.remove(qradar_client)
 
         event_grouping = {} # key = self.group_by field value, value = Submission
 
@@ -146,8 +156,9 @@ class QRadarHunt(QueryHunt):
         return submissions
 
     def cancel(self):
-        """Cancels the currently executing query."""
-        if self.qradar_client is None:
-            return
+        """Cancels the currently executing queries."""
+        with self.qradar_clients_lock:
+            qradar_clients = self.qradar_clients[:]
 
-        self.qradar_client.cancel_aql_query()
+        for qradar_client in qradar_clients:
+            qradar_client.cancel_aql_query()
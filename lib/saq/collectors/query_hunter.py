@@ -3,6 +3,7 @@
 # ACE Hunting System - query based hunting
 #
 
+import concurrent.futures
 import datetime
 import logging
 import re
@@ -30,6 +31,7 @@ class QueryHunt(Hunt):
                        directives=None,
                        directive_options=None,
                        strip_comments=False,
+                       max_parallel_slices=0,
                        *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -60,11 +62,34 @@ class QueryHunt(Hunt):
         # if this is set to True then hash-style comments are stripped from the loaded query
         self.strip_comments = strip_comments
 
+        # when the time range to cover is larger than time_range (catching up after an outage)
+        # the range is split into slices of time_range that are executed up to this many at a time
+        # the default of 0 executes the entire range as a single query
+        self.max_parallel_slices = max_parallel_slices
+
     def execute_query(self, start_time, end_time, *args, **kwargs):
         """Called to execute the query over the time period given by the start_time and end_time parameters.
-           Returns a list of zero or more Submission objects."""
+           Returns a list of zero or more Submission objects.
+           This can be called concurrently for different time ranges (see max_parallel_slices.)"""
         raise NotImplementedError()
 
+    def get_time_slices(self, start_time, end_time):
+        """Splits the given time range into a list of equal (start_time, end_time) slices.
+           Each slice is at least time_range long and less than twice as long."""
+        if not self.time_range or not self.max_parallel_slices:
+            return [ (start_time, end_time) ]
+
+        count = max(int((end_time - start_time) / self.time_range), 1)
+        slice_range = (end_time - start_time) / count
+
+        result = []
+        for index in range(count):
+            slice_start_time = start_time + (slice_range * index)
+            slice_end_time = end_time if index == count - 1 else slice_start_time + slice_range
+            result.append((slice_start_time, slice_end_time))
+
+        return result
+
     # XXX copy pasta from lib/saq/collectors/hunter.py
     @property
     def last_end_time(self):
@@ -90,18 +115,17 @@ class QueryHunt(Hunt):
 
     @last_end_time.setter
     def last_end_time(self, value):
+        self.set_last_end_time(value)
+
+    def set_last_end_time(self, value, defer=False):
+        """Sets the last_end_time. If defer is True then the write to the database may be batched."""
         if value.tzinfo is None:
             value = pytz.utc.localize(value)
 
         value = value.astimezone(pytz.utc)
 
-        with open_hunt_db(self.type) as db:
-            c = db.cursor()
-            c.execute("UPDATE hunt SET last_end_time = ? WHERE hunt_name = ?",
-                     (value.replace(tzinfo=None), self.name))
-                     # NOTE -- datetime with tzinfo not supported by default timestamp converter in 3.6
-            db.commit()
-
+        # NOTE -- datetime with tzinfo not supported by default timestamp converter in 3.6
+        self.write_state('last_end_time', value.replace(tzinfo=None), defer=defer)
         self._last_end_time = value
 
     @property
@@ -199,6 +223,8 @@ class QueryHunt(Hunt):
         if 'offset' in rule_section:
             self.offset = create_timedelta(rule_section['offset'])
 
+        self.max_parallel_slices = rule_section.getint('max_parallel_slices', fallback=0)
+
         observable_mapping_section = config['observable_mapping']
         
         self.observable_mapping = {}
@@ -246,15 +272,59 @@ class QueryHunt(Hunt):
         offset_start_time = target_start_time = start_time if start_time is not None else self.start_time
         offset_end_time = target_end_time = end_time if end_time is not None else self.end_time
 
+        # the end of the time that was covered by this execution
+        last_end_time = target_end_time
+
         try:
             # the optional offset allows hunts to run at some offset of time
             if not self.manual_hunt and self.offset:
                 offset_start_time -= self.offset
                 offset_end_time -= self.offset
 
-            return self.execute_query(offset_start_time, offset_end_time, *args, **kwargs)
+            if self.manual_hunt:
+                return self.execute_query(offset_start_time, offset_end_time, *args, **kwargs)
+
+            time_slices = self.get_time_slices(offset_start_time, offset_end_time)
+            if len(time_slices) == 1:
+                return self.execute_query(offset_start_time, offset_end_time, *args, **kwargs)
+
+            # we're catching up so we break the range up into multiple smaller queries
+            logging.info(f"{self} splitting {offset_start_time} to {offset_end_time} into {len(time_slices)} queries")
+            max_workers = max(min(self.max_parallel_slices, len(time_slices)), 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [ executor.submit(self.execute_query, slice_start_time, slice_end_time, *args, **kwargs)
+                            for slice_start_time, slice_end_time in time_slices ]
+
+                # the time covered only extends to the end of the slices that completed before the first one failed
+                # the slices after it (and their submissions) are executed again the next time the hunt executes
+                last_end_time = target_start_time
+                submissions = None
+                exceptions = []
+                for (slice_start_time, slice_end_time), future in zip(time_slices, futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"{self} failed to query {slice_start_time} to {slice_end_time}: {e}")
+                        exceptions.append(e)
+                        continue
+
+                    if exceptions:
+                        continue
+
+                    last_end_time = slice_end_time + self.offset if self.offset else slice_end_time
+                    if result is not None:
+                        if submissions is None:
+                            submissions = []
+
+                        submissions.extend(result)
+
+                # nothing was covered
+                if exceptions and last_end_time == target_start_time:
+                    raise exceptions[0]
+
+                return submissions
 
         finally:
             # if we're not manually hunting then record the last end time
             if not self.manual_hunt:
-                self.last_end_time = target_end_time
+                self.set_last_end_time(last_end_time, defer=True)
@@ -5,6 +5,7 @@ import datetime
 import threading
 
 import saq
+from saq.collectors import Submission
 from saq.collectors.hunter import HunterCollector, HuntManager, Hunt, open_hunt_db
 from saq.collectors.test import CollectorBaseTestCase
 from saq.constants import *
@@ -160,4 +161,127 @@ class TestCase(HunterBaseTestCase):
         collector.stop_service()
         collector.wait_service()
 
+    def test_hunt_schedule(self):
+        hunter = HuntManager(**manager_kwargs())
+        hunter.add_hunt(default_hunt(name='test_hunt_3', frequency=create_timedelta('00:30')))
+        hunter.add_hunt(default_hunt(name='test_hunt_2', frequency=create_timedelta('00:20')))
+        hunter.add_hunt(default_hunt(name='test_hunt_1', frequency=create_timedelta('00:10')))
+
+        for hunt in hunter.hunts:
+            hunt.last_executed_time = datetime.datetime.now()
+            hunter.schedule_hunt(hunt)
+
+        # the next hunt to execute is at the top of the heap
+        scheduled_time, sequence, hunt = hunter._schedule[0]
+        self.assertEquals(hunt.name, 'test_hunt_1')
+        self.assertEquals(scheduled_time, hunt.next_execution_time)
+
+        # removed hunts are no longer scheduled
+        hunter.remove_hunt(hunt)
+        self.assertFalse('test_hunt_1' in hunter._scheduled)
+
+    def test_hunt_schedule_jitter(self):
+        kwargs = manager_kwargs()
+        kwargs['schedule_jitter'] = create_timedelta('00:10:00')
+        hunter = HuntManager(**kwargs)
+        start_time = local_time()
+        hunter.add_hunt(default_hunt())
+        scheduled_time, sequence, hunt = hunter._schedule[0]
+        self.assertTrue(scheduled_time >= start_time)
+        self.assertTrue(scheduled_time <= local_time() + create_timedelta('00:10:00'))
+
+    def test_deferred_hunt_persistence(self):
+        hunter = HuntManager(**manager_kwargs())
+        hunt = hunter.add_hunt(default_hunt())
+        hunt.set_last_executed_time(datetime.datetime(2019, 12, 10, 8, 21, 13), defer=True)
+        self.assertEquals(hunt.last_executed_time.year, 2019)
+
+        def _get_last_executed_time():
+            with open_hunt_db(hunt.type) as db:
+                c = db.cursor()
+                c.execute("""SELECT last_executed_time FROM hunt WHERE hunt_name = ?""", (hunt.name,))
+                return c.fetchone()[0]
+
+        # not written until the manager flushes
+        self.assertIsNone(_get_last_executed_time())
+        self.assertEquals(hunter.state_writer.flush(), 1)
+        self.assertEquals(_get_last_executed_time(), datetime.datetime(2019, 12, 10, 8, 21, 13))
+        self.assertEquals(hunter.state_writer.flush(), 0)
+
+    def test_hunt_statistics(self):
+        collector = HunterCollector()
+        collector.start_service(threaded=True)
+        wait_for_log_count('unit test execute marker: Hunt(unit_test_2[test])', 2)
+        collector.stop_service()
+        collector.wait_service()
+
+        stats = collector.hunt_managers['test'].get_hunt_statistics()
+        self.assertTrue('unit_test_2' in stats)
+        self.assertTrue(stats['unit_test_2']['executions'] >= 1)
+        self.assertEquals(stats['unit_test_2']['total_result_count'], 0)
+
+    def test_pending_hunts(self):
+        class BlockingHunt(TestHunt):
+            def execute(self):
+                release_event.wait(timeout=10)
+                logging.info(f"unit test execute marker: {self}")
+
+        release_event = threading.Event()
+        kwargs = manager_kwargs()
+        kwargs['max_workers'] = 1
+        kwargs['concurrency_limit'] = 2
+        hunter = HuntManager(**kwargs)
+        hunt_1 = hunter.add_hunt(BlockingHunt(enabled=True, name='test_hunt_1', description='Test Hunt', type='test',
+                                              frequency=create_timedelta('00:10'), tags=[]))
+        hunt_2 = hunter.add_hunt(default_hunt(name='test_hunt_2'))
+
+        # the second hunt waits for the only worker thread without blocking the manager
+        hunter.execute_hunt(hunt_1)
+        hunter.execute_hunt(hunt_2)
+        self.assertTrue(hunter.hunt_pending(hunt_1))
+        self.assertTrue(hunter.hunt_pending(hunt_2))
+
+        # and is never started once it is cancelled
+        self.assertEquals(hunter.cancel_pending_hunts(), 1)
+        self.assertFalse(hunter.hunt_pending(hunt_2))
+        # the concurrency lock it acquired is released
+        self.assertTrue(hunter.concurrency_semaphore.acquire(blocking=False))
+        hunter.concurrency_semaphore.release()
+
+        release_event.set()
+        hunt_1.wait()
+        hunter.executor.shutdown(wait=True)
+        self.assertEquals(log_count('unit test execute marker: Hunt(test_hunt_1[test])'), 1)
+        self.assertEquals(log_count('unit test execute marker: Hunt(test_hunt_2[test])'), 0)
+
+        # both hunts are eligible to execute again and the manager is woken up
+        self.assertEquals(sorted([ _.name for _ in hunter._completed_hunts ]), [ 'test_hunt_1', 'test_hunt_2' ])
+        self.assertTrue(hunter.wait_control_event.is_set())
+
+    def test_completed_hunt_submissions(self):
+        class SubmissionHunt(TestHunt):
+            def execute(self):
+                return [ Submission(description='test_description', analysis_mode='analysis', tool='unittest_tool',
+                                    tool_instance='unittest_tool_instance', type='unittest_type',
+                                    event_time=datetime.datetime.now(), details={}, observables=[], tags=[],
+                                    files=[]) ]
+
+        kwargs = manager_kwargs()
+        collector = kwargs['collector']
+        hunter = HuntManager(**kwargs)
+        hunt = hunter.add_hunt(SubmissionHunt(enabled=True, name='test_hunt', description='Test Hunt', type='test',
+                                              frequency=create_timedelta('00:10'), tags=[]))
+
+        # the hunt is only rescheduled after its submissions have been queued
+        queue_size = []
+        def _completed(future):
+            queue_size.append(collector.submission_list.qsize())
+
+        hunter.execute_hunt(hunt)
+        hunter._futures[hunt.name].add_done_callback(_completed)
+        hunter.executor.shutdown(wait=True)
+        self.assertEquals(queue_size, [ 1 ])
+        self.assertEquals(list(hunter._completed_hunts), [ hunt ])
+        self.assertTrue(hunter.wait_control_event.is_set())
+
     # TODO test the semaphore locking
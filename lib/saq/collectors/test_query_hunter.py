@@ -17,11 +17,13 @@ class TestQueryHunt(QueryHunt):
         super().__init__(*args, **kwargs)
         self.exec_start_time = None
         self.exec_end_time = None
+        self.exec_ranges = []
 
     def execute_query(self, start_time, end_time):
         logging.info(f"executing query {self.query} {start_time} {end_time}")
         self.exec_start_time = start_time
         self.exec_end_time = end_time
+        self.exec_ranges.append((start_time, end_time))
 
     def cancel(self):
         pass
@@ -47,7 +49,8 @@ def default_hunt(enabled=True,
                  group_by='field1',
                  observable_mapping={},
                  temporal_fields=[],
-                 directives={}):
+                 directives={},
+                 max_parallel_slices=0):
     return TestQueryHunt(enabled=enabled, 
                          name=name, 
                          description=description,
@@ -61,7 +64,8 @@ def default_hunt(enabled=True,
                          group_by=group_by,
                          observable_mapping=observable_mapping,
                          temporal_fields=temporal_fields,
-                         directives=directives)
+                         directives=directives,
+                         max_parallel_slices=max_parallel_slices)
 
 class TestCase(HunterBaseTestCase):
     def setUp(self):
@@ -195,3 +199,85 @@ class TestCase(HunterBaseTestCase):
         # the times passed to hunt.execute_query should be 30 minutes offset
         self.assertEquals(target_start_time - hunt.offset, hunt.exec_start_time)
         self.assertEquals(hunt.last_end_time - hunt.offset, hunt.exec_end_time)
+
+    def test_time_slices(self):
+        manager = HuntManager(**manager_kwargs())
+        hunt = default_hunt(time_range=create_timedelta('01:00:00'), 
+                            frequency=create_timedelta('01:00:00'),
+                            max_parallel_slices=2)
+        manager.add_hunt(hunt)
+
+        # we were down for a little over 3 hours
+        hunt.max_time_range = create_timedelta('1:00:00:00')
+        hunt.last_executed_time = local_time() - datetime.timedelta(hours=4)
+        target_start_time = hunt.last_end_time = local_time() - datetime.timedelta(hours=3, minutes=10)
+        self.assertTrue(hunt.ready)
+        hunt.execute()
+
+        # the time range was split into 3 queries that cover the entire range
+        self.assertEquals(len(hunt.exec_ranges), 3)
+        exec_ranges = sorted(hunt.exec_ranges)
+        self.assertEquals(exec_ranges[0][0], target_start_time)
+        self.assertEquals(exec_ranges[-1][1], hunt.last_end_time)
+        for index in range(1, len(exec_ranges)):
+            self.assertEquals(exec_ranges[index - 1][1], exec_ranges[index][0])
+
+        for start_time, end_time in exec_ranges:
+            self.assertTrue(end_time - start_time >= hunt.time_range)
+            self.assertTrue(end_time - start_time < hunt.time_range * 2)
+
+    def test_time_slices_failure(self):
+        class FailingQueryHunt(TestQueryHunt):
+            def execute_query(self, start_time, end_time):
+                super().execute_query(start_time, end_time)
+                # the second slice (or every slice) fails
+                if self.fail_all or self.last_end_time + self.time_range < start_time < \
+                                    self.last_end_time + self.time_range * 2:
+                    raise RuntimeError("query failed")
+
+                return [ start_time ]
+
+        kwargs = manager_kwargs()
+        kwargs['hunt_cls'] = FailingQueryHunt
+        manager = HuntManager(**kwargs)
+        hunt = FailingQueryHunt(enabled=True, name='test_hunt', description='Test Hunt', type='test_query',
+                                frequency=create_timedelta('01:00:00'), tags=[],
+                                search_query_path='hunts/test/query/test_1.query',
+                                time_range=create_timedelta('01:00:00'), full_coverage=True, group_by='field1',
+                                max_parallel_slices=2)
+        hunt.fail_all = False
+        manager.add_hunt(hunt)
+
+        hunt.max_time_range = create_timedelta('1:00:00:00')
+        hunt.last_executed_time = local_time() - datetime.timedelta(hours=4)
+        target_start_time = hunt.last_end_time = local_time() - datetime.timedelta(hours=3, minutes=10)
+
+        # the submissions of the first slice are kept and the time covered ends where the second slice starts
+        self.assertEquals(hunt.execute(), [ target_start_time ])
+        self.assertEquals(len(hunt.exec_ranges), 3)
+        exec_ranges = sorted(hunt.exec_ranges)
+        self.assertEquals(hunt.last_end_time, exec_ranges[0][1])
+        self.assertEquals(log_count('failed to query'), 1)
+
+        # when nothing is covered the error is raised and the time covered does not change
+        hunt.fail_all = True
+        target_start_time = hunt.last_end_time
+        with self.assertRaises(RuntimeError):
+            hunt.execute()
+
+        self.assertEquals(hunt.last_end_time, target_start_time)
+
+    def test_time_slices_disabled(self):
+        manager = HuntManager(**manager_kwargs())
+        hunt = default_hunt(time_range=create_timedelta('01:00:00'), 
+                            frequency=create_timedelta('01:00:00'))
+        manager.add_hunt(hunt)
+
+        # by default the entire range is executed as a single query
+        hunt.max_time_range = create_timedelta('1:00:00:00')
+        hunt.last_executed_time = local_time() - datetime.timedelta(hours=4)
+        target_start_time = hunt.last_end_time = local_time() - datetime.timedelta(hours=3, minutes=10)
+        self.assertTrue(hunt.ready)
+        hunt.execute()
+
+        self.assertEquals(hunt.exec_ranges, [ (target_start_time, hunt.last_end_time) ])
@@ -416,8 +416,21 @@ ACTION_UN_WHITELIST = 'un_whitelist'
 ACTION_UPLOAD_TO_CRITS = 'upload_crits'
 ACTION_WHITELIST = 'whitelist'
 
-# recorded metrics
+# recorded metrics (see saq.metrics)
 METRIC_THREAD_COUNT = 'thread_count'
+METRIC_HELPER_EXECUTION_TIME = 'ace_helper_execution_seconds'
+METRIC_FUNCTION_EXECUTION_TIME = 'ace_function_execution_seconds'
+METRIC_WORK_ITEMS_STARTED = 'ace_engine_work_items_started'
+METRIC_WORK_ITEMS_FINISHED = 'ace_engine_work_items_finished'
+METRIC_WORK_ITEM_EXECUTION_TIME = 'ace_engine_work_item_seconds'
+METRIC_MODULE_EXECUTION_TIME = 'ace_engine_module_execution_seconds'
+METRIC_WORKLOAD_QUEUE_SIZE = 'ace_engine_workload_queue_size'
+METRIC_DELAYED_ANALYSIS_QUEUE_SIZE = 'ace_engine_delayed_analysis_queue_size'
+METRIC_LOCK_CONTENTION = 'ace_engine_lock_contention'
+METRIC_SEMAPHORE_WAIT_TIME = 'ace_semaphore_wait_seconds'
+METRIC_COLLECTOR_SUBMISSIONS = 'ace_collector_submissions'
+METRIC_HUNT_EXECUTION_TIME = 'ace_hunt_execution_seconds'
+METRIC_HUNT_SEMAPHORE_WAIT_TIME = 'ace_hunt_semaphore_wait_seconds'
 
 # relationships
 R_DOWNLOADED_FROM = 'downloaded_from'
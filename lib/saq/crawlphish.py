@@ -282,16 +282,25 @@ class CrawlphishURLFilter(object):
         """Is this URL in crits?  value is the result of calling process_url on a URL."""
         assert isinstance(value, ParseResult)
 
+        from saq.intel import get_indicator_cache_lookup, sqlite_lower
+
+        # the in-memory lookup tells us if something is there before we go to the database for the details
+        lookup = get_indicator_cache_lookup(cache_path)
+
         with sqlite3.connect('file:{}?mode=ro'.format(cache_path), uri=True) as db:
             db_cursor = db.cursor()
-            row = None
 
-            # check ipv4
-            if is_ipv4(value.hostname):
+            def _query(indicator_type, indicator_value):
+                if (indicator_type, indicator_value) not in lookup:
+                    return None
+
                 db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = ?", 
-                                 (CRITS_IPV4, value.hostname))
+                                 (indicator_type, indicator_value))
+                return db_cursor.fetchone()
 
-                row = db_cursor.fetchone()
+            # check ipv4
+            if is_ipv4(value.hostname):
+                row = _query(CRITS_IPV4, value.hostname)
                 if row:
                     logging.debug("{} matched ipv4 indicator {}".format(value.hostname, row[0]))
                     return True
@@ -299,19 +308,13 @@ class CrawlphishURLFilter(object):
                 # check fqdn
                 for partial_fqdn in iterate_fqdn_parts(value.hostname):
                     #logging.debug("checking crits for {}".format(partial_fqdn))
-                    db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = ?",
-                                     (CRITS_FQDN, partial_fqdn.lower()))
-
-                    row = db_cursor.fetchone()
+                    row = _query(CRITS_FQDN, partial_fqdn.lower())
                     if row:
                         logging.debug("{} matched fqdn indicator {}".format(partial_fqdn, row[0]))
                         return True
                         
             # check full url
-            db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                             (CRITS_URL, value.geturl()))
-
-            row = db_cursor.fetchone()
+            row = _query(CRITS_URL, sqlite_lower(value.geturl()))
             if row:
                 logging.debug("{} matched url indicator{}".format(value.geturl(), row[0]))
                 return True
@@ -319,10 +322,7 @@ class CrawlphishURLFilter(object):
             # check url path
             path = urlunparse(('', '', value.path, value.params, value.query, value.fragment))
             if path:
-                db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                                 (CRITS_URL_PATH, path))
-
-                row = db_cursor.fetchone()
+                row = _query(CRITS_URL_PATH, sqlite_lower(path))
                 if row:
                     logging.debug("{} matched url_path indicator {}".format(value.path, row[0]))
                     return True
@@ -331,10 +331,7 @@ class CrawlphishURLFilter(object):
             if value.path:
                 if not value.path.endswith('/'):
                     file_name = value.path.split('/')[-1]
-                    db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                                     (CRITS_FILE_NAME, file_name))
-
-                    row = db_cursor.fetchone()
+                    row = _query(CRITS_FILE_NAME, sqlite_lower(file_name))
                     if row:
                         logging.debug("{} matched file_name indicator {}".format(file_name, row[0]))
                         return True
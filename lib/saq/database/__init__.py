@@ -751,7 +751,9 @@ class Alert(RootAnalysis, Base):
         self._end_hour = int(_bhours[1])
         self._bt = businesstime.BusinessTime(business_hours=(datetime.time(self._start_hour), datetime.time(self._end_hour)), holidays=SiteHolidays())
         # keep track of what Tag and Observable objects we add as we analyze
-        self._tracked_tags = [] # of saq.analysis.Tag
+        # these are written to the database in a single transaction the next time the Alert is saved
+        # see sync_tracked_objects()
+        self._tracked_tags = [] # of tuple(source, saq.analysis.Tag)
         self._tracked_observables = [] # of saq.analysis.Observable
         self._synced_tags = set() # of Tag.name
         self._synced_observables = set() # of '{}:{}'.format(observable.type, observable.value)
@@ -1144,13 +1146,8 @@ class Alert(RootAnalysis, Base):
     def _handle_tag_added(self, source, event_type, *args, **kwargs):
         assert args
         assert isinstance(args[0], saq.analysis.Tag)
-        tag = args[0]
-
-        try:
-            self.sync_tag_mapping(tag)
-        except Exception as e:
-            logging.error("sync_tag_mapping failed: {}".format(e))
-            report_exception()
+        # the mapping is written the next time the alert is saved
+        self._tracked_tags.append((source, args[0]))
 
     def sync_tag_mapping(self, tag):
         tag_id = None
@@ -1198,13 +1195,8 @@ class Alert(RootAnalysis, Base):
     def _handle_observable_added(self, source, event_type, *args, **kwargs):
         assert args
         assert isinstance(args[0], saq.analysis.Observable)
-        observable = args[0]
-
-        try:
-            self.sync_observable_mapping(observable)
-        except Exception as e:
-            logging.error("sync_observable_mapping failed: {}".format(e))
-            #report_exception()
+        # the mapping is written the next time the alert is saved
+        self._tracked_observables.append(args[0])
 
     @retry
     def sync_observable_mapping(self, observable):
@@ -1274,35 +1266,61 @@ class Alert(RootAnalysis, Base):
 
         return True
 
-    #@track_execution_time
-    #def sync_tracked_objects(self):
-        #"""Updates the observable_mapping and tag_mapping tables according to what objects were added during analysis."""
+    @track_execution_time
+    def sync_tracked_objects(self):
+        """Updates the observables, tags, observable_mapping, tag_mapping and observable_tag_index tables
+           with the Tag and Observable objects that were added since the last time this was called.
+           Everything is written in a single transaction."""
         # make sure we have something to do
-        #if not self._tracked_tags and not self._tracked_observables:
-            #return
-
-        #with get_db_connection() as db:
-            #c = db.cursor()
-            #if self._tracked_tags:
-                #logging.debug("syncing {} tags to {}".format(len(self._tracked_tags), self))
-                #self._sync_tags(db, c, self._tracked_tags)
+        if not self._tracked_tags and not self._tracked_observables:
+            return
+
+        tracked_tags = self._tracked_tags
+        tracked_observables = self._tracked_observables
+        self._tracked_tags = []
+        self._tracked_observables = []
+
+        observables = list(tracked_observables)
+        tag_names = set()
+        observable_tags = [] # of tuple(observable, tag_name)
+
+        for source, tag in tracked_tags:
+            tag_names.add(tag.name)
+            if isinstance(source, saq.analysis.Observable):
+                observables.append(source)
+                observable_tags.append((source, tag.name))
+
+        # observables can be tagged before they are added
+        for observable in tracked_observables:
+            for tag in observable.tags:
+                tag_names.add(tag.name)
+                observable_tags.append((observable, tag.name))
 
-            #if self._tracked_observables:
-                #logging.debug("syncing {} observables to {}".format(len(self._tracked_observables), self))
-                #self._sync_observables(db, c, self._tracked_observables)
+        logging.debug("syncing {} tags and {} observables to {}".format(
+                      len(tracked_tags), len(tracked_observables), self))
 
-            #db.commit()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                with get_db_connection() as db:
+                    c = db.cursor()
+                    execute_with_retry(db, c, self._sync_index, observables, tag_names, observable_tags)
+        except Exception as e:
+            logging.error("unable to sync tracked objects for {}: {}".format(self, e))
+            report_exception()
+            # try again the next time we save
+            self._tracked_tags = tracked_tags + self._tracked_tags
+            self._tracked_observables = tracked_observables + self._tracked_observables
 
-        #self._tracked_tags.clear()
-        #self._tracked_observables.clear()
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
 
-    #def flush(self):
-        #super().flush()
-        
         # if this Alert is in the database then
         # we want to go ahead and update if we added any new Tags or Observables
-        #if self.id:
-            #self.sync_tracked_objects()
+        if self.id:
+            self.sync_tracked_objects()
+
+        return result
 
     def reset(self):
         super().reset()
@@ -1323,99 +1341,148 @@ class Alert(RootAnalysis, Base):
                 c = db.cursor()
                 execute_with_retry(db, c, self._rebuild_index)
 
-    def _rebuild_index(self, db, c):
+    def _rebuild_index(self, db, c, commit=True):
         logging.info(f"rebuilding indexes for {self}")
-        c.execute("""DELETE FROM observable_mapping WHERE alert_id = %s""", ( self.id, ))
-        c.execute("""DELETE FROM tag_mapping WHERE alert_id = %s""", ( self.id, ))
-        c.execute("""DELETE FROM observable_tag_index WHERE alert_id = %s""", ( self.id, ))
 
-        tag_names = tuple([ tag.name for tag in self.all_tags ])
-        if tag_names:
-            sql = "INSERT IGNORE INTO tags ( name ) VALUES {}".format(','.join(['(%s)' for name in tag_names]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tag_names)
+        # anything tracked so far is included in the rebuild
+        self._tracked_tags = []
+        self._tracked_observables = []
 
         all_observables = self.all_observables
-
-        observables = []
-        observable_hash_mapping = {} # key = md5, value = observable
+        observable_tags = []
         for observable in all_observables:
-            observables.append(observable.type)
-            observables.append(observable.value)
-            observables.append(observable.md5_hex)
-            observable_hash_mapping[observable.md5_hex] = observable
+            for tag in observable.tags:
+                observable_tags.append((observable, tag.name))
+
+        self._sync_index(db, c, all_observables, set([tag.name for tag in self.all_tags]), observable_tags,
+                         remove_stale=True, commit=commit)
+
+    def _sync_index(self, db, c, observables, tag_names, observable_tags, remove_stale=False, commit=True):
+        """Brings the observable_mapping, tag_mapping and observable_tag_index tables up to date for this Alert.
+           Only the rows that are missing are inserted. If remove_stale is True then rows that are not in
+           the given observables, tag_names and observable_tags are deleted.  Existing rows are left alone.
+           If commit is False then the caller is responsible for committing the transaction."""
+
+        # make sure every tag is also mapped to the alert
+        tag_names = set(tag_names) | set([tag_name for observable, tag_name in observable_tags])
+        tag_names = tuple(tag_names)
+
+        unique_observables = {} # key = (type, md5), value = observable
+        for observable in observables:
+            unique_observables[(observable.type, observable.md5_hex.lower())] = observable
+        for observable, tag_name in observable_tags:
+            unique_observables[(observable.type, observable.md5_hex.lower())] = observable
+
+        observables = list(unique_observables.values())
+
+        if tag_names:
+            sql = "INSERT IGNORE INTO tags ( name ) VALUES {}".format(','.join(['(%s)' for name in tag_names]))
+            c.execute(sql, tag_names)
 
-        observables = tuple(observables)
+        if observables:
+            parameters = []
+            for observable in observables:
+                parameters.append(observable.type)
+                parameters.append(observable.value)
+                parameters.append(observable.md5_hex)
 
-        if all_observables:
-            sql = "INSERT IGNORE INTO observables ( type, value, md5 ) VALUES {}".format(','.join('(%s, %s, UNHEX(%s))' for o in all_observables))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, observables)
+            sql = "INSERT IGNORE INTO observables ( type, value, md5 ) VALUES {}".format(
+                  ','.join(['(%s, %s, UNHEX(%s))' for o in observables]))
+            c.execute(sql, tuple(parameters))
 
         tag_mapping = {} # key = tag_name, value = tag_id
         if tag_names:
             sql = "SELECT id, name FROM tags WHERE name IN ( {} )".format(','.join(['%s' for name in tag_names]))
-            #logging.debug(f"MARKER: sql = {sql}")
             c.execute(sql, tag_names)
-
-            for row in c:
-                tag_id, tag_name = row
+            for tag_id, tag_name in c:
                 tag_mapping[tag_name] = tag_id
 
-            sql = "INSERT INTO tag_mapping ( alert_id, tag_id ) VALUES {}".format(','.join(['(%s, %s)' for name in tag_mapping.values()]))
-            #logging.debug(f"MARKER: sql = {sql}")
+        observable_mapping = {} # key = (type, md5), value = observable_id
+        if observables:
+            sql = "SELECT id, type, HEX(md5) FROM observables WHERE md5 IN ( {} )".format(
+                  ','.join(['UNHEX(%s)' for o in observables]))
+            c.execute(sql, tuple([o.md5_hex for o in observables]))
+            for observable_id, o_type, md5_hex in c:
+                observable_mapping[(o_type, md5_hex.lower())] = observable_id
+
+        # compute what the tables should contain
+        desired_tag_ids = set(tag_mapping.values())
+        desired_observable_ids = set()
+        for key in unique_observables.keys():
+            if key in observable_mapping:
+                desired_observable_ids.add(observable_mapping[key])
+
+        desired_observable_tags = set()
+        for observable, tag_name in observable_tags:
+            try:
+                tag_id = tag_mapping[tag_name]
+                observable_id = observable_mapping[(observable.type, observable.md5_hex.lower())]
+            except KeyError:
+                logging.debug(f"missing mapping for tag {tag_name} in observable {observable} alert {self.uuid}")
+                continue
+
+            desired_observable_tags.add((observable_id, tag_id))
+
+        # and then see what they already contain
+        c.execute("SELECT tag_id FROM tag_mapping WHERE alert_id = %s", ( self.id, ))
+        existing_tag_ids = set([row[0] for row in c])
+        c.execute("SELECT observable_id FROM observable_mapping WHERE alert_id = %s", ( self.id, ))
+        existing_observable_ids = set([row[0] for row in c])
+        c.execute("SELECT observable_id, tag_id FROM observable_tag_index WHERE alert_id = %s", ( self.id, ))
+        existing_observable_tags = set([tuple(row) for row in c])
+
+        new_tag_ids = desired_tag_ids - existing_tag_ids
+        if new_tag_ids:
+            sql = "INSERT IGNORE INTO tag_mapping ( alert_id, tag_id ) VALUES {}".format(
+                  ','.join(['(%s, %s)' for _ in new_tag_ids]))
             parameters = []
-            for tag_id in tag_mapping.values():
+            for tag_id in new_tag_ids:
                 parameters.append(self.id)
                 parameters.append(tag_id)
 
             c.execute(sql, tuple(parameters))
 
-        observable_mapping = {} # key = observable_id, value = observable
-        if all_observables:
-            sql = "SELECT id, HEX(md5) FROM observables WHERE md5 IN ( {} )".format(','.join(['UNHEX(%s)' for o in all_observables]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tuple([o.md5_hex for o in all_observables]))
-
-            for row in c:
-                observable_id, md5_hex = row
-                observable_mapping[md5_hex.lower()] = observable_id
-
-            sql = "INSERT INTO observable_mapping ( alert_id, observable_id ) VALUES {}".format(','.join(['(%s, %s)' for o in observable_mapping.keys()]))
-            #logging.debug(f"MARKER: sql = {sql}")
+        new_observable_ids = desired_observable_ids - existing_observable_ids
+        if new_observable_ids:
+            sql = "INSERT IGNORE INTO observable_mapping ( alert_id, observable_id ) VALUES {}".format(
+                  ','.join(['(%s, %s)' for _ in new_observable_ids]))
             parameters = []
-            for observable_id in observable_mapping.values():
+            for observable_id in new_observable_ids:
                 parameters.append(self.id)
                 parameters.append(observable_id)
 
             c.execute(sql, tuple(parameters))
 
-        sql = "INSERT IGNORE INTO observable_tag_index ( alert_id, observable_id, tag_id ) VALUES "
-        parameters = []
-        sql_clause = []
-
-        for observable in all_observables:
-            for tag in observable.tags:
-                try:
-                    tag_id = tag_mapping[tag.name]
-                except KeyError:
-                    logging.debug(f"missing tag mapping for tag {tag.name} in observable {observable} alert {self.uuid}")
-                    continue
-
-                observable_id = observable_mapping[observable.md5_hex.lower()]
-
+        new_observable_tags = desired_observable_tags - existing_observable_tags
+        if new_observable_tags:
+            sql = "INSERT IGNORE INTO observable_tag_index ( alert_id, observable_id, tag_id ) VALUES {}".format(
+                  ','.join(['(%s, %s, %s)' for _ in new_observable_tags]))
+            parameters = []
+            for observable_id, tag_id in new_observable_tags:
                 parameters.append(self.id)
                 parameters.append(observable_id)
                 parameters.append(tag_id)
-                sql_clause.append('(%s, %s, %s)')
 
-        if sql_clause:
-            sql += ','.join(sql_clause)
-            #logging.debug(f"MARKER: sql = {sql}")
             c.execute(sql, tuple(parameters))
 
-        db.commit()
-        
+        if remove_stale:
+            stale_tag_ids = tuple(existing_tag_ids - desired_tag_ids)
+            if stale_tag_ids:
+                c.execute("DELETE FROM tag_mapping WHERE alert_id = %s AND tag_id IN ( {} )".format(
+                          ','.join(['%s' for _ in stale_tag_ids])), ( self.id, ) + stale_tag_ids)
+
+            stale_observable_ids = tuple(existing_observable_ids - desired_observable_ids)
+            if stale_observable_ids:
+                c.execute("DELETE FROM observable_mapping WHERE alert_id = %s AND observable_id IN ( {} )".format(
+                          ','.join(['%s' for _ in stale_observable_ids])), ( self.id, ) + stale_observable_ids)
+
+            for observable_id, tag_id in existing_observable_tags - desired_observable_tags:
+                c.execute("DELETE FROM observable_tag_index WHERE alert_id = %s AND observable_id = %s AND tag_id = %s",
+                          ( self.id, observable_id, tag_id ))
+
+        if commit:
+            db.commit()
+
     @track_execution_time
     def rebuild_index_old(self):
         """Rebuilds the data for this Alert in the observables, tags, observable_mapping and tag_mapping tables."""
@@ -1608,6 +1675,144 @@ WHERE
             report_exception()
             continue
 
+def _load_alert_for_rebuild(alert_id, storage_dir):
+    """Returns a detached Alert loaded from the given storage directory for rebuilding the index, or None if it could
+       not be loaded. Only the JSON of the root is loaded (which includes the observables and tags, but not the
+       analysis details.)"""
+    try:
+        alert = Alert(storage_dir=storage_dir)
+        alert.load()
+        alert.id = alert_id
+        return alert
+    except Exception as e:
+        logging.error(f"unable to load alert {alert_id} from {storage_dir}: {e}")
+        return None
+
+def rebuild_indexes(alerts):
+    """Rebuilds the observable and tag indexes for the given list of (alert_id, storage_dir) tuples.
+       The changes for all of the alerts are written in a single transaction. If that transaction fails then each
+       alert is retried in its own transaction so that a single bad alert does not fail the entire batch.
+       Returns a tuple of (rebuilt, failed) where each is a list of alert ids."""
+
+    loaded = []
+    failed = []
+    for alert_id, storage_dir in alerts:
+        alert = _load_alert_for_rebuild(alert_id, storage_dir)
+        if alert is None:
+            failed.append(alert_id)
+        else:
+            loaded.append(alert)
+
+    if not loaded:
+        return [], failed
+
+    def _rebuild_batch(db, c):
+        for alert in loaded:
+            alert._rebuild_index(db, c, commit=False)
+
+        db.commit()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with get_db_connection() as db:
+            c = db.cursor()
+            try:
+                execute_with_retry(db, c, _rebuild_batch)
+                return [alert.id for alert in loaded], failed
+            except Exception as e:
+                logging.warning(f"batch rebuild of {len(loaded)} alerts failed ({e}) -- rebuilding one at a time")
+                db.rollback()
+
+            rebuilt = []
+            for alert in loaded:
+                try:
+                    execute_with_retry(db, c, alert._rebuild_index)
+                    rebuilt.append(alert.id)
+                except Exception as e:
+                    logging.error(f"rebuild failure on {alert.storage_dir}: {e} ({type(e)})")
+                    db.rollback()
+                    failed.append(alert.id)
+
+            return rebuilt, failed
+
+def rebuild_all_indexes(alerts, workers=1, batch_size=100, checkpoint_path=None, progress_interval=10):
+    """Rebuilds the observable and tag indexes for the given list of (alert_id, storage_dir) tuples.
+
+       :param workers: The number of processes to use. A value of 1 rebuilds in the current process.
+       :param batch_size: The number of alerts to rebuild in a single transaction.
+       :param checkpoint_path: Optional path to a file that records the ids of the alerts that have been rebuilt.
+       Alerts listed in an existing checkpoint file are skipped, which allows an interrupted rebuild to resume.
+       The file is removed once every alert has been rebuilt.
+       :param progress_interval: How often (in seconds) progress is logged.
+
+       Returns a tuple of (rebuilt, failed) where each is a list of alert ids."""
+    import concurrent.futures
+
+    completed = set()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    completed.add(int(line))
+
+        logging.info(f"resuming rebuild from {checkpoint_path} ({len(completed)} alerts already rebuilt)")
+
+    alerts = [ (alert_id, storage_dir) for alert_id, storage_dir in alerts if alert_id not in completed ]
+    batches = [ alerts[i:i + batch_size] for i in range(0, len(alerts), batch_size) ]
+    logging.info(f"rebuilding indexes for {len(alerts)} alerts in {len(batches)} batches using {workers} workers")
+
+    checkpoint_fp = None
+    if checkpoint_path:
+        checkpoint_fp = open(checkpoint_path, 'a')
+
+    rebuilt = []
+    failed = []
+    start_time = time.time()
+    last_progress = start_time
+
+    def _batch_completed(result):
+        nonlocal last_progress
+        batch_rebuilt, batch_failed = result
+        rebuilt.extend(batch_rebuilt)
+        failed.extend(batch_failed)
+        if checkpoint_fp is not None and batch_rebuilt:
+            checkpoint_fp.write(''.join([f'{alert_id}\n' for alert_id in batch_rebuilt]))
+            checkpoint_fp.flush()
+
+        now = time.time()
+        if now - last_progress >= progress_interval:
+            last_progress = now
+            logging.info("rebuilt {} of {} alerts ({} failed) {:.1f} alerts/sec".format(
+                         len(rebuilt), len(alerts), len(failed), len(rebuilt) / (now - start_time)))
+
+    try:
+        if workers <= 1:
+            for batch in batches:
+                _batch_completed(rebuild_indexes(batch))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [ executor.submit(rebuild_indexes, batch) for batch in batches ]
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        _batch_completed(future.result())
+                    except Exception as e:
+                        logging.error(f"rebuild worker failed: {e}")
+                        report_exception()
+    finally:
+        if checkpoint_fp is not None:
+            checkpoint_fp.close()
+
+    elapsed = time.time() - start_time
+    logging.info("rebuilt {} alerts ({} failed) in {:.1f} seconds ({:.1f} alerts/sec)".format(
+                 len(rebuilt), len(failed), elapsed, len(rebuilt) / elapsed if elapsed else 0.0))
+
+    # once every alert has been rebuilt there is nothing left to resume
+    if checkpoint_path and not failed and len(rebuilt) == len(alerts) and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return rebuilt, failed
+
 class Similarity:
     def __init__(self, uuid, disposition, percent):
         self.uuid = uuid
@@ -1768,6 +1973,8 @@ def add_observable_tag_mapping(o_type, o_value, o_md5, tag):
     except NoResultFound as e:
         saq.db.execute(ObservableTagMapping.__table__.insert().values(observable_id=observable.id, tag_id=tag.id))
         saq.db.commit()
+        # cached lookups of the tags of this observable are no longer valid
+        saq.analysis.clear_tag_cache()
         return True
 
 def remove_observable_tag_mapping(o_type, o_value, o_md5, tag):
@@ -1798,6 +2005,7 @@ def remove_observable_tag_mapping(o_type, o_value, o_md5, tag):
     saq.db.execute(ObservableTagMapping.__table__.delete().where(and_(ObservableTagMapping.observable_id == observable.id,
                                                                  ObservableTagMapping.tag_id == tag.id)))
     saq.db.commit()
+    saq.analysis.clear_tag_cache()
     return True
 
 # this is used to map what observables had what tags in what alerts
@@ -2289,8 +2497,15 @@ class DelayedAnalysis(Base):
         unique=False, 
         nullable=False)
 
+# the results of add_delayed_analysis_request
+DELAYED_ANALYSIS_ADDED = 'added' # the request was added
+DELAYED_ANALYSIS_EXISTS = 'exists' # the same request was already waiting
+DELAYED_ANALYSIS_FAILED = 'failed' # the request could not be added
+
 @use_db
 def add_delayed_analysis_request(root, observable, analysis_module, next_analysis, exclusive_uuid=None, db=None, c=None):
+    """Adds a request to the delayed_analysis table. 
+       Returns one of DELAYED_ANALYSIS_ADDED, DELAYED_ANALYSIS_EXISTS or DELAYED_ANALYSIS_FAILED."""
     try:
         #logging.info("adding delayed analysis uuid {} observable_uuid {} analysis_module {} delayed_until {} node {} exclusive_uuid {} storage_dir {}".format(
                      #root.uuid, observable.id, analysis_module.config_section, next_analysis, saq.SAQ_NODE_ID, exclusive_uuid, root.storage_dir))
@@ -2304,16 +2519,18 @@ def add_delayed_analysis_request(root, observable, analysis_module, next_analysi
         logging.info("added delayed analysis uuid {} observable_uuid {} analysis_module {} delayed_until {} node {} exclusive_uuid {} storage_dir {}".format(
                      root.uuid, observable.id, analysis_module.config_section, next_analysis, saq.SAQ_NODE_ID, exclusive_uuid, root.storage_dir))
 
+        return DELAYED_ANALYSIS_ADDED
+
     except pymysql.err.IntegrityError as ie:
         logging.warning(str(ie))
         logging.warning("already waiting for delayed analysis on {} by {} for {}".format(
                          root, analysis_module.config_section, observable))
-        return True
+        return DELAYED_ANALYSIS_EXISTS
     except Exception as e:
         logging.error("unable to insert delayed analysis on {} by {} for {}: {}".format(
                          root, analysis_module.config_section, observable, e))
         report_exception()
-        return False
+        return DELAYED_ANALYSIS_FAILED
 
 @use_db
 def clear_delayed_analysis_requests(root, db, c):
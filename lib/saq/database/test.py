@@ -1,7 +1,9 @@
 # vim: sw=4:ts=4:et
 
+import json
 import logging
 import multiprocessing
+import os, os.path
 import threading
 import time
 import unittest
@@ -406,6 +408,92 @@ class TestCase(ACEBasicTestCase):
 
         self.assertEquals(len(alert.description), 1024)
 
+    def test_archive_alerts(self):
+        from saq.util.maintenance import archive_alerts
+
+        root_analysis = create_root_analysis()
+        root_analysis.save()
+        alert = Alert(storage_dir=root_analysis.storage_dir)
+        alert.load()
+        alert.disposition = DISPOSITION_FALSE_POSITIVE
+        alert.sync()
+        alert_id = alert.id
+        saq.db.remove()
+
+        self.assertEquals(archive_alerts([ (alert_id, alert.storage_dir) ]), [ alert_id ])
+
+        # the data.json written by the archive keeps the fields that came from the database
+        alert = saq.db.query(Alert).filter(Alert.id == alert_id).one()
+        self.assertTrue(alert.archived)
+        with open(alert.json_path, 'r') as fp:
+            data = json.load(fp)
+
+        self.assertEquals(data[Alert.KEY_DATABASE_ID], alert_id)
+        self.assertEquals(data[Alert.KEY_DISPOSITION], DISPOSITION_FALSE_POSITIVE)
+        saq.db.remove()
+
+        # alerts that are already archived are skipped
+        self.assertEquals(archive_alerts([ (alert_id, alert.storage_dir) ]), [])
+
+    def test_archive_alerts_workers(self):
+        from saq.util.maintenance import archive_alerts, _process_batches
+
+        alerts = []
+        for _ in range(4):
+            root_analysis = create_root_analysis(uuid=str(uuid.uuid4()))
+            root_analysis.save()
+            alert = Alert(storage_dir=root_analysis.storage_dir)
+            alert.load()
+            alert.disposition = DISPOSITION_FALSE_POSITIVE
+            alert.sync()
+            alerts.append((alert.id, alert.storage_dir))
+
+        saq.db.remove()
+
+        # each worker process uses it's own database connections
+        self.assertEquals(_process_batches(archive_alerts, alerts, 2, 1, 0), 4)
+        for alert in saq.db.query(Alert).filter(Alert.id.in_([ alert_id for alert_id, _ in alerts ])):
+            self.assertTrue(alert.archived)
+
+        saq.db.remove()
+
+        # and the connections of this process still work
+        self.assertEquals(_process_batches(archive_alerts, alerts, 2, 1, 0), 0)
+        self.assertEquals(log_count('cleanup worker failed'), 0)
+
+    def test_add_delayed_analysis_request(self):
+        import datetime
+        from saq.database import add_delayed_analysis_request, \
+                                 DELAYED_ANALYSIS_ADDED, DELAYED_ANALYSIS_EXISTS, DELAYED_ANALYSIS_FAILED
+        from saq.modules.test import BasicTestAnalyzer
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        root.save()
+
+        analysis_module = BasicTestAnalyzer('analysis_module_basic_test')
+        next_analysis = datetime.datetime.now() + datetime.timedelta(minutes=5)
+
+        self.assertEquals(add_delayed_analysis_request(root, observable, analysis_module, next_analysis),
+                          DELAYED_ANALYSIS_ADDED)
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("SELECT COUNT(*) FROM delayed_analysis WHERE uuid = %s", (root.uuid,))
+            self.assertEquals(c.fetchone()[0], 1)
+
+        # integrity errors are reported as a request that is already waiting
+        storage_dir = root.storage_dir
+        root.storage_dir = None
+        self.assertEquals(add_delayed_analysis_request(root, observable, analysis_module, next_analysis),
+                          DELAYED_ANALYSIS_EXISTS)
+        root.storage_dir = storage_dir
+
+        # anything else is a failure
+        self.assertEquals(add_delayed_analysis_request(root, None, analysis_module, next_analysis),
+                          DELAYED_ANALYSIS_FAILED)
+
     def test_sync_observable_mapping(self):
         root_analysis = create_root_analysis()
         root_analysis.save()
@@ -421,6 +509,95 @@ class TestCase(ACEBasicTestCase):
         observable = saq.db.query(Observable).filter(Observable.type == o1.type, Observable.md5 == func.UNHEX(o1.md5_hex)).first()
         self.assertIsNotNone(observable)
 
+    def test_sync_tracked_objects(self):
+        root_analysis = create_root_analysis()
+        root_analysis.save()
+        alert = Alert(storage_dir=root_analysis.storage_dir)
+        alert.load()
+        alert.sync()
+
+        o1 = alert.add_observable(F_TEST, 'test_1')
+        o1.add_tag('test_tag')
+        alert.add_tag('alert_tag')
+
+        def _get_mapping():
+            with get_db_connection() as db:
+                c = db.cursor()
+                c.execute("""SELECT o.value FROM observable_mapping om JOIN observables o ON om.observable_id = o.id
+                             WHERE om.alert_id = %s""", (alert.id,))
+                observables = set([_[0].decode() for _ in c])
+                c.execute("""SELECT t.name FROM tag_mapping tm JOIN tags t ON tm.tag_id = t.id
+                             WHERE tm.alert_id = %s""", (alert.id,))
+                tags = set([_[0] for _ in c])
+                c.execute("""SELECT COUNT(*) FROM observable_tag_index WHERE alert_id = %s""", (alert.id,))
+                return observables, tags, c.fetchone()[0]
+
+        # nothing is written until the alert is saved
+        self.assertEquals(_get_mapping(), (set(), set(), 0))
+        self.assertEquals(len(alert._tracked_observables), 1)
+        self.assertEquals(len(alert._tracked_tags), 2)
+
+        alert.save()
+        self.assertEquals(_get_mapping(), ({'test_1'}, {'test_tag', 'alert_tag'}, 1))
+        self.assertFalse(alert._tracked_observables)
+        self.assertFalse(alert._tracked_tags)
+
+        # rebuilding the index does not change anything that is already there
+        alert.rebuild_index()
+        self.assertEquals(_get_mapping(), ({'test_1'}, {'test_tag', 'alert_tag'}, 1))
+
+        # rebuilding removes what is no longer in the alert
+        alert.tags = []
+        alert.rebuild_index()
+        self.assertEquals(_get_mapping(), ({'test_1'}, {'test_tag'}, 1))
+
+    def test_rebuild_all_indexes(self):
+        from saq.database import rebuild_all_indexes
+
+        alerts = []
+        for index in range(5):
+            root_analysis = create_root_analysis(uuid=str(uuid.uuid4()))
+            root_analysis.initialize_storage()
+            root_analysis.add_observable(F_TEST, f'test_{index}')
+            root_analysis.add_tag('rebuild_tag')
+            root_analysis.save()
+            alert = Alert(storage_dir=root_analysis.storage_dir)
+            alert.load()
+            alert.sync()
+            alerts.append((alert.id, alert.storage_dir))
+
+        def _get_counts():
+            with get_db_connection() as db:
+                c = db.cursor()
+                c.execute("SELECT COUNT(*) FROM observable_mapping")
+                observable_count = c.fetchone()[0]
+                c.execute("SELECT COUNT(*) FROM tag_mapping")
+                return observable_count, c.fetchone()[0]
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("DELETE FROM observable_mapping")
+            c.execute("DELETE FROM tag_mapping")
+            db.commit()
+
+        # an alert that cannot be loaded fails without affecting the rest of the batch
+        checkpoint_path = os.path.join(saq.TEMP_DIR, 'rebuild.checkpoint')
+        rebuilt, failed = rebuild_all_indexes(alerts + [ (-1, 'missing') ], workers=2, batch_size=2,
+                                              checkpoint_path=checkpoint_path)
+        self.assertEquals(sorted(rebuilt), sorted([alert_id for alert_id, storage_dir in alerts]))
+        self.assertEquals(failed, [-1])
+        self.assertEquals(_get_counts(), (5, 5))
+
+        # the checkpoint is kept because something failed
+        with open(checkpoint_path, 'r') as fp:
+            self.assertEquals(len(fp.read().split()), 5)
+
+        # and resuming skips the alerts that were already rebuilt
+        rebuilt, failed = rebuild_all_indexes(alerts, checkpoint_path=checkpoint_path)
+        self.assertEquals(rebuilt, [])
+        self.assertEquals(failed, [])
+        self.assertFalse(os.path.exists(checkpoint_path))
+
     # XXX fix this
     @unittest.skip("Now this one is failing too -- need to revisit this soon.")
     def test_retry_function_on_deadlock(self):
@@ -4,11 +4,15 @@ import logging
 import os
 import os.path
 import socket
+import time
 
 import saq
 from email.utils import parseaddr
 from email.header import decode_header
-from saq.database import get_db_connection
+from saq.database import get_db_connection, execute_with_retry
+
+# the size of the archive_search.value column
+ARCHIVE_SEARCH_VALUE_SIZE = 512
 
 def normalize_email_address(email_address):
     """Returns a normalized version of email address.  Returns None if the address cannot be parsed."""
@@ -204,6 +208,164 @@ def search_archive(source, message_ids, excluded_emails=[]):
 
     return _buffer
 
+def get_archive_trigrams(value):
+    """Returns the set of trigrams (as integers) of the given archive_search value as it is stored in the database.
+       Returns an empty set if the value is shorter than three bytes."""
+    if isinstance(value, str):
+        value = value.encode('utf8', errors='ignore')
+
+    value = value[:ARCHIVE_SEARCH_VALUE_SIZE]
+    return set([int.from_bytes(value[i:i + 3], 'big') for i in range(len(value) - 2)])
+
+def index_archive_trigrams(db, c, archive_id, properties):
+    """Adds the trigrams of the given list of (field, value) archive_search properties of the given archive_id to the
+       archive_search_trigram table. The caller is responsible for committing."""
+    rows = set()
+    for field, value in properties:
+        for trigram in get_archive_trigrams(value):
+            rows.add((trigram, field))
+
+    rows = list(rows)
+    for index in range(0, len(rows), 1024):
+        batch = rows[index:index + 1024]
+        parameters = []
+        for trigram, field in batch:
+            parameters.extend([trigram, field, archive_id])
+
+        execute_with_retry(db, c, "INSERT IGNORE INTO archive_search_trigram ( trigram, field, archive_id ) VALUES {}".format(
+                                  ','.join(['(%s, %s, %s)' for _ in batch])), tuple(parameters))
+
+def rebuild_archive_trigrams(db, c, batch_size=1024):
+    """Rebuilds the archive_search_trigram table from the archive_search table for every archived email.
+       Returns the number of archived emails indexed."""
+    count = 0
+    last_archive_id = 0
+    while True:
+        c.execute("SELECT archive_id FROM archive WHERE archive_id > %s ORDER BY archive_id LIMIT %s",
+                  (last_archive_id, batch_size))
+        archive_ids = [row[0] for row in c]
+        if not archive_ids:
+            break
+
+        properties = {} # key = archive_id, value = [ (field, value) ]
+        c.execute("SELECT archive_id, field, value FROM archive_search WHERE archive_id IN ( {} )".format(
+                  ','.join(['%s' for _ in archive_ids])), tuple(archive_ids))
+        for archive_id, field, value in c:
+            properties.setdefault(archive_id, []).append((field, value))
+
+        for archive_id, _properties in properties.items():
+            index_archive_trigrams(db, c, archive_id, _properties)
+
+        db.commit()
+        count += len(archive_ids)
+        last_archive_id = archive_ids[-1]
+        logging.info(f"indexed {count} archived emails")
+
+    return count
+
+def is_archive_trigram_index_ready(db, c):
+    """Returns True if the archive_search_trigram table exists and covers the emails already in archive_search.
+       The index is considered to cover the archive if the oldest email in archive_search has been indexed, which is
+       the case once ace index-archive-search has been run for the emails archived before the index was enabled."""
+    try:
+        c.execute("SELECT MIN(archive_id) FROM archive_search")
+        oldest_archive_id = c.fetchone()[0]
+        c.execute("SELECT MIN(archive_id) FROM archive_search_trigram")
+        oldest_indexed_id = c.fetchone()[0]
+    except Exception as e:
+        logging.warning(f"unable to query archive_search_trigram (was the sql update applied?): {e}")
+        return False
+
+    if oldest_archive_id is None:
+        return True
+
+    return oldest_indexed_id is not None and oldest_indexed_id <= oldest_archive_id
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_archive_values(db, c, search_items, fields=None, use_index=True):
+    """Searches the archive_search table for archived emails that have a value containing any of the given
+       search_items in any of the given fields (or any field if fields is None.)
+
+       The archive_search_trigram table is used to find the candidate emails for every search item in a single query
+       before the values are matched, which avoids a full scan of archive_search. Search items shorter than three
+       bytes cannot use the index and are matched against the entire table, as they are if use_index is False or if
+       the index has not been built for the existing archive yet (see is_archive_trigram_index_ready.)
+
+       Returns a list of (hostname, md5) tuples of the matching emails."""
+
+    field_clause = ''
+    field_parameters = []
+    if fields:
+        field_clause = 'AND {{table}}.field IN ( {} )'.format(','.join(['%s' for _ in fields]))
+        field_parameters = list(fields)
+
+    if use_index and not is_archive_trigram_index_ready(db, c):
+        logging.warning("the trigram index does not cover the email archive (run ace index-archive-search) "
+                        "- searching without it")
+        use_index = False
+
+    indexed = {} # key = search_item, value = set(trigrams)
+    unindexed = []
+    for search_item in search_items:
+        trigrams = get_archive_trigrams(search_item) if use_index else None
+        if trigrams:
+            indexed[search_item] = trigrams
+        else:
+            unindexed.append(search_item)
+
+    query = """
+SELECT DISTINCT
+    archive_server.hostname, HEX(archive.md5)
+FROM
+    archive JOIN archive_server ON archive.server_id = archive_server.server_id
+    JOIN archive_search ON archive.archive_id = archive_search.archive_id
+WHERE
+    {candidate_clause} ( {like_clauses} ) {field_clause}"""
+
+    def _search(items, candidate_ids=None):
+        candidate_clause = ''
+        parameters = []
+        if candidate_ids:
+            candidate_clause = 'archive.archive_id IN ( {} ) AND'.format(','.join(['%s' for _ in candidate_ids]))
+            parameters.extend(candidate_ids)
+
+        parameters.extend(['%{}%'.format(_escape_like(item)) for item in items])
+        parameters.extend(field_parameters)
+        c.execute(query.format(candidate_clause=candidate_clause,
+                               like_clauses=' OR '.join(['archive_search.value LIKE %s' for _ in items]),
+                               field_clause=field_clause.format(table='archive_search')), tuple(parameters))
+        return [tuple(row) for row in c]
+
+    results = set()
+    if indexed:
+        start = time.time()
+        # an email is a candidate for a search item if it contains every trigram of the search item
+        queries = []
+        parameters = []
+        for search_item, trigrams in indexed.items():
+            queries.append("""(SELECT archive_id FROM archive_search_trigram
+                               WHERE trigram IN ( {} ) {} GROUP BY archive_id HAVING COUNT(DISTINCT trigram) = %s)""".format(
+                           ','.join(['%s' for _ in trigrams]), field_clause.format(table='archive_search_trigram')))
+            parameters.extend(trigrams)
+            parameters.extend(field_parameters)
+            parameters.append(len(trigrams))
+
+        c.execute(' UNION '.join(queries), tuple(parameters))
+        candidate_ids = sorted([row[0] for row in c])
+        logging.info("found {} candidate emails for {} search items in {:.3f} seconds".format(
+                     len(candidate_ids), len(indexed), time.time() - start))
+
+        for index in range(0, len(candidate_ids), 1024):
+            results.update(_search(list(indexed.keys()), candidate_ids[index:index + 1024]))
+
+    if unindexed:
+        logging.info(f"searching without the trigram index for {len(unindexed)} search items")
+        results.update(_search(unindexed))
+
+    return sorted(results)
+
 def maintain_archive(verbose=False):
     """Deletes archived emails older than what is configured as [analysis_module_email_archiver] expiration_days."""
 
@@ -3,9 +3,11 @@
 import collections
 import datetime
 import gc
+import heapq
 import importlib
 import inspect
 import io
+import json
 import logging
 import os, os.path
 import queue
@@ -28,14 +30,19 @@ from subprocess import Popen, PIPE
 
 import saq
 import saq.analysis
+import saq.analysis.timeline
 import saq.database
+import saq.metrics
 
 from saq.analysis import Observable, Analysis, RootAnalysis
+from saq.analysis.timeline import TimelineEntry, TIMELINE_RESULT_ANALYSIS, TIMELINE_RESULT_NO_ANALYSIS, \
+                                  TIMELINE_RESULT_WAIT, TIMELINE_RESULT_ERROR
 from saq.constants import *
 from saq.database import Alert, use_db, release_cached_db_connection, enable_cached_db_connections, \
                          get_db_connection, add_workload, acquire_lock, release_lock, execute_with_retry, \
                          add_delayed_analysis_request, clear_expired_locks, clear_expired_local_nodes, \
-                         initialize_node, ALERT
+                         initialize_node, ALERT, DELAYED_ANALYSIS_ADDED, DELAYED_ANALYSIS_EXISTS, \
+                         DELAYED_ANALYSIS_FAILED
 from saq.error import report_exception
 from saq.modules import AnalysisModule
 from saq.performance import record_metric
@@ -58,6 +65,21 @@ CURRENT_ENGINE = None
 STATE_PRE_ANALYSIS_EXECUTED = 'pre_analysis_executed'
 STATE_POST_ANALYSIS_EXECUTED = 'post_analysis_executed'
 
+# metrics (see saq.metrics)
+WORK_ITEMS_STARTED = saq.metrics.counter(METRIC_WORK_ITEMS_STARTED,
+                                         "work items the engine started analyzing", [ 'mode' ])
+WORK_ITEMS_FINISHED = saq.metrics.counter(METRIC_WORK_ITEMS_FINISHED,
+                                          "work items the engine finished analyzing", [ 'mode' ])
+WORK_ITEM_EXECUTION_TIME = saq.metrics.histogram(METRIC_WORK_ITEM_EXECUTION_TIME,
+                                                 "time spent analyzing a work item", [ 'mode' ])
+MODULE_EXECUTION_TIME = saq.metrics.histogram(METRIC_MODULE_EXECUTION_TIME,
+                                              "time spent in a single call to an analysis module", [ 'module' ])
+WORKLOAD_QUEUE_SIZE = saq.metrics.gauge(METRIC_WORKLOAD_QUEUE_SIZE, "size of the workload queue of this node")
+DELAYED_ANALYSIS_QUEUE_SIZE = saq.metrics.gauge(METRIC_DELAYED_ANALYSIS_QUEUE_SIZE,
+                                                "size of the delayed analysis queue of this node")
+LOCK_CONTENTION = saq.metrics.counter(METRIC_LOCK_CONTENTION,
+                                      "failed attempts to lock a work item locked by something else")
+
 class AnalysisTimeoutError(RuntimeError):
     pass
 
@@ -357,6 +379,314 @@ class WorkerManager(object):
 
         logging.info("worker manager on pid {} exiting".format(os.getpid()))
 
+class DelayedAnalysisScheduler(object):
+    """Keeps the delayed analysis requests for this node in memory ordered by when they are ready.
+       Requests that are ready are handed to the workers through a queue so that the workers do not need to
+       scan the delayed_analysis table looking for work. The delayed_analysis table remains the durable store
+       of the requests and is periodically reloaded to pick up anything the scheduler missed."""
+
+    def __init__(self, resync_frequency):
+        assert isinstance(resync_frequency, datetime.timedelta)
+
+        # how often we reload the pending requests from the database
+        self.resync_frequency = resync_frequency
+
+        # new requests sent from the workers
+        self.request_queue = Queue()
+
+        # requests that are ready to be processed by the workers
+        self.ready_queue = Queue()
+
+        # the thread that runs the scheduler (on the engine process)
+        self.thread = None
+        self.control_event = None
+
+        # the following are only used by the scheduler thread
+        # heap of [ delayed_until, sequence, key ]
+        self.schedule = []
+        # key = (uuid, observable_uuid, analysis_module), value = sequence of the current heap entry
+        self.scheduled = {}
+        # key = (uuid, observable_uuid, analysis_module), value = the request tuple
+        self.requests = {}
+        # keys of requests handed to the workers since the last resync
+        self.handed_out = set()
+        self.sequence = 0
+        self.next_resync_time = None
+
+    def start(self):
+        self.control_event = threading.Event()
+        self.thread = threading.Thread(target=self.scheduler_loop, name="Delayed Analysis Scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.control_event is None:
+            return
+
+        self.control_event.set()
+        self.thread.join()
+
+    def schedule_request(self, uuid, observable_uuid, analysis_module, delayed_until, storage_dir):
+        """Sends a new delayed analysis request to the scheduler. This can be called from any process."""
+        self.request_queue.put((uuid, observable_uuid, analysis_module, delayed_until, storage_dir))
+
+    def get_ready_request(self):
+        """Returns the next request tuple that is ready, or None if nothing is ready."""
+        try:
+            return self.ready_queue.get_nowait()
+        except Empty:
+            return None
+
+    def add_request(self, request):
+        """Adds the given request tuple to the schedule, replacing any existing request for the same target."""
+        uuid, observable_uuid, analysis_module, delayed_until, storage_dir = request
+        key = (uuid, observable_uuid, analysis_module)
+        self.sequence += 1
+        self.scheduled[key] = self.sequence
+        self.requests[key] = request
+        heapq.heappush(self.schedule, [ delayed_until, self.sequence, key ])
+
+    def resync(self):
+        """Reloads the schedule from the delayed_analysis table."""
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""
+SELECT
+    delayed_analysis.uuid,
+    delayed_analysis.observable_uuid,
+    delayed_analysis.analysis_module,
+    delayed_analysis.delayed_until,
+    delayed_analysis.storage_dir
+FROM
+    delayed_analysis LEFT JOIN locks ON delayed_analysis.uuid = locks.uuid
+WHERE
+    delayed_analysis.node_id = %s
+    AND locks.uuid IS NULL
+    AND exclusive_uuid IS NULL""", (saq.SAQ_NODE_ID,))
+            rows = c.fetchall()
+            db.commit()
+
+        self.schedule = []
+        self.scheduled = {}
+        self.requests = {}
+
+        for row in rows:
+            # skip anything we just handed to the workers
+            if tuple(row[0:3]) in self.handed_out:
+                continue
+
+            self.add_request(tuple(row))
+
+        self.handed_out.clear()
+        logging.debug("loaded {} delayed analysis requests".format(len(self.requests)))
+
+    def execute(self):
+        """Hands any requests that are ready to the workers. Returns the number of seconds until the next request
+           is ready (or None if nothing is scheduled.)"""
+
+        if self.next_resync_time is None or datetime.datetime.now() >= self.next_resync_time:
+            try:
+                self.resync()
+            except Exception as e:
+                logging.error("unable to load delayed analysis requests: {}".format(e))
+                report_exception()
+
+            self.next_resync_time = datetime.datetime.now() + self.resync_frequency
+
+        while True:
+            try:
+                self.add_request(self.request_queue.get_nowait())
+            except Empty:
+                break
+
+        now = datetime.datetime.now()
+        while self.schedule:
+            delayed_until, sequence, key = self.schedule[0]
+            # entries for requests that have been replaced or handed out are skipped
+            if self.scheduled.get(key) != sequence:
+                heapq.heappop(self.schedule)
+                continue
+
+            if delayed_until > now:
+                return (delayed_until - now).total_seconds()
+
+            heapq.heappop(self.schedule)
+            del self.scheduled[key]
+            self.handed_out.add(key)
+            self.ready_queue.put(self.requests.pop(key))
+
+        return None
+
+    def scheduler_loop(self):
+        logging.info("delayed analysis scheduler started")
+        while not self.control_event.is_set():
+            try:
+                wait_time = self.execute()
+                if wait_time is None or wait_time > 1.0:
+                    wait_time = 1.0
+
+                # wake up early if a new request comes in
+                try:
+                    self.add_request(self.request_queue.get(timeout=wait_time))
+                except Empty:
+                    pass
+
+            except Exception as e:
+                logging.error("error in delayed analysis scheduler: {}".format(e))
+                report_exception()
+                self.control_event.wait(1)
+
+        logging.info("delayed analysis scheduler stopped")
+
+class LockKeepaliveService(object):
+    """Keeps the locks held by all of the workers on this node alive with a single UPDATE per interval.
+       Workers tell the service when they take and release a lock, the service runs as a thread on the
+       engine process and periodically records statistics about the locks it maintains."""
+
+    # the messages the workers send
+    MESSAGE_HOLD = 'hold'
+    MESSAGE_RELEASE = 'release'
+    MESSAGE_CONTENTION = 'contention'
+
+    def __init__(self, keepalive_frequency, statistics_path=None):
+        # how often (in seconds) we update the lock_time of the locks we hold
+        self.keepalive_frequency = keepalive_frequency
+
+        # where we write the lock statistics to (optional)
+        self.statistics_path = statistics_path
+
+        # messages sent from the workers
+        self.message_queue = Queue()
+
+        self.thread = None
+        self.control_event = None
+
+        # the following are only used by the service thread
+        # key = uuid, value = [ lock_uuid, lock_owner, pid, time acquired ]
+        self.locks = {}
+        self.renewal_count = 0
+        self.lost_lock_count = 0
+        self.contention_count = 0
+
+    def start(self):
+        self.control_event = threading.Event()
+        self.thread = threading.Thread(target=self.service_loop, name="Lock Keepalive Service")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.control_event is None:
+            return
+
+        self.control_event.set()
+        self.thread.join()
+
+    def hold_lock(self, uuid, lock_uuid, lock_owner):
+        """Tells the service to start keeping the given lock alive. This can be called from any process."""
+        self.message_queue.put((self.MESSAGE_HOLD, uuid, lock_uuid, lock_owner, os.getpid(), time.time()))
+
+    def release_lock(self, uuid, lock_uuid):
+        """Tells the service to stop keeping the given lock alive. This can be called from any process."""
+        self.message_queue.put((self.MESSAGE_RELEASE, uuid, lock_uuid))
+
+    def report_contention(self, uuid):
+        """Records a failed attempt to acquire a lock. This can be called from any process."""
+        self.message_queue.put((self.MESSAGE_CONTENTION, uuid))
+
+    def process_messages(self):
+        while True:
+            try:
+                message = self.message_queue.get_nowait()
+            except Empty:
+                break
+
+            if message[0] == self.MESSAGE_HOLD:
+                _, uuid, lock_uuid, lock_owner, pid, acquired_time = message
+                self.locks[uuid] = [ lock_uuid, lock_owner, pid, acquired_time ]
+            elif message[0] == self.MESSAGE_RELEASE:
+                _, uuid, lock_uuid = message
+                if uuid in self.locks and self.locks[uuid][0] == lock_uuid:
+                    del self.locks[uuid]
+            elif message[0] == self.MESSAGE_CONTENTION:
+                self.contention_count += 1
+
+    def renew_locks(self):
+        """Updates the lock_time of every lock we are keeping alive."""
+        self.process_messages()
+
+        # stop maintaining locks for workers that died
+        for uuid, (lock_uuid, lock_owner, pid, acquired_time) in list(self.locks.items()):
+            if not psutil.pid_exists(pid):
+                logging.warning("process {} holding lock {} ({}) no longer exists".format(pid, uuid, lock_owner))
+                del self.locks[uuid]
+
+        if not self.locks:
+            return
+
+        targets = [ (uuid, lock[0]) for uuid, lock in self.locks.items() ]
+        parameters = []
+        for uuid, lock_uuid in targets:
+            parameters.append(uuid)
+            parameters.append(lock_uuid)
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            execute_with_retry(db, c, "UPDATE locks SET lock_time = NOW() WHERE ( uuid, lock_uuid ) IN ( {} )".format(
+                               ','.join(['( %s, %s )' for _ in targets])), tuple(parameters), commit=True)
+
+            c.execute("SELECT uuid, lock_uuid FROM locks WHERE uuid IN ( {} )".format(
+                      ','.join(['%s' for _ in targets])), tuple([uuid for uuid, lock_uuid in targets]))
+            current_locks = set([tuple(row) for row in c])
+            db.commit()
+
+        self.renewal_count += 1
+
+        # locks released while we were working are not lost
+        self.process_messages()
+        for uuid, lock_uuid in targets:
+            if (uuid, lock_uuid) in current_locks:
+                continue
+
+            if uuid in self.locks and self.locks[uuid][0] == lock_uuid:
+                logging.warning("failed to maintain lock {} ({})".format(uuid, self.locks[uuid][1]))
+                del self.locks[uuid]
+                self.lost_lock_count += 1
+
+    def get_statistics(self):
+        """Returns a dict of statistics about the locks maintained by this service."""
+        now = time.time()
+        lock_ages = [ now - lock[3] for lock in self.locks.values() ]
+        return {
+            'locks_held': len(self.locks),
+            'oldest_lock_age': max(lock_ages) if lock_ages else 0,
+            'average_lock_age': sum(lock_ages) / len(lock_ages) if lock_ages else 0,
+            'renewal_count': self.renewal_count,
+            'lost_lock_count': self.lost_lock_count,
+            'contention_count': self.contention_count,
+        }
+
+    def write_statistics(self):
+        if self.statistics_path is None:
+            return
+
+        temp_path = '{}.tmp'.format(self.statistics_path)
+        with open(temp_path, 'w') as fp:
+            json.dump(self.get_statistics(), fp)
+
+        os.replace(temp_path, self.statistics_path)
+
+    def service_loop(self):
+        logging.info("lock keepalive service started")
+        while not self.control_event.wait(self.keepalive_frequency):
+            try:
+                self.renew_locks()
+                self.write_statistics()
+            except Exception as e:
+                logging.error("error in lock keepalive service: {}".format(e))
+                report_exception()
+
+        logging.info("lock keepalive service stopped")
+
 # syntactic suger for if self.is_local: return None
 def exclude_if_local(target_function):
     """A member function of Engine wrapped with this function will not execute if the Engine is in "local" mode."""
@@ -465,6 +795,14 @@ class Engine(ACEService):
         # used to start and stop the workers
         self.worker_control_event = Event()
 
+        # keeps track of delayed analysis requests in memory (see DelayedAnalysisScheduler)
+        # this is created when the engine starts (when enabled)
+        self.delayed_analysis_scheduler = None
+
+        # keeps the locks of all the workers alive (see LockKeepaliveService)
+        # this is created when the engine starts (when enabled)
+        self.lock_keepalive_service = None
+
         # a list of analysis modules to enable specified by configuration section names
         # this is typically used in unit testing
         # if this list is not empty then ONLY these modules will be loaded regardless of configuration settings
@@ -522,6 +860,8 @@ class Engine(ACEService):
 
         # things we do *not* want to analyze
         self.observable_exclusions = {} # key = o_type, value = [] of values
+        # the compiled ipv4 exclusions (see get_ipv4_exclusion_index)
+        self._ipv4_exclusion_index = None # tuple(list of exclusions, IPv4RangeIndex)
 
         # this is set to True to cancel the analysis going on in the process() function
         self._cancel_analysis_flag = False
@@ -529,6 +869,9 @@ class Engine(ACEService):
         # we keep track of the total amount of time (in seconds) that each module takes
         self.total_analysis_time = {} # key = module.config_section, value = total_seconds
 
+        # and we record every call to an analysis module in the timeline of the root (see saq.analysis.timeline)
+        self.timeline = [] # of TimelineEntry
+
         # this gets set to true when we receive a unix signal
         self.sigterm_received = False
         self.sighup_received = False
@@ -547,6 +890,9 @@ class Engine(ACEService):
         self.lock_manager_control_event = None
         self.lock_keepalive_thread = None
 
+        # the uuid of the lock the LockKeepaliveService is keeping open for us
+        self.lock_keepalive_uuid = None
+
         # each worker assigns this to some random uuid to use as a lock
         self.lock_uuid = None
 
@@ -732,6 +1078,22 @@ class Engine(ACEService):
         """Returns True if the work queue is empty, False otherwise."""
         return self.workload_queue_size == 0
 
+    def get_ipv4_exclusion_index(self):
+        """Returns the IPv4RangeIndex of the ipv4 observable exclusions. The index is rebuilt when they change."""
+        exclusions = list(self.observable_exclusions.get(F_IPV4, []))
+        if self._ipv4_exclusion_index is None or self._ipv4_exclusion_index[0] != exclusions:
+            index = IPv4RangeIndex()
+            for exclusion in exclusions:
+                try:
+                    index.add(exclusion)
+                except Exception as e:
+                    logging.error("invalid ipv4 exclusion {}: {}".format(exclusion, e))
+
+            index.compile()
+            self._ipv4_exclusion_index = (exclusions, index)
+
+        return self._ipv4_exclusion_index[1]
+
     def _get_analysis_module_by_generated_analysis(self, spec, instance=None):
         """Internal function to return the loaded AnalysisModule by type or string of generated Analysis."""
         assert isinstance(spec, str) or (inspect.isclass(spec) and issubclass(spec, Analysis))
@@ -1090,6 +1452,17 @@ class Engine(ACEService):
             return
 
         self.initialize()
+
+        # requests that are exclusive to a local engine are always pulled from the database
+        if not self.is_local and self.service_config.getboolean('delayed_analysis_scheduler', fallback=False):
+            self.delayed_analysis_scheduler = DelayedAnalysisScheduler(create_timedelta(
+                self.service_config.get('delayed_analysis_resync_frequency', fallback='00:00:30')))
+
+        if self.service_config.getboolean('lock_keepalive_service', fallback=False):
+            self.lock_keepalive_service = LockKeepaliveService(
+                float(saq.CONFIG['global']['lock_keepalive_frequency']),
+                statistics_path=os.path.join(self.runtime_dir, 'lock_statistics.json'))
+
         if not self.start_engine():
             sys.exit(1)
 
@@ -1177,6 +1550,12 @@ class Engine(ACEService):
         if self.single_threaded_mode:
             return
 
+        # if the engine is running the lock keepalive service then we let it keep the lock open
+        if self.lock_keepalive_service is not None:
+            self.lock_keepalive_service.hold_lock(uuid, self.lock_uuid, self.lock_owner)
+            self.lock_keepalive_uuid = uuid
+            return
+
         logging.debug("starting lock manager for {}".format(uuid))
 
         # we use this event for a controlled shutdown
@@ -1194,6 +1573,13 @@ class Engine(ACEService):
         if self.single_threaded_mode:
             return
 
+        if self.lock_keepalive_service is not None:
+            if self.lock_keepalive_uuid is not None:
+                self.lock_keepalive_service.release_lock(self.lock_keepalive_uuid, self.lock_uuid)
+                self.lock_keepalive_uuid = None
+
+            return
+
         if self.lock_manager_control_event is None:
             logging.warning("called stop_root_lock_manager() when no lock manager was running")
             return
@@ -1202,6 +1588,12 @@ class Engine(ACEService):
         self.lock_manager_control_event.set()
         self.lock_keepalive_thread.join()
 
+    def report_lock_contention(self, uuid):
+        """Records a failed attempt to acquire the lock on the given uuid."""
+        LOCK_CONTENTION.inc()
+        if self.lock_keepalive_service is not None:
+            self.lock_keepalive_service.report_contention(uuid)
+
     def root_lock_manager_loop(self, uuid):
         try:
             while not self.lock_manager_control_event.is_set():
@@ -1259,9 +1651,18 @@ class Engine(ACEService):
 
         # add the request to the workload
         try:
-            if add_delayed_analysis_request(root, observable, analysis_module, next_analysis, 
-                                            exclusive_uuid=self.exclusive_uuid):
+            result = add_delayed_analysis_request(root, observable, analysis_module, next_analysis, 
+                                                  exclusive_uuid=self.exclusive_uuid)
+            if result == DELAYED_ANALYSIS_FAILED:
+                return False
+
+            if result == DELAYED_ANALYSIS_EXISTS:
                 analysis.delayed = True
+            elif result == DELAYED_ANALYSIS_ADDED and self.delayed_analysis_scheduler is not None \
+                 and self.exclusive_uuid is None:
+                self.delayed_analysis_scheduler.schedule_request(root.uuid, observable.id, 
+                                                                 analysis_module.config_section,
+                                                                 next_analysis, root.storage_dir)
         except Exception as e:
             logging.error("unable to insert delayed analysis on {} by {} for {}: {}".format(
                              root, analysis_module.config_section, observable, e))
@@ -1289,6 +1690,14 @@ class Engine(ACEService):
             logging.error("unable to update node {} status: {}".format(saq.SAQ_NODE, e))
             report_exception()
 
+    def record_queue_sizes(self):
+        """Records the size of the workload and delayed analysis queues (see saq.metrics.)"""
+        try:
+            WORKLOAD_QUEUE_SIZE.set(self.workload_queue_size)
+            DELAYED_ANALYSIS_QUEUE_SIZE.set(self.delayed_analysis_queue_size)
+        except Exception as e:
+            logging.error("unable to record queue sizes: {}".format(e))
+
     @exclude_if_local
     @use_db
     def execute_primary_node_routines(self, db, c):
@@ -1350,6 +1759,12 @@ class Engine(ACEService):
     def engine_loop(self):
         logging.info("started engine on process {}".format(os.getpid()))
 
+        if self.delayed_analysis_scheduler is not None:
+            self.delayed_analysis_scheduler.start()
+
+        if self.lock_keepalive_service is not None:
+            self.lock_keepalive_service.start()
+
         self.worker_manager = WorkerManager()
         self.worker_manager.start()
 
@@ -1370,6 +1785,7 @@ class Engine(ACEService):
 
                     self.update_node_status()
                     self.execute_primary_node_routines()
+                    self.record_queue_sizes()
 
                     # when will we do this again?
                     self.next_status_update_time = datetime.datetime.now() + \
@@ -1407,6 +1823,10 @@ class Engine(ACEService):
         logging.info("ending engine loop")
         self.worker_manager.wait()
         self.stop_maintenance_threads()
+        if self.delayed_analysis_scheduler is not None:
+            self.delayed_analysis_scheduler.stop()
+        if self.lock_keepalive_service is not None:
+            self.lock_keepalive_service.stop()
         logging.info("ended engine loop")
 
     #
@@ -1504,6 +1924,8 @@ class Engine(ACEService):
     @use_db
     def get_delayed_analysis_work_target(self, db, c):
         """Returns the next DelayedAnalysisRequest that is ready, or None if none are ready."""
+        if self.delayed_analysis_scheduler is not None and self.exclusive_uuid is None:
+            return self.get_scheduled_delayed_analysis_work_target(db, c)
         # get the next thing to do
         # first we look for any delayed analysis that needs to complete
 
@@ -1540,6 +1962,7 @@ ORDER BY
 
         for _id, uuid, observable_uuid, analysis_module, delayed_until, storage_dir in c:
             if not acquire_lock(uuid, self.lock_uuid, lock_owner=self.lock_owner):
+                self.report_lock_contention(uuid)
                 continue
 
             return DelayedAnalysisRequest(uuid,
@@ -1551,6 +1974,43 @@ ORDER BY
 
         return None
 
+    def get_scheduled_delayed_analysis_work_target(self, db, c):
+        """Returns the next DelayedAnalysisRequest handed to us by the DelayedAnalysisScheduler, 
+           or None if none are ready."""
+        while True:
+            request = self.delayed_analysis_scheduler.get_ready_request()
+            if request is None:
+                return None
+
+            uuid, observable_uuid, analysis_module, delayed_until, storage_dir = request
+            if not acquire_lock(uuid, self.lock_uuid, lock_owner=self.lock_owner):
+                self.report_lock_contention(uuid)
+                # the root is busy (usually being analyzed) so try again in a moment
+                self.delayed_analysis_scheduler.schedule_request(uuid, observable_uuid, analysis_module,
+                                                                 datetime.datetime.now() + datetime.timedelta(
+                                                                 seconds=1), storage_dir)
+                continue
+
+            # make sure the request was not already processed
+            c.execute("""
+SELECT id, delayed_until, storage_dir FROM delayed_analysis
+WHERE uuid = %s AND observable_uuid = %s AND analysis_module = %s AND node_id = %s AND exclusive_uuid IS NULL
+ORDER BY delayed_until ASC LIMIT 1""", (uuid, observable_uuid, analysis_module, saq.SAQ_NODE_ID))
+            row = c.fetchone()
+            db.commit()
+
+            if row is None or row[1] > datetime.datetime.now():
+                release_lock(uuid, self.lock_uuid)
+                continue
+
+            _id, delayed_until, storage_dir = row
+            return DelayedAnalysisRequest(uuid,
+                                          observable_uuid,
+                                          analysis_module,
+                                          delayed_until,
+                                          storage_dir,
+                                          database_id=_id)
+
     @use_db
     def get_work_target(self, db, c, priority=True, local=True):
         """Returns the next work item available. 
@@ -1611,6 +2071,7 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
 
         for _id, uuid, analysis_mode, insert_date, node_id, storage_dir in c:
             if not acquire_lock(uuid, self.lock_uuid, lock_owner=self.lock_owner):
+                self.report_lock_contention(uuid)
                 continue
 
             # is this work item on a different node?
@@ -1744,12 +2205,19 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
         except Exception as e:
             logging.error(f"unable to check for disposition of {work_item}: {e}")
 
+        analysis_mode = self.root.analysis_mode
+        WORK_ITEMS_STARTED.labels(analysis_mode).inc()
+        work_item_start_time = time.perf_counter()
+
         try:
             self.analyze(work_item)
         except Exception as e:
             logging.error("error analyzing {}: {}".format(work_item, e))
             report_exception()
 
+        WORK_ITEMS_FINISHED.labels(analysis_mode).inc()
+        WORK_ITEM_EXECUTION_TIME.labels(analysis_mode).observe(time.perf_counter() - work_item_start_time)
+
         self.stop_root_lock_manager()
         self.clear_work_target(work_item)
 
@@ -1907,6 +2375,7 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
             self.delayed_analysis_request = work_item
             self.delayed_analysis_request.load()
             self.root = self.delayed_analysis_request.root
+            self.root.prefetch_tags()
 
             # reset the delay flag for this analysis
             self.delayed_analysis_request.analysis.delayed = False
@@ -1923,6 +2392,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                               f"to workload value of {current_analysis_mode}")
                 self.root.override_analysis_mode(current_analysis_mode)
 
+            # load the tags for everything we already have at once rather than one at a time during analysis
+            self.root.prefetch_tags()
+
         logging.info("processing {} mode {} ({})".format(self.root.description, self.root.analysis_mode, self.root.uuid))
 
     def analyze(self, target):
@@ -1933,6 +2405,7 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
     
         # reset total analysis measurements
         self.total_analysis_time.clear()
+        self.timeline.clear()
 
         # reset each module to it's default state
         for analysis_module in self.analysis_modules:
@@ -2063,6 +2536,8 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                 except Exception as e:
                     logging.error("unable to create error reporting stats dir {}: {}".format(error_report_stats_dir, e))
 
+        self.record_timeline()
+
         # save module execution time metrics
         try:
             # how long did all the analysis take combined?
@@ -2104,6 +2579,22 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
 
         return
 
+    def record_timeline(self):
+        """Appends the timeline of the analysis that just completed to the timeline of the root
+           and records the cost of each module in the node-wide module cost log."""
+        if not self.timeline or not saq.analysis.timeline.is_enabled():
+            return
+
+        try:
+            saq.analysis.timeline.append_timeline(self.root.storage_dir, self.timeline)
+        except Exception as e:
+            logging.error("unable to record timeline for {}: {}".format(self.root, e))
+
+        try:
+            saq.analysis.timeline.record_module_costs(self.root.uuid, self.root.analysis_mode, self.timeline)
+        except Exception as e:
+            logging.error("unable to record module costs for {}: {}".format(self.root, e))
+
     def get_analysis_modules_by_mode(self, analysis_mode):
         """Returns the list of analysis modules configured for the given mode sorted alphabetically by configuration section name."""
         if analysis_mode is None:
@@ -2410,7 +2901,7 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                     # so special case for ipv4 so you can allow cidr
                     exclusions = self.observable_exclusions[work_item.observable.type]
                     if work_item.observable.type == F_IPV4:
-                        exclusions = [iptools.IpRange(x) for x in exclusions]
+                        exclusions = [ self.get_ipv4_exclusion_index() ]
                     for exclusion in exclusions:
                         try:
                             if work_item.observable.value in exclusion:
@@ -2542,6 +3033,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
 
                 #logging.debug("analyzing {} with {}".format(work_item, analysis_module))
                 last_work_stack_size = len(work_stack)
+                timeline_result = None
+                timeline_delayed = False
+                analysis_module.semaphore_wait_time = 0.0
 
                 try:
                     # final_analysis_mode will be True if this is the last pass of analysis
@@ -2598,6 +3092,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                         output_analysis = work_item.observable.get_analysis(analysis_module.generated_analysis_type,
                                                                             instance=analysis_module.instance)
 
+                        timeline_result = TIMELINE_RESULT_ANALYSIS if output_analysis else TIMELINE_RESULT_NO_ANALYSIS
+                        timeline_delayed = bool(output_analysis and output_analysis.delayed)
+
                         if output_analysis:
                             # if it hasn't been delayed
                             if not output_analysis.delayed:
@@ -2641,6 +3138,8 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                                 work_item.dependency.increment_status()
 
                 except WaitForAnalysisException as wait_exception:
+                    timeline_result = TIMELINE_RESULT_WAIT
+
                     # first off, if we completed the source analysis of a dependency then we are done with that
                     if work_item.dependency and work_item.dependency.completed:
                         work_item.dependency.increment_status()
@@ -2668,6 +3167,7 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                     logging.error("analysis module {} failed on {} for {} reason {}".format(
                         analysis_module, work_item, self.root, e))
                     report_exception()
+                    timeline_result = TIMELINE_RESULT_ERROR
 
                     if work_item.dependency:
                         work_item.dependency.set_status_failed('error: {}'.format(e))
@@ -2680,6 +3180,18 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                     self.total_analysis_time[analysis_module.config_section] = 0
 
                 self.total_analysis_time[analysis_module.config_section] += (module_end_time - module_start_time).total_seconds()
+                MODULE_EXECUTION_TIME.labels(analysis_module.config_section).observe(
+                    (module_end_time - module_start_time).total_seconds())
+
+                if work_item.observable and timeline_result is not None:
+                    self.timeline.append(TimelineEntry(
+                        module=analysis_module.config_section,
+                        observable_id=work_item.observable.id,
+                        start=module_start_time.timestamp(),
+                        duration=(module_end_time - module_start_time).total_seconds(),
+                        result=timeline_result,
+                        delayed=timeline_delayed,
+                        semaphore_wait=analysis_module.semaphore_wait_time))
 
                 # when analyze() executes it populates the work_stack_buffer with things that need to be analyzed
                 # if the thing that was just analyzed turned out to be whitelisted (tagged with 'whitelisted')
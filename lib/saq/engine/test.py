@@ -946,6 +946,77 @@ class TestCase(ACEEngineTestCase):
         # post analysis should have executed
         self.assertEquals(log_count('execute_post_analysis called'), 1)
 
+    def test_delayed_analysis_scheduler(self):
+        import datetime
+        from saq.engine import DelayedAnalysisScheduler
+
+        scheduler = DelayedAnalysisScheduler(datetime.timedelta(minutes=5))
+        # don't load anything from the database
+        scheduler.next_resync_time = datetime.datetime.now() + datetime.timedelta(minutes=5)
+
+        now = datetime.datetime.now()
+        scheduler.add_request(('uuid_1', 'observable_1', 'module', now + datetime.timedelta(minutes=1), 'dir_1'))
+        scheduler.add_request(('uuid_2', 'observable_2', 'module', now - datetime.timedelta(seconds=1), 'dir_2'))
+        scheduler.add_request(('uuid_3', 'observable_3', 'module', now - datetime.timedelta(seconds=2), 'dir_3'))
+        # replacing a request moves it in the schedule
+        scheduler.add_request(('uuid_1', 'observable_1', 'module', now + datetime.timedelta(minutes=2), 'dir_1'))
+
+        # the time until the next request is ready is returned
+        wait_time = scheduler.execute()
+        self.assertTrue(60 < wait_time <= 120)
+
+        # only the requests that are ready are handed out (in order)
+        self.assertEquals(scheduler.ready_queue.get(timeout=5)[0], 'uuid_3')
+        self.assertEquals(scheduler.ready_queue.get(timeout=5)[0], 'uuid_2')
+        self.assertIsNone(scheduler.get_ready_request())
+        self.assertEquals(list(scheduler.requests.keys()), [ ('uuid_1', 'observable_1', 'module') ])
+        self.assertEquals(scheduler.handed_out, set([ ('uuid_2', 'observable_2', 'module'),
+                                                      ('uuid_3', 'observable_3', 'module') ]))
+
+    def test_lock_keepalive_service(self):
+        from saq.engine import LockKeepaliveService
+
+        service = LockKeepaliveService(1)
+        lock_uuid = str(uuid.uuid4())
+        target_uuid = str(uuid.uuid4())
+        self.assertTrue(acquire_lock(target_uuid, lock_uuid, lock_owner='test'))
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("UPDATE locks SET lock_time = DATE_SUB(NOW(), INTERVAL 1 HOUR) WHERE uuid = %s", (target_uuid,))
+            db.commit()
+
+        service.hold_lock(target_uuid, lock_uuid, 'test')
+        service.report_contention(target_uuid)
+        # messages arrive asynchronously
+        for _ in range(50):
+            service.process_messages()
+            if service.locks and service.contention_count:
+                break
+            time.sleep(0.1)
+
+        service.renew_locks()
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("SELECT TIMESTAMPDIFF(SECOND, lock_time, NOW()) FROM locks WHERE uuid = %s", (target_uuid,))
+            self.assertTrue(c.fetchone()[0] < 60)
+
+        statistics = service.get_statistics()
+        self.assertEquals(statistics['locks_held'], 1)
+        self.assertEquals(statistics['renewal_count'], 1)
+        self.assertEquals(statistics['contention_count'], 1)
+
+        # a lock taken by someone else is lost
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("UPDATE locks SET lock_uuid = %s WHERE uuid = %s", (str(uuid.uuid4()), target_uuid))
+            db.commit()
+
+        service.renew_locks()
+        statistics = service.get_statistics()
+        self.assertEquals(statistics['locks_held'], 0)
+        self.assertEquals(statistics['lost_lock_count'], 1)
+
     def test_delayed_analysis_recovery(self):
 
         from saq.database import DelayedAnalysis, Workload
@@ -1024,6 +1095,35 @@ class TestCase(ACEEngineTestCase):
 
         self.assertEquals(log_count("depends on"), 1)
 
+    def test_analysis_timeline(self):
+        from saq.analysis.timeline import load_timeline, get_module_costs
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_groups')
+        root.initialize_storage()
+        test_observable = root.add_observable(F_TEST, 'test_1')
+        root.save()
+        root.schedule()
+
+        engine = TestEngine(analysis_pools={'test_groups': 1})
+        engine.enable_module('analysis_module_test_wait_a', 'test_groups')
+        engine.enable_module('analysis_module_test_wait_b', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # every call to a module is recorded in the timeline of the root
+        timeline = load_timeline(root.storage_dir)
+        self.assertTrue(all([entry.observable_id == test_observable.id for entry in timeline]))
+        results = { (entry.module, entry.result) for entry in timeline }
+        self.assertTrue(('analysis_module_test_wait_a', 'wait') in results)
+        self.assertTrue(('analysis_module_test_wait_a', 'analysis') in results)
+        self.assertTrue(('analysis_module_test_wait_b', 'analysis') in results)
+
+        # and the cost of each module is recorded for the node
+        modules = { module['module'] for module in get_module_costs(analysis_mode='test_groups') }
+        self.assertTrue('analysis_module_test_wait_a' in modules)
+        self.assertTrue('analysis_module_test_wait_b' in modules)
+
     def test_wait_for_analysis_instance(self):
 
         # same as test_wait_for_analysis except we wait for instanced modules
@@ -0,0 +1,274 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# content-addressed file storage
+#
+# Files added to alerts are hard linked into a single store under DATA_DIR keyed by the sha256 of the content.
+# When the same content shows up in another alert the local copy is replaced with a hard link to the stored copy,
+# so the content is only stored once no matter how many alerts it is attached to.
+#
+# The link count of the stored file is the reference count: a stored file with a link count of 1 is no longer
+# referenced by any alert and can be removed (see release() and collect()).
+#
+# Alongside each stored file we keep the cached results of deterministic analysis modules, keyed by the name of the
+# analysis module, so that the same work is not performed over and over again for the same content.
+#
+# NOTE files in the store must never be modified in place since every alert that references the content shares
+# the same inode
+#
+
+import json
+import logging
+import os, os.path
+import re
+import time
+import uuid
+
+import saq
+from saq.error import report_exception
+
+SHA256_REGEX = re.compile(r'^[a-f0-9]{64}$')
+
+# suffix of the files that contain cached analysis results
+CACHE_FILE_EXT = '.json'
+
+def is_enabled():
+    """Returns True if the file store is enabled in the configuration."""
+    return saq.CONFIG.getboolean('file_store', 'enabled', fallback=False)
+
+def is_analysis_cache_enabled():
+    """Returns True if cached analysis results should be used."""
+    return is_enabled() and saq.CONFIG.getboolean('file_store', 'analysis_cache_enabled', fallback=False)
+
+def get_store_dir():
+    """Returns the path to the base directory of the file store."""
+    return os.path.join(saq.DATA_DIR, saq.CONFIG['file_store']['store_dir'])
+
+def _validate_sha256(sha256):
+    if sha256 is None or not SHA256_REGEX.match(sha256):
+        raise ValueError("invalid sha256 {}".format(sha256))
+
+def get_store_path(sha256):
+    """Returns the path to the stored content for the given sha256."""
+    _validate_sha256(sha256)
+    return os.path.join(get_store_dir(), sha256[0:2], sha256)
+
+def get_cache_path(sha256, key):
+    """Returns the path to the cached analysis results for the given sha256 and key."""
+    _validate_sha256(sha256)
+    return os.path.join(get_store_dir(), sha256[0:2], '{}.{}{}'.format(sha256, key, CACHE_FILE_EXT))
+
+def is_stored(sha256):
+    """Returns True if the content for the given sha256 is in the file store."""
+    return os.path.exists(get_store_path(sha256))
+
+def get_reference_count(sha256):
+    """Returns the number of files (outside of the store) that refer to the stored content for this sha256.
+       Returns 0 if the content is not stored."""
+    try:
+        return os.stat(get_store_path(sha256)).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+def store_file(path, sha256):
+    """Adds the file at the given path to the file store.
+       If the content is already stored then the file at path is replaced with a hard link to the stored content.
+       Returns True if the file at path refers to the stored content, False otherwise."""
+
+    if not is_enabled():
+        return False
+
+    store_path = get_store_path(sha256)
+
+    try:
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+
+        try:
+            # is this new content?
+            os.link(path, store_path)
+            logging.debug("stored {} as {}".format(path, sha256))
+            return True
+        except FileExistsError:
+            pass
+
+        # are we already linked to the stored content?
+        if os.path.samefile(path, store_path):
+            return True
+
+        # replace our copy with a link to the stored copy
+        temp_path = '{}.{}.link'.format(path, str(uuid.uuid4()))
+        os.link(store_path, temp_path)
+        os.replace(temp_path, path)
+        logging.debug("replaced {} with link to stored content {}".format(path, sha256))
+        return True
+
+    except OSError as e:
+        # this happens when the store is on a different file system than the storage directory (EXDEV)
+        # or if the stored content is released by another process while we're working on it
+        logging.debug("unable to store {} as {}: {}".format(path, sha256, e))
+        return False
+
+def link_file(sha256, dest_path):
+    """Creates a hard link at dest_path to the stored content for the given sha256.
+       Returns True if the link was created, False otherwise."""
+    try:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.link(get_store_path(sha256), dest_path)
+        return True
+    except OSError as e:
+        logging.debug("unable to link stored content {} to {}: {}".format(sha256, dest_path, e))
+        return False
+
+def get_cached_analysis(sha256, key, lifetime=None):
+    """Returns the cached analysis results for the given sha256 and key, or None if nothing was cached.
+       If lifetime is a datetime.timedelta then cached results older than lifetime are ignored."""
+
+    if not is_analysis_cache_enabled():
+        return None
+
+    cache_path = get_cache_path(sha256, key)
+
+    try:
+        with open(cache_path, 'r') as fp:
+            cache_entry = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("unable to load cached analysis {}: {}".format(cache_path, e))
+        return None
+
+    if lifetime is not None and time.time() - cache_entry['time'] > lifetime.total_seconds():
+        logging.debug("cached analysis {} has expired".format(cache_path))
+        return None
+
+    logging.debug("using cached analysis {} for {}".format(key, sha256))
+    return cache_entry['value']
+
+def set_cached_analysis(sha256, key, value):
+    """Caches the given (JSON serializable) analysis results for the given sha256 and key.
+       The results are only cached if the content is stored.  Returns True if the results were cached."""
+
+    from saq.analysis import _JSONEncoder
+
+    if not is_analysis_cache_enabled():
+        return False
+
+    # there is no reason to cache results for content we do not reference
+    if not is_stored(sha256):
+        return False
+
+    cache_path = get_cache_path(sha256, key)
+    temp_path = '{}.{}.tmp'.format(cache_path, str(uuid.uuid4()))
+
+    try:
+        with open(temp_path, 'w') as fp:
+            json.dump({ 'time': time.time(), 'value': value }, fp, cls=_JSONEncoder)
+
+        os.replace(temp_path, cache_path)
+        return True
+
+    except Exception as e:
+        logging.error("unable to cache analysis {} for {}: {}".format(key, sha256, e))
+        report_exception()
+
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        except Exception as e:
+            logging.error("unable to remove {}: {}".format(temp_path, e))
+
+        return False
+
+def _remove_stored_content(sha256):
+    """Removes the stored content and any cached analysis results for the given sha256."""
+    store_path = get_store_path(sha256)
+    store_dir = os.path.dirname(store_path)
+
+    try:
+        os.remove(store_path)
+    except FileNotFoundError:
+        pass
+
+    cache_prefix = '{}.'.format(sha256)
+    try:
+        for file_name in os.listdir(store_dir):
+            if file_name.startswith(cache_prefix) and file_name.endswith(CACHE_FILE_EXT):
+                os.remove(os.path.join(store_dir, file_name))
+    except FileNotFoundError:
+        pass
+
+def release(sha256_list):
+    """Removes the stored content for each of the given sha256 values that are no longer referenced.
+       This is called after files have been deleted from a storage directory.  Returns the number of items removed."""
+
+    if not is_enabled():
+        return 0
+
+    count = 0
+    for sha256 in set(sha256_list):
+        if sha256 is None:
+            continue
+
+        try:
+            store_path = get_store_path(sha256)
+            if os.stat(store_path).st_nlink > 1:
+                continue
+
+            _remove_stored_content(sha256)
+            logging.debug("released stored content {}".format(sha256))
+            count += 1
+
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logging.error("unable to release stored content {}: {}".format(sha256, e))
+
+    return count
+
+def collect():
+    """Removes all stored content that is no longer referenced by anything.
+       Alerts that are deleted without being loaded (see saq.util.maintenance.cleanup_alerts) are released here.
+       Returns the number of items removed."""
+
+    if not is_enabled():
+        return 0
+
+    store_dir = get_store_dir()
+    if not os.path.isdir(store_dir):
+        return 0
+
+    count = 0
+    for sub_dir in os.listdir(store_dir):
+        sub_dir_path = os.path.join(store_dir, sub_dir)
+        if not os.path.isdir(sub_dir_path):
+            continue
+
+        for file_name in os.listdir(sub_dir_path):
+            if not SHA256_REGEX.match(file_name):
+                continue
+
+            try:
+                if os.stat(os.path.join(sub_dir_path, file_name)).st_nlink > 1:
+                    continue
+
+                _remove_stored_content(file_name)
+                count += 1
+
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.error("unable to collect stored content {}: {}".format(file_name, e))
+
+        # remove cached results left behind for content that is no longer stored
+        for file_name in os.listdir(sub_dir_path):
+            if not file_name.endswith(CACHE_FILE_EXT):
+                continue
+
+            sha256 = file_name.split('.', 1)[0]
+            if SHA256_REGEX.match(sha256) and not os.path.exists(os.path.join(sub_dir_path, sha256)):
+                try:
+                    os.remove(os.path.join(sub_dir_path, file_name))
+                except FileNotFoundError:
+                    pass
+
+    logging.info("removed {} unreferenced items from the file store".format(count))
+    return count
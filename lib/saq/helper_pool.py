@@ -0,0 +1,302 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# pool of long-lived python helper processes
+#
+# Some of the tools used by file analysis (olevba, rtfobj, pdf-parser, officeparser) only run under python2.7.
+# Starting a new interpreter for every file means paying for interpreter startup and imports every time.
+# Instead each process keeps a small pool of bin/python_helper.py processes that run the scripts in-process and then
+# wait for the next one (see bin/python_helper.py for the protocol.) The helpers are started with
+# saq.process_server.Popen like the other tools and talk to the pool over a unix socket.
+#
+# The helper removes the modules and logging configuration each script leaves behind. A helper that times out is
+# killed and replaced. Helpers are also replaced after they have run max_jobs scripts so that whatever other state the
+# scripts leave behind does not accumulate.
+#
+
+import atexit
+import base64
+import json
+import logging
+import os, os.path
+import select
+import signal
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import saq
+import saq.metrics
+from saq.constants import METRIC_HELPER_EXECUTION_TIME
+from saq.process_server import Popen, PIPE, DEVNULL, TimeoutExpired
+
+# the amount of data read from a helper at once
+BLOCK_SIZE = 64 * 1024
+
+# how long (in seconds) we wait for a new helper to connect
+HELPER_STARTUP_TIMEOUT = 30
+
+HELPER_EXECUTION_TIME = saq.metrics.histogram(METRIC_HELPER_EXECUTION_TIME,
+                                              "time spent running a python tool", [ 'tool' ])
+
+def is_enabled():
+    """Returns True if python scripts should be run in the helper pool."""
+    return saq.CONFIG['helper_pool'].getboolean('enabled', fallback=False)
+
+def get_interpreter():
+    """Returns the python interpreter used to run the scripts."""
+    return saq.CONFIG['helper_pool'].get('interpreter', fallback='python2.7')
+
+def get_helper_path():
+    return os.path.join(saq.SAQ_HOME, 'bin', 'python_helper.py')
+
+class HelperProcess(object):
+    """A single bin/python_helper.py process."""
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        # the pid the helper reports when it connects
+        self.pid = None
+        # set to True once the helper has been killed or closed
+        self.closed = False
+        # the number of scripts this helper has been asked to run
+        self.job_count = 0
+        self.buffer = bytearray()
+
+        socket_path = os.path.join(saq.DATA_DIR, 'var', 'helper_{}.socket'.format(uuid.uuid4()))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(socket_path)
+            listener.listen(1)
+            listener.settimeout(HELPER_STARTUP_TIMEOUT)
+            # the helper runs in its own session so that it can be killed along with anything it starts
+            self.process = Popen([interpreter, get_helper_path(), socket_path],
+                                 stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+            try:
+                self.sock, _ = listener.accept()
+            except socket.timeout:
+                self.closed = True
+                try:
+                    self.process.communicate(timeout=5)
+                except TimeoutExpired:
+                    # the process server kills the process group itself when the timeout expires
+                    if isinstance(self.process, subprocess.Popen):
+                        os.killpg(self.process.pid, signal.SIGKILL)
+                        self.process.communicate()
+
+                raise RuntimeError("helper process ({}) did not connect".format(interpreter))
+        finally:
+            listener.close()
+            try:
+                os.remove(socket_path)
+            except OSError:
+                pass
+
+        self.sock.settimeout(None)
+        self.pid = int(self._read_line(HELPER_STARTUP_TIMEOUT, [ interpreter, get_helper_path() ]))
+        logging.debug("started helper process {} ({})".format(self.pid, interpreter))
+
+    @property
+    def is_alive(self):
+        if self.closed:
+            return False
+
+        # the helper only writes in response to a request so anything to read while it is idle means it exited
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return not readable
+
+    def _read_line(self, timeout, command):
+        """Returns the next line the helper sends (without the newline.)
+           Raises TimeoutExpired (after killing the helper) if nothing is sent in timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            index = self.buffer.find(b'\n')
+            if index != -1:
+                break
+
+            wait_time = None if deadline is None else max(0, deadline - time.time())
+            readable, _, _ = select.select([self.sock], [], [], wait_time)
+            if not readable:
+                self.kill()
+                raise TimeoutExpired(command, timeout)
+
+            data = self.sock.recv(BLOCK_SIZE)
+            if not data:
+                self.kill()
+                raise RuntimeError("helper process {} exited".format(self.pid))
+
+            self.buffer.extend(data)
+
+        line = bytes(self.buffer[:index])
+        del self.buffer[:index + 1]
+        return line
+
+    def run(self, script, args, cwd=None, timeout=None):
+        """Runs the given script in this helper. Returns a tuple of (returncode, stdout, stderr).
+           Raises TimeoutExpired (after killing the helper) if the script takes longer than timeout seconds."""
+        request = json.dumps({ 'script': script, 'args': args, 'cwd': cwd }).encode('utf8') + b'\n'
+        self.sock.sendall(request)
+        self.job_count += 1
+
+        response = json.loads(self._read_line(timeout, [ script ] + args).decode('utf8'))
+        return response['returncode'], base64.b64decode(response['stdout']), base64.b64decode(response['stderr'])
+
+    def kill(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        try:
+            if self.pid is not None:
+                os.killpg(self.pid, signal.SIGKILL)
+        except Exception as e:
+            logging.debug("unable to kill helper process {}: {}".format(self.pid, e))
+
+        self._cleanup()
+
+    def close(self):
+        """Asks the helper to exit (killing it if it does not.)"""
+        if self.closed:
+            return
+
+        # the helper exits when the connection is closed
+        self.closed = True
+        self._cleanup()
+
+    def _cleanup(self):
+        try:
+            self.sock.close()
+        except Exception as e:
+            logging.debug("unable to close connection to helper process {}: {}".format(self.pid, e))
+
+        try:
+            self.process.communicate(timeout=5)
+        except Exception as e:
+            logging.debug("helper process {} did not exit: {}".format(self.pid, e))
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+                self.process.communicate()
+            except Exception as e:
+                logging.debug("unable to kill helper process {}: {}".format(self.pid, e))
+
+class HelperPool(object):
+    """A pool of HelperProcess objects shared by the threads of a process."""
+
+    def __init__(self, interpreter, size=2, max_jobs=100):
+        self.interpreter = interpreter
+        self.max_jobs = max_jobs
+        # helpers that belong to another process (after a fork) are never used
+        self.pid = os.getpid()
+        self.idle = [] # of HelperProcess
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # key = tool name, value = [ count, total seconds, max seconds ]
+        self.execution_times = {}
+
+    def _get_helper(self):
+        with self.lock:
+            while self.idle:
+                helper = self.idle.pop()
+                if helper.is_alive:
+                    return helper
+
+        return HelperProcess(self.interpreter)
+
+    def _release_helper(self, helper):
+        if not helper.is_alive:
+            return
+
+        if helper.job_count >= self.max_jobs:
+            logging.debug("recycling helper process {} after {} jobs".format(helper.pid, helper.job_count))
+            helper.close()
+            return
+
+        with self.lock:
+            self.idle.append(helper)
+
+    def _record_execution_time(self, tool, elapsed):
+        with self.lock:
+            stats = self.execution_times.setdefault(tool, [ 0, 0.0, 0.0 ])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+        HELPER_EXECUTION_TIME.labels(tool).observe(elapsed)
+
+    def get_execution_times(self):
+        """Returns a dict of tool name -> (count, average seconds, max seconds) for the scripts run by this pool."""
+        with self.lock:
+            return { tool: (count, total / count, maximum)
+                     for tool, (count, total, maximum) in self.execution_times.items() }
+
+    def run(self, script, args, cwd=None, timeout=None, tool=None):
+        """Runs the given python script with the given arguments in a helper process.
+           Returns a tuple of (returncode, stdout, stderr) where stdout and stderr are bytes.
+           Raises TimeoutExpired if the script does not finish in timeout seconds.
+           The execution time is recorded under the given tool name (defaults to the name of the script.)
+           This does not include the time spent waiting for a helper."""
+        if tool is None:
+            tool = os.path.splitext(os.path.basename(script))[0]
+
+        with self.semaphore:
+            helper = self._get_helper()
+            start = time.time()
+            try:
+                result = helper.run(script, args, cwd=cwd, timeout=timeout)
+            except Exception:
+                helper.kill()
+                raise
+            finally:
+                self._record_execution_time(tool, time.time() - start)
+
+            self._release_helper(helper)
+            return result
+
+    def close(self):
+        """Stops all of the idle helpers."""
+        if self.pid != os.getpid():
+            return
+
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for helper in idle:
+            helper.close()
+
+_helper_pool = None
+_helper_pool_lock = threading.Lock()
+
+def get_helper_pool():
+    """Returns the HelperPool shared by the threads of this process (see [helper_pool])."""
+    global _helper_pool
+    with _helper_pool_lock:
+        if _helper_pool is None or _helper_pool.pid != os.getpid():
+            _helper_pool = HelperPool(get_interpreter(),
+                                      size=saq.CONFIG['helper_pool'].getint('size', fallback=2),
+                                      max_jobs=saq.CONFIG['helper_pool'].getint('max_jobs', fallback=100))
+            atexit.register(_helper_pool.close)
+
+        return _helper_pool
+
+def run_python_script(script, args, cwd=None, timeout=None, tool=None):
+    """Runs the given python script with the given arguments using the configured interpreter.
+       The script is run in the helper pool if [helper_pool] is enabled, otherwise in a new process.
+       Returns a tuple of (returncode, stdout, stderr) where stdout and stderr are bytes.
+       Raises TimeoutExpired if the script does not finish in timeout seconds."""
+    if is_enabled():
+        return get_helper_pool().run(script, args, cwd=cwd, timeout=timeout, tool=tool)
+
+    p = Popen([get_interpreter(), script] + list(args), stdout=PIPE, stderr=PIPE, cwd=cwd)
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        # the process server kills the process when the timeout expires, a local process is killed here
+        if isinstance(p, subprocess.Popen):
+            p.kill()
+            p.communicate()
+
+        raise
+
+    return p.returncode, stdout, stderr
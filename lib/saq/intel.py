@@ -2,6 +2,7 @@
 #
 # utility functions and constants for intel (SIP) support
 
+import datetime
 import json
 import logging
 import os
@@ -9,6 +10,7 @@ import os.path
 import sqlite3
 
 import saq
+from saq.util import create_timedelta
 
 indicator_type_mapping = None
 observable_type_mapping = None
@@ -271,12 +273,104 @@ def load_observable_type_mapping():
 def get_observables_by_type_mapping(indicator_type):
     return observable_type_mapping[indicator_type] 
 
-def update_local_cache():
+# the number of indicators written to the cache database at a time
+CACHE_BATCH_SIZE = 10000
+
+# the format of the modified_after parameter of the SIP indicators api
+SIP_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# indicators modified this long before the last update are requested again to allow for clock skew
+CACHE_WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+class LocalIndicatorSource(object):
+    """A stand-in for the SIP client that serves indicators from a local JSON file.
+       The file contains a list of indicators with the id, type, value, status and (optionally) modified fields.
+       Set [sip] cache_source_path to use this instead of a live SIP instance."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, url):
+        from urllib.parse import urlparse, parse_qs
+        query = parse_qs(urlparse(url).query)
+        status = query.get('status', [ None ])[0]
+        modified_after = query.get('modified_after', [ None ])[0]
+
+        with open(self.path, 'r') as fp:
+            indicators = json.load(fp)
+
+        for indicator in indicators:
+            if status is not None and indicator.get('status') != status:
+                continue
+
+            if modified_after is not None and indicator.get('modified', '') <= modified_after:
+                continue
+
+            yield indicator
+
+def get_indicator_source():
+    """Returns the object used to download indicators (either a pysip.Client or a LocalIndicatorSource.)"""
+    if saq.CONFIG['sip'].get('cache_source_path', fallback=None):
+        return LocalIndicatorSource(os.path.join(saq.SAQ_HOME, saq.CONFIG['sip']['cache_source_path']))
 
     import pysip
 
     # XXX remove verify=False
-    sip_client = pysip.Client(saq.CONFIG['sip']['remote_address'], saq.CONFIG['sip']['api_key'], verify=False)
+    return pysip.Client(saq.CONFIG['sip']['remote_address'], saq.CONFIG['sip']['api_key'], verify=False)
+
+def _create_cache_tables(db_cursor):
+    db_cursor.execute("""CREATE TABLE indicators ( 
+                           id TEXT PRIMARY KEY, 
+                           type TEXT NOT NULL,
+                           value TEXT NOT NULL )""")
+    db_cursor.execute("CREATE TABLE cache_state ( name TEXT PRIMARY KEY, value TEXT NOT NULL )")
+
+def _get_cache_state(db_cursor, name):
+    """Returns the given value (as a string) from the cache_state table of the given cache, or None if it is not set."""
+    try:
+        db_cursor.execute("SELECT value FROM cache_state WHERE name = ?", (name,))
+    except sqlite3.OperationalError:
+        # cache created before we tracked this
+        return None
+
+    row = db_cursor.fetchone()
+    return row[0] if row else None
+
+def _get_cache_watermark(db_cursor):
+    """Returns the time (as a string) the given cache was last updated, or None if it is not known."""
+    return _get_cache_state(db_cursor, 'watermark')
+
+def _execute_batches(db_cursor, sql, rows):
+    """Executes the given sql for each of the rows CACHE_BATCH_SIZE rows at a time. Returns the number of rows."""
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CACHE_BATCH_SIZE:
+            db_cursor.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        db_cursor.executemany(sql, batch)
+        count += len(batch)
+
+    return count
+
+def update_local_cache(incremental=None, source=None):
+    """Updates the local SQLite cache of SIP indicators.
+       If incremental is True then only the indicators that changed since the last update are downloaded and applied
+       to a copy of the current cache. Otherwise the entire cache is rebuilt. If incremental is None then the
+       [sip] incremental_cache_update setting is used. A full rebuild is done if there is nothing to start from
+       or if the cache was last rebuilt longer ago than [sip] full_cache_update_frequency.
+       The source defaults to the result of get_indicator_source()."""
+
+    if incremental is None:
+        incremental = saq.CONFIG['sip'].getboolean('incremental_cache_update', fallback=False)
+
+    if source is None:
+        source = get_indicator_source()
+
     cache_path = os.path.join(saq.DATA_DIR, saq.CONFIG['sip']['cache_db_path'])
 
     # the actual file should be a symlink
@@ -307,29 +401,86 @@ def update_local_cache():
     
     if os.path.exists(target_cache_path):
         try:
-            logging.info("deleting existing crits cache {}".format(target_cache_path))
+            logging.info("deleting existing sip cache {}".format(target_cache_path))
             os.remove(target_cache_path)
         except Exception as e:
             logging.error("unable to delete {}: {}".format(target_cache_path, e))
             return False
 
-    cache_db = sqlite3.connect(target_cache_path)
-    db_cursor = cache_db.cursor()
-    db_cursor.execute("""CREATE TABLE indicators ( 
-                           id TEXT PRIMARY KEY, 
-                           type TEXT NOT NULL,
-                           value TEXT NOT NULL )""")
-    db_cursor.execute("CREATE INDEX i_type_value_index ON indicators ( type, value )")
+    # the time we started is the watermark for the next update
+    # SIP records the time indicators are modified in UTC
+    update_time = datetime.datetime.utcnow()
+
+    # indicators deleted from SIP are only removed from the cache when it is rebuilt
+    full_update_frequency = create_timedelta(saq.CONFIG['sip'].get('full_cache_update_frequency',
+                                                                   fallback='1:00:00:00'))
+
+    # if we're doing an incremental update we start with a copy of what we've already got
+    watermark = None
+    full_update_time = None
+    if incremental and os.path.exists(cache_path):
+        with sqlite3.connect('file:{}?mode=ro'.format(current_cache_path), uri=True) as current_db:
+            watermark = _get_cache_watermark(current_db.cursor())
+            full_update_time = _get_cache_state(current_db.cursor(), 'full_update')
+            if full_update_frequency and watermark is not None and (full_update_time is None or \
+               datetime.datetime.strptime(full_update_time, SIP_TIME_FORMAT) + full_update_frequency < update_time):
+                logging.info("sip cache was last rebuilt at {} -- rebuilding".format(full_update_time))
+                watermark = None
+                incremental = False
+
+            if watermark is not None:
+                cache_db = sqlite3.connect(target_cache_path)
+                current_db.backup(cache_db)
+
+    if watermark is None:
+        full_update_time = update_time.strftime(SIP_TIME_FORMAT)
+        if incremental:
+            logging.info("no watermark available for incremental update of sip cache -- rebuilding")
+
+        cache_db = sqlite3.connect(target_cache_path)
+        db_cursor = cache_db.cursor()
+        _create_cache_tables(db_cursor)
+
+        logging.info("caching indicators...")
+        c = _execute_batches(db_cursor, "INSERT INTO indicators ( id, type, value ) VALUES ( ?, ?, LOWER(?) )",
+                             ((str(indicator['id']), indicator['type'], indicator['value']) for indicator in 
+                             source.get('/api/indicators?status={}&bulk=True'.format(SIP_STATUS_ANALYZED))))
+
+        # it's faster to build the index after the data is loaded
+        db_cursor.execute("CREATE INDEX i_type_value_index ON indicators ( type, value )")
+        logging.debug("loaded {} indicators".format(c))
+
+    else:
+        db_cursor = cache_db.cursor()
+        modified_after = (datetime.datetime.strptime(watermark, SIP_TIME_FORMAT) - CACHE_WATERMARK_OVERLAP).strftime(
+                         SIP_TIME_FORMAT)
+
+        logging.info("caching indicators modified after {}...".format(modified_after))
+        c = _execute_batches(db_cursor, 
+                             "INSERT OR REPLACE INTO indicators ( id, type, value ) VALUES ( ?, ?, LOWER(?) )",
+                             ((str(indicator['id']), indicator['type'], indicator['value']) for indicator in 
+                             source.get('/api/indicators?status={}&bulk=True&modified_after={}'.format(
+                                        SIP_STATUS_ANALYZED, modified_after))))
+        logging.debug("updated {} indicators".format(c))
 
-    logging.info("caching indicators...")
-    c = 0
-    for indicator in sip_client.get('/api/indicators?status=Analyzed&bulk=True'):
-        db_cursor.execute("INSERT INTO indicators ( id, type, value ) VALUES ( ?, ?, LOWER(?) )", 
-                         (str(indicator['id']), indicator['type'], indicator['value']))
-        c += 1
+        # indicators that are no longer analyzed are removed
+        for status in [ SIP_STATUS_DEPRECATED, SIP_STATUS_FA, SIP_STATUS_IN_PROGRESS, SIP_STATUS_INFORMATIONAL,
+                        SIP_STATUS_NEW ]:
+            c = _execute_batches(db_cursor, "DELETE FROM indicators WHERE id = ?",
+                                 ((str(indicator['id']),) for indicator in 
+                                 source.get('/api/indicators?status={}&bulk=True&modified_after={}'.format(
+                                            status, modified_after))))
+            logging.debug("removed {} {} indicators".format(c, status))
+
+    db_cursor.execute("INSERT OR REPLACE INTO cache_state ( name, value ) VALUES ( 'watermark', ? )",
+                      (update_time.strftime(SIP_TIME_FORMAT),))
+    db_cursor.execute("INSERT OR REPLACE INTO cache_state ( name, value ) VALUES ( 'full_update', ? )",
+                      (full_update_time,))
 
     logging.info("comitting changes to database...")
     cache_db.commit()
+    cache_db.close()
+
     logging.info("updating symlink...")
     # now point current link to our new database
     # leaving the old one in place for current processes to keep using
@@ -345,9 +496,56 @@ def update_local_cache():
         logging.error("failed to update symlink: {}".format(e))
 
     logging.info("done")
-    logging.debug("loaded {} indicators".format(c))
     return True
 
+def sqlite_lower(value):
+    """Returns the value lowercased the same way the SQLite LOWER function does it (ASCII characters only.)"""
+    return value.translate(_SQLITE_LOWER_TABLE)
+
+_SQLITE_LOWER_TABLE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+class IndicatorCacheLookup(object):
+    """An in-memory set of the (type, value) pairs in an indicator cache database.
+       This sits in front of the database so that values that are not in the cache never touch SQLite.
+       The set is reloaded when the cache database is replaced."""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.indicators = frozenset()
+        # the (realpath, mtime) of the database the set was loaded from
+        self.loaded_from = None
+
+    def refresh(self):
+        """Reloads the set if the cache database has changed."""
+        real_path = os.path.realpath(self.cache_path)
+        current = (real_path, os.stat(real_path).st_mtime)
+        if current == self.loaded_from:
+            return
+
+        with sqlite3.connect('file:{}?mode=ro'.format(real_path), uri=True) as db:
+            db_cursor = db.cursor()
+            db_cursor.execute("SELECT type, value FROM indicators")
+            self.indicators = frozenset(db_cursor)
+
+        self.loaded_from = current
+        logging.debug("loaded {} indicators from {}".format(len(self.indicators), real_path))
+
+    def __contains__(self, key):
+        """Returns True if the given (type, value) is in the cache database."""
+        return key in self.indicators
+
+# key = cache_path, value = IndicatorCacheLookup
+_indicator_cache_lookups = {}
+
+def get_indicator_cache_lookup(cache_path):
+    """Returns the (refreshed) IndicatorCacheLookup for the given cache database."""
+    if cache_path not in _indicator_cache_lookups:
+        _indicator_cache_lookups[cache_path] = IndicatorCacheLookup(cache_path)
+
+    lookup = _indicator_cache_lookups[cache_path]
+    lookup.refresh()
+    return lookup
+
 # curl -k -H "Authorization: Bearer blah" https://sip.local:4443/api/indicators/status
 SIP_STATUS_ANALYZED = 'Analyzed'
 SIP_STATUS_DEPRECATED = 'Deprecated'
@@ -19,10 +19,14 @@ import saq
 from saq.error import report_exception
 from saq.constants import *
 from saq.database import Message, MessageRouting
+from saq.util import get_wakeup_signal
 
 from sqlalchemy import and_, func, literal, asc, text
 from sqlalchemy.orm import joinedload
 
+# used to initialize the message system on first use
+_message_system_lock = threading.Lock()
+
 def initialize_message_system(*args, **kwargs):
     saq.MESSAGE_SYSTEM = MessageSystem(*args, **kwargs)
 
@@ -35,8 +39,22 @@ def stop_message_system(*args, **kwargs):
 def wait_message_system(*args, **kwargs):
     saq.MESSAGE_SYSTEM.wait(*args, **kwargs)
 
+def get_route_wakeup_signal(route):
+    """Returns the saq.util.WakeupSignal used to notify the dispatch system for the given route of new messages."""
+    return get_wakeup_signal(f'messaging.{route}')
+
 def send_message(*args, **kwargs):
     """Submits the given message to the dispatch system. Returns the saq.database.Message object that was created."""
+    # the message system is loaded the first time it is needed
+    if saq.MESSAGE_SYSTEM is None:
+        with _message_system_lock:
+            if saq.MESSAGE_SYSTEM is None:
+                try:
+                    initialize_message_system()
+                except Exception as e:
+                    logging.error(f"unable to initialize message system: {e}")
+                    report_exception()
+
     if saq.MESSAGE_SYSTEM is None:
         logging.error("send_message was called but no message systems are defined")
         return None
@@ -99,6 +117,11 @@ class MessageSystem(object):
 
         saq.db.commit()
         logging.info("added message {} to {} destinations".format(content[:10], len(routing)))
+
+        # wake up the dispatch systems for these routes so they don't wait for the next poll
+        for route in set([route for route, destination in routing]):
+            get_route_wakeup_signal(route).notify()
+
         return message
 
     def load_routes(self):
@@ -169,6 +192,12 @@ class MessageDispatchSystem(object):
         self.batch_size = saq.CONFIG['messaging'].getint('batch_size')
         # used to stop the system once all available messages (for this route) have been processed
         self.controlled_stop = False
+        # how long (in seconds) we wait for new messages before checking again
+        self.idle_timeout = saq.CONFIG['messaging'].getint('idle_timeout', fallback=5)
+        # notified by send_message when new messages are available for this route
+        self.wakeup_signal = get_route_wakeup_signal(self.route)
+        # the next time we delete messages that have been dispatched to all of their routes
+        self.next_orphan_cleanup = None
 
     def start(self):
         self.control_event = threading.Event()
@@ -177,6 +206,7 @@ class MessageDispatchSystem(object):
 
     def stop(self, wait=True):
         self.control_event.set()
+        self.wakeup_signal.interrupt()
         if wait:
             self.wait()
 
@@ -206,7 +236,17 @@ class MessageDispatchSystem(object):
             if sleep_time is None:
                 sleep_time = 0
 
-            self.control_event.wait(sleep_time)
+            if sleep_time > 0:
+                self.wakeup_signal.wait(sleep_time, self.control_event)
+
+        # clear out whatever we dispatched since the last periodic cleanup
+        try:
+            self.delete_orphaned_messages()
+        except Exception as e:
+            logging.error(f"unable to delete dispatched messages: {e}")
+            report_exception()
+        finally:
+            saq.db.close()
                 
         logging.info(f"stopped {self.name}")
 
@@ -221,12 +261,17 @@ class MessageDispatchSystem(object):
             self.next_lock_timeout_check = datetime.datetime.now() + \
                 datetime.timedelta(seconds=saq.CONFIG['messaging'].getint('lock_timeout'))
 
-        # get the next message to send
-        message_route = saq.db.query(MessageRouting).options(joinedload('message')).filter(
-            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).first()
+        # periodically clear out messages that have been dispatched to all of their routes
+        if self.next_orphan_cleanup is None or datetime.datetime.now() >= self.next_orphan_cleanup:
+            self.delete_orphaned_messages()
+            self.next_orphan_cleanup = datetime.datetime.now() + \
+                datetime.timedelta(seconds=saq.CONFIG['messaging'].getint('orphan_cleanup_frequency', fallback=60))
+
+        # get the messages we already have locked
+        message_routes = self.get_locked_message_routes()
 
-        if message_route is None:
-            # if we didn't get one then go ahead and lock the next batch of messages
+        if not message_routes:
+            # if we didn't get any then go ahead and lock the next batch of messages
             target_ids = saq.db.query(MessageRouting.id).filter(and_(
                 MessageRouting.lock == None,
                 MessageRouting.route == self.route))\
@@ -241,7 +286,7 @@ class MessageDispatchSystem(object):
                 if self.controlled_stop:
                     raise ControlledStop()
                 else:
-                    return 5
+                    return self.idle_timeout
                 
             saq.db.execute(MessageRouting.__table__.update().values(
                 lock=self.lock_uuid,
@@ -252,30 +297,58 @@ class MessageDispatchSystem(object):
 
             saq.db.commit()
 
-        # try again to get the next message to send
-        message_route = saq.db.query(MessageRouting).options(joinedload('message')).filter(
-            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).first()
+            # try again to get the messages to send
+            message_routes = self.get_locked_message_routes()
 
         # if we still didn't get a message then we wait for a while
-        if message_route is None:
+        if not message_routes:
             if self.controlled_stop:
                 raise ControlledStop()
             else:
-                return 5 # TODO make configurable?
+                return self.idle_timeout
 
-        # dispatch the message
-        logging.debug(f"dispatching message {message_route.message_id} to route {message_route.route} destination {message_route.destination}")
-        self.dispatch(message_route.message, message_route.destination)
-        
-        # clear this message out
-        saq.db.execute(MessageRouting.__table__.delete().where(MessageRouting.id == message_route.id))
+        # dispatch the entire batch
+        dispatched_ids = []
+        for message_route in message_routes:
+            if self.control_event.is_set():
+                break
 
-        # and finally clear the message if all the routes have completed
-        saq.db.execute(Message.__table__.delete().where(Message.id.notin_(saq.db.query(MessageRouting.message_id))))
-        saq.db.commit()
+            logging.debug(f"dispatching message {message_route.message_id} to route {message_route.route} "
+                          f"destination {message_route.destination}")
+
+            try:
+                self.dispatch(message_route.message, message_route.destination)
+                dispatched_ids.append(message_route.id)
+            except Exception as e:
+                # this stays locked and is tried again the next time around
+                logging.error(f"unable to dispatch message {message_route.message_id} "
+                              f"to destination {message_route.destination}: {e}")
+                report_exception()
+
+        # clear these messages out
+        if dispatched_ids:
+            saq.db.execute(MessageRouting.__table__.delete().where(MessageRouting.id.in_(dispatched_ids)))
+            saq.db.commit()
+
+        # if something failed to dispatch then wait a bit before trying it again
+        if len(dispatched_ids) < len(message_routes) and not self.control_event.is_set():
+            return self.idle_timeout
 
         return 0
 
+    def get_locked_message_routes(self):
+        """Returns the list of MessageRouting objects currently locked by this system."""
+        return saq.db.query(MessageRouting).options(joinedload('message')).filter(
+            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).all()
+
+    def delete_orphaned_messages(self):
+        """Deletes the messages that have been dispatched to all of their routes."""
+        result = saq.db.execute(Message.__table__.delete().where(
+            Message.id.notin_(saq.db.query(MessageRouting.message_id))))
+        saq.db.commit()
+        if result.rowcount:
+            logging.debug(f"deleted {result.rowcount} dispatched messages")
+
     @property
     def name(self):
         return type(self).__name__
@@ -100,3 +100,21 @@ class TestCase(ACEBasicTestCase):
         self.assertTrue(saq.MESSAGE_SYSTEM.systems['test_2'].message_dispatched.wait(5))
         stop_message_system()
         self.assertIsNone(saq.db.query(Message).first())
+
+    def test_batch_dispatch(self):
+        # messages are dispatched as soon as they are sent, not on the next poll
+        saq.CONFIG['messaging']['idle_timeout'] = '60'
+        saq.CONFIG['messaging']['orphan_cleanup_frequency'] = '600'
+        initialize_message_system()
+        start_message_system()
+        wait_for_log_count('started TestMessageDispatchSystem', 1)
+        system = saq.MESSAGE_SYSTEM.systems['test']
+        for index in range(3):
+            send_message(f'hello world {index}', 'test')
+
+        wait_for(lambda: len(system.messages_received) == 3, 1, 5)
+        self.assertEquals(len(system.messages_received), 3)
+
+        # dispatched messages are cleaned up when the system stops
+        stop_message_system()
+        self.assertIsNone(saq.db.query(Message).first())
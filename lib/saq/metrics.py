@@ -0,0 +1,631 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# in-process metrics registry
+#
+# Counters, gauges and histograms are kept in memory by the process that records them. Recording a value is a dict
+# lookup and an addition under a lock, so metrics can be recorded from hot paths (the per-module analysis loop, the
+# collector submission loop, etc...)
+#
+# Every [metrics] export_frequency seconds a background thread hands a snapshot of the registry to each of the enabled
+# exporters, which are configured in metrics_exporter_ sections just like services and analysis modules:
+#
+# [metrics_exporter_NAME]
+# module = saq.metrics
+# class = ProcessExporter
+# enabled = yes
+#
+# Each ACEService with a metrics_port in its configuration serves the metrics on a local OpenMetrics HTTP endpoint.
+# Most services fork other processes (the engine forks the engine process which forks the workers) so the endpoint
+# merges the metrics of the service process with the snapshots the ProcessExporter of each forked process writes to
+# DATA_DIR/stats/metrics/processes/SERVICE/PID.json. Counters and histograms are summed. Gauges are not (a queue size
+# recorded by two processes is still one queue) so each process keeps its own value under an extra pid label. The
+# snapshots of processes that have exited are removed when the metrics are collected.
+#
+# Processes created with fork (multiprocessing) start with an empty registry and restart the export thread.
+# (so do not hold on to the objects returned by labels() across a fork.)
+#
+
+import bisect
+import collections
+import csv
+import datetime
+import glob
+import http.server
+import importlib
+import json
+import logging
+import os, os.path
+import socketserver
+import sys
+import threading
+import time
+
+import saq
+from saq.error import report_exception
+
+# the content type of the OpenMetrics text format
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+METRIC_TYPE_COUNTER = 'counter'
+METRIC_TYPE_GAUGE = 'gauge'
+METRIC_TYPE_HISTOGRAM = 'histogram'
+
+# the default histogram buckets (in seconds)
+DEFAULT_BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0 )
+
+def is_enabled():
+    """Returns True if metrics are exported and served."""
+    return saq.CONFIG['metrics'].getboolean('enabled', fallback=False)
+
+class CounterValue(object):
+    __slots__ = ( 'lock', 'value' )
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        assert amount >= 0
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+class GaugeValue(object):
+    __slots__ = ( 'lock', 'value' )
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0.0
+
+    def set(self, value):
+        with self.lock:
+            self.value = float(value)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def get(self):
+        return self.value
+
+class Timer(object):
+    """Context manager that observes the number of seconds it was active in a HistogramValue."""
+
+    def __init__(self, histogram_value):
+        self.histogram_value = histogram_value
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram_value.observe(time.perf_counter() - self.start)
+
+class HistogramValue(object):
+    __slots__ = ( 'lock', 'buckets', 'counts', 'sum', 'count' )
+
+    def __init__(self, lock, buckets):
+        self.lock = lock
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        # NOTE these are NOT cumulative (see get())
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Returns a context manager that observes how long the block took to execute (in seconds.)"""
+        return Timer(self)
+
+    def get(self):
+        with self.lock:
+            return { 'counts': list(self.counts), 'sum': self.sum, 'count': self.count }
+
+class Metric(object):
+    """Base class of Counter, Gauge and Histogram. Use the counter(), gauge() and histogram() functions to get one."""
+
+    metric_type = None
+
+    def __init__(self, name, documentation='', labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # key = tuple of label values, value = CounterValue, GaugeValue or HistogramValue
+        self.values = {}
+
+    def new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        """Returns the value object for the given label values (in the order of labelnames.)"""
+        # values are usually given as strings already
+        key = tuple([ value if isinstance(value, str) else str(value) for value in values ])
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+
+        if len(key) != len(self.labelnames):
+            raise ValueError("metric {} expects labels {} (got {})".format(self.name, self.labelnames, key))
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = self.new_value()
+
+            return self.values[key]
+
+    def collect(self):
+        """Returns a snapshot of this metric as a dict that can be serialized as JSON."""
+        with self.lock:
+            values = list(self.values.items())
+
+        result = { 'name': self.name,
+                   'type': self.metric_type,
+                   'documentation': self.documentation,
+                   'labelnames': list(self.labelnames),
+                   'samples': [ [ list(key), value.get() ] for key, value in values ] }
+
+        if self.metric_type == METRIC_TYPE_HISTOGRAM:
+            result['buckets'] = list(self.buckets)
+
+        return result
+
+    def reset(self):
+        # NOTE this is called after a fork where another thread of the parent could have been holding the lock
+        self.lock = threading.Lock()
+        self.values = {}
+
+class Counter(Metric):
+    metric_type = METRIC_TYPE_COUNTER
+
+    def new_value(self):
+        return CounterValue(self.lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    metric_type = METRIC_TYPE_GAUGE
+
+    def new_value(self):
+        return GaugeValue(self.lock)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+class Histogram(Metric):
+    metric_type = METRIC_TYPE_HISTOGRAM
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_value(self):
+        return HistogramValue(self.lock, self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+class MetricRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict() # key = name, value = Metric
+
+    def _get_or_create(self, metric_class, name, documentation, labelnames, **kwargs):
+        with self.lock:
+            if name in self.metrics:
+                metric = self.metrics[name]
+                if not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                    raise ValueError("metric {} is already registered as a different metric".format(name))
+
+                return metric
+
+            metric = self.metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation='', labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation='', labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation='', labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def collect(self):
+        """Returns a snapshot of all the metrics in this registry (a list of dicts, see Metric.collect.)"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return [ metric.collect() for metric in metrics ]
+
+    def reset(self):
+        """Clears the recorded values of all the metrics (the metrics stay registered.)
+           This is called in new processes after a fork so it does not wait on any locks."""
+        self.lock = threading.Lock()
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+# the registry used by everything in this process
+REGISTRY = MetricRegistry()
+
+def counter(name, documentation='', labelnames=()):
+    """Returns the Counter with the given name, creating it if it does not exist yet."""
+    return REGISTRY.counter(name, documentation, labelnames)
+
+def gauge(name, documentation='', labelnames=()):
+    """Returns the Gauge with the given name, creating it if it does not exist yet."""
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+def histogram(name, documentation='', labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Returns the Histogram with the given name, creating it if it does not exist yet."""
+    return REGISTRY.histogram(name, documentation, labelnames, buckets=buckets)
+
+#
+# OpenMetrics
+#
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+def _escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{{{}}}'.format(','.join([ '{}="{}"'.format(name, _escape_label_value(value)) for name, value in pairs ]))
+
+def generate_openmetrics(families):
+    """Returns the given metrics (see MetricRegistry.collect) in the OpenMetrics text format."""
+    lines = []
+    for family in families:
+        name = family['name']
+        labelnames = family['labelnames']
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+        if family['documentation']:
+            lines.append('# HELP {} {}'.format(name, family['documentation'].replace('\\', '\\\\').replace('\n', '\\n')))
+
+        for labelvalues, value in family['samples']:
+            if family['type'] == METRIC_TYPE_COUNTER:
+                lines.append('{}_total{} {}'.format(name, _format_labels(labelnames, labelvalues), _format_value(value)))
+            elif family['type'] == METRIC_TYPE_GAUGE:
+                lines.append('{}{} {}'.format(name, _format_labels(labelnames, labelvalues), _format_value(value)))
+            elif family['type'] == METRIC_TYPE_HISTOGRAM:
+                cumulative = 0
+                for upper_bound, count in zip(list(family['buckets']) + [ float('inf') ], value['counts']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name,
+                                 _format_labels(labelnames, labelvalues, [ ('le', _format_value(upper_bound)) ]),
+                                 cumulative))
+
+                lines.append('{}_count{} {}'.format(name, _format_labels(labelnames, labelvalues), value['count']))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labelnames, labelvalues),
+                                                  _format_value(value['sum'])))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def merge_families(snapshots):
+    """Merges the metrics of multiple processes into one list of metrics.
+       snapshots is a list of tuple(pid, families). Gauges get an extra pid label."""
+    merged = collections.OrderedDict() # key = name, value = family
+    for pid, families in snapshots:
+        for family in families:
+            is_gauge = family['type'] == METRIC_TYPE_GAUGE
+            labelnames = list(family['labelnames'])
+            if is_gauge:
+                labelnames.append('pid')
+
+            if family['name'] not in merged:
+                merged[family['name']] = dict(family, labelnames=labelnames, samples=[], index={})
+
+            target = merged[family['name']]
+            if target['type'] != family['type'] or target['labelnames'] != labelnames \
+            or target.get('buckets') != family.get('buckets'):
+                logging.warning("metric {} from process {} does not match the other processes".format(
+                                family['name'], pid))
+                continue
+
+            for labelvalues, value in family['samples']:
+                key = tuple(labelvalues) + ((str(pid),) if is_gauge else ())
+                if key not in target['index']:
+                    # histogram values are changed in place below
+                    if isinstance(value, dict):
+                        value = dict(value, counts=list(value['counts']))
+
+                    target['index'][key] = len(target['samples'])
+                    target['samples'].append([ list(key), value ])
+                    continue
+
+                sample = target['samples'][target['index'][key]]
+                if family['type'] == METRIC_TYPE_HISTOGRAM:
+                    sample[1]['counts'] = [ a + b for a, b in zip(sample[1]['counts'], value['counts']) ]
+                    sample[1]['sum'] += value['sum']
+                    sample[1]['count'] += value['count']
+                else:
+                    sample[1] += value
+
+    for family in merged.values():
+        del family['index']
+
+    return list(merged.values())
+
+#
+# exporters
+#
+
+class MetricExporter(object):
+    """Base class of the exporters configured in the metrics_exporter_ sections."""
+
+    def __init__(self, config):
+        # the metrics_exporter_ configuration section
+        self.config = config
+
+    def export(self, families):
+        """Called every [metrics] export_frequency seconds with a snapshot of the metrics of this process."""
+        raise NotImplementedError()
+
+def get_csv_export_dir():
+    """Returns the directory the CSVExporter writes to.
+       This is kept apart from the files written by saq.performance.record_metric, which use a different layout."""
+    return os.path.join(saq.DATA_DIR, 'stats', 'metrics', 'export')
+
+class CSVExporter(MetricExporter):
+    """Appends a row for each recorded value to DATA_DIR/stats/metrics/export/NAME.csv"""
+
+    def export(self, families):
+        now = str(datetime.datetime.now())
+        target_dir = get_csv_export_dir()
+        os.makedirs(target_dir, exist_ok=True)
+        for family in families:
+            if not family['samples']:
+                continue
+
+            with open(os.path.join(target_dir, '{}.csv'.format(family['name'])), 'a') as fp:
+                writer = csv.writer(fp)
+                for labelvalues, value in family['samples']:
+                    labels = ','.join([ '{}={}'.format(name, value)
+                                        for name, value in zip(family['labelnames'], labelvalues) ])
+                    if isinstance(value, dict):
+                        # histograms record the number of observations and the sum of the observations
+                        values = [ value['count'], value['sum'] ]
+                    else:
+                        values = [ value ]
+
+                    writer.writerow([ now, os.getpid(), ' '.join(sys.argv), labels ] + values)
+
+class ProcessExporter(MetricExporter):
+    """Writes the metrics of this process where the OpenMetrics endpoint of the service can read them."""
+
+    def export(self, families):
+        if _metrics_group is None:
+            return
+
+        target_dir = get_process_metrics_dir(_metrics_group)
+        os.makedirs(target_dir, exist_ok=True)
+        target_path = os.path.join(target_dir, '{}.json'.format(os.getpid()))
+        temp_path = '{}.tmp'.format(target_path)
+        with open(temp_path, 'w') as fp:
+            json.dump({ 'pid': os.getpid(), 'families': families }, fp)
+
+        os.replace(temp_path, target_path)
+
+def get_process_metrics_dir(group):
+    """Returns the directory that contains the metrics of the processes of the given service."""
+    return os.path.join(saq.DATA_DIR, 'stats', 'metrics', 'processes', group)
+
+def load_exporters():
+    """Returns the list of MetricExporter objects enabled in the configuration."""
+    exporters = []
+    for section_name in saq.CONFIG.sections():
+        if not section_name.startswith('metrics_exporter_'):
+            continue
+
+        config = saq.CONFIG[section_name]
+        if not config.getboolean('enabled', fallback=False):
+            continue
+
+        try:
+            _module = importlib.import_module(config['module'])
+            exporters.append(getattr(_module, config['class'])(config))
+        except Exception as e:
+            logging.error("unable to load metrics exporter {}: {}".format(section_name, e))
+            report_exception()
+
+    return exporters
+
+# the name of the service this process (and the processes it forks) belongs to
+_metrics_group = None
+# the exporters used by this process
+_exporters = []
+_export_thread = None
+_export_shutdown_event = None
+
+def export_metrics():
+    """Hands a snapshot of the metrics of this process to each of the exporters."""
+    families = REGISTRY.collect()
+    for exporter in _exporters:
+        try:
+            exporter.export(families)
+        except Exception as e:
+            logging.error("metrics exporter {} failed: {}".format(exporter, e))
+
+def _export_loop(shutdown_event, frequency):
+    while not shutdown_event.wait(frequency):
+        export_metrics()
+
+def _start_export_thread():
+    global _export_thread, _export_shutdown_event
+    _export_shutdown_event = threading.Event()
+    _export_thread = threading.Thread(target=_export_loop,
+                                      args=(_export_shutdown_event,
+                                            saq.CONFIG['metrics'].getint('export_frequency', fallback=60)),
+                                      name="Metrics Exporter")
+    _export_thread.daemon = True
+    _export_thread.start()
+
+def start_exporters(group):
+    """Starts exporting the metrics of this process (and of the processes it forks) for the given service name."""
+    global _metrics_group, _exporters
+    if _export_thread is not None or not is_enabled():
+        return
+
+    _metrics_group = group
+    _exporters = load_exporters()
+    if _exporters:
+        _start_export_thread()
+
+def stop_exporters():
+    """Stops the export thread and exports the metrics one last time."""
+    global _export_thread
+    if _export_thread is None:
+        return
+
+    _export_shutdown_event.set()
+    _export_thread.join()
+    _export_thread = None
+    export_metrics()
+
+def _after_fork():
+    global _export_thread
+    # the new process starts with no recorded values so the values of the parent are not counted twice
+    REGISTRY.reset()
+    # threads do not survive a fork
+    if _export_thread is not None:
+        _export_thread = None
+        _start_export_thread()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+#
+# OpenMetrics endpoint
+#
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def collect_metrics(group=None):
+    """Returns the metrics of this process merged with the metrics the other processes of the given service exported."""
+    snapshots = [ (os.getpid(), REGISTRY.collect()) ]
+    if group is not None:
+        for path in glob.glob(os.path.join(get_process_metrics_dir(group), '*.json')):
+            try:
+                with open(path, 'r') as fp:
+                    snapshot = json.load(fp)
+            except Exception as e:
+                logging.debug("unable to load metrics from {}: {}".format(path, e))
+                continue
+
+            if snapshot['pid'] == os.getpid():
+                continue
+
+            # the metrics of processes that have exited are no longer reported
+            if not _is_process_alive(snapshot['pid']):
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    logging.debug("unable to remove {}: {}".format(path, e))
+
+                continue
+
+            snapshots.append((snapshot['pid'], snapshot['families']))
+
+    return merge_families(snapshots)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in [ '/', '/metrics' ]:
+            self.send_error(404)
+            return
+
+        try:
+            body = generate_openmetrics(collect_metrics(self.server.group)).encode('utf8')
+        except Exception as e:
+            logging.error("unable to generate metrics: {}".format(e))
+            report_exception()
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics request from {}: {}".format(self.address_string(), format % args))
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serves the metrics of a service on a local OpenMetrics endpoint."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, group=None):
+        super().__init__(server_address, MetricsRequestHandler)
+        # the name of the service
+        self.group = group
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="Metrics Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+def start_metrics_server(group, port):
+    """Starts exporting metrics for the given service name and serves them on the given local port.
+       Returns the MetricsServer."""
+    # anything left behind by the last time the service ran
+    for path in glob.glob(os.path.join(get_process_metrics_dir(group), '*.json')):
+        try:
+            os.remove(path)
+        except Exception as e:
+            logging.debug("unable to remove {}: {}".format(path, e))
+
+    start_exporters(group)
+    server = MetricsServer((saq.CONFIG['metrics'].get('bind_address', fallback='127.0.0.1'), port), group=group)
+    server.start()
+    logging.info("serving metrics for {} on {}:{}".format(group, *server.server_address[:2]))
+    return server
@@ -66,6 +66,10 @@ class AnalysisModule(object):
         # the actual semaphore to use
         self.semaphore = None
 
+        # the total time (in seconds) spent waiting for the semaphore during the current call to the module
+        # (reset by the engine before each call, see saq.analysis.timeline)
+        self.semaphore_wait_time = 0.0
+
         # we'll keep track of the Analysis and Observable objects we've generated
         # this is useful for cleanup routines
         self.generated_analysis = []
@@ -650,6 +654,7 @@ class AnalysisModule(object):
         self.semaphore = NetworkSemaphoreClient()
 
         logging.debug("analysis module {0} acquiring semaphore {1}".format(self, self.semaphore_name))
+        acquire_start = time.time()
         try:
             if not self.semaphore.acquire(self.semaphore_name):
                 raise RuntimeError("acquire returned False")
@@ -662,6 +667,8 @@ class AnalysisModule(object):
 
             # TODO fall back to something else we can use
             return False
+        finally:
+            self.semaphore_wait_time += time.time() - acquire_start
 
         return True
 
@@ -14,6 +14,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.modules import AnalysisModule, LDAPAnalysisModule, CarbonBlackAnalysisModule
 from saq.constants import *
+from saq.util import IPv4RangeIndex
 
 import iptools
 
@@ -96,6 +97,8 @@ class NetworkIdentifier(AnalysisModule):
     def __init__(self, *args, **kwargs):
         super(NetworkIdentifier, self).__init__(*args, **kwargs)
         self._networks = [] # list of _NetworkDefinition
+        # used to look up which networks an address belongs to
+        self._network_index = IPv4RangeIndex()
         
         # load the network definitions from the CSV file
         with open(os.path.join(saq.SAQ_HOME, saq.CONFIG.get(self.config_section, 'csv_file')), 'r') as fp:
@@ -107,6 +110,9 @@ class NetworkIdentifier(AnalysisModule):
             for row in reader:
                 #logging.debug("loading {0} = {1}".format(row[0], row[1]))
                 self._networks.append(_NetworkDefinition(iptools.IpRange(row[0]), row[1]))
+                self._network_index.add(row[0], row[1])
+
+        self._network_index.compile()
 
         logging.debug("loaded {0} network definitions".format(len(self._networks)))
 
@@ -115,15 +121,11 @@ class NetworkIdentifier(AnalysisModule):
         # results contain a list of the names of the networks this IP address is in
         analysis = self.create_analysis(observable)
 
-        for network in self._networks:
-            try:
-                if observable.value in network.cidr:
-                    analysis.details.append(network.name)
-            except Exception as e:
-                logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
-                continue
+        try:
+            analysis.details.extend(self._network_index.lookup(observable.value))
+        except Exception as e:
+            logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
 
-        #analysis.details = [x.name for x in self._networks if observable.value in x.cidr]
         observable.add_analysis(analysis)
 
         # if this ipv4 has at least one identified network then we can assume it's an asset
@@ -13,18 +13,21 @@ import re
 import shutil
 import socket
 import subprocess
+import tarfile
 import uuid
 
 #from subprocess import Popen, PIPE
 
 import saq
+import saq.archive
 
 from saq.analysis import Analysis, Observable, recurse_tree, search_down
 from saq.brocess import query_brocess_by_email_conversation, query_brocess_by_source_email
 from saq.constants import *
 from saq.crypto import encrypt, decrypt
 from saq.database import get_db_connection, execute_with_retry, Alert, use_db
-from saq.email import normalize_email_address, search_archive, get_email_archive_sections, decode_rfc2822
+from saq.email import normalize_email_address, search_archive, get_email_archive_sections, decode_rfc2822, \
+                      index_archive_trigrams
 from saq.error import report_exception
 from saq.modules import AnalysisModule, SplunkAnalysisModule, AnalysisModule
 from saq.modules.remediation import *
@@ -601,20 +604,15 @@ class BrotexSMTPPackageAnalyzer(AnalysisModule):
 
         # view the contents of the package
         file_path = os.path.join(self.root.storage_dir, _file.value)
-        _stdout = _stderr = None
 
         try:
-            p = Popen(['tar', 'tf', file_path], stdout=PIPE, stderr=PIPE, universal_newlines=True)
-            _stdout, _stderr = p.communicate() # meh
-            p.wait()
+            with saq.archive.open_archive(file_path) as archive:
+                member_names = [ member.name for member in archive.members ]
         except Exception as e:
             logging.error("unable to view brotex package {}: {}".format(_file, e))
             report_exception()
             return False
 
-        if _stderr:
-            logging.warning("tar reported errors on {}: {}".format(_file, _stderr)) # TODO fold stderr newlines
-
         #
         # basically the issue here is that bro sometimes does not record the TCP stream like we want it to
         # but it's still able to parse the SMTP data and extract the files
@@ -624,7 +622,7 @@ class BrotexSMTPPackageAnalyzer(AnalysisModule):
         # parse the tar file listing to see if it has an smtp stream file
         smtp_stream_file = None
 
-        for relative_path in _stdout.split('\n'):
+        for relative_path in member_names:
             if _pattern_brotex_stream.match(os.path.basename(relative_path)):
                 smtp_stream_file = relative_path
                 break # this is all we need
@@ -637,20 +635,14 @@ class BrotexSMTPPackageAnalyzer(AnalysisModule):
         #while False: #smtp_stream_file:
         while smtp_stream_file:
             # extract *only* that file
-            p = Popen(['tar', 'xf', file_path, '-C', self.root.storage_dir, smtp_stream_file], 
-                      stdout=PIPE, stderr=PIPE, universal_newlines=True)
-            stdout, stderr = p.communicate()
-            p.wait()
-
-            if p.returncode:
-                logging.warning("unable to extract {} from {} (tar returned error code {}".format(
-                                smtp_stream_file, _file, p.returncode))
+            try:
+                with saq.archive.open_archive(file_path) as archive:
+                    archive.extract(self.root.storage_dir, names=[ smtp_stream_file ])
+            except Exception as e:
+                logging.warning("unable to extract {} from {}: {}".format(smtp_stream_file, _file, e))
                 smtp_stream_file = None
                 break
 
-            if stderr:
-                logging.warning("tar reported errors on {}: {}".format(_file, stderr))
-
             # add the extracted smtp stream file as an observable and let the SMTPStreamAnalysis module do it's work
             analysis.add_observable(F_FILE, os.path.relpath(
                                     os.path.join(self.root.storage_dir, smtp_stream_file), 
@@ -675,18 +667,12 @@ class BrotexSMTPPackageAnalyzer(AnalysisModule):
                 return False
 
         # extract all the things into the brotex_dir
-        p = Popen(['tar', 'xf', file_path, '-C', brotex_dir], 
-                  stdout=PIPE, stderr=PIPE, universal_newlines=True)
-        stdout, stderr = p.communicate()
-        p.wait()
-
-        if p.returncode:
-                logging.warning("unable to extract files from {} (tar returned error code {}".format(
-                                _file, p.returncode))
-                return False
-
-        if stderr:
-            logging.warning("tar reported errors on {}: {}".format(_file, stderr))
+        try:
+            with saq.archive.open_archive(file_path) as archive:
+                archive.extract(brotex_dir)
+        except Exception as e:
+            logging.warning("unable to extract files from {}: {}".format(_file, e))
+            return False
 
         # iterate over all the extracted files
         # map message numbers to the connection file
@@ -712,19 +698,16 @@ class BrotexSMTPPackageAnalyzer(AnalysisModule):
             logging.debug("relative_dir = {}".format(relative_dir))
 
             # we tar up the connection info file and any files under the message_N subdirectory
-            p = Popen(['tar', '-C', relative_dir, '-c', '-f', missing_stream_path, 
-                        os.path.basename(connection_files[message_number]), 
-                       'message_{}/'.format(message_number)], stdout=PIPE, stderr=PIPE)
-            _stdout, _stderr = p.communicate()
-            p.wait()
-
-            if p.returncode != 0:
-                logging.error("tar returned error code {} when creating {}".format(p.returncode, missing_stream_path))
+            try:
+                with tarfile.open(missing_stream_path, 'w') as tar:
+                    tar.add(connection_files[message_number], 
+                            arcname=os.path.basename(connection_files[message_number]))
+                    tar.add(os.path.join(relative_dir, 'message_{}'.format(message_number)), 
+                            arcname='message_{}'.format(message_number))
+            except Exception as e:
+                logging.error("unable to create {}: {}".format(missing_stream_path, e))
                 continue
 
-            if _stderr:
-                logging.warning("tar printing output to stderr when creating {}: {}".format(missing_stream_path, _stderr))
-
             # this by itself gets added as a file observable that will later get parsed by EmailAnalyzer
             observable = analysis.add_observable(F_FILE, missing_stream_file)
             if observable: observable.limited_analysis = [ EmailAnalyzer.__name__ ]
@@ -1662,18 +1645,12 @@ class EmailAnalyzer(AnalysisModule):
         analysis = self.create_analysis(_file)
 
         # extract all the things into the brotex_dir
-        p = Popen(['tar', 'xf', file_path, '-C', extracted_dir], 
-                  stdout=PIPE, stderr=PIPE, universal_newlines=True)
-        stdout, stderr = p.communicate()
-        p.wait()
-
-        if p.returncode:
-                logging.warning("unable to extract files from {} (tar returned error code {}".format(
-                                _file, p.returncode))
-                return False
-
-        if stderr:
-            logging.warning("tar reported errors on {}: {}".format(_file, stderr))
+        try:
+            with saq.archive.open_archive(file_path) as archive:
+                archive.extract(extracted_dir)
+        except Exception as e:
+            logging.warning("unable to extract files from {}: {}".format(_file, e))
+            return False
 
         # iterate over all the extracted files
         # map message numbers to the connection file
@@ -2077,6 +2054,14 @@ class EmailArchiveAction(AnalysisModule):
                     "INSERT IGNORE INTO archive_search ( field, value, archive_id ) VALUES ( %s, %s, %s )", 
                     (field, email_property[:2083], archive_id))
 
+            # and the trigram index used to narrow down substring searches
+            if saq.CONFIG['email_archive'].getboolean('trigram_index', fallback=False):
+                try:
+                    index_archive_trigrams(db, c, archive_id, transactions)
+                except Exception as e:
+                    # searches fall back to scanning archive_search if the index is missing
+                    logging.error(f"unable to update the trigram index for archive {archive_id}: {e}")
+
             db.commit()
 
     #
@@ -30,14 +30,17 @@ from tld import get_tld
 from urlfinderlib import find_urls
 
 import saq
+import saq.archive
+import saq.file_store
 import yara_scanner
 
 from saq.analysis import Analysis, Observable, RootAnalysis
 from saq.constants import *
 from saq.error import report_exception
+from saq.helper_pool import run_python_script
 from saq.modules import AnalysisModule
 from saq.process_server import Popen, PIPE, DEVNULL, TimeoutExpired
-from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR, is_subdomain, abs_path
+from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR, is_subdomain, abs_path, create_timedelta
 
 from bs4 import BeautifulSoup
 from iptools import IpRangeList
@@ -208,6 +211,96 @@ def get_local_file_path(root, _file):
     # This requires that the services (engine, gui, etc...) all run from the SAQ_HOME directory as CWD.
     return os.path.join(root.storage_dir, _file.value)
 
+def store_file_content(root, _file):
+    """Adds the content of the given F_FILE observable to the file store (see saq.file_store.)
+       Returns True if the local file refers to the stored content."""
+    if not saq.file_store.is_enabled():
+        return False
+
+    if not _file.compute_hashes():
+        return False
+
+    return saq.file_store.store_file(get_local_file_path(root, _file), _file.sha256_hash)
+
+def get_cached_file_analysis(module, _file):
+    """Returns the cached results of the given analysis module for the content of the given F_FILE observable,
+       or None if there are no (valid) cached results.
+       Modules can set file_store_cache_lifetime (in DD:HH:MM:SS format) to limit how long results are valid for."""
+    if not saq.file_store.is_analysis_cache_enabled():
+        return None
+
+    if not store_file_content(module.root, _file):
+        return None
+
+    lifetime = None
+    if 'file_store_cache_lifetime' in module.config:
+        lifetime = create_timedelta(module.config['file_store_cache_lifetime'])
+
+    return saq.file_store.get_cached_analysis(_file.sha256_hash, module.config_section_name, lifetime=lifetime)
+
+def cache_file_analysis(module, _file, value):
+    """Caches the results of the given analysis module for the content of the given F_FILE observable."""
+    if not saq.file_store.is_analysis_cache_enabled():
+        return False
+
+    if not store_file_content(module.root, _file):
+        return False
+
+    return saq.file_store.set_cached_analysis(_file.sha256_hash, module.config_section_name, value)
+
+def strip_file_path(values, key, path):
+    """Returns a copy of the given list of dicts with the value of key set to None where it is the given path.
+       Cached analysis results are shared by every alert that has the same content, so paths to the analyzed
+       file (which is in the storage directory of a specific alert) are removed before the results are cached
+       and then put back with restore_file_path() for the alert that uses them."""
+    return [ dict(value, **{ key: None }) if value.get(key) == path else value for value in values ]
+
+def restore_file_path(values, key, path):
+    """Returns a copy of the given list of dicts with the value of key set to the given path where it is None."""
+    return [ dict(value, **{ key: path }) if value.get(key) is None else value for value in values ]
+
+def store_extracted_files(target_dir):
+    """Adds every file found inside target_dir to the file store.
+       Returns a list of [relative_path, sha256] for each file stored, or None if any file could not be stored."""
+    result = []
+    for dir_path, dir_names, file_names in os.walk(target_dir):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            hasher = hashlib.sha256()
+            with open(file_path, 'rb') as fp:
+                while True:
+                    data = fp.read(io.DEFAULT_BUFFER_SIZE)
+                    if data == b'':
+                        break
+
+                    hasher.update(data)
+
+            sha256 = hasher.hexdigest()
+            if not saq.file_store.store_file(file_path, sha256):
+                return None
+
+            result.append([os.path.relpath(file_path, start=target_dir), sha256])
+
+    return result
+
+def link_extracted_files(members, target_dir):
+    """Recreates the files previously stored with store_extracted_files inside target_dir.
+       Returns True if all the files were linked, False otherwise."""
+    for relative_path, sha256 in members:
+        dest_path = os.path.join(target_dir, relative_path)
+        # make sure we stay inside the target directory
+        if os.path.relpath(dest_path, start=target_dir).startswith('..'):
+            logging.warning("invalid cached file path {}".format(relative_path))
+            return False
+
+        if os.path.exists(dest_path):
+            continue
+
+        if not saq.file_store.link_file(sha256, dest_path):
+            return False
+
+    return True
+
 
 class FileHashAnalysis(Analysis):
     """What are the hash values of this file?"""
@@ -301,6 +394,9 @@ class FileHashAnalyzer(AnalysisModule):
             logging.error("file hash analysis failed for {}".format(_file))
             return False
 
+        # now that we know what the content is we can deduplicate it
+        store_file_content(self.root, _file)
+
         logging.debug("analyzing file {}".format(local_file_path))
 
         result = self.create_analysis(_file)
@@ -482,6 +578,14 @@ Z7_SUMMARY_REGEX = re.compile(rb'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+\d+\s+
 # listed: 1 files, totaling 711.168 bytes (compressed 326.520)
 UNACE_SUMMARY_REGEX = re.compile(rb'^listed: (\d+) files,.*')
 
+# archive members that indicate the archive is actually an office document
+OFFICE_DOCUMENT_MEMBERS = [ 'ppt/slides/_rels', 'word/document.xml', 'xl/embeddings/oleObject', 'xl/worksheets/sheet' ]
+# NOTE the uses of regex wildcard match for file separator, sometimes windows sometimes unix
+OFFICE_OLE_OBJECT_REGEX = re.compile(r'word.embeddings.oleObject1\.bin')
+
+# the members of excel files we do not extract (there are a lot of them and they are not interesting)
+EXCEL_EXCLUDED_MEMBERS = [ 'xl/activeX/*', 'xl/activeX/_rels/*', 'xl/ctrlProps/*.xml' ]
+
 class ArchiveAnalyzer(AnalysisModule):
     def verify_environment(self):
         self.verify_config_exists('max_file_count')
@@ -519,70 +623,25 @@ class ArchiveAnalyzer(AnalysisModule):
     def valid_observable_types(self):
         return F_FILE
 
-    def execute_analysis(self, _file):
-
-        # does this file exist as an attachment?
-        local_file_path = get_local_file_path(self.root, _file)
-        if not os.path.exists(local_file_path):
-            logging.error("cannot find local file path for {}".format(_file.value))
-            return False
-
-        # we need file type analysis first
-        file_type_analysis = self.wait_for_analysis(_file, FileTypeAnalysis)
-        if file_type_analysis is None or file_type_analysis.details is None:
-            return False
-
-        # there are some we exclude
-        for excluded_mime_type in self.excluded_mime_types:
-            if file_type_analysis.mime_type.lower().startswith(excluded_mime_type.lower()):
-                logging.debug("skipping excluded mime type {} on archive file {}".format(excluded_mime_type, _file.value))
-                return False
-
-            # we also do not extract OLE compound documents (we have other modules that do a better job)
-            if is_ole_file(local_file_path):
-                logging.debug("skipping archive extraction of OLE file {}".format(_file.value))
-                return False
-
-        # special logic for rar files
-        is_rar_file = 'RAR archive data' in file_type_analysis.file_type
-        is_rar_file |= file_type_analysis.mime_type == 'application/x-rar'
-
-        # and special logic for some types of zip files
-        is_zip_file = 'Microsoft Excel 2007+' in file_type_analysis.file_type
-        is_zip_file |= file_type_analysis.mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-
-        # special logic for jar files
-        is_jar_file = file_type_analysis.mime_type == 'application/java-archive'
-
-        # special logic for microsoft office files
-        is_office_document = is_office_file(_file)
-        #is_office_document = is_office_ext(os.path.basename(local_file_path))
-        #is_office_document |= 'microsoft powerpoint' in file_type_analysis.file_type.lower()
-        #is_office_document |= 'microsoft excel' in file_type_analysis.file_type.lower()
-        #is_office_document |= 'microsoft word' in file_type_analysis.file_type.lower()
-        #is_office_document |= 'microsoft ooxml' in file_type_analysis.file_type.lower()
-
-        # notice that we pass in a password of "infected" here even if we're not prompted for one
-        # infosec commonly use that as the password, and if it's not right then it just fails because
-        # we don't know it anyways
-
-        # special logic for ACE files
-        is_ace_file = 'ACE archive data' in file_type_analysis.file_type
-        is_ace_file |= _file.value.lower().endswith('.ace')
+    def list_archive(self, archive_tool, local_file_path):
+        """Lists the contents of the given archive with the given tool.
+           Returns a tuple of (file_count, is_office_document) or None if the archive could not be listed.
+           A file_count of 0 means the file is not an archive."""
 
         count = 0
+        listed_office_document = False
 
-        if is_rar_file:
+        if archive_tool == 'unrar':
             logging.debug("using unrar to extract files from {}".format(local_file_path))
             p = Popen(['unrar', 'la', local_file_path], stdout=PIPE, stderr=PIPE)
             try:
                 (stdout, stderr) = p.communicate(timeout=self.timeout)
             except TimeoutExpired as e:
                 logging.error("timed out tryign to extract files from {} with unrar".format(local_file_path))
-                return False
+                return None
 
             if b'is not RAR archive' in stdout:
-                return False
+                return 0, False
 
             start_flag = False
             for line in stdout.split(b'\n'):
@@ -598,24 +657,38 @@ class ArchiveAnalyzer(AnalysisModule):
 
                 count += 1
 
-        elif is_jar_file:
+        elif archive_tool == 'python':
+            try:
+                with saq.archive.open_archive(local_file_path) as archive:
+                    names = [ member.name for member in archive.members ]
+            except Exception as e:
+                logging.error("unable to list files in {}: {}".format(local_file_path, e))
+                return None
+
+            count = len(names)
+            for name in names:
+                if any([member in name for member in OFFICE_DOCUMENT_MEMBERS]) or OFFICE_OLE_OBJECT_REGEX.search(name):
+                    listed_office_document = True
+                    break
+
+        elif archive_tool == 'jar':
             try:
                 with zipfile.ZipFile(local_file_path, "r") as zfile:
                     count = len(zfile.namelist())
             except Exception as e:
                 logging.error("unable to read jar file")
 
-        elif is_zip_file:
+        elif archive_tool == 'unzip':
             logging.debug("using unzip to extract files from {}".format(local_file_path))
             p = Popen(['unzip', '-l', '-P', 'infected', local_file_path], stdout=PIPE, stderr=PIPE)
             try:
                 (stdout, stderr) = p.communicate(timeout=self.timeout)
             except TimeoutExpired as e:
                 logging.error("timed out trying to list files from {} with unzip".format(local_file_path))
-                return False
+                return None
 
             if b'End-of-central-directory signature not found.' in stdout:
-                return False
+                return 0, False
 
             start_flag = False
             for line in stdout.split(b'\n'):
@@ -630,16 +703,16 @@ class ArchiveAnalyzer(AnalysisModule):
                     break
 
                 if b'ppt/slides/_rels' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'word/document.xml' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'xl/embeddings/oleObject' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'xl/worksheets/sheet' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 count += 1
 
@@ -647,16 +720,16 @@ class ArchiveAnalyzer(AnalysisModule):
             # we can use presence of ole file as indicator
             # NOTE the uses of regex wildcard match for file separator, sometimes windows sometimes unix
             ole_object_regex = re.compile(b'word.embeddings.oleObject1\\.bin', re.M)
-            is_office_document |= (ole_object_regex.search(stdout) is not None)
-                
-        elif is_ace_file:
+            listed_office_document |= (ole_object_regex.search(stdout) is not None)
+            
+        elif archive_tool == 'unace':
             p = Popen(['unace', 'l', local_file_path], stdout=PIPE, stderr=PIPE)
 
             try:
                 (stdout, stderr) = p.communicate(timeout=self.timeout)
             except TimeoutExpired as e:
                 logging.error("timed out trying to extract files from {} with 7z".format(local_file_path))
-                return False
+                return None
 
             for line in stdout.split(b'\n'):
                 m = UNACE_SUMMARY_REGEX.match(line)
@@ -671,10 +744,10 @@ class ArchiveAnalyzer(AnalysisModule):
                 (stdout, stderr) = p.communicate(timeout=self.timeout)
             except TimeoutExpired as e:
                 logging.error("timed out trying to extract files from {} with 7z".format(local_file_path))
-                return False
+                return None
 
             if b'Error: Can not open file as archive' in stdout:
-                return False
+                return 0, False
 
             for line in stdout.split(b'\n'):
                 m = Z7_SUMMARY_REGEX.match(line)
@@ -685,22 +758,114 @@ class ArchiveAnalyzer(AnalysisModule):
                     #count += 1
 
                 if b'ppt/slides/_rels' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'word/document.xml' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'xl/embeddings/oleObject' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
                 if b'xl/worksheets/sheet' in line:
-                    is_office_document = True
+                    listed_office_document = True
 
             # 01/17/2017 - docx sample 42f587b277f02445b526e3887893c2c5 file command does not indicate docx
             # we can use presence of ole file as indicator
             # NOTE the uses of regex wildcard match for file separator, sometimes windows sometimes unix
             ole_object_regex = re.compile(b'word.embeddings.oleObject1\\.bin', re.M)
-            is_office_document |= (ole_object_regex.search(stdout) is not None)
+            listed_office_document |= (ole_object_regex.search(stdout) is not None)
+
+        return count, listed_office_document
+
+    def execute_analysis(self, _file):
+
+        # does this file exist as an attachment?
+        local_file_path = get_local_file_path(self.root, _file)
+        if not os.path.exists(local_file_path):
+            logging.error("cannot find local file path for {}".format(_file.value))
+            return False
+
+        # we need file type analysis first
+        file_type_analysis = self.wait_for_analysis(_file, FileTypeAnalysis)
+        if file_type_analysis is None or file_type_analysis.details is None:
+            return False
+
+        # there are some we exclude
+        for excluded_mime_type in self.excluded_mime_types:
+            if file_type_analysis.mime_type.lower().startswith(excluded_mime_type.lower()):
+                logging.debug("skipping excluded mime type {} on archive file {}".format(excluded_mime_type, _file.value))
+                return False
+
+            # we also do not extract OLE compound documents (we have other modules that do a better job)
+            if is_ole_file(local_file_path):
+                logging.debug("skipping archive extraction of OLE file {}".format(_file.value))
+                return False
+
+        # special logic for rar files
+        is_rar_file = 'RAR archive data' in file_type_analysis.file_type
+        is_rar_file |= file_type_analysis.mime_type == 'application/x-rar'
+
+        # and special logic for some types of zip files
+        is_zip_file = 'Microsoft Excel 2007+' in file_type_analysis.file_type
+        is_zip_file |= file_type_analysis.mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        # special logic for jar files
+        is_jar_file = file_type_analysis.mime_type == 'application/java-archive'
+
+        # special logic for microsoft office files
+        is_office_document = is_office_file(_file)
+        #is_office_document = is_office_ext(os.path.basename(local_file_path))
+        #is_office_document |= 'microsoft powerpoint' in file_type_analysis.file_type.lower()
+        #is_office_document |= 'microsoft excel' in file_type_analysis.file_type.lower()
+        #is_office_document |= 'microsoft word' in file_type_analysis.file_type.lower()
+        #is_office_document |= 'microsoft ooxml' in file_type_analysis.file_type.lower()
+
+        # notice that we pass in a password of "infected" here even if we're not prompted for one
+        # infosec commonly use that as the password, and if it's not right then it just fails because
+        # we don't know it anyways
+
+        # special logic for ACE files
+        is_ace_file = 'ACE archive data' in file_type_analysis.file_type
+        is_ace_file |= _file.value.lower().endswith('.ace')
+
+        # which tool do we use to list and extract this archive?
+        if is_rar_file:
+            archive_tool = 'unrar'
+        elif is_jar_file:
+            archive_tool = 'jar'
+        elif is_zip_file:
+            archive_tool = 'unzip'
+        elif is_ace_file:
+            archive_tool = 'unace'
+        else:
+            archive_tool = '7z'
+
+        # zip and tar archives are listed and extracted in-process (see saq.archive)
+        if archive_tool in [ 'unzip', '7z' ] and saq.archive.is_supported(local_file_path):
+            external_archive_tool = archive_tool
+            archive_tool = 'python'
+
+        # have we already looked at this content?
+        cached_results = get_cached_file_analysis(self, _file)
+        if cached_results is not None and cached_results['tool'] != archive_tool:
+            cached_results = None
+
+        if cached_results is not None:
+            count = cached_results['count']
+            listed_office_document = cached_results['is_office_document']
+        else:
+            listing = self.list_archive(archive_tool, local_file_path)
+            if listing is None:
+                return False
+
+            count, listed_office_document = listing
+            cached_results = { 'tool': archive_tool, 
+                               'count': count, 
+                               'is_office_document': listed_office_document,
+                               'members': None }
+            cache_file_analysis(self, _file, cached_results)
+
+        is_office_document |= listed_office_document
 
         # skip archives with lots of files
         if is_jar_file:
@@ -741,7 +906,7 @@ class ArchiveAnalyzer(AnalysisModule):
             params = ['java', '-jar', decompiler_path, '-jar', local_file_path, '-o', extracted_path]
         elif is_zip_file:
             # avoid the numerious XML documents in excel files
-            params = ['unzip', local_file_path, '-x', 'xl/activeX/*', 
+            params = ['unzip', '-o', local_file_path, '-x', 'xl/activeX/*', 
                                                 '-x', 'xl/activeX/_rels/*', 
                                                 '-x', 'xl/ctrlProps/*.xml',
                       '-d', extracted_path]
@@ -752,13 +917,65 @@ class ArchiveAnalyzer(AnalysisModule):
         else:
             params = ['7z', '-y', '-pinfected', '-o{}'.format(extracted_path), 'x', local_file_path]
 
+        # if we've already extracted this content then we link the extracted files from the file store
+        if cached_results['members'] is not None and link_extracted_files(cached_results['members'], extracted_path):
+            logging.debug("linked {} cached files from archive {} into {}".format(
+                          len(cached_results['members']), local_file_path, extracted_path))
+            params = []
+
         if params:
-            p = Popen(params, **kwargs)
+            extracted = False
+            # set to False if we only got some of the files
+            complete = True
+            if archive_tool == 'python':
+                # bounded by the same timeout as the external tools
+                limits = saq.archive.get_default_limits()
+                limits.timeout = self.timeout
 
-            try:
-                (stdout, stderr) = p.communicate(timeout=self.timeout)
-            except TimeoutExpired as e:
-                (stdout, stderr) = p.communicate()
+                try:
+                    with saq.archive.open_archive(local_file_path) as archive:
+                        archive.extract(extracted_path, exclude=EXCEL_EXCLUDED_MEMBERS if is_zip_file else None,
+                                        limits=limits)
+
+                    extracted = True
+
+                except saq.archive.ArchiveLimitError as e:
+                    # we keep what was extracted up to the limit
+                    logging.warning("stopped extracting files from {}: {}".format(local_file_path, e))
+                    _file.add_tag('archive_limit_exceeded')
+                    extracted = True
+                    complete = False
+
+                except Exception as e:
+                    # encrypted with an unknown password, unsupported compression method, etc...
+                    logging.info("unable to extract files from {} in-process ({}): using {}".format(
+                                 local_file_path, e, external_archive_tool))
+
+                    # start over with whatever was extracted before the failure removed
+                    try:
+                        shutil.rmtree(extracted_path)
+                        os.makedirs(extracted_path)
+                    except Exception as e:
+                        logging.error("unable to clear {}: {}".format(extracted_path, e))
+                        report_exception()
+                        return False
+
+            if not extracted:
+                p = Popen(params, **kwargs)
+
+                try:
+                    (stdout, stderr) = p.communicate(timeout=self.timeout)
+                except TimeoutExpired as e:
+                    (stdout, stderr) = p.communicate()
+                    complete = False
+
+            # remember what we extracted for the next time we see this content
+            # (but not if the extraction stopped before all the files were extracted)
+            if not complete:
+                logging.debug("not caching the partial extraction of {}".format(local_file_path))
+            elif saq.file_store.is_analysis_cache_enabled():
+                cached_results['members'] = store_extracted_files(extracted_path)
+                cache_file_analysis(self, _file, cached_results)
 
         #logging.debug("extracted into {}".format(extracted_path))
 
@@ -1006,7 +1223,6 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
         # so we wrote our own
 
         output_dir = None
-        p = None
 
         try:
 
@@ -1019,8 +1235,8 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
             if not os.path.isabs(olevba_wrapper_path):
                 olevba_wrapper_path = os.path.join(saq.SAQ_HOME, olevba_wrapper_path)
                 
-            p = Popen(['python2.7', olevba_wrapper_path, '-d', output_dir, local_file_path], stdout=PIPE, stderr=PIPE)
-            _stdout, _stderr = p.communicate(timeout=self.timeout)
+            returncode, _stdout, _stderr = run_python_script(olevba_wrapper_path, ['-d', output_dir, local_file_path],
+                                                             timeout=self.timeout, tool='olevba')
 
         except Exception as e:
             logging.error("olevba execution error on {}: {}".format(local_file_path, e))
@@ -1030,16 +1246,10 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
                 _file.add_tag('olevba_failed')
                 _file.add_directive(DIRECTIVE_SANDBOX)
 
-            try:
-                #p.kill()
-                _stdout, _stderr = p.communicate()
-            except Exception as e:
-                logging.error("unable to finished process {}: {}".format(p, e))
-
             return False
 
         # if the process returned with error code 2 then the parsing failed, which means it wasn't an office document format
-        if p.returncode == 2:
+        if returncode == 2:
             logging.debug("{} reported not a valid office document: {}".format(olevba_wrapper_path, local_file_path))
             return False
 
@@ -1256,52 +1466,69 @@ class OLEVBA_Analyzer_v1_2(AnalysisModule):
         from oletools.olevba3 import VBA_Parser, VBA_Scanner, filter_vba
         parser = None
 
+        # have we already looked at this content?
+        cached_results = get_cached_file_analysis(self, _file)
+
         try:
-            parser = VBA_Parser(local_file_path, relaxed=True)
-            analysis.type = parser.type
+            if cached_results is not None:
+                analysis.type = cached_results['type']
+                extracted_macros = restore_file_path(cached_results['macros'], 'file_name', local_file_path)
+                scan_results = cached_results['scan_results']
+            else:
+                parser = VBA_Parser(local_file_path, relaxed=True)
+                analysis.type = parser.type
+
+                extracted_macros = []
+                scan_results = None
+
+                for file_name, stream_path, vba_filename, vba_code in parser.extract_macros():
+                    if isinstance(vba_code, bytes):
+                        vba_code = vba_code.decode('utf8', errors='ignore')
+
+                    vba_code = filter_vba(vba_code)
+                    if not vba_code.strip():
+                        continue
+
+                    extracted_macros.append({'file_name': file_name,
+                                             'stream_path': stream_path,
+                                             'vba_filename': vba_filename,
+                                             'vba_code': vba_code})
 
-            current_macro_index = None
             output_dir = None
 
-            for file_name, stream_path, vba_filename, vba_code in parser.extract_macros():
-                if current_macro_index is None:
-                    current_macro_index = 0
+            for current_macro_index, macro in enumerate(extracted_macros):
+                if output_dir is None:
                     output_dir = '{}.olevba'.format(local_file_path)
                     if not os.path.isdir(output_dir):
                         os.mkdir(output_dir)
 
                 output_path = os.path.join(output_dir, 'macro_{}.bas'.format(current_macro_index))
 
-                if isinstance(vba_code, bytes):
-                    vba_code = vba_code.decode('utf8', errors='ignore')
-
-                vba_code = filter_vba(vba_code)
-                if not vba_code.strip():
-                    continue
-
                 with open(output_path, 'w') as fp:
-                    fp.write(vba_code)
+                    fp.write(macro['vba_code'])
 
                 file_observable = analysis.add_observable(F_FILE, os.path.relpath(output_path, self.root.storage_dir))
                 if file_observable:
                     file_observable.redirection = _file
                     file_observable.add_tag('macro')
                     file_observable.add_directive(DIRECTIVE_SANDBOX)
-                    analysis.macros.append({'file_name': file_name,
-                                            'stream_path': stream_path,
-                                            'vba_filename': vba_filename,
-                                            'vba_code': vba_code,
+                    analysis.macros.append({'file_name': macro['file_name'],
+                                            'stream_path': macro['stream_path'],
+                                            'vba_filename': macro['vba_filename'],
+                                            'vba_code': macro['vba_code'],
                                             'local_path': file_observable.value})
 
                     # this analysis module will analyze it's own output so we need to not do that
                     file_observable.exclude_analysis(self)
 
-                current_macro_index += 1
-
             if analysis.macros:
-                all_macro_code = '\r\n\r\n'.join([x['vba_code'] for x in analysis.macros])
-                scanner = VBA_Scanner(all_macro_code)
-                analysis.scan_results = scanner.scan(False, False) # setting this to True takes too long to use in prod
+                # the cached scan results are only valid if we scanned all the same macros
+                if scan_results is None or len(analysis.macros) != len(extracted_macros):
+                    all_macro_code = '\r\n\r\n'.join([x['vba_code'] for x in analysis.macros])
+                    scanner = VBA_Scanner(all_macro_code)
+                    scan_results = scanner.scan(False, False) # setting this to True takes too long to use in prod
+
+                analysis.scan_results = scan_results
                 analysis.keyword_summary = {}
                 for _type, keyword, description in analysis.scan_results:
                     if _type not in analysis.keyword_summary:
@@ -1333,6 +1560,15 @@ class OLEVBA_Analyzer_v1_2(AnalysisModule):
                 if threshold_exceeded:
                     _file.add_tag('olevba') # tag it for alerting
                     _file.add_directive(DIRECTIVE_SANDBOX)
+
+            if cached_results is None:
+                if len(analysis.macros) != len(extracted_macros):
+                    scan_results = None
+
+                cache_file_analysis(self, _file, { 'type': analysis.type,
+                                                   'macros': strip_file_path(extracted_macros, 'file_name',
+                                                                             local_file_path),
+                                                   'scan_results': scan_results })
                 
         except Exception as e:
             logging.warning("olevba execution error on {}: {}".format(local_file_path, e))
@@ -1627,9 +1863,7 @@ class OfficeParserAnalyzer_v1_0(AnalysisModule):
                 return False
 
         # lol look at all these options
-        p = Popen([
-            'python2.7',
-            self.officeparser_path,
+        args = [
             '-l', 'DEBUG',
             '--print-header',
             '--print-directory',
@@ -1647,24 +1881,15 @@ class OfficeParserAnalyzer_v1_0(AnalysisModule):
             '--extract-macros',
             '--extract-unknown-sectors',
             '--create-manifest',
-            local_file_path],
-            stdout=PIPE,
-            stderr=PIPE)
+            local_file_path]
 
         try:
-            stdout, stderr = p.communicate(timeout=self.timeout)
+            _, stdout, stderr = run_python_script(self.officeparser_path, args, timeout=self.timeout, tool='officeparser')
         except TimeoutExpired as e:
             logging.warning("timeout expired for officeparser on {}".format(local_file_path))
             _file.add_tag('officeparser_failed')
             _file.add_directive(DIRECTIVE_SANDBOX)
 
-            #try:
-                #p.kill()
-            #except:
-                #pass
-
-            stdout, stderr = p.communicate()
-
         manifest_path = os.path.join(officeparser_output_dir, 'manifest')
         if not os.path.exists(manifest_path):
             #logging.warning("manifest {0} is missing".format(manifest_path))
@@ -1972,30 +2197,39 @@ class FileTypeAnalyzer(AnalysisModule):
         logging.debug("analyzing file {}".format(local_file_path))
         analysis = self.create_analysis(_file)
 
-        # get the human readable
-        p = Popen(['file', '-b', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
+        # have we already looked at this content?
+        cached_details = get_cached_file_analysis(self, _file)
+        if cached_details is not None:
+            analysis.details.update(cached_details)
+        else:
+            # get the human readable
+            p = Popen(['file', '-b', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+            
+            if len(stderr) > 0:
+                logging.warning("file command returned error output for {0}".format(local_file_path))
 
-        analysis.details['type'] = stdout.decode().strip()
+            analysis.details['type'] = stdout.decode().strip()
 
-        # get the mime type
-        p = Popen(['file', '-b', '--mime-type', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
+            # get the mime type
+            p = Popen(['file', '-b', '--mime-type', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+            
+            if len(stderr) > 0:
+                logging.warning("file command returned error output for {0}".format(local_file_path))
+
+            analysis.details['mime'] = stdout.decode().strip()
+
+            analysis.details['is_ole_file'] = is_ole_file(local_file_path)
+            analysis.details['is_rtf_file'] = is_rtf_file(local_file_path)
+            analysis.details['is_pdf_file'] = is_pdf_file(local_file_path)
+            analysis.details['is_pe_ext'] = is_pe_file(local_file_path)
+            analysis.details['is_zip_file'] = is_zip_file(local_file_path)
 
-        analysis.details['mime'] = stdout.decode().strip()
+            # everything but the file extension check depends only on the content of the file
+            cache_file_analysis(self, _file, analysis.details)
 
         analysis.details['is_office_ext'] = is_office_ext(local_file_path)
-        analysis.details['is_ole_file'] = is_ole_file(local_file_path)
-        analysis.details['is_rtf_file'] = is_rtf_file(local_file_path)
-        analysis.details['is_pdf_file'] = is_pdf_file(local_file_path)
-        analysis.details['is_pe_ext'] = is_pe_file(local_file_path)
-        analysis.details['is_zip_file'] = is_zip_file(local_file_path)
 
         is_office_document = analysis.details['is_office_ext']
         is_office_document |= 'microsoft powerpoint' in analysis.file_type.lower()
@@ -2082,15 +2316,15 @@ class PDFAnalyzer(AnalysisModule):
         pdfparser_output_file = '{}.pdfparser'.format(local_file_path)
 
         # run pdf parser
+        try:
+            _, stdout, stderr = run_python_script(self.pdfparser_path, ['-f', '-w', '-v', '-c', '--debug', local_file_path],
+                                                  timeout=10, tool='pdf-parser')
+        except TimeoutExpired as e:
+            logging.warning("pdfparser timed out on {}".format(local_file_path))
+            stdout = stderr = b''
+
         with open(pdfparser_output_file, 'wb') as fp:
-            p = Popen(['python2.7', self.pdfparser_path,
-            '-f', '-w', '-v', '-c', '--debug', local_file_path], stdout=fp, stderr=PIPE)
-            try:
-                _, stderr = p.communicate(timeout=10)
-            except TimeoutExpired as e:
-                logging.warning("pdfparser timed out on {}".format(local_file_path))
-                #p.kill()
-                _, stderr = p.communicate()
+            fp.write(stdout)
 
         if len(stderr) > 0:
             logging.warning("pdfparser returned errors for {}".format(local_file_path))
@@ -2375,36 +2609,48 @@ class YaraScanner_v3_4(AnalysisModule):
             no_alert_rules = set() # the set of rules that matches that have the no_alert modifier
             matches_found = False # set to True if at least one rule matched
 
-            try:
-                # this path needs to be absolute for the yara scanner server to know where to find it
-                _full_path = local_file_path
-                if not os.path.isabs(local_file_path):
-                    _full_path = os.path.join(os.getcwd(), local_file_path)
-                result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
-                matches_found = bool(result)
+            # this path needs to be absolute for the yara scanner server to know where to find it
+            _full_path = local_file_path
+            if not os.path.isabs(local_file_path):
+                _full_path = os.path.join(os.getcwd(), local_file_path)
 
-                logging.debug("scanned file {} with yss (matches found: {})".format(_full_path, matches_found))
-
-                # if that worked and we have a local scanner see if we still need it
-                # we keep it around for some length of time
-                # even when we get the yara scanner server back
-                if self.scanner:
-                    if (datetime.datetime.now() - self.scanner_start_time).total_seconds() * 60 >= self.local_scanner_lifetime:
-                        # get rid of it
-                        logging.info("releasing local yara scanner")
-                        self.scanner = None
-                        self.scanner_start_time = None
-                        gc.collect()
+            # have we already scanned this content?
+            # (the path of the scanned file is removed from the matches before they are cached)
+            result = get_cached_file_analysis(self, _file)
+            if result is not None:
+                result = restore_file_path(result, 'target', _full_path)
+                matches_found = bool(result)
+            else:
+                try:
+                    result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
+                    matches_found = bool(result)
+
+                    logging.debug("scanned file {} with yss (matches found: {})".format(_full_path, matches_found))
+
+                    # if that worked and we have a local scanner see if we still need it
+                    # we keep it around for some length of time
+                    # even when we get the yara scanner server back
+                    if self.scanner:
+                        if (datetime.datetime.now() - self.scanner_start_time).total_seconds() * 60 >= self.local_scanner_lifetime:
+                            # get rid of it
+                            logging.info("releasing local yara scanner")
+                            self.scanner = None
+                            self.scanner_start_time = None
+                            gc.collect()
                 
-            except socket.error as e:
-                logging.warning("failed to connect to yara socket server: {}".format(e))
-                if not self.scanner:
-                    self.initialize_local_scanner()
+                except socket.error as e:
+                    logging.warning("failed to connect to yara socket server: {}".format(e))
+                    if not self.scanner:
+                        self.initialize_local_scanner()
+
+                    matches_found = self.scanner.scan(local_file_path)
+                    result = self.scanner.scan_results
+                    # we want to keep using it for now...
+                    self.scanner_start_time = datetime.datetime.now()
 
-                matches_found = self.scanner.scan(local_file_path)
-                result = self.scanner.scan_results
-                # we want to keep using it for now...
-                self.scanner_start_time = datetime.datetime.now()
+                # (the local scanner reports the path it was given)
+                cache_file_analysis(self, _file, strip_file_path(strip_file_path(result, 'target', _full_path),
+                                                                 'target', local_file_path))
 
             #if self.scanner.scan(local_file_path):
             if matches_found:
@@ -3056,6 +3302,10 @@ class RTFOLEObjectAnalyzer(AnalysisModule):
         return self.config['rtfobj_path']
         
 
+    @property
+    def timeout(self):
+        return self.config.getint('timeout', fallback=60)
+
     def verify_environment(self):
         self.verify_config_exists('rtfobj_path')
         self.verify_path_exists(self.config['rtfobj_path'])
@@ -3099,10 +3349,11 @@ class RTFOLEObjectAnalyzer(AnalysisModule):
         analysis = self.create_analysis(_file)
 
         try:
-            p = Popen(['python2.7', self.rtfobj_path, '-d', output_dir, '-s', 'all', local_file_path], 
-                      stdout=PIPE, stderr=PIPE, universal_newlines=True)
-            analysis.stderr, analysis.stdout = p.communicate()
-            analysis.return_code = p.returncode
+            returncode, stdout, stderr = run_python_script(self.rtfobj_path, ['-d', output_dir, '-s', 'all', local_file_path],
+                                                           timeout=self.timeout, tool='rtfobj')
+            analysis.stdout = stdout.decode(errors='replace')
+            analysis.stderr = stderr.decode(errors='replace')
+            analysis.return_code = returncode
         except Exception as e:
             logging.error("execution of {} failed: {}".format(self.rtfobj_path, e))
             report_exception()
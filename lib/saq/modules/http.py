@@ -5,9 +5,8 @@ import logging
 import os.path
 import re
 
-from subprocess import Popen, PIPE
-
 import saq
+import saq.archive
 
 from saq.constants import *
 from saq.analysis import Analysis
@@ -288,17 +287,12 @@ class BrotexHTTPPackageAnalyzer(AnalysisModule):
                 return False
 
         # extract all the things into the brotex_dir
-        p = Popen(['tar', 'xf', file_path, '-C', brotex_dir], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        p.wait()
-
-        if p.returncode:
-                logging.warning("unable to extract files from {} (tar returned error code {}".format(
-                                _file, p.returncode))
-                return False
-
-        if stderr:
-            logging.warning("tar reported errors on {}: {}".format(_file, stderr))
+        try:
+            with saq.archive.open_archive(file_path) as archive:
+                archive.extract(brotex_dir)
+        except Exception as e:
+            logging.warning("unable to extract files from {}: {}".format(_file, e))
+            return False
 
         # iterate over all the extracted files
         message_dirs = {}
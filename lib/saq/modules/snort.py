@@ -1,9 +1,10 @@
 # vim: sw=4:ts=4:et
 
 import logging
-import os.path
-
-from subprocess import Popen, PIPE
+import os, os.path
+import re
+import threading
+import time
 
 import saq
 
@@ -69,6 +70,106 @@ index=snort {0}
         analysis.details = self.json()
         return True
 
+# matches the sid of a rule (the same thing grep -r 'sid:N;' used to match)
+RE_SID = re.compile(rb'sid:(\d+);')
+
+class SnortRuleIndex(object):
+    """An in-memory index of sid -> rule text for all of the rule files in a directory.
+       Only the files that were added, removed or modified (by mtime) since the last refresh are parsed again."""
+
+    def __init__(self, rules_dir, check_interval=60):
+        self.rules_dir = rules_dir
+        # how often (in seconds) refresh() checks the rule files for changes
+        self.check_interval = check_interval
+        self.last_check = None
+        # key = path, value = tuple(mtime_ns, { sid: [ line ] })
+        self.files = {}
+        # key = sid, value = rule text (the matching lines)
+        self.index = {}
+        self.lock = threading.RLock()
+
+    def _parse_file(self, path):
+        sids = {}
+        with open(path, 'rb') as fp:
+            for line in fp:
+                for sid in RE_SID.findall(line):
+                    sids.setdefault(sid.decode(), []).append(line.decode('utf8', errors='replace'))
+
+        return sids
+
+    def refresh(self, force=False):
+        """Rebuilds the index if any of the rule files changed.
+           Unless force is True this only checks the files once every check_interval seconds.
+           Returns True if the index was rebuilt."""
+        with self.lock:
+            if not force and self.last_check is not None and time.time() - self.last_check < self.check_interval:
+                return False
+
+            self.last_check = time.time()
+
+            current = {} # key = path, value = mtime_ns
+            for dirpath, dirnames, filenames in os.walk(self.rules_dir):
+                dirnames.sort()
+                for file_name in sorted(filenames):
+                    path = os.path.join(dirpath, file_name)
+                    try:
+                        current[path] = os.stat(path).st_mtime_ns
+                    except OSError as e:
+                        logging.warning("unable to stat snort rule file {}: {}".format(path, e))
+
+            changed = False
+            for path in list(self.files.keys()):
+                if path not in current:
+                    logging.debug("snort rule file {} was removed".format(path))
+                    del self.files[path]
+                    changed = True
+
+            for path, mtime_ns in current.items():
+                if path in self.files and self.files[path][0] == mtime_ns:
+                    continue
+
+                try:
+                    self.files[path] = (mtime_ns, self._parse_file(path))
+                    changed = True
+                except Exception as e:
+                    logging.error("unable to parse snort rule file {}: {}".format(path, e))
+
+            if not changed:
+                return False
+
+            start = time.time()
+            index = {}
+            for path in sorted(self.files.keys()):
+                for sid, lines in self.files[path][1].items():
+                    index.setdefault(sid, []).extend(lines)
+
+            self.index = { sid: ''.join(lines) for sid, lines in index.items() }
+            logging.info("indexed {} snort signatures in {} files from {} in {:.3f} seconds".format(
+                         len(self.index), len(self.files), self.rules_dir, time.time() - start))
+            return True
+
+    def lookup(self, sid):
+        """Returns the text of the rules with the given sid, or an empty string if there are none."""
+        self.refresh()
+        return self.index.get(str(sid), '')
+
+    def lookup_batch(self, sids):
+        """Returns a dict of sid -> rule text for each of the given sids."""
+        self.refresh()
+        index = self.index
+        return { sid: index.get(str(sid), '') for sid in sids }
+
+_rule_indexes = {} # key = rules_dir, value = SnortRuleIndex
+_rule_indexes_lock = threading.Lock()
+
+def get_rule_index(rules_dir, check_interval=60):
+    """Returns the SnortRuleIndex shared by everything in this process for the given rules directory."""
+    with _rule_indexes_lock:
+        if rules_dir not in _rule_indexes:
+            _rule_indexes[rules_dir] = SnortRuleIndex(rules_dir, check_interval=check_interval)
+
+        return _rule_indexes[rules_dir]
+
 KEY_SIGNATURE_ID = 'signature_id'
 KEY_SIGNATURE = 'signature'
 
@@ -110,6 +211,8 @@ class SnortSignatureAnalyzer_v1(AnalysisModule):
     def verify_environment(self):
         self.verify_config_exists('rules_dir')
         self.verify_path_exists(self.config['rules_dir'])
+        # build the index when the module is loaded
+        self.rule_index.refresh(force=True)
 
     @property
     def rules_dir(self):
@@ -118,6 +221,11 @@ class SnortSignatureAnalyzer_v1(AnalysisModule):
             return path
         return os.path.join(saq.SAQ_HOME, path)
 
+    @property
+    def rule_index(self):
+        return get_rule_index(self.rules_dir,
+                              check_interval=self.config.getint('index_check_interval', fallback=60))
+
     @property
     def generated_analysis_type(self):
         return SnortSignatureAnalysis_v1
@@ -130,9 +238,7 @@ class SnortSignatureAnalyzer_v1(AnalysisModule):
 
         analysis = self.create_analysis(snort_sig)
         logging.debug("searching snort rules for {0}".format(snort_sig.value))
-        p = Popen(['grep', '-h', '-r', 'sid:{0};'.format(snort_sig.value), self.rules_dir], stdout=PIPE, universal_newlines=True)
         analysis.signature_id = snort_sig.value
-        analysis.signature, _ = p.communicate()
-        p.wait() # needed?
+        analysis.signature = self.rule_index.lookup(snort_sig.value)
 
         return True
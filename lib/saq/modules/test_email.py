@@ -574,6 +574,43 @@ class TestCase(ACEModuleTestCase):
                     value = row[0]
                     self.assertEquals(value, field_value)
 
+            # substring searches are narrowed down by the trigram index
+            from saq.email import search_archive_values, rebuild_archive_trigrams
+            c.execute("SELECT COUNT(*) FROM archive_search_trigram WHERE archive_id = %s", (archive_id,))
+            self.assertTrue(c.fetchone()[0] > 0)
+
+            c.execute("""SELECT archive_server.hostname, HEX(archive.md5) FROM archive JOIN archive_server
+                         ON archive.server_id = archive_server.server_id WHERE archive_id = %s""", (archive_id,))
+            expected_result = [ tuple(c.fetchone()) ]
+            for use_index in [ True, False ]:
+                with self.subTest(use_index=use_index):
+                    self.assertEquals(search_archive_values(db, c, [ 'alienvault', 'nothing.com', 'xx' ],
+                                                            use_index=use_index), expected_result)
+                    self.assertEquals(search_archive_values(db, c, [ 'alienvault' ], fields=[ 'url' ],
+                                                            use_index=use_index), expected_result)
+                    self.assertEquals(search_archive_values(db, c, [ 'alienvault' ], fields=[ 'subject' ],
+                                                            use_index=use_index), [])
+
+            # the index returns the same results as scanning archive_search
+            for search_items in [ [ 'alienvault' ], [ 'canary', 'tldp.org' ], [ 'company.com' ], [ 'nothing.com' ],
+                                  [ 'gmail', 'xx' ] ]:
+                with self.subTest(search_items=search_items):
+                    self.assertEquals(search_archive_values(db, c, search_items, use_index=True),
+                                      search_archive_values(db, c, search_items, use_index=False))
+
+            # searches fall back to scanning archive_search until the index covers the archive
+            from saq.email import is_archive_trigram_index_ready
+            self.assertTrue(is_archive_trigram_index_ready(db, c))
+            c.execute("DELETE FROM archive_search_trigram")
+            db.commit()
+            self.assertFalse(is_archive_trigram_index_ready(db, c))
+            self.assertEquals(search_archive_values(db, c, [ 'alienvault' ]), expected_result)
+
+            # the index can be rebuilt from the archive_search table
+            self.assertEquals(rebuild_archive_trigrams(db, c), 1)
+            self.assertTrue(is_archive_trigram_index_ready(db, c))
+            self.assertEquals(search_archive_values(db, c, [ 'alienvault' ]), expected_result)
+
     def test_archive_2(self):
 
         set_encryption_password('test')
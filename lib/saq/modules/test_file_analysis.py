@@ -8,6 +8,7 @@ import tempfile
 import threading
 import unittest
 import uuid
+import zipfile
 
 from subprocess import Popen, PIPE
 
@@ -320,6 +321,50 @@ class TestCase(ACEModuleTestCase):
         _file = analysis.get_observables_by_type(F_FILE)
         self.assertEquals(len(_file), 1)
 
+    def test_file_analysis_archive_zip_fallback(self):
+
+        # the second member is corrupted so in-process extraction fails after it has extracted the first member
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        zip_path = os.path.join(root.storage_dir, 'corrupted.zip')
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr('file_1.txt', b'first file\n')
+            zip_file.writestr('file_2.txt', b'second file\n')
+
+        with open(zip_path, 'rb') as fp:
+            data = fp.read()
+
+        with open(zip_path, 'wb') as fp:
+            fp.write(data.replace(b'second file', b'Second file'))
+
+        _file = root.add_observable(F_FILE, 'corrupted.zip')
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_archive', 'test_groups')
+        engine.enable_module('analysis_module_file_type', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        self.assertEquals(log_count('unable to extract files from'), 1)
+
+        root.load()
+        _file = root.get_observable(_file.id)
+
+        from saq.modules.file_analysis import ArchiveAnalysis
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(len(analysis.get_observables_by_type(F_FILE)), 2)
+
+        # unzip replaced what was left behind by the failed in-process extraction
+        with open(os.path.join(root.storage_dir, 'corrupted.zip.extracted', 'file_1.txt'), 'rb') as fp:
+            self.assertEquals(fp.read(), b'first file\n')
+
+        with open(os.path.join(root.storage_dir, 'corrupted.zip.extracted', 'file_2.txt'), 'rb') as fp:
+            self.assertEquals(fp.read(), b'Second file\n')
+
     def test_file_analysis_002_archive_001_rar(self):
 
         root = create_root_analysis(uuid=str(uuid.uuid4()))
@@ -0,0 +1,79 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import logging
+import os, os.path
+import shutil
+import time
+
+import saq
+from saq.modules.snort import SnortRuleIndex
+from saq.test import *
+
+RULE = 'alert tcp any any -> any any (msg:"test rule {0}"; sid:{0}; rev:1;)\n'
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.rules_dir = os.path.join(saq.TEMP_DIR, 'snort_rules')
+        if os.path.exists(self.rules_dir):
+            shutil.rmtree(self.rules_dir)
+
+        os.makedirs(os.path.join(self.rules_dir, 'sub'))
+
+    def write_rules(self, file_name, sids, comment=False):
+        path = os.path.join(self.rules_dir, file_name)
+        with open(path, 'w') as fp:
+            for sid in sids:
+                fp.write('{}{}'.format('# ' if comment else '', RULE.format(sid)))
+
+        return path
+
+    def test_rule_index(self):
+        self.write_rules('a.rules', [ 1000, 1001 ])
+        self.write_rules(os.path.join('sub', 'b.rules'), [ 2000 ])
+        # disabled rules are still found (grep found them too)
+        self.write_rules('c.rules', [ 1000 ], comment=True)
+
+        index = SnortRuleIndex(self.rules_dir)
+        self.assertTrue(index.refresh())
+        self.assertEquals(index.lookup('1001'), RULE.format(1001))
+        self.assertEquals(index.lookup(2000), RULE.format(2000))
+        self.assertEquals(index.lookup('1000'), RULE.format(1000) + '# ' + RULE.format(1000))
+        # sid:100; is not the same as sid:1000;
+        self.assertEquals(index.lookup('100'), '')
+        self.assertEquals(index.lookup_batch([ '1001', '2000', '3000' ]),
+                          { '1001': RULE.format(1001), '2000': RULE.format(2000), '3000': '' })
+
+        # nothing changed
+        self.assertFalse(index.refresh(force=True))
+
+        # modified files are parsed again
+        path = self.write_rules('a.rules', [ 1001, 1002 ])
+        os.utime(path, ns=(0, 0))
+        self.assertFalse(index.refresh())
+        self.assertTrue(index.refresh(force=True))
+        self.assertEquals(index.lookup('1000'), '# ' + RULE.format(1000))
+        self.assertEquals(index.lookup('1002'), RULE.format(1002))
+
+        # removed files are dropped
+        os.remove(path)
+        self.assertTrue(index.refresh(force=True))
+        self.assertEquals(index.lookup('1002'), '')
+
+    def test_rule_index_benchmark(self):
+        rule_count = 50000
+        with open(os.path.join(self.rules_dir, 'benchmark.rules'), 'w') as fp:
+            for sid in range(rule_count):
+                fp.write(RULE.format(sid))
+
+        index = SnortRuleIndex(self.rules_dir)
+        start = time.time()
+        index.refresh()
+        build_time = time.time() - start
+
+        start = time.time()
+        for sid in range(0, rule_count, 10):
+            self.assertEquals(index.lookup(sid), RULE.format(sid))
+
+        logging.info("BENCHMARK: indexed {} snort rules in {:.3f} seconds and looked up {} sids in {:.3f} seconds".format(
+                     rule_count, build_time, rule_count // 10, time.time() - start))
@@ -0,0 +1,157 @@
+# vim: sw=4:ts=4:et
+
+import hashlib
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import urllib.parse
+import uuid
+
+import saq, saq.test
+from saq.constants import *
+from saq.test import *
+
+LOCAL_PORT = 43126
+web_server = None
+
+# the hashes requested in each batch and single query made to our fake vt hash cache
+batch_requests = []
+query_requests = []
+
+# hashes the fake batch endpoint does not resolve
+unresolved_hashes = set()
+
+# hashes the fake vt hash cache reports as detected
+detected_hashes = set()
+
+def get_vt_result(_hash):
+    scans = { 'Vendor': { 'detected': _hash in detected_hashes, 'result': 'Test' } }
+    return { 'response_code': 1, 'positives': 1 if _hash in detected_hashes else 0, 'total': 1,
+             'permalink': 'https://localhost/{}'.format(_hash), 'scans': scans }
+
+class _FakeVTHashCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Answers /vthc/batch and /vthc/query requests."""
+    def send_json(self, value):
+        content = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        hashes = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())['hashes']
+        batch_requests.append(hashes)
+        self.send_json({ _hash: get_vt_result(_hash) for _hash in hashes if _hash not in unresolved_hashes })
+
+    def do_GET(self):
+        _hash = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['h'][0]
+        query_requests.append(_hash)
+        self.send_json(get_vt_result(_hash))
+
+    def log_message(self, format, *args):
+        logging.debug("[fake vt hash cache] {}".format(format % args))
+
+def random_hash(hash_function):
+    return hash_function(str(uuid.uuid4()).encode()).hexdigest()
+
+class TestCase(ACEModuleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        global web_server
+
+        class _customTCPServer(socketserver.TCPServer):
+            allow_reuse_address = True
+
+        web_server = _customTCPServer(('localhost', LOCAL_PORT), _FakeVTHashCacheHandler)
+        web_server_thread = threading.Thread(target=web_server.serve_forever)
+        web_server_thread.daemon = True
+        web_server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        web_server.shutdown()
+        web_server.server_close()
+
+    def setUp(self):
+        ACEModuleTestCase.setUp(self)
+        del batch_requests[:]
+        del query_requests[:]
+        unresolved_hashes.clear()
+        detected_hashes.clear()
+
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['query_url'] = \
+            'http://localhost:{}/vthc/query'.format(LOCAL_PORT)
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['use_proxy'] = 'no'
+
+    def analyze(self, batch_url=None):
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['batch_url'] = batch_url or ''
+
+        md5_hash = random_hash(hashlib.md5)
+        sha1_hash = random_hash(hashlib.sha1)
+        sha2_hash = random_hash(hashlib.sha256)
+
+        # the batch does not resolve the sha1 and the sha2 is detected
+        unresolved_hashes.add(sha1_hash)
+        detected_hashes.add(sha2_hash)
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        observables = [ root.add_observable(F_MD5, md5_hash),
+                        root.add_observable(F_SHA1, sha1_hash),
+                        root.add_observable(F_SHA256, sha2_hash) ]
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_vt_hash_analyzer', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        root.load()
+        return root, [ root.get_observable(_.id) for _ in observables ]
+
+    def test_vt_hash_analyzer(self):
+        from saq.modules.vt import VTHashAnalysis
+
+        root, observables = self.analyze()
+
+        # without a batch url each hash is looked up by itself
+        self.assertEquals(len(batch_requests), 0)
+        self.assertEquals(sorted(query_requests), sorted([ _.value for _ in observables ]))
+
+        for observable in observables:
+            analysis = observable.get_analysis(VTHashAnalysis)
+            self.assertIsNotNone(analysis)
+            self.assertTrue(analysis.is_known())
+
+        self.assertTrue(observables[2].has_tag('malicious'))
+        self.assertFalse(observables[0].has_tag('malicious'))
+
+    def test_vt_hash_analyzer_batch(self):
+        from saq.modules.vt import VTHashAnalysis
+
+        root, observables = self.analyze(batch_url='http://localhost:{}/vthc/batch'.format(LOCAL_PORT))
+        md5_hash, sha1_hash, sha2_hash = [ _.value for _ in observables ]
+
+        # all of the hashes are looked up with a single batch request
+        self.assertEquals(len(batch_requests), 1)
+        self.assertEquals(sorted(batch_requests[0]), sorted([ md5_hash, sha1_hash, sha2_hash ]))
+
+        # and the hash the batch did not resolve falls back to a single query
+        self.assertEquals(query_requests, [ sha1_hash ])
+
+        for observable in observables:
+            analysis = observable.get_analysis(VTHashAnalysis)
+            self.assertIsNotNone(analysis)
+            self.assertTrue(analysis.is_known())
+
+        # the batch results are checked for detections the same way
+        self.assertTrue(observables[2].has_tag('malicious'))
+        self.assertFalse(observables[0].has_tag('malicious'))
+        self.assertFalse(observables[1].has_tag('malicious'))
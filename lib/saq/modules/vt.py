@@ -289,6 +289,73 @@ class VTHashAnalyzer(AnalysisModule):
         else:
             self.ignored_vendors = set()
 
+        # (optional) url of the vt hash cache batch endpoint
+        # if this is set then all of the hashes in the alert are looked up in a single request
+        self.batch_url = self.config.get('batch_url', fallback=None)
+        self.batch_timeout = self.config.getint('batch_timeout', fallback=30)
+
+        # the results of the batch lookups for the root we're currently analyzing
+        self.batch_root_uuid = None
+        self.batch_results = {} # key = lower case hash, value = VT result
+        self.batch_queried = set() # of lower case hashes we've already looked up
+
+    def get_batch_hashes(self):
+        """Returns the set of (lower case) hashes in the current root that still need to be looked up."""
+        result = set()
+        for observable in self.root.all_observables:
+            if observable.type not in self.valid_observable_types:
+                continue
+
+            if observable.get_analysis(VTHashAnalysis) is not None:
+                continue
+
+            result.add(observable.value.lower())
+
+        # we only need one of the hashes of the files we've hashed (see execute_analysis)
+        for analysis in self.root.all_analysis:
+            if not isinstance(analysis, FileHashAnalysis):
+                continue
+
+            sha256_hashes = [_.value.lower() for _ in analysis.get_observables_by_type(F_SHA256)]
+            if not sha256_hashes:
+                continue
+
+            for hash_type in [ F_MD5, F_SHA1 ]:
+                for other_hash in analysis.get_observables_by_type(hash_type):
+                    result.discard(other_hash.value.lower())
+
+        return result - self.batch_queried
+
+    def lookup_batch(self, _hash):
+        """Looks up all of the hashes in the current root in a single request to the batch endpoint.
+           Returns the VT result for the given hash, or None if it is not available."""
+        if self.batch_root_uuid != self.root.uuid:
+            self.batch_root_uuid = self.root.uuid
+            self.batch_results = {}
+            self.batch_queried = set()
+
+        hash_value = _hash.value.lower()
+        if hash_value not in self.batch_queried:
+            hashes = self.get_batch_hashes()
+            hashes.add(hash_value)
+            self.batch_queried.update(hashes)
+
+            logging.debug("looking up VT reports for {} hashes".format(len(hashes)))
+
+            try:
+                r = requests.post(self.batch_url, json={ 'hashes': sorted(hashes) }, proxies=self.proxies, 
+                                  timeout=self.batch_timeout, verify=False)
+
+                if r.status_code != 200:
+                    logging.error("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+                else:
+                    self.batch_results.update(json.loads(r.content.decode()))
+
+            except Exception as e:
+                logging.error("unable to query VT batch: {}".format(e))
+
+        return self.batch_results.get(hash_value, None)
+
     def execute_analysis(self, _hash):
 
         # it is possible that you are looking at an MD5 but you already have the analysis of the SHA1
@@ -315,26 +382,34 @@ class VTHashAnalyzer(AnalysisModule):
                             return False
 
 
-        logging.debug("looking up VT report for {}".format(_hash))
+        vt_result = None
+        if self.batch_url:
+            vt_result = self.lookup_batch(_hash)
 
-        try:
-            #r = requests.get(self.query_url, params={
-                #'resource': _hash.value,
-                #'apikey': self.api_key}, proxies=saq.PROXIES, timeout=5)
+        # fall back to looking up this single hash
+        if vt_result is None:
+            logging.debug("looking up VT report for {}".format(_hash))
+
+            try:
+                #r = requests.get(self.query_url, params={
+                    #'resource': _hash.value,
+                    #'apikey': self.api_key}, proxies=saq.PROXIES, timeout=5)
 
-            r = requests.get(self.query_url, params={ 'h': _hash.value }, proxies=self.proxies, timeout=5, verify=False)
+                r = requests.get(self.query_url, params={ 'h': _hash.value }, proxies=self.proxies, timeout=5, verify=False)
 
-        except Exception as e:
-            logging.error("unable to query VT: {}".format(e))
-            return False
+            except Exception as e:
+                logging.error("unable to query VT: {}".format(e))
+                return False
 
-        if r.status_code == 403:
-            logging.error("invalid virus total api key!")
-            return False
+            if r.status_code == 403:
+                logging.error("invalid virus total api key!")
+                return False
 
-        if r.status_code != 200:
-            logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
-            return False
+            if r.status_code != 200:
+                logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+                return False
+
+            vt_result = json.loads(r.content.decode())
 
         analysis = self.create_analysis(_hash)
 
@@ -342,7 +417,7 @@ class VTHashAnalyzer(AnalysisModule):
         # if they change their JSON structure we'll probably break
 
         logging.debug("got valid vt result for {}".format(_hash))
-        analysis.details = json.loads(r.content.decode())
+        analysis.details = vt_result
         
         # 4/28/2016 - looks like they now return an array of results
         if isinstance(analysis.details, list):
@@ -20,16 +20,32 @@ from math import floor
 from threading import Thread, Semaphore, RLock
 
 import saq
+import saq.metrics
 from saq.constants import *
 from saq.error import report_exception
 from saq.performance import record_metric
 from saq.service import *
 
+SEMAPHORE_WAIT_TIME = saq.metrics.histogram(METRIC_SEMAPHORE_WAIT_TIME,
+                                            "time spent waiting to acquire a network semaphore",
+                                            [ 'semaphore', 'result' ])
+
 # this is a fall back device to be used if the network semaphore is unavailable
 fallback_semaphores = {}
 
+# used to initialize the fallback semaphores on first use
+fallback_semaphores_lock = threading.Lock()
+
+def get_fallback_semaphore(semaphore_name):
+    """Returns the fallback semaphore for the given name, initializing the fallback semaphores if needed."""
+    with fallback_semaphores_lock:
+        if not fallback_semaphores:
+            initialize_fallback_semaphores()
+
+    return fallback_semaphores[semaphore_name]
+
 def initialize_fallback_semaphores():
-    """This needs to be called once at the very beginning of starting ACE."""
+    """Creates the fallback semaphores. This is called the first time a fallback semaphore is needed."""
 
     # we need some fallback functionality for when the network semaphore server is down
     # these semaphores serve that purpose
@@ -102,6 +118,14 @@ class NetworkSemaphoreClient(object):
                                              and self.cancel_request_callback() )
 
     def acquire(self, semaphore_name):
+        """Blocks until the given semaphore is acquired (returns True) or the request is cancelled (returns False.)"""
+        start_time = time.perf_counter()
+        result = self._acquire(semaphore_name)
+        SEMAPHORE_WAIT_TIME.labels(semaphore_name, 'acquired' if result else 'cancelled').observe(
+            time.perf_counter() - start_time)
+        return result
+
+    def _acquire(self, semaphore_name):
         if self.semaphore_acquired:
             logging.warning(f"semaphore {self.semaphore_name} already acquired")
             return True
@@ -157,9 +181,9 @@ class NetworkSemaphoreClient(object):
             try:
                 logging.warning(f"acquiring fallback semaphore {semaphore_name}")
                 while not self.request_is_cancelled:
-                    if fallback_semaphores[semaphore_name].acquire(blocking=True, timeout=1):
+                    if get_fallback_semaphore(semaphore_name).acquire(blocking=True, timeout=1):
                         logging.debug(f"fallback semaphore {semaphore_name} acquired")
-                        self.fallback_semaphore = fallback_semaphores[semaphore_name]
+                        self.fallback_semaphore = get_fallback_semaphore(semaphore_name)
                         self.semaphore_acquired = True
                         self.semaphore_name = semaphore_name
                         self.start_failsafe_monitor()
@@ -77,6 +77,9 @@ class CaselessObservable(Observable):
     def _compare_value(self, other):
         return self.normalize_caseless(self.value) == self.normalize_caseless(other)
 
+    def _normalize_value(self, value):
+        return self.normalize_caseless(value)
+
 class IPv4Observable(Observable):
 
     def __init__(self, *args, **kwargs):
@@ -2,28 +2,41 @@
 
 import csv
 import datetime
+import functools
 import logging
 import os, os.path
 import sys
 import time
 
 import saq
+import saq.metrics
+from saq.constants import METRIC_FUNCTION_EXECUTION_TIME
+
+FUNCTION_EXECUTION_TIME = saq.metrics.histogram(METRIC_FUNCTION_EXECUTION_TIME,
+                                                "time spent in functions decorated with track_execution_time",
+                                                [ 'function' ])
 
 def record_execution_time(function, start, stop):
     logging.debug("EXECUTION TIME {}: {:.3f}".format(function.__name__, stop - start))
+    FUNCTION_EXECUTION_TIME.labels(function.__qualname__).observe(stop - start)
 
 def track_execution_time(f):
+    @functools.wraps(f)
     def _track_execution_time(*args, **kwargs):
-        start = time.clock()
+        start = time.perf_counter()
         try:
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
         finally:
-            stop = time.clock()
+            stop = time.perf_counter()
             record_execution_time(f, start, stop)
 
     return _track_execution_time
 
 def record_metric(metric, value):
+    """Appends the current value of the given metric to DATA_DIR/stats/metrics/NAME.csv
+       as a (time, pid, command line, value) row and records it as a gauge (see saq.metrics.)"""
     with open(os.path.join(saq.DATA_DIR, 'stats', 'metrics', '{}.csv'.format(metric)), 'a') as fp:
         writer = csv.writer(fp)
         writer.writerow([str(datetime.datetime.now()), os.getpid(), ' '.join(sys.argv), value])
+
+    saq.metrics.gauge(metric).set(value)
@@ -35,6 +35,10 @@ from sqlalchemy import asc, func, and_, or_
 MESSAGE_TYPE_REMEDIATION_SUCCESS = 'remediation_success'
 MESSAGE_TYPE_REMEDIATION_FAILURE = 'remediation_failure'
 
+def get_remediation_wakeup_signal(remediation_type):
+    """Returns the saq.util.WakeupSignal used to notify the remediation system for the given type of new requests."""
+    return get_wakeup_signal(f'remediation.{remediation_type}')
+
 class RemediationSystemManager(ACEService):
     def __init__(self, *args, **kwargs):
         super().__init__(service_config=saq.CONFIG['service_remediation'], *args, **kwargs)
@@ -157,6 +161,12 @@ class RemediationSystem(object):
         self.message_on_success = self.config.getboolean('message_on_success', fallback=False)
         self.message_on_error = self.config.getboolean('message_on_error', fallback=False)
 
+        # how long (in seconds) we wait for new requests before checking again
+        self.idle_timeout = saq.CONFIG['service_remediation'].getint('idle_timeout', fallback=3)
+
+        # notified by request() when new remediation requests are available for this type
+        self.wakeup_signal = get_remediation_wakeup_signal(self.remediation_type)
+
         # if this is set to True then we run everything in a single thread
         self.debug = False
 
@@ -217,6 +227,7 @@ class RemediationSystem(object):
 
     def stop(self, wait=True):
         self.control_event.set()
+        self.wakeup_signal.interrupt()
         if wait:
             self.wait()
 
@@ -242,7 +253,8 @@ class RemediationSystem(object):
                 # are closed after each iteration
                 saq.db.close()
 
-            self.control_event.wait(sleep_time)
+            if sleep_time > 0:
+                self.wakeup_signal.wait(sleep_time, self.control_event)
 
         logging.debug("remediation manager loop exiting")
 
@@ -291,7 +303,7 @@ class RemediationSystem(object):
             .all()
 
         if not target_ids:
-            return 3 # if we didn't get anything then we wait 3 seconds to try again
+            return self.idle_timeout # if we didn't get anything then we wait for a request to come in
 
         # gather the ids into a list
         target_ids = [_[0] for _ in target_ids]
@@ -307,7 +319,7 @@ class RemediationSystem(object):
 
         if result.rowcount == 0:
             # execute again but wait a few seconds
-            return 3 # do we need to make this configurable?
+            return self.idle_timeout
 
         # execute again (don't wait)
         return 0
@@ -438,6 +450,11 @@ def request(action,
     saq.db.commit()
     saq.db.refresh(remediation)
     saq.db.expunge_all()
+
+    # wake up the remediation system for this type (unless this request is already locked by someone)
+    if lock is None and status == REMEDIATION_STATUS_NEW:
+        get_remediation_wakeup_signal(type).notify()
+
     return remediation
 
 def request_remediation(*args, **kwargs):
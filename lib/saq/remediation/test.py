@@ -4,6 +4,7 @@
 import datetime
 import threading
 import logging
+import time
 
 import saq
 from saq.database import Remediation
@@ -118,6 +119,24 @@ class TestCase(ACEBasicTestCase):
         self.assertTrue(manager.systems['test'].remediation_executed.is_set())
         self.assertEquals(len(saq.db.query(Remediation).filter(Remediation.id == remediation.id, Remediation.status == REMEDIATION_STATUS_COMPLETED).all()), 1)
 
+    def test_request_wakeup(self):
+        # new requests wake up the remediation system instead of waiting for the next poll
+        saq.CONFIG['service_remediation']['idle_timeout'] = '60'
+        manager = self._start_manager()
+        # give the manager a chance to go idle
+        time.sleep(1)
+        remediation = request_remediation(REMEDIATION_TYPE_TEST, 'some_value', saq.test.UNITTEST_USER_ID, saq.COMPANY_ID)
+
+        wait_for(
+            lambda: len(saq.db.query(Remediation).filter(
+                Remediation.id == remediation.id, 
+                Remediation.status == REMEDIATION_STATUS_COMPLETED).all()) > 0,
+            1, 5)
+
+        manager.stop_service()
+        manager.wait_service()
+        self.assertTrue(manager.systems['test'].remediation_executed.is_set())
+
     def test_worker_loop(self):
 
         # test that a single worker can work two items
@@ -19,6 +19,7 @@ import time
 import psutil
 
 import saq
+import saq.metrics
 from saq.error import report_exception
 
 # the global list of services registered under this process
@@ -106,6 +107,9 @@ class ACEService(object):
         # NOTE services running as daemons are also tracked elsewhere
         self.service_indicator_path = os.path.join(saq.SERVICES_DIR, self.service_name)
 
+        # the OpenMetrics endpoint of this service (see saq.metrics)
+        self.metrics_server = None
+
     def execute_service(self):
         """The entry point for the service. This function is expected to start the service
            and *NOT* return until the service has completed."""
@@ -118,6 +122,30 @@ class ACEService(object):
     def cleanup_service(self):
         pass
 
+    def start_metrics_server(self):
+        """Starts serving the metrics of this service on the local metrics_port (if one is configured.)"""
+        port = self.service_config.getint('metrics_port', fallback=0)
+        if not port or not saq.metrics.is_enabled():
+            return
+
+        try:
+            self.metrics_server = saq.metrics.start_metrics_server(self.service_name, port)
+        except Exception as e:
+            logging.error(f"unable to start metrics server for {self.service_name} on port {port}: {e}")
+            report_exception()
+
+    def stop_metrics_server(self):
+        saq.metrics.stop_exporters()
+        if self.metrics_server is None:
+            return
+
+        try:
+            self.metrics_server.stop()
+        except Exception as e:
+            logging.error(f"unable to stop metrics server for {self.service_name}: {e}")
+
+        self.metrics_server = None
+
     def start_service(self, threaded=False, daemon=False, debug=False):
         assert threaded or daemon or debug
         # make sure the service is enable and not already running
@@ -279,6 +307,7 @@ class ACEService(object):
             self.record_service_pid()
             if not saq.UNIT_TESTING:
                 atexit.register(self.remove_service_pid)
+            self.start_metrics_server()
             return self.execute_service()
         except Exception as e:
             logging.error(f"uncaught exception: {e}")
@@ -286,6 +315,7 @@ class ACEService(object):
             return None
         finally:
             self.cleanup_service()
+            self.stop_metrics_server()
             self.remove_service_pid()
 
         if self.service_is_daemon:
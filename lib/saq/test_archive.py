@@ -0,0 +1,135 @@
+# vim: sw=4:ts=4:et
+
+import io
+import logging
+import os, os.path
+import shutil
+import tarfile
+import time
+import zipfile
+
+from subprocess import Popen, PIPE, DEVNULL
+
+import saq
+import saq.archive
+from saq.archive import open_archive, ArchiveLimits, ArchiveLimitError
+from saq.test import *
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.test_dir = os.path.join(saq.TEMP_DIR, 'archive_test')
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+        os.makedirs(self.test_dir)
+
+    def create_zip(self, file_name, members):
+        path = os.path.join(self.test_dir, file_name)
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for name, data in members.items():
+                zip_file.writestr(name, data)
+
+        return path
+
+    def test_zip(self):
+        path = self.create_zip('test.zip', { 'a.txt': b'a', 'sub/b.txt': b'b', '../../escape.txt': b'c' })
+        with open_archive(path) as archive:
+            self.assertEquals(sorted([m.name for m in archive.members]), [ '../../escape.txt', 'a.txt', 'sub/b.txt' ])
+            target_dir = os.path.join(self.test_dir, 'extracted')
+            self.assertEquals(sorted(archive.extract(target_dir)), [ 'a.txt', 'escape.txt', 'sub/b.txt' ])
+
+        # nothing is written outside of the target directory
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'escape.txt')))
+        with open(os.path.join(target_dir, 'sub', 'b.txt'), 'rb') as fp:
+            self.assertEquals(fp.read(), b'b')
+
+    def test_tar(self):
+        path = os.path.join(self.test_dir, 'test.tar.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            for name in [ 'a.txt', 'sub/b.txt' ]:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = 1
+                tar.addfile(tarinfo, io.BytesIO(b'x'))
+
+            # links are not extracted
+            tarinfo = tarfile.TarInfo('link')
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = '/etc/passwd'
+            tar.addfile(tarinfo)
+
+        with open_archive(path) as archive:
+            self.assertEquals(sorted([m.name for m in archive.members]), [ 'a.txt', 'sub/b.txt' ])
+            target_dir = os.path.join(self.test_dir, 'extracted')
+            self.assertEquals(archive.extract(target_dir, names=[ 'sub/b.txt' ]), [ 'sub/b.txt' ])
+
+    def test_not_archive(self):
+        path = os.path.join(self.test_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello world')
+
+        self.assertFalse(saq.archive.is_supported(path))
+        self.assertIsNone(open_archive(path))
+
+    def test_nested(self):
+        inner_path = self.create_zip('inner.zip', { 'inner.txt': b'inner' })
+        with open(inner_path, 'rb') as fp:
+            outer_path = self.create_zip('outer.zip', { 'inner.zip': fp.read() })
+
+        # the inner archive is read straight out of the outer one
+        with open_archive(outer_path) as archive:
+            with archive.open_member(archive.members[0]) as fp:
+                with open_archive(fileobj=fp) as inner_archive:
+                    self.assertEquals([m.name for m in inner_archive.members], [ 'inner.txt' ])
+
+    def test_limits(self):
+        path = self.create_zip('test.zip', { 'file_{}'.format(i): b'x' for i in range(10) })
+        with open_archive(path) as archive:
+            with self.assertRaises(ArchiveLimitError):
+                archive.extract(os.path.join(self.test_dir, 'count'), limits=ArchiveLimits(max_member_count=5))
+
+            with self.assertRaises(ArchiveLimitError):
+                archive.extract(os.path.join(self.test_dir, 'size'), limits=ArchiveLimits(max_total_size=5))
+
+            self.assertEquals(len(archive.extract(os.path.join(self.test_dir, 'ok'), limits=ArchiveLimits())), 10)
+
+        # something that compresses really well
+        path = self.create_zip('bomb.zip', { 'bomb': b'\x00' * (16 * 1024 * 1024) })
+        with open_archive(path) as archive:
+            with self.assertRaises(ArchiveLimitError):
+                archive.extract(os.path.join(self.test_dir, 'ratio'), limits=ArchiveLimits(max_ratio=100))
+
+            # extraction is also bounded by time
+            with self.assertRaises(ArchiveLimitError):
+                archive.extract(os.path.join(self.test_dir, 'timeout'), limits=ArchiveLimits(timeout=0.001))
+
+    def test_archive_benchmark(self):
+        # a corpus of zipped emails
+        archive_count = 200
+        with open(os.path.join('test_data', 'emails', 'splunk_logging.email.rfc822'), 'rb') as fp:
+            email_data = fp.read()
+
+        paths = [ self.create_zip('email_{}.zip'.format(i), { 'email_{}.eml'.format(i): email_data })
+                  for i in range(archive_count) ]
+
+        start = time.time()
+        for path in paths:
+            with open_archive(path) as archive:
+                archive.extract('{}.extracted'.format(path))
+
+        in_process_time = time.time() - start
+
+        if not shutil.which('unzip'):
+            logging.info("BENCHMARK: extracted {} zipped emails in-process in {:.3f} seconds".format(
+                         archive_count, in_process_time))
+            return
+
+        start = time.time()
+        for path in paths:
+            Popen(['unzip', '-l', path], stdout=DEVNULL, stderr=DEVNULL).wait()
+            Popen(['unzip', '-o', path, '-d', '{}.unzip'.format(path)], stdout=DEVNULL, stderr=DEVNULL).wait()
+
+        external_time = time.time() - start
+
+        logging.info("BENCHMARK: extracted {} zipped emails in-process in {:.3f} seconds "
+                     "and with unzip in {:.3f} seconds".format(archive_count, in_process_time, external_time))
@@ -0,0 +1,170 @@
+# vim: sw=4:ts=4:et
+
+import datetime
+import hashlib
+import os, os.path
+import uuid
+
+import saq
+import saq.file_store
+from saq.constants import *
+from saq.test import *
+
+def _sha256(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+class FileStoreTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        saq.CONFIG['file_store']['enabled'] = 'yes'
+        saq.CONFIG['file_store']['analysis_cache_enabled'] = 'yes'
+
+    def create_root(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        return root
+
+    def test_store_file(self):
+        root_1 = self.create_root()
+        root_2 = self.create_root()
+        path_1 = os.path.join(root_1.storage_dir, 'test.txt')
+        path_2 = os.path.join(root_2.storage_dir, 'test.txt')
+
+        for path in [ path_1, path_2 ]:
+            with open(path, 'w') as fp:
+                fp.write('hello, world')
+
+        sha256 = _sha256(path_1)
+        self.assertTrue(saq.file_store.store_file(path_1, sha256))
+        self.assertTrue(saq.file_store.is_stored(sha256))
+        self.assertEquals(saq.file_store.get_reference_count(sha256), 1)
+
+        # the second copy should become a link to the first
+        self.assertTrue(saq.file_store.store_file(path_2, sha256))
+        self.assertTrue(os.path.samefile(path_1, path_2))
+        self.assertEquals(saq.file_store.get_reference_count(sha256), 2)
+
+        # storing it again changes nothing
+        self.assertTrue(saq.file_store.store_file(path_2, sha256))
+        self.assertEquals(saq.file_store.get_reference_count(sha256), 2)
+
+    def test_disabled(self):
+        saq.CONFIG['file_store']['enabled'] = 'no'
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path)
+        self.assertFalse(saq.file_store.store_file(path, sha256))
+        self.assertFalse(saq.file_store.is_stored(sha256))
+        self.assertIsNone(saq.file_store.get_cached_analysis(sha256, 'test'))
+
+    def test_cached_analysis(self):
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path)
+
+        # nothing is cached for content that is not stored
+        self.assertFalse(saq.file_store.set_cached_analysis(sha256, 'test', { 'result': True }))
+
+        self.assertTrue(saq.file_store.store_file(path, sha256))
+        self.assertIsNone(saq.file_store.get_cached_analysis(sha256, 'test'))
+        self.assertTrue(saq.file_store.set_cached_analysis(sha256, 'test', { 'result': True }))
+        self.assertEquals(saq.file_store.get_cached_analysis(sha256, 'test'), { 'result': True })
+
+        # expired results are ignored
+        self.assertIsNone(saq.file_store.get_cached_analysis(sha256, 'test',
+                                                             lifetime=datetime.timedelta(seconds=-1)))
+
+        saq.CONFIG['file_store']['analysis_cache_enabled'] = 'no'
+        self.assertIsNone(saq.file_store.get_cached_analysis(sha256, 'test'))
+
+    def test_link_file(self):
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path)
+        self.assertTrue(saq.file_store.store_file(path, sha256))
+
+        dest_path = os.path.join(root.storage_dir, 'sub_dir', 'linked.txt')
+        self.assertTrue(saq.file_store.link_file(sha256, dest_path))
+        self.assertTrue(os.path.samefile(path, dest_path))
+
+        # cannot link content that is not stored
+        self.assertFalse(saq.file_store.link_file('0' * 64, os.path.join(root.storage_dir, 'missing.txt')))
+
+    def test_release(self):
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path)
+        self.assertTrue(saq.file_store.store_file(path, sha256))
+        self.assertTrue(saq.file_store.set_cached_analysis(sha256, 'test', { 'result': True }))
+
+        # still referenced
+        self.assertEquals(saq.file_store.release([sha256]), 0)
+        self.assertTrue(saq.file_store.is_stored(sha256))
+
+        os.remove(path)
+        self.assertEquals(saq.file_store.release([sha256]), 1)
+        self.assertFalse(saq.file_store.is_stored(sha256))
+        self.assertFalse(os.path.exists(saq.file_store.get_cache_path(sha256, 'test')))
+
+    def test_root_delete(self):
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        _file = root.add_observable(F_FILE, 'test.txt')
+        self.assertTrue(saq.file_store.store_file(path, _file.sha256_hash))
+        root.save()
+
+        root.delete()
+        self.assertFalse(saq.file_store.is_stored(_file.sha256_hash))
+
+    def test_collect(self):
+        root = self.create_root()
+        path = os.path.join(root.storage_dir, 'test.txt')
+        with open(path, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path)
+        self.assertTrue(saq.file_store.store_file(path, sha256))
+        self.assertEquals(saq.file_store.collect(), 0)
+
+        os.remove(path)
+        self.assertEquals(saq.file_store.collect(), 1)
+        self.assertFalse(saq.file_store.is_stored(sha256))
+
+    def test_cached_file_paths(self):
+        from saq.modules.file_analysis import strip_file_path, restore_file_path
+
+        root_1 = self.create_root()
+        root_2 = self.create_root()
+        path_1 = os.path.join(root_1.storage_dir, 'test.txt')
+        path_2 = os.path.join(root_2.storage_dir, 'test.txt')
+        with open(path_1, 'w') as fp:
+            fp.write('hello, world')
+
+        sha256 = _sha256(path_1)
+        self.assertTrue(saq.file_store.store_file(path_1, sha256))
+
+        # paths into the storage directory of the first alert are not cached
+        result = [ { 'rule': 'test_1', 'target': path_1 }, { 'rule': 'test_2', 'target': 'word/vbaProject.bin' } ]
+        self.assertTrue(saq.file_store.set_cached_analysis(sha256, 'test', strip_file_path(result, 'target', path_1)))
+        cached = saq.file_store.get_cached_analysis(sha256, 'test')
+        self.assertFalse(path_1 in [ _['target'] for _ in cached ])
+
+        # and are replaced with the path of the file in the alert that uses the cached results
+        self.assertEquals(restore_file_path(cached, 'target', path_2),
+                          [ { 'rule': 'test_1', 'target': path_2 }, { 'rule': 'test_2', 'target': 'word/vbaProject.bin' } ])
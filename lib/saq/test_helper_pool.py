@@ -0,0 +1,101 @@
+# vim: sw=4:ts=4:et
+
+import os, os.path
+import subprocess
+import sys
+
+import saq
+from saq.helper_pool import HelperPool, run_python_script
+from saq.test import *
+
+TEST_SCRIPT = """
+import os, sys, time
+if sys.argv[1] == 'sleep':
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as fp:
+            fp.write(str(os.getpid()))
+
+    time.sleep(5)
+
+# output from child processes does not end up in the protocol
+os.system('echo noise')
+sys.stderr.write('error\\n')
+print(' '.join(sys.argv[1:]))
+sys.exit(int(sys.argv[2]))
+"""
+
+# a script that configures logging and keeps state in a module it imports
+LOGGING_TEST_SCRIPT = """
+import logging, sys
+import helper_test_state
+helper_test_state.runs.append(sys.argv[1])
+logging.basicConfig(format='%(message)s')
+logging.getLogger('helper_test').error('%s %d', sys.argv[1], len(helper_test_state.runs))
+"""
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.script_path = os.path.join(saq.TEMP_DIR, 'helper_test.py')
+        with open(self.script_path, 'w') as fp:
+            fp.write(TEST_SCRIPT)
+
+        self.logging_script_path = os.path.join(saq.TEMP_DIR, 'helper_logging_test.py')
+        with open(self.logging_script_path, 'w') as fp:
+            fp.write(LOGGING_TEST_SCRIPT)
+
+        with open(os.path.join(saq.TEMP_DIR, 'helper_test_state.py'), 'w') as fp:
+            fp.write('runs = []\n')
+
+    def test_helper_pool(self):
+        pool = HelperPool(sys.executable, size=2, max_jobs=2)
+        try:
+            self.assertEquals(pool.run(self.script_path, ['test', '0']), (0, b'test 0\n', b'error\n'))
+            self.assertEquals(pool.run(self.script_path, ['test', '2'])[0], 2)
+            # the helper was recycled after two jobs
+            self.assertEquals(len(pool.idle), 0)
+
+            self.assertEquals(pool.run(self.script_path, ['test', '0'])[0], 0)
+            self.assertEquals(len(pool.idle), 1)
+            helper = pool.idle[0]
+
+            # helpers that time out are killed
+            with self.assertRaises(subprocess.TimeoutExpired):
+                pool.run(self.script_path, ['sleep', '0'], timeout=1)
+
+            self.assertFalse(helper.is_alive)
+            self.assertEquals(pool.run(self.script_path, ['test', '1'])[0], 1)
+
+            count, average, maximum = pool.get_execution_times()['helper_test']
+            self.assertEquals(count, 5)
+            self.assertTrue(maximum >= 1)
+        finally:
+            pool.close()
+
+    def test_helper_state(self):
+        pool = HelperPool(sys.executable, size=1, max_jobs=10)
+        try:
+            # both scripts run in the same helper
+            self.assertEquals(pool.run(self.logging_script_path, ['first']), (0, b'', b'first 1\n'))
+            self.assertEquals(pool.run(self.logging_script_path, ['second']), (0, b'', b'second 1\n'))
+            self.assertEquals(len(pool.idle), 1)
+            self.assertEquals(pool.idle[0].job_count, 2)
+        finally:
+            pool.close()
+
+    def test_run_python_script_timeout(self):
+        saq.CONFIG['helper_pool']['enabled'] = 'no'
+        saq.CONFIG['helper_pool']['interpreter'] = sys.executable
+        # (output from child processes is included when the script runs in its own process)
+        self.assertEquals(run_python_script(self.script_path, ['test', '0']), (0, b'noise\ntest 0\n', b'error\n'))
+
+        # scripts that time out are killed
+        pid_path = os.path.join(saq.TEMP_DIR, 'helper_test.pid')
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_python_script(self.script_path, ['sleep', '0', pid_path], timeout=1)
+
+        with open(pid_path, 'r') as fp:
+            pid = int(fp.read())
+
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
@@ -0,0 +1,87 @@
+# vim: sw=4:ts=4:et
+
+import json
+import os, os.path
+import sqlite3
+
+import saq
+import saq.intel
+from saq.test import *
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.source_path = os.path.join(saq.TEMP_DIR, 'sip_indicators.json')
+        self.cache_path = os.path.join(saq.DATA_DIR, saq.CONFIG['sip']['cache_db_path'])
+        for path in [ self.cache_path, '{}.a'.format(self.cache_path), '{}.b'.format(self.cache_path) ]:
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def write_indicators(self, indicators):
+        with open(self.source_path, 'w') as fp:
+            json.dump(indicators, fp)
+
+    def test_update_local_cache(self):
+        indicators = [ { 'id': index,
+                         'type': saq.intel.I_URI,
+                         'value': 'HTTP://LOCAL/{}'.format(index),
+                         'status': saq.intel.SIP_STATUS_ANALYZED,
+                         'modified': '2019-01-01 00:00:00' } for index in range(100) ]
+        self.write_indicators(indicators)
+
+        source = saq.intel.LocalIndicatorSource(self.source_path)
+        self.assertTrue(saq.intel.update_local_cache(incremental=True, source=source))
+        lookup = saq.intel.get_indicator_cache_lookup(self.cache_path)
+        self.assertEquals(len(lookup.indicators), 100)
+        self.assertTrue((saq.intel.I_URI, 'http://local/1') in lookup)
+        first_path = os.path.realpath(self.cache_path)
+
+        # only the changes are applied the next time
+        indicators[1]['status'] = saq.intel.SIP_STATUS_DEPRECATED
+        indicators[1]['modified'] = '2099-01-01 00:00:00'
+        indicators.append({ 'id': 100,
+                            'type': saq.intel.I_URI,
+                            'value': 'http://local/new',
+                            'status': saq.intel.SIP_STATUS_ANALYZED,
+                            'modified': '2099-01-01 00:00:00' })
+        self.write_indicators(indicators)
+
+        self.assertTrue(saq.intel.update_local_cache(incremental=True, source=source))
+        self.assertNotEquals(os.path.realpath(self.cache_path), first_path)
+        lookup = saq.intel.get_indicator_cache_lookup(self.cache_path)
+        self.assertEquals(len(lookup.indicators), 100)
+        self.assertFalse((saq.intel.I_URI, 'http://local/1') in lookup)
+        self.assertTrue((saq.intel.I_URI, 'http://local/new') in lookup)
+
+        # a full rebuild gives the same result
+        self.assertTrue(saq.intel.update_local_cache(incremental=False, source=source))
+        lookup = saq.intel.get_indicator_cache_lookup(self.cache_path)
+        self.assertEquals(len(lookup.indicators), 100)
+        self.assertFalse((saq.intel.I_URI, 'http://local/1') in lookup)
+
+    def test_update_local_cache_deleted_indicators(self):
+        indicators = [ { 'id': index,
+                         'type': saq.intel.I_URI,
+                         'value': 'http://local/{}'.format(index),
+                         'status': saq.intel.SIP_STATUS_ANALYZED,
+                         'modified': '2019-01-01 00:00:00' } for index in range(10) ]
+        self.write_indicators(indicators)
+
+        source = saq.intel.LocalIndicatorSource(self.source_path)
+        self.assertTrue(saq.intel.update_local_cache(incremental=True, source=source))
+
+        # an indicator deleted from SIP is still in the cache after an incremental update
+        self.write_indicators(indicators[1:])
+        self.assertTrue(saq.intel.update_local_cache(incremental=True, source=source))
+        lookup = saq.intel.get_indicator_cache_lookup(self.cache_path)
+        self.assertTrue((saq.intel.I_URI, 'http://local/0') in lookup)
+
+        # until the cache is rebuilt after full_cache_update_frequency
+        with sqlite3.connect(os.path.realpath(self.cache_path)) as db:
+            db.execute("UPDATE cache_state SET value = '2019-01-01 00:00:00' WHERE name = 'full_update'")
+
+        self.assertTrue(saq.intel.update_local_cache(incremental=True, source=source))
+        self.assertEquals(log_count('sip cache was last rebuilt at 2019-01-01 00:00:00'), 1)
+        lookup = saq.intel.get_indicator_cache_lookup(self.cache_path)
+        self.assertEquals(len(lookup.indicators), 9)
+        self.assertFalse((saq.intel.I_URI, 'http://local/0') in lookup)
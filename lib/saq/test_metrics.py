@@ -0,0 +1,142 @@
+# vim: sw=4:ts=4:et
+
+import csv
+import json
+import os, os.path
+import shutil
+import subprocess
+import urllib.request
+
+import saq
+import saq.metrics
+from saq.metrics import MetricRegistry, MetricsServer, CSVExporter, generate_openmetrics, collect_metrics, \
+                        get_process_metrics_dir
+from saq.test import *
+
+class TestCase(ACEBasicTestCase):
+    def test_registry(self):
+        registry = MetricRegistry()
+        counter = registry.counter('test_counter', 'test counter', [ 'mode' ])
+        counter.labels('analysis').inc()
+        counter.labels('analysis').inc(2)
+        counter.labels('correlation').inc()
+        # the same metric is returned for the same name
+        self.assertTrue(registry.counter('test_counter', 'test counter', [ 'mode' ]) is counter)
+        with self.assertRaises(ValueError):
+            registry.gauge('test_counter')
+        with self.assertRaises(ValueError):
+            counter.labels('analysis', 'extra')
+
+        gauge = registry.gauge('test_gauge')
+        gauge.set(10)
+        gauge.dec(3)
+
+        histogram = registry.histogram('test_histogram', buckets=( 1, 5 ))
+        for value in [ 0.5, 1, 3, 10 ]:
+            histogram.observe(value)
+
+        families = { family['name']: family for family in registry.collect() }
+        self.assertEquals(sorted(families['test_counter']['samples']), [ [ [ 'analysis' ], 3 ], [ [ 'correlation' ], 1 ] ])
+        self.assertEquals(families['test_gauge']['samples'], [ [ [], 7 ] ])
+        self.assertEquals(families['test_histogram']['samples'],
+                          [ [ [], { 'counts': [ 2, 1, 1 ], 'sum': 14.5, 'count': 4 } ] ])
+
+        text = generate_openmetrics(registry.collect())
+        self.assertTrue('# TYPE test_counter counter\n' in text)
+        self.assertTrue('test_counter_total{mode="analysis"} 3\n' in text)
+        self.assertTrue('test_gauge 7\n' in text)
+        self.assertTrue('test_histogram_bucket{le="1"} 2\n' in text)
+        self.assertTrue('test_histogram_bucket{le="5"} 3\n' in text)
+        self.assertTrue('test_histogram_bucket{le="+Inf"} 4\n' in text)
+        self.assertTrue('test_histogram_count 4\n' in text)
+        self.assertTrue('test_histogram_sum 14.5\n' in text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+        registry.reset()
+        self.assertEquals(families.keys(), { family['name'] for family in registry.collect() })
+        self.assertTrue(all([ not family['samples'] for family in registry.collect() ]))
+
+    def test_process_metrics(self):
+        saq.metrics.counter('test_process_counter', labelnames=[ 'mode' ]).labels('analysis').inc(2)
+        saq.metrics.gauge('test_process_gauge').set(5)
+
+        # metrics exported by another process of the service
+        # (the pid of this process's parent is used since it is a process that is running)
+        target_dir = get_process_metrics_dir('test')
+        if os.path.exists(target_dir):
+            shutil.rmtree(target_dir)
+
+        os.makedirs(target_dir)
+        other_pid = os.getppid()
+        with open(os.path.join(target_dir, '{}.json'.format(other_pid)), 'w') as fp:
+            json.dump({ 'pid': other_pid, 'families': [
+                { 'name': 'test_process_counter', 'type': 'counter', 'documentation': '', 'labelnames': [ 'mode' ],
+                  'samples': [ [ [ 'analysis' ], 3 ] ] },
+                { 'name': 'test_process_gauge', 'type': 'gauge', 'documentation': '', 'labelnames': [],
+                  'samples': [ [ [], 1 ] ] }, ] }, fp)
+
+        # metrics exported by a process that has exited
+        p = subprocess.Popen([ 'true' ])
+        p.wait()
+        exited_path = os.path.join(target_dir, '{}.json'.format(p.pid))
+        with open(exited_path, 'w') as fp:
+            json.dump({ 'pid': p.pid, 'families': [
+                { 'name': 'test_process_counter', 'type': 'counter', 'documentation': '', 'labelnames': [ 'mode' ],
+                  'samples': [ [ [ 'analysis' ], 7 ] ] }, ] }, fp)
+
+        families = { family['name']: family for family in collect_metrics('test') }
+        # the metrics of the process that exited are not counted and are removed
+        self.assertFalse(os.path.exists(exited_path))
+        # counters are summed
+        self.assertEquals(families['test_process_counter']['samples'], [ [ [ 'analysis' ], 5 ] ])
+        # gauges are per process
+        self.assertEquals(families['test_process_gauge']['labelnames'], [ 'pid' ])
+        self.assertEquals(sorted(families['test_process_gauge']['samples']),
+                          sorted([ [ [ str(os.getpid()) ], 5 ], [ [ str(other_pid) ], 1 ] ]))
+
+        # the metrics are served over http
+        server = MetricsServer(('127.0.0.1', 0), group='test')
+        server.start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])) as response:
+                self.assertEquals(response.headers['Content-Type'], saq.metrics.CONTENT_TYPE)
+                text = response.read().decode()
+
+            self.assertTrue('test_process_counter_total{mode="analysis"} 5\n' in text)
+        finally:
+            server.stop()
+
+    def test_csv_exporter(self):
+        registry = MetricRegistry()
+        registry.counter('test_csv_counter', labelnames=[ 'mode' ]).labels('analysis').inc()
+        path = os.path.join(saq.metrics.get_csv_export_dir(), 'test_csv_counter.csv')
+        if os.path.exists(path):
+            os.remove(path)
+
+        CSVExporter(None).export(registry.collect())
+        with open(path, 'r') as fp:
+            rows = list(csv.reader(fp))
+
+        self.assertEquals(len(rows), 1)
+        self.assertEquals(rows[0][1], str(os.getpid()))
+        self.assertEquals(rows[0][3:], [ 'mode=analysis', '1.0' ])
+
+    def test_record_metric(self):
+        from saq.performance import record_metric
+        path = os.path.join(saq.DATA_DIR, 'stats', 'metrics', 'test_record_metric.csv')
+        if os.path.exists(path):
+            os.remove(path)
+
+        # every call appends a (time, pid, command line, value) row
+        record_metric('test_record_metric', 1)
+        record_metric('test_record_metric', 2)
+        with open(path, 'r') as fp:
+            rows = list(csv.reader(fp))
+
+        self.assertEquals([ len(row) for row in rows ], [ 4, 4 ])
+        self.assertEquals([ row[3] for row in rows ], [ '1', '2' ])
+        self.assertEquals(rows[0][1], str(os.getpid()))
+
+        # and the current value is available as a gauge
+        families = { family['name']: family for family in saq.metrics.REGISTRY.collect() }
+        self.assertEquals(families['test_record_metric']['samples'], [ [ [], 2 ] ])
@@ -3,6 +3,7 @@
 # various utility functions
 #
 
+import bisect
 import collections
 import datetime
 import functools
@@ -12,15 +13,24 @@ import os, os.path
 import re
 import signal
 import tempfile
+import threading
+import time
 import urllib
 
 import saq
 from saq.constants import *
 
+import iptools
 import psutil
 import pytz
 import requests
 
+# optional multi-pattern matcher used by RegexObservableParserGroup
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
 CIDR_REGEX = re.compile(r'^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}(/[0-9]{1,2})?$')
 CIDR_WITH_NETMASK_REGEX = re.compile(r'^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}/[0-9]{1,2}$')
 URL_REGEX_B = re.compile(rb'(((?:(?:https?|ftp)://)[A-Za-z0-9\.\-]+)((?:\/[\+~%\/\.\w\-_]*)?\??(?:[\-\+=&;%@\.\w_:\?]*)#?(?:[\.\!\/\\\w:%\?&;=-]*))?(?<!=))', re.I)
@@ -334,6 +344,202 @@ class FileMonitorLink(object):
         return FileMonitorLink.FILE_UNMODIFIED
 
 
+class WakeupSignal(object):
+    """Wakes up a thread that is waiting for work to become available.
+       Threads in the same process are woken with an event. Other processes are woken by touching a signal file,
+       which the waiting thread checks with a stat() call instead of querying the database.
+       Use get_wakeup_signal() to get the instance shared by the current process."""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.event = threading.Event()
+        self.last_mtime = self._get_mtime()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def notify(self):
+        """Wakes up anything waiting on this signal, in this process or any other."""
+        self.event.set()
+        try:
+            with open(self.path, 'a'):
+                pass
+
+            os.utime(self.path, None)
+        except Exception as e:
+            logging.warning(f"unable to touch wakeup signal {self.path}: {e}")
+
+    def interrupt(self):
+        """Wakes up anything waiting on this signal in this process only."""
+        self.event.set()
+
+    def wait(self, timeout, control_event=None):
+        """Waits up to timeout seconds for a notification.
+           Returns True if a notification was received, False if the timeout expired
+           or the optional control_event was set."""
+        deadline = time.time() + timeout
+        while True:
+            if self.event.is_set():
+                self.event.clear()
+                self.last_mtime = self._get_mtime()
+                return True
+
+            mtime = self._get_mtime()
+            if mtime != self.last_mtime:
+                self.last_mtime = mtime
+                return True
+
+            if control_event is not None and control_event.is_set():
+                return False
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            self.event.wait(min(remaining, self.check_interval))
+
+_WAKEUP_SIGNALS = {} # key = signal name, value = WakeupSignal
+_WAKEUP_SIGNALS_LOCK = threading.Lock()
+
+def get_wakeup_signal(name):
+    """Returns the WakeupSignal for the given name shared by everything in this process."""
+    with _WAKEUP_SIGNALS_LOCK:
+        if name not in _WAKEUP_SIGNALS:
+            _WAKEUP_SIGNALS[name] = WakeupSignal(os.path.join(saq.DATA_DIR, 'var', f'{name}.signal'))
+
+        return _WAKEUP_SIGNALS[name]
+
+class TokenBucket(object):
+    """Limits how often something happens to rate times per second by blocking in acquire() until it is allowed.
+       Up to burst operations can happen at once before the limit kicks in. A rate of 0 (or None) means unlimited."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 0)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Blocks until count operations are allowed."""
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+def remove_directory(path, keep=None, rate_limiter=None):
+    """Deletes everything inside the given directory (and the directory itself) in-process.
+       Anything in the optional set of paths given as keep (and the directories that contain them) are left alone.
+       The optional TokenBucket is acquired once for every file and directory removed.
+       Returns the number of files removed."""
+    count = 0
+    keep = keep or set()
+    for dir_path, dir_names, file_names in os.walk(path, topdown=False):
+        # os.walk does not follow symlinks to directories
+        file_names = file_names + [ _ for _ in dir_names if os.path.islink(os.path.join(dir_path, _)) ]
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if file_path in keep:
+                continue
+
+            if rate_limiter:
+                rate_limiter.acquire()
+
+            try:
+                os.remove(file_path)
+                count += 1
+            except Exception as e:
+                logging.error("unable to remove {}: {}".format(file_path, e))
+
+        if dir_path in keep:
+            continue
+
+        # directories are walked bottom up so any directory that is still not empty contains something to keep
+        try:
+            if rate_limiter:
+                rate_limiter.acquire()
+
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+
+    return count
+
+class IPv4RangeIndex(object):
+    """Maps IPv4 addresses to the values assigned to the ranges that contain them.
+       Ranges are anything iptools.IpRange accepts (CIDR notation or a single address.)
+       The ranges are compiled into a sorted list of non-overlapping segments so that a lookup is a binary search
+       instead of testing every range."""
+
+    def __init__(self):
+        self.ranges = [] # of tuple(start, end, value)
+        self._boundaries = None # sorted list of segment start addresses (as integers)
+        self._segments = None # the values of the ranges that contain each segment
+
+    def add(self, spec, value=None):
+        """Adds the given range with the given value (defaults to the spec itself.)"""
+        ip_range = iptools.IpRange(spec)
+        self.ranges.append((ip_range.startIp, ip_range.endIp, spec if value is None else value))
+        self._boundaries = None
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def compile(self):
+        """Builds the lookup segments. This is called automatically by lookup() after ranges are added."""
+        # key = address, value = list of range indexes that start or end (+1) at that address
+        starts = collections.defaultdict(list)
+        ends = collections.defaultdict(list)
+        for index, (start, end, value) in enumerate(self.ranges):
+            starts[start].append(index)
+            ends[end + 1].append(index)
+
+        boundaries = sorted(set(starts.keys()) | set(ends.keys()))
+        segments = []
+        active = set()
+        for address in boundaries:
+            active.difference_update(ends[address])
+            active.update(starts[address])
+            # values are returned in the order the ranges were added
+            segments.append(tuple([self.ranges[index][2] for index in sorted(active)]))
+
+        self._boundaries = boundaries
+        self._segments = segments
+
+    def lookup(self, value):
+        """Returns the list of values of the ranges that contain the given IPv4 address (as a string.)
+           Raises ValueError if the value is not a valid IPv4 address."""
+        address = iptools.ipv4.ip2long(value)
+        if address is None:
+            raise ValueError("invalid ipv4 {}".format(value))
+
+        if self._boundaries is None:
+            self.compile()
+
+        index = bisect.bisect_right(self._boundaries, address) - 1
+        if index < 0:
+            return []
+
+        return list(self._segments[index])
+
+    def __contains__(self, value):
+        try:
+            return len(self.lookup(value)) > 0
+        except ValueError:
+            return False
+
 class RegexObservableParser:
     """Helper class to handle regex and observable mapping.
 
@@ -422,6 +628,12 @@ class RegexObservableParserGroup:
     Add RegexObservableParsers and then parse your content. This class
         runs the content through each parser and converts the results
         into observables.
+
+    The regexes of the group are also compiled into a single combined
+        pattern that is used to skip content that none of the parsers
+        can match in one pass. If the hyperscan library is available it
+        is used instead to determine which of the parsers can match, so
+        only those parsers are run.
     """
 
     def __init__(self, tags=None):
@@ -431,6 +643,11 @@ class RegexObservableParserGroup:
         self._observable_map = None
         self._observables = []
         self.tags = tags or []
+        # see compile()
+        self._compiled = False
+        self._prefilter = None
+        self._hyperscan_db = None
+        self._hyperscan_parsers = None # the indexes of the parsers in the hyperscan database
 
     def add(self, regex, observable_type, capture_groups=None, delimiter='_',
             override_class=None, tags=None, directives=None, re_compile_options=0):
@@ -454,18 +671,126 @@ class RegexObservableParserGroup:
         )
 
         self.parsers.append(parser)
+        self._compiled = False
 
-    def parse_content(self, content):
-        """Iterate through parsers and extract observables from the
-            content.
-        """
+    def _is_combinable(self, parser):
+        """Returns True if the regex of the given parser can be safely combined with the others."""
+        # subclasses can extract observables any way they want
+        if type(parser)._parse is not RegexObservableParser._parse:
+            return False
 
+        # only these flags can be scoped to part of a pattern
+        if parser.regex.flags & ~(re.UNICODE | re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE):
+            return False
+
+        # group numbers change when patterns are combined
+        if re.search(r'\\[1-9]|\\g<|\(\?P=|\(\?\(', parser.regex.pattern):
+            return False
+
+        # global inline flags would apply to all of the combined patterns
+        if re.search(r'\(\?[aiLmsux]+\)', parser.regex.pattern):
+            return False
+
+        return True
+
+    def compile(self):
+        """Builds the combined pattern (and hyperscan database if available) for the parsers in this group.
+            This is called automatically when content is parsed."""
+        self._prefilter = None
+        self._hyperscan_db = None
+        self._hyperscan_parsers = None
+        self._compiled = True
+
+        if not self.parsers or not all([self._is_combinable(parser) for parser in self.parsers]):
+            return
+
+        if hyperscan is not None:
+            self._compile_hyperscan()
+
+        patterns = []
+        for parser in self.parsers:
+            flags = ''.join([_flag for _flag, _value in [('i', re.IGNORECASE), ('m', re.MULTILINE),
+                                                           ('s', re.DOTALL), ('x', re.VERBOSE)]
+                             if parser.regex.flags & _value])
+            patterns.append('(?{}:{})'.format(flags, parser.regex.pattern) if flags
+                            else '(?:{})'.format(parser.regex.pattern))
+
+        try:
+            self._prefilter = re.compile('|'.join(patterns))
+        except re.error as e:
+            logging.debug(f"unable to combine observable parser regexes: {e}")
+
+    def _compile_hyperscan(self):
+        flag_map = [(re.IGNORECASE, hyperscan.HS_FLAG_CASELESS),
+                    (re.MULTILINE, hyperscan.HS_FLAG_MULTILINE),
+                    (re.DOTALL, hyperscan.HS_FLAG_DOTALL)]
+
+        expressions = []
+        ids = []
+        flags = []
+        for index, parser in enumerate(self.parsers):
+            # verbose patterns are not supported
+            if parser.regex.flags & re.VERBOSE:
+                continue
+
+            expression = parser.regex.pattern.encode('utf8')
+            # prefilter mode reports every possible match (and maybe some that are not)
+            # which is all we need to know to skip the parsers that cannot match
+            _flags = hyperscan.HS_FLAG_PREFILTER | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_ALLOWEMPTY \
+                     | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+            for re_flag, hs_flag in flag_map:
+                if parser.regex.flags & re_flag:
+                    _flags |= hs_flag
+
+            # make sure hyperscan can handle this pattern by itself
+            try:
+                hyperscan.Database().compile(expressions=[expression], ids=[index], elements=1, flags=[_flags])
+            except Exception as e:
+                logging.debug(f"observable parser regex {parser.regex.pattern} not supported by hyperscan: {e}")
+                continue
+
+            expressions.append(expression)
+            ids.append(index)
+            flags.append(_flags)
+
+        if not expressions:
+            return
+
+        try:
+            db = hyperscan.Database()
+            db.compile(expressions=expressions, ids=ids, elements=len(expressions), flags=flags)
+            self._hyperscan_db = db
+            self._hyperscan_parsers = set(ids)
+        except Exception as e:
+            logging.warning(f"unable to compile observable parser regexes with hyperscan: {e}")
+
+    def _get_candidate_parsers(self, content):
+        """Returns the list of parsers that might match the given content."""
+        if not self._compiled:
+            self.compile()
+
+        if self._prefilter is not None and self._prefilter.search(content) is None:
+            return []
+
+        if self._hyperscan_db is None:
+            return self.parsers
+
+        hits = set()
+        def _on_match(_id, _from, _to, _flags, _context):
+            hits.add(_id)
+
+        self._hyperscan_db.scan(content.encode('utf8', errors='replace'), match_event_handler=_on_match)
+        return [parser for index, parser in enumerate(self.parsers)
+                if index in hits or index not in self._hyperscan_parsers]
+
+    def _reset(self):
         self._observable_map = {_parser.observable_type: set() for _parser in self.parsers}
-        
         self._directives_map = {} # Keeps track of observable/directives pairs
         self._tags_map = {} # Keeps track of observable/tag pairs
-        
-        for parser in self.parsers:
+        self._observables = []
+
+    def _parse_chunk(self, content):
+        for parser in self._get_candidate_parsers(content):
             parser.parse(content)
             for match in parser.matches:
                 _match = match.strip()
@@ -480,6 +805,24 @@ class RegexObservableParserGroup:
                 self._directives_map[_match] = parser.directives
                 self._tags_map[_match] = parser.tags
 
+    def parse_content(self, content):
+        """Iterate through parsers and extract observables from the
+            content.
+        """
+        self._reset()
+        self._parse_chunk(content)
+
+    def parse_stream(self, chunks):
+        """Extract observables from an iterable of content (such as the
+            events of a large search result) without joining it
+            together first. Each chunk is parsed separately so matches
+            do not span chunks. Observables are de-duplicated across
+            all of the chunks.
+        """
+        self._reset()
+        for chunk in chunks:
+            self._parse_chunk(chunk)
+
     @property
     def observable_map(self):
         if self._observable_map is not None:
@@ -1,13 +1,149 @@
 # vim: sw=4:ts=4:et
 import datetime
-import os.path
+import os, os.path
 import logging
-import shutil
+import time
 
 import saq
 
-def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
-    """Cleans up the alerts stored in the ACE system. 
+def _get_cleanup_rate_limiter(max_deletes_per_second, workers):
+    from saq.util import TokenBucket
+    # the limit applies to all of the workers combined
+    return TokenBucket(max_deletes_per_second / max(1, workers) if max_deletes_per_second else 0)
+
+def delete_alerts(alerts, max_deletes_per_second=0, workers=1):
+    """Deletes the given list of (alert_id, storage_dir) alerts from disk and then from the database.
+       Returns the list of alert ids that were deleted."""
+    from saq.database import get_db_connection, execute_with_retry
+    from saq.util import remove_directory
+
+    rate_limiter = _get_cleanup_rate_limiter(max_deletes_per_second, workers)
+    for alert_id, storage_dir in alerts:
+        # delete the files backing the alert
+        target_path = os.path.join(saq.SAQ_HOME, storage_dir)
+        logging.info(f"deleting files {target_path}")
+        try:
+            if os.path.isdir(target_path):
+                remove_directory(target_path, rate_limiter=rate_limiter)
+        except Exception as e:
+            logging.error(f"unable to delete alert storage directory {storage_dir}: {e}")
+
+    # delete the alerts from the database
+    alert_ids = [ alert_id for alert_id, storage_dir in alerts ]
+    if alert_ids:
+        logging.info(f"deleting {len(alert_ids)} database entries")
+        with get_db_connection() as db:
+            c = db.cursor()
+            execute_with_retry(db, c, "DELETE FROM alerts WHERE id IN ( {} )".format(
+                                      ','.join(['%s' for _ in alert_ids])), tuple(alert_ids), commit=True)
+
+    return alert_ids
+
+def archive_alerts(alerts, max_deletes_per_second=0, workers=1):
+    """Archives the given list of (alert_id, storage_dir) alerts (see :method:`saq.database.Alert.archive`)
+       and then marks them as archived in the database.
+       Returns the list of alert ids that were archived."""
+    from saq.database import Alert, get_db_connection, execute_with_retry
+
+    rate_limiter = _get_cleanup_rate_limiter(max_deletes_per_second, workers)
+    archived = []
+    try:
+        for alert in saq.db.query(Alert).filter(Alert.id.in_([ alert_id for alert_id, _ in alerts ])):
+            logging.info(f"resetting false positive {alert}")
+            if alert.archived:
+                logging.warning(f"{alert} is already archived (skipping)")
+                continue
+
+            try:
+                alert.load()
+                alert.archive(rate_limiter=rate_limiter)
+                # saved through the Alert so that the database fields (disposition, owner, etc...) are kept
+                alert.save()
+                archived.append(alert.id)
+            except Exception as e:
+                logging.error(f"unable to archive {alert}: {e}")
+                continue
+    finally:
+        # the archived flags are updated below for the entire batch at once
+        saq.db.rollback()
+        saq.db.remove()
+
+    if archived:
+        with get_db_connection() as db:
+            c = db.cursor()
+            execute_with_retry(db, c, "UPDATE alerts SET archived = 1 WHERE id IN ( {} )".format(
+                                      ','.join(['%s' for _ in archived])), tuple(archived), commit=True)
+
+    return archived
+
+def compress_alerts_batch(alerts, max_deletes_per_second=0, workers=1):
+    """Moves the given list of (alert_uuid, storage_dir) alerts into cold storage (see :mod:`saq.analysis.cold`.)
+       Returns the list of alert uuids that were compressed."""
+    import saq.analysis.cold
+    from saq.database import acquire_lock, release_lock
+
+    rate_limiter = _get_cleanup_rate_limiter(max_deletes_per_second, workers)
+    compressed = []
+    for alert_uuid, storage_dir in alerts:
+        # make sure nothing is using the alert while we move the files around
+        lock_uuid = acquire_lock(alert_uuid, lock_owner='compress-alerts')
+        if not lock_uuid:
+            logging.warning(f"unable to lock {storage_dir} (skipping)")
+            continue
+
+        try:
+            logging.info(f"moving {storage_dir} into cold storage")
+            saq.analysis.cold.compress_storage_dir(storage_dir, rate_limiter=rate_limiter)
+            compressed.append(alert_uuid)
+        except Exception as e:
+            logging.error(f"unable to move {storage_dir} into cold storage: {e}")
+        finally:
+            release_lock(alert_uuid, lock_uuid)
+
+    return compressed
+
+# the pid of the cleanup worker process the database connections were initialized for
+_worker_pid = None
+
+def _execute_batch(function, batch, max_deletes_per_second, workers):
+    """Calls function(batch, max_deletes_per_second, workers) in a worker process of _process_batches."""
+    global _worker_pid
+
+    # each worker process gets it's own SQLAlchemy connections (the ones inherited from the parent cannot be shared)
+    if _worker_pid != os.getpid():
+        import saq.database
+        saq.database.initialize_database()
+        _worker_pid = os.getpid()
+
+    return function(batch, max_deletes_per_second, workers)
+
+def _process_batches(function, alerts, workers, batch_size, max_deletes_per_second):
+    """Calls function(batch, max_deletes_per_second, workers) for each batch of the given alerts using a pool of
+       workers (or in the current process if workers is 1.) Returns the total number of alerts processed."""
+    import concurrent.futures
+
+    batches = [ alerts[i:i + batch_size] for i in range(0, len(alerts), batch_size) ]
+    count = 0
+    if workers <= 1:
+        for batch in batches:
+            count += len(function(batch, max_deletes_per_second, workers))
+
+        return count
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(_execute_batch, function, batch, max_deletes_per_second, workers)
+                    for batch in batches ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                count += len(future.result())
+            except Exception as e:
+                logging.error(f"cleanup worker failed: {e}")
+
+    return count
+
+def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False, workers=None, batch_size=None,
+                   max_deletes_per_second=None):
+    """Cleans up the alerts stored in the ACE system.
        Alerts dispositioned as FALSE_POSITIVE are archived (see :method:`saq.database.Alert.archive`)
        Alerts dispositioned as IGNORE as deleted.
        This is intended to be called from an external maintenance script.
@@ -18,15 +154,18 @@ def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
        is stored in the configuration file. Setting this overrides these settings.
        :param bool dry_run: Setting this to True will simply print the number of alerts would
        be archived and deleted. Defaults to False.
-    """
+       :param int workers: The number of processes to use. Defaults to [global] cleanup_workers.
+       :param int batch_size: The number of alerts each worker updates in the database at once.
+       Defaults to [global] cleanup_batch_size.
+       :param int max_deletes_per_second: The maximum number of files deleted per second (by all workers) so that
+       cleanup does not starve live analysis of I/O. 0 is unlimited. Defaults to [global] cleanup_max_deletes_per_second.
 
-    import gc
-    import weakref
+       Archived alerts older than [cold_storage] days_old are then moved into cold storage (see compress_alerts.)
+    """
 
+    import saq.analysis.cold
     from saq.constants import DISPOSITION_FALSE_POSITIVE, DISPOSITION_IGNORE
-    from saq.database import Alert, DatabaseSession, retry_sql_on_deadlock
-
-    from sqlalchemy.sql.expression import select, delete
+    from saq.database import get_db_connection
 
     ignore_days = saq.CONFIG['global'].getint('ignore_days')
     fp_days = saq.CONFIG['global'].getint('fp_days')
@@ -37,54 +176,88 @@ def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
     if ignore_days_old:
         ignore_days = ignore_days_old
 
-    # delete alerts dispositioned as IGNORE and older than N days
-    dry_run_count = 0
-    for storage_dir, alert_id in saq.db.execute(select([Alert.storage_dir, Alert.id])
-        .where(Alert.location == saq.CONFIG['global']['node'])
-        .where(Alert.disposition == DISPOSITION_IGNORE)
-        .where(Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=ignore_days))):
+    if workers is None:
+        workers = saq.CONFIG['global'].getint('cleanup_workers', fallback=1)
 
-        if dry_run:
-            dry_run_count += 1
-            continue
+    if batch_size is None:
+        batch_size = saq.CONFIG['global'].getint('cleanup_batch_size', fallback=100)
 
-        # delete the files backing the alert
-        try:
-            target_path = os.path.join(saq.SAQ_HOME, storage_dir)
-            logging.info(f"deleting files {target_path}")
-            shutil.rmtree(target_path)
-        except Exception as e:
-            logging.error(f"unable to delete alert storage directory {storage_dir}: {e}")
+    if max_deletes_per_second is None:
+        max_deletes_per_second = saq.CONFIG['global'].getint('cleanup_max_deletes_per_second', fallback=0)
 
-        # delete the alert from the database
-        logging.info(f"deleting database entry {alert_id}")
-        retry_sql_on_deadlock(delete(Alert).where(Alert.id == alert_id), commit=True)
+    with get_db_connection() as db:
+        c = db.cursor()
+        # alerts dispositioned as IGNORE and older than N days are deleted
+        c.execute("""SELECT id, storage_dir FROM alerts
+                     WHERE location = %s AND disposition = %s AND disposition_time < %s ORDER BY id""",
+                  (saq.CONFIG['global']['node'], DISPOSITION_IGNORE,
+                   datetime.datetime.now() - datetime.timedelta(days=ignore_days)))
+        ignored_alerts = [ tuple(row) for row in c ]
+
+        # alerts dispositioned as False Positive older than N days are archived
+        c.execute("""SELECT id, storage_dir FROM alerts
+                     WHERE location = %s AND archived = 0 AND disposition = %s AND disposition_time < %s ORDER BY id""",
+                  (saq.CONFIG['global']['node'], DISPOSITION_FALSE_POSITIVE,
+                   datetime.datetime.now() - datetime.timedelta(days=fp_days)))
+        fp_alerts = [ tuple(row) for row in c ]
 
     if dry_run:
-        logging.info(f"{dry_run_count} ignored alerts would be deleted")
-
-    # archive alerts dispositioned as False Positive older than N days
-    dry_run_count = 0
-    for alert in saq.db.query(Alert).filter(
-        Alert.location == saq.CONFIG['global']['node'],
-        Alert.archived == False,
-        Alert.disposition == DISPOSITION_FALSE_POSITIVE,
-        Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=fp_days)):
-    
-        if dry_run:
-            dry_run_count += 1
-            continue
+        logging.info(f"{len(ignored_alerts)} ignored alerts would be deleted")
+        logging.info(f"{len(fp_alerts)} fp alerts would be archived")
+        return
 
-        logging.info(f"resetting false positive {alert}")
+    start = time.time()
+    count = _process_batches(delete_alerts, ignored_alerts, workers, batch_size, max_deletes_per_second)
+    logging.info("deleted {} ignored alerts in {:.1f} seconds".format(count, time.time() - start))
 
-        try:
-            alert.load()
-        except Exception as e:
-            logging.error(f"unable to load {alert}: {e}")
-            continue
+    start = time.time()
+    count = _process_batches(archive_alerts, fp_alerts, workers, batch_size, max_deletes_per_second)
+    logging.info("archived {} fp alerts in {:.1f} seconds".format(count, time.time() - start))
+
+    if saq.analysis.cold.get_days_old():
+        compress_alerts(workers=workers, batch_size=batch_size, max_deletes_per_second=max_deletes_per_second)
+
+    # alerts deleted above were never loaded so the file store needs to find what they released
+    import saq.file_store
+    saq.file_store.collect()
+
+def compress_alerts(days_old=None, dry_run=False, workers=None, batch_size=None, max_deletes_per_second=None):
+    """Moves archived alerts older than the given number of days into cold storage (see :mod:`saq.analysis.cold`.)
+       The remaining parameters are the same as cleanup_alerts.
+       Returns the number of alerts compressed."""
+
+    import saq.analysis.cold
+    from saq.database import get_db_connection
+
+    if days_old is None:
+        days_old = saq.analysis.cold.get_days_old()
+
+    if not days_old:
+        logging.warning("cold storage is disabled ([cold_storage] days_old is 0)")
+        return 0
+
+    if workers is None:
+        workers = saq.CONFIG['global'].getint('cleanup_workers', fallback=1)
+
+    if batch_size is None:
+        batch_size = saq.CONFIG['global'].getint('cleanup_batch_size', fallback=100)
+
+    if max_deletes_per_second is None:
+        max_deletes_per_second = saq.CONFIG['global'].getint('cleanup_max_deletes_per_second', fallback=0)
+
+    with get_db_connection() as db:
+        c = db.cursor()
+        c.execute("""SELECT uuid, storage_dir FROM alerts
+                     WHERE location = %s AND archived = 1 AND disposition_time < %s ORDER BY id""",
+                  (saq.CONFIG['global']['node'], datetime.datetime.now() - datetime.timedelta(days=days_old)))
+        # skip the ones that are already compressed
+        alerts = [ tuple(row) for row in c if not saq.analysis.cold.is_cold(row[1]) ]
 
-        alert.archive()
-        alert.sync()
-        
     if dry_run:
-        logging.info(f"{dry_run_count} fp alerts would be archived")
+        logging.info(f"{len(alerts)} archived alerts would be moved into cold storage")
+        return 0
+
+    start = time.time()
+    count = _process_batches(compress_alerts_batch, alerts, workers, batch_size, max_deletes_per_second)
+    logging.info("moved {} archived alerts into cold storage in {:.1f} seconds".format(count, time.time() - start))
+    return count
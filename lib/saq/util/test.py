@@ -1,8 +1,12 @@
 # vim: sw=4:ts=4:et:cc=120
 
 import json
+import logging
 import os, os.path
+import re
 import tempfile
+import threading
+import time
 import unittest
 
 import saq
@@ -72,6 +76,48 @@ class TestCase(ACEBasicTestCase):
         
         monitor.close()
 
+    def test_wakeup_signal(self):
+        path = os.path.join(saq.TEMP_DIR, 'test.signal')
+        waiter = WakeupSignal(path, check_interval=0.1)
+        self.assertFalse(waiter.wait(0.2))
+
+        # notified in the same process
+        waiter.notify()
+        self.assertTrue(waiter.wait(0.2))
+        self.assertFalse(waiter.wait(0.2))
+
+        # notified by a different process (or anything else that touches the signal file)
+        time.sleep(0.01)
+        WakeupSignal(path).notify()
+        self.assertTrue(waiter.wait(1))
+        self.assertFalse(waiter.wait(0.2))
+
+        # a control event stops the wait
+        control_event = threading.Event()
+        control_event.set()
+        self.assertFalse(waiter.wait(60, control_event))
+
+        self.assertTrue(get_wakeup_signal('test') is get_wakeup_signal('test'))
+
+    def test_remove_directory(self):
+        target_dir = os.path.join(saq.TEMP_DIR, 'remove_directory')
+        os.makedirs(os.path.join(target_dir, 'a', 'b'))
+        os.makedirs(os.path.join(target_dir, 'c'))
+        for path in [ os.path.join(target_dir, 'a', 'b', 'test.txt'),
+                      os.path.join(target_dir, 'c', 'test.txt'),
+                      os.path.join(target_dir, 'test.txt') ]:
+            with open(path, 'w') as fp:
+                fp.write('test')
+
+        # files we keep (and the directories they are in) are left alone
+        keep_path = os.path.join(target_dir, 'c', 'test.txt')
+        self.assertEquals(remove_directory(target_dir, keep=set([keep_path])), 2)
+        self.assertTrue(os.path.exists(keep_path))
+        self.assertFalse(os.path.exists(os.path.join(target_dir, 'a')))
+
+        self.assertEquals(remove_directory(target_dir, rate_limiter=TokenBucket(1000)), 1)
+        self.assertFalse(os.path.exists(target_dir))
+
     def test_json_parse(self):
         # read a single JSON object out of a file
         json_value = { 'Hello': 'world' }
@@ -160,3 +206,116 @@ class TestNoAceInit(unittest.TestCase):
 
         for _test in test_pairs:
             self.assertEqual(_test['expected'], fang(_test['test_case']))
+
+    def test_token_bucket(self):
+        # the burst is allowed right away
+        rate_limiter = TokenBucket(100, burst=10)
+        start = time.monotonic()
+        for _ in range(10):
+            rate_limiter.acquire()
+        self.assertTrue(time.monotonic() - start < 0.05)
+
+        # and then it is limited to the rate
+        for _ in range(20):
+            rate_limiter.acquire()
+        self.assertTrue(time.monotonic() - start >= 0.15)
+
+        # a rate of 0 is unlimited
+        rate_limiter = TokenBucket(0)
+        start = time.monotonic()
+        for _ in range(10000):
+            rate_limiter.acquire()
+        self.assertTrue(time.monotonic() - start < 1)
+
+    def test_ipv4_range_index(self):
+        index = IPv4RangeIndex()
+        index.add('10.0.0.0/8', 'internal')
+        index.add('10.1.0.0/16', 'datacenter')
+        index.add('10.1.2.3', 'server')
+        index.add('192.168.0.0/16')
+
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup('10.1.2.3'), ['internal', 'datacenter', 'server'])
+        self.assertEqual(index.lookup('10.1.2.4'), ['internal', 'datacenter'])
+        self.assertEqual(index.lookup('10.2.0.1'), ['internal'])
+        self.assertEqual(index.lookup('10.255.255.255'), ['internal'])
+        self.assertEqual(index.lookup('11.0.0.0'), [])
+        self.assertEqual(index.lookup('0.0.0.0'), [])
+        self.assertEqual(index.lookup('192.168.1.1'), ['192.168.0.0/16'])
+
+        self.assertTrue('10.1.1.1' in index)
+        self.assertFalse('8.8.8.8' in index)
+        self.assertFalse('not an ip' in index)
+
+        with self.assertRaises(ValueError):
+            index.lookup('not an ip')
+
+        # adding a range recompiles the index
+        index.add('8.8.8.0/24', 'dns')
+        self.assertEqual(index.lookup('8.8.8.8'), ['dns'])
+
+    def _create_parser_group(self):
+        group = RegexObservableParserGroup(tags=['test'])
+        group.add(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b', F_IPV4)
+        group.add(r'h[tx]{2}ps?://[^\s"]+', F_URL)
+        group.add(r'\b((?:[a-z0-9-]+\.)+(?:com|net|org))\b', F_FQDN, re_compile_options=re.I)
+        group.add(r'src=(\S+) dst=(\S+)', F_IPV4_CONVERSATION, capture_groups=[1, 2])
+        return group
+
+    def test_regex_observable_parser_group(self):
+        group = self._create_parser_group()
+        group.parse_content('src=1.2.3.4 dst=5.6.7.8 url="hxxp://Evil.COM/path" other=evil.com')
+
+        self.assertEqual(group.observable_map[F_IPV4], set(['1.2.3.4', '5.6.7.8']))
+        self.assertEqual(group.observable_map[F_URL], set(['http://Evil.COM/path']))
+        # overlapping matches of different types are all found
+        self.assertEqual(group.observable_map[F_FQDN], set(['Evil.COM', 'evil.com']))
+        self.assertEqual(group.observable_map[F_IPV4_CONVERSATION], set(['1.2.3.4_5.6.7.8']))
+        self.assertEqual(len(group.observables), 6)
+        self.assertTrue(all([o['tags'] == ['test'] for o in group.observables]))
+
+        # content none of the parsers match
+        group.parse_content('nothing to see here')
+        self.assertTrue(all([len(_) == 0 for _ in group.observable_map.values()]))
+        self.assertEqual(group.observables, [])
+
+    def test_regex_observable_parser_group_override(self):
+        # parsers that handle the regex results themselves are always run
+        class _TestParser(RegexObservableParser):
+            def _parse(self, text):
+                self.matches = ['always']
+
+        group = self._create_parser_group()
+        group.add(r'never', F_TEST, override_class=_TestParser)
+        group.parse_content('nothing to see here')
+        self.assertEqual(group.observable_map[F_TEST], set(['always']))
+
+    def test_regex_observable_parser_group_stream(self):
+        group = self._create_parser_group()
+        events = [ 'src=1.2.3.4 dst=5.6.7.8 host=evil.com',
+                   'nothing to see here',
+                   'src=1.2.3.4 dst=9.9.9.9 host=evil.com' ]
+
+        group.parse_stream(iter(events))
+        self.assertEqual(group.observable_map[F_IPV4], set(['1.2.3.4', '5.6.7.8', '9.9.9.9']))
+        self.assertEqual(group.observable_map[F_FQDN], set(['evil.com']))
+        # capture groups are extracted from each chunk
+        self.assertEqual(group.observable_map[F_IPV4_CONVERSATION], set(['1.2.3.4_5.6.7.8', '1.2.3.4_9.9.9.9']))
+
+    def test_regex_observable_parser_group_benchmark(self):
+        events = []
+        for index in range(20000):
+            if index % 2:
+                events.append('src=10.0.{}.{} dst=10.1.0.1 url="http://host{}.example.com/index.html"'.format(
+                              int(index / 256) % 256, index % 256, index))
+            else:
+                events.append('status=200 bytes={} user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64)"'.format(index))
+
+        group = self._create_parser_group()
+        start = time.time()
+        group.parse_stream(events)
+        elapsed = time.time() - start
+        logging.info("BENCHMARK: parsed {} events into {} observables in {:.3f} seconds".format(
+                     len(events), len(group.observables), elapsed))
+
+        self.assertEqual(len(group.observable_map[F_URL]), 10000)
@@ -71,6 +71,23 @@ CREATE TABLE `archive_search` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `archive_search_trigram`
+--
+
+DROP TABLE IF EXISTS `archive_search_trigram`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `archive_search_trigram` (
+  `trigram` mediumint(8) unsigned NOT NULL,
+  `field` enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id','content','url') NOT NULL,
+  `archive_id` int(11) NOT NULL,
+  PRIMARY KEY (`trigram`,`field`,`archive_id`),
+  KEY `archive_id` (`archive_id`),
+  CONSTRAINT `fk_archive_search_trigram_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `archive_server`
 --
@@ -0,0 +1,10 @@
+-- trigram index of archive_search used to narrow down substring searches
+-- after applying this run ace index-archive-search to index the existing archives
+CREATE TABLE `archive_search_trigram` (
+  `trigram` mediumint(8) unsigned NOT NULL,
+  `field` enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id','content','url') NOT NULL,
+  `archive_id` int(11) NOT NULL,
+  PRIMARY KEY (`trigram`,`field`,`archive_id`),
+  KEY `archive_id` (`archive_id`),
+  CONSTRAINT `fk_archive_search_trigram_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
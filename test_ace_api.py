@@ -382,6 +382,74 @@ class TestCase(ACEEngineTestCase):
         self.assertEquals(result['workload']['analysis_mode'], 'test_empty')
         self.assertTrue(isinstance(parse_event_time(result['workload']['insert_date']), datetime.datetime))
 
+    def test_session_pooling(self):
+        ace_api.close_sessions()
+        ace_api.reset_api_statistics()
+
+        for _ in range(3):
+            self.assertEquals(ace_api.ping()['result'], 'pong')
+
+        # all three calls should have used the same connection
+        statistics = ace_api.get_api_statistics()[saq.API_PREFIX]
+        self.assertEquals(statistics['requests'], 3)
+        self.assertEquals(statistics['errors'], 0)
+        self.assertEquals(statistics['connections'], 1)
+        self.assertTrue(statistics['total_time'] > 0)
+
+        # without sessions every call opens a new connection
+        ace_api.reset_api_statistics()
+        ace_api.set_use_sessions(False)
+        try:
+            for _ in range(2):
+                self.assertEquals(ace_api.ping()['result'], 'pong')
+        finally:
+            ace_api.set_use_sessions(True)
+
+        statistics = ace_api.get_api_statistics()[saq.API_PREFIX]
+        self.assertEquals(statistics['requests'], 2)
+        self.assertEquals(statistics['connections'], 2)
+
+    def test_submit_file_paths(self):
+        # files can be passed as paths instead of open file descriptors
+        temp_path = os.path.join(saq.TEMP_DIR, 'submit_test.dat')
+        temp_data = os.urandom(1024 * 1024)
+        with open(temp_path, 'wb') as fp:
+            fp.write(temp_data)
+
+        result = ace_api.submit(
+            analysis_mode='test_empty',
+            tool='unittest_tool',
+            tool_instance='unittest_tool_instance',
+            type='unittest_type',
+            description='testing',
+            files=[('submit_test.dat', temp_path),
+                   ('sample.dat', io.BytesIO(b'Hello, world!'))])
+
+        root = RootAnalysis(storage_dir=workload_storage_dir(result['result']['uuid']))
+        root.load()
+
+        with open(os.path.join(root.storage_dir, 'submit_test.dat'), 'rb') as fp:
+            self.assertEquals(fp.read(), temp_data)
+
+        with open(os.path.join(root.storage_dir, 'sample.dat'), 'rb') as fp:
+            self.assertEquals(fp.read(), b'Hello, world!')
+
+    def test_submit_async(self):
+        futures = [ ace_api.submit_async(
+                    analysis_mode='test_empty',
+                    tool='unittest_tool',
+                    tool_instance='unittest_tool_instance',
+                    type='unittest_type',
+                    description='testing {}'.format(index)) for index in range(4) ]
+
+        uuids = set()
+        for future in futures:
+            result = future.result(timeout=30)
+            self.assertTrue('uuid' in result['result'])
+            uuids.add(result['result']['uuid'])
+
+        self.assertEquals(len(uuids), 4)
+
     def test_download(self):
         root = create_root_analysis(uuid=str(uuid.uuid4()))
         root.initialize_storage()